@@ -0,0 +1,53 @@
+"""FAST tokens
+
+Revision ID: 3f1c9a2e7b44
+Revises: 7ccb2156db5e
+Create Date: 2026-10-19 10:12:31.204617
+
+"""
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import context, op
+
+# revision identifiers, used by Alembic.
+revision: str = '3f1c9a2e7b44'
+down_revision: Union[str, None] = '7ccb2156db5e'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # The shards only hold the tables of the users
+    if context.config.attributes.get("user_tables_only"):
+        return
+
+    # The table can be already created from the model metadata
+    if sa.inspect(op.get_bind()).has_table("fast_tokens"):
+        return
+
+    op.create_table(
+        'fast_tokens',
+        sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+        sa.Column('jid', sa.String(), nullable=False),
+        sa.Column('client_id', sa.String(), nullable=False),
+        sa.Column('token_hash', sa.String(), nullable=False),
+        sa.Column('responder', sa.String(), nullable=False),
+        sa.Column('count', sa.Integer(), nullable=False),
+        sa.Column('issued', sa.Integer(), nullable=False),
+        sa.Column('expiry', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('token_hash'),
+    )
+    op.create_index(
+        'ix_fast_tokens_jid_client', 'fast_tokens', ['jid', 'client_id'], unique=False
+    )
+
+
+def downgrade() -> None:
+    # The shards only hold the tables of the users
+    if context.config.attributes.get("user_tables_only"):
+        return
+
+    op.drop_index('ix_fast_tokens_jid_client', table_name='fast_tokens')
+    op.drop_table('fast_tokens')
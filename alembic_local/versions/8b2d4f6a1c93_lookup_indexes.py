@@ -0,0 +1,53 @@
+"""Lookup indexes
+
+Revision ID: 8b2d4f6a1c93
+Revises: 3f1c9a2e7b44
+Create Date: 2026-10-19 11:40:07.513930
+
+"""
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import context, op
+
+# revision identifiers, used by Alembic.
+revision: str = '8b2d4f6a1c93'
+down_revision: Union[str, None] = '3f1c9a2e7b44'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# pubsub_items is searched by node, which is already the leading column of its
+# primary key index
+
+
+def _create_index(name: str, table: str, columns: list, unique: bool = False):
+    # The index can be already created from the model metadata
+    indexes = sa.inspect(op.get_bind()).get_indexes(table)
+    if name not in [index['name'] for index in indexes]:
+        op.create_index(name, table, columns, unique=unique)
+
+
+def upgrade() -> None:
+    _create_index('ix_roster_jid', 'roster', ['jid'])
+
+    # The shards only hold the tables of the users
+    if context.config.attributes.get("user_tables_only"):
+        return
+
+    # Duplicated accounts logged in with the first row. The others are dropped
+    op.execute(
+        "DELETE FROM credentials WHERE id NOT IN "
+        "(SELECT MIN(id) FROM credentials GROUP BY jid)"
+    )
+
+    _create_index('ix_credentials_jid', 'credentials', ['jid'], unique=True)
+    _create_index('ix_pubsub_subscribers_jid', 'pubsub_subscribers', ['jid'])
+
+
+def downgrade() -> None:
+    op.drop_index('ix_roster_jid', table_name='roster')
+    if context.config.attributes.get("user_tables_only"):
+        return
+
+    op.drop_index('ix_pubsub_subscribers_jid', table_name='pubsub_subscribers')
+    op.drop_index('ix_credentials_jid', table_name='credentials')
@@ -0,0 +1,43 @@
+"""Caps features
+
+Revision ID: a9d3e5b7c214
+Revises: e1f7b3c9a6d2
+Create Date: 2026-10-19 18:41:37.205114
+
+"""
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import context, op
+
+# revision identifiers, used by Alembic.
+revision: str = 'a9d3e5b7c214'
+down_revision: Union[str, None] = 'e1f7b3c9a6d2'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # The shards only hold the tables of the users
+    if context.config.attributes.get("user_tables_only"):
+        return
+
+    # The table can be already created from the model metadata
+    if sa.inspect(op.get_bind()).has_table("caps_features"):
+        return
+
+    op.create_table(
+        'caps_features',
+        sa.Column('ver', sa.String(), nullable=False),
+        sa.Column('hash', sa.String(), nullable=False),
+        sa.Column('features', sa.String(), nullable=False),
+        sa.PrimaryKeyConstraint('ver'),
+    )
+
+
+def downgrade() -> None:
+    # The shards only hold the tables of the users
+    if context.config.attributes.get("user_tables_only"):
+        return
+
+    op.drop_table('caps_features')
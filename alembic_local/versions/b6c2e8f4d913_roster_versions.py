@@ -0,0 +1,53 @@
+"""Roster versions
+
+Revision ID: b6c2e8f4d913
+Revises: a9d3e5b7c214
+Create Date: 2026-10-19 21:07:52.618340
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "b6c2e8f4d913"
+down_revision: Union[str, None] = "a9d3e5b7c214"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # The tables can be already created from the model metadata
+    inspector = sa.inspect(op.get_bind())
+
+    if not inspector.has_table("roster_versions"):
+        op.create_table(
+            "roster_versions",
+            sa.Column("jid", sa.String(), nullable=False),
+            sa.Column("version", sa.Integer(), nullable=False),
+            sa.PrimaryKeyConstraint("jid"),
+        )
+
+    if not inspector.has_table("roster_changes"):
+        op.create_table(
+            "roster_changes",
+            sa.Column("id", sa.Integer(), autoincrement=True, nullable=False),
+            sa.Column("jid", sa.String(), nullable=False),
+            sa.Column("version", sa.Integer(), nullable=False),
+            sa.Column("item", sa.String(), nullable=False),
+            sa.PrimaryKeyConstraint("id"),
+        )
+        op.create_index(
+            "ix_roster_changes_jid_version",
+            "roster_changes",
+            ["jid", "version"],
+            unique=False,
+        )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_roster_changes_jid_version", table_name="roster_changes")
+    op.drop_table("roster_changes")
+    op.drop_table("roster_versions")
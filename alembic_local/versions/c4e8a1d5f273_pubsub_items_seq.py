@@ -0,0 +1,59 @@
+"""Pubsub items sequence
+
+Revision ID: c4e8a1d5f273
+Revises: 8b2d4f6a1c93
+Create Date: 2026-10-19 16:02:48.118305
+
+"""
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import context, op
+
+# revision identifiers, used by Alembic.
+revision: str = 'c4e8a1d5f273'
+down_revision: Union[str, None] = '8b2d4f6a1c93'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # The shards only hold the tables of the users
+    if context.config.attributes.get("user_tables_only"):
+        return
+
+    # The table can be already created from the model metadata
+    inspector = sa.inspect(op.get_bind())
+    if not inspector.has_table('pubsub_items'):
+        return
+    if 'seq' in [column['name'] for column in inspector.get_columns('pubsub_items')]:
+        return
+
+    # SQLite only adds NOT NULL columns with a default
+    op.add_column(
+        'pubsub_items',
+        sa.Column('seq', sa.Integer(), nullable=False, server_default='0'),
+    )
+    op.add_column(
+        'pubsub_items',
+        sa.Column('published', sa.Integer(), nullable=False, server_default='0'),
+    )
+
+    # The stored items keep their insertion order. Their publish time is unknown
+    op.execute(
+        "UPDATE pubsub_items SET seq = rowid, "
+        "published = CAST(strftime('%s', 'now') AS INTEGER)"
+    )
+    op.create_index(
+        'ix_pubsub_items_node_seq', 'pubsub_items', ['node', 'seq'], unique=True
+    )
+
+
+def downgrade() -> None:
+    # The shards only hold the tables of the users
+    if context.config.attributes.get("user_tables_only"):
+        return
+
+    op.drop_index('ix_pubsub_items_node_seq', table_name='pubsub_items')
+    op.drop_column('pubsub_items', 'published')
+    op.drop_column('pubsub_items', 'seq')
@@ -0,0 +1,37 @@
+"""PEP items
+
+Revision ID: e1f7b3c9a6d2
+Revises: c4e8a1d5f273
+Create Date: 2026-10-19 17:25:10.642871
+
+"""
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = 'e1f7b3c9a6d2'
+down_revision: Union[str, None] = 'c4e8a1d5f273'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # The table can be already created from the model metadata
+    if sa.inspect(op.get_bind()).has_table("pep_items"):
+        return
+
+    op.create_table(
+        'pep_items',
+        sa.Column('jid', sa.String(), nullable=False),
+        sa.Column('node', sa.String(), nullable=False),
+        sa.Column('item_id', sa.String(), nullable=False),
+        sa.Column('payload', sa.String(), nullable=False),
+        sa.Column('published', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('jid', 'node'),
+    )
+
+
+def downgrade() -> None:
+    op.drop_table('pep_items')
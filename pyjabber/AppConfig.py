@@ -1,6 +1,4 @@
-import asyncio
 import ssl
-from concurrent.futures import ProcessPoolExecutor
 from socket import AddressFamily
 from typing import List, Optional
 
@@ -24,11 +22,27 @@ class AppConfig:
     database_purge: bool
     database_debug: bool
     message_persistence: bool
-    semaphore: asyncio.Semaphore
-    process_pool_exe: ProcessPoolExecutor
     verbose: bool
     plugins: List[str]
     items: dict
+    s2s_queue_size: int = 1000
+    s2s_queue_ttl: int = 30
+    ssl_context_s2s_incoming: Optional[ssl.SSLContext] = None
+    fast_token_ttl: int = 14 * 24 * 3600
+    kdf_mode: str = "thread"
+    kdf_workers: Optional[int] = None
+    login_rate: float = 10.0
+    login_burst: int = 20
+    login_max_wait: float = 5.0
+    credential_cache_size: int = 10000
+    credential_cache_negative_ttl: float = 30.0
+    database_write_timeout: float = 5.0
+    database_read_timeout: float = 5.0
+    database_readers: int = 4
+    database_shards: int = 1
+    caps_persistence: bool = False
+    sm_resume_timeout: int = 300
+    sm_max_unacked: int = 1000
 
 
 app_config: Optional[AppConfig] = None
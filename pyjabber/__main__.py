@@ -2,10 +2,14 @@ import logging
 import os
 import socket
 import sys
+from concurrent.futures import ProcessPoolExecutor
 
 import click
 import yaml
 
+from pyjabber import AppConfig
+from pyjabber.db import BulkImport
+from pyjabber.db.database import DB, ShardingError
 from pyjabber.server_parameters import Parameters
 
 if sys.platform != "win32":
@@ -66,7 +70,7 @@ def load_config(path=os.path.join(FILE_PATH, "config/config.yaml")):
 config_defaults = load_config()
 
 
-@click.command(context_settings=dict(
+@click.group(invoke_without_command=True, context_settings=dict(
     default_map=config_defaults,
     auto_envvar_prefix='PYJABBER'
 ))
@@ -114,6 +118,25 @@ config_defaults = load_config()
     is_flag=True,
     help="Database in memory. The data will be erased after protocols shutdown",
 )
+@click.option(
+    "--database_shards",
+    type=int,
+    default=1,
+    show_default=True,
+    help="Number of database files the user tables are split across",
+)
+@click.option(
+    "--caps_persistence",
+    is_flag=True,
+    help="Store the verified entity capabilities of the clients across restarts",
+)
+@click.option(
+    "--sm_resume_timeout",
+    type=int,
+    default=300,
+    show_default=True,
+    help="Seconds a lost session is kept for a resumption (XEP-0198). 0 disables it",
+)
 @click.option(
     "--message_persistence",
     is_flag=True,
@@ -122,6 +145,13 @@ config_defaults = load_config()
 @click.option(
     "--cert_path", type=str, default=None, help="Path to the certificate files"
 )
+@click.option(
+    "--kdf_mode",
+    type=click.Choice(["thread", "process", "inline"], case_sensitive=False),
+    default="thread",
+    show_default=True,
+    help="Executor used to derive the password keys",
+)
 @click.option(
     "-v",
     "--verbose",
@@ -130,7 +160,9 @@ config_defaults = load_config()
 )
 @click.option("--log_path", type=str, help="Path to log dumpfile")
 @click.option("--debug", "-D", is_flag=True, help="Enables debug mode in Asyncio")
+@click.pass_context
 def main(
+    ctx,
     host,
     client_port,
     server_port,
@@ -139,8 +171,12 @@ def main(
     database_path,
     database_purge,
     database_in_memory,
+    database_shards,
+    caps_persistence,
+    sm_resume_timeout,
     message_persistence,
     cert_path,
+    kdf_mode,
     verbose,
     log_path,
     debug,
@@ -179,13 +215,21 @@ def main(
         database_path=database_path,
         database_purge=database_purge,
         database_in_memory=database_in_memory,
+        database_shards=database_shards,
+        caps_persistence=caps_persistence,
+        sm_resume_timeout=sm_resume_timeout,
         cert_path=cert_path,
         message_persistence=message_persistence,
+        kdf_mode=kdf_mode.lower(),
         verbose=verbosity == "TRACE",
         plugins=config_defaults["modules"],
         items=config_defaults["items"],
     )
 
+    if ctx.invoked_subcommand is not None:
+        ctx.obj = param
+        return 0
+
     server = Server(param)
 
     run(server.start(), debug=debug)
@@ -193,6 +237,115 @@ def main(
     return 0
 
 
+@main.command("import-users")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option(
+    "--format",
+    "fmt",
+    type=click.Choice(["csv", "jsonl"], case_sensitive=False),
+    default=None,
+    help="Format of the file. By default, taken from its extension",
+)
+@click.option(
+    "--iterations",
+    type=click.IntRange(min=BulkImport.MIN_ITERATIONS),
+    default=BulkImport.ITERATIONS,
+    show_default=True,
+    help="PBKDF2 iterations of the password hashes",
+)
+@click.option(
+    "--workers",
+    type=int,
+    default=None,
+    help="Hashing processes. One per CPU by default",
+)
+@click.pass_obj
+def import_users(param, path, fmt, iterations, workers):
+    """
+    Create the accounts, and their roster items, listed in a CSV or JSONL file
+    """
+    if param.database_in_memory:
+        raise click.UsageError("Users cannot be imported into a database in memory")
+
+    fmt = (fmt or os.path.splitext(path)[1].lstrip(".")).lower()
+    if fmt not in ("csv", "jsonl"):
+        raise click.UsageError("Unknown file format. Use --format csv|jsonl")
+
+    run(import_file(param, path, fmt, iterations, workers))
+
+
+def offline_config(param: Parameters) -> AppConfig.AppConfig:
+    """
+    Configuration for the commands that only use the database, without starting
+    the server
+    """
+    return AppConfig.AppConfig(
+        host=param.host,
+        ip=[],
+        ssl_context=None,
+        ssl_context_s2s=None,
+        connection_timeout=param.connection_timeout,
+        server_port=param.server_port,
+        family=param.family,
+        config_path=os.path.join(FILE_PATH, "config/config.yaml"),
+        cert_path=param.cert_path,
+        root_path=FILE_PATH,
+        database_path=param.database_path,
+        database_in_memory=param.database_in_memory,
+        database_purge=param.database_purge,
+        database_debug=param.database_debug,
+        message_persistence=param.message_persistence,
+        verbose=param.verbose,
+        plugins=param.plugins,
+        items=param.items,
+        database_write_timeout=param.database_write_timeout,
+        database_read_timeout=param.database_read_timeout,
+        database_readers=param.database_readers,
+        database_shards=param.database_shards,
+    )
+
+
+async def import_file(
+    param: Parameters, path: str, fmt: str, iterations: int, workers: int
+):
+    AppConfig.app_config = offline_config(param)
+
+    with open(path, encoding="utf-8") as f:
+        try:
+            users, errors = BulkImport.parse(f.read(), fmt, param.host)
+        except BulkImport.ImportFormatError as e:
+            raise click.ClickException(str(e))
+
+    for error in errors:
+        logger.warning(f"Skipped {error}")
+
+    try:
+        await DB.setup_database()
+    except ShardingError as e:
+        raise click.ClickException(str(e))
+    DB.run_db_migrations()
+
+    async def progress(result: BulkImport.ImportResult):
+        done = result.created + result.skipped
+        click.echo(
+            f"{done}/{result.total} users ({done / result.elapsed:.0f}/s)", err=True
+        )
+
+    try:
+        with ProcessPoolExecutor(workers) as executor:
+            result = await BulkImport.import_users(
+                users, executor, iterations, progress=progress
+            )
+    finally:
+        await DB.close_engine_async()
+
+    click.echo(
+        f"{result.created} users created, {result.skipped} skipped, "
+        f"{len(errors)} invalid, {result.roster_items} roster items "
+        f"in {result.elapsed:.1f}s"
+    )
+
+
 def set_verbosity(verbose):
     if verbose == 1:
         return "INFO"
@@ -0,0 +1,322 @@
+"""
+Bulk provisioning of accounts, from CSV or JSONL.
+
+CSV needs a header with the jid and password columns. An optional roster
+column holds the contacts, separated by spaces or ';'.
+    jid,password,roster
+    alice,pencil,bob;carol@example.org
+
+JSONL holds an object per line, the roster entries can be a jid or an
+object with the jid, name and subscription of the item.
+    {"jid": "alice", "password": "pw", "roster": ["bob", {"jid": "carol", "name": "C"}]}
+
+The passwords are hashed into the SCRAM credentials format (see
+SCRAM.format_credentials), in chunks spread over the executor workers, and
+the rows are inserted in large transactions. Accounts that already exist are
+skipped, so an import can be run again after a failure.
+"""
+
+import asyncio
+import csv
+import hashlib
+import io
+import json
+import secrets
+import time
+from concurrent.futures import Executor
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+from xml.etree import ElementTree as ET
+
+from attrs import define, field
+from loguru import logger
+from sqlalchemy import select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+from pyjabber.db.database import DB
+from pyjabber.db.model import Model
+from pyjabber.features.SASL import SCRAM
+from pyjabber.plugins.roster.Roster import Roster
+
+ITERATIONS = 100000
+MIN_ITERATIONS = 4096  # RFC 7677
+BATCH_SIZE = 2000  # Accounts per transaction
+HASH_CHUNK = 32  # Accounts per executor job
+
+SUBSCRIPTIONS = ("none", "to", "from", "both")
+
+
+class ImportFormatError(Exception):
+    """
+    The input cannot be parsed
+    """
+
+
+@define(frozen=True, slots=True)
+class RosterEntry:
+    jid: str
+    name: Optional[str] = None
+    subscription: str = "none"
+
+
+@define(frozen=True, slots=True)
+class UserEntry:
+    jid: str
+    password: str
+    roster: Tuple[RosterEntry, ...] = ()
+
+
+@define(slots=True)
+class ImportResult:
+    total: int = 0
+    created: int = 0
+    skipped: int = 0
+    roster_items: int = 0
+    invalid: List[str] = field(factory=list)
+    elapsed: float = 0.0
+
+    def as_dict(self) -> Dict:
+        return {
+            "total": self.total,
+            "created": self.created,
+            "skipped": self.skipped,
+            "roster_items": self.roster_items,
+            "invalid": self.invalid,
+            "elapsed": round(self.elapsed, 3),
+        }
+
+
+def _localpart(jid: str, host: str = None) -> str:
+    """
+    Accounts and local contacts are stored by username, remote contacts by
+    bare JID
+    """
+    jid = jid.strip().split("/")[0]
+    if "@" not in jid:
+        return jid
+    user, domain = jid.split("@", 1)
+    return user if host is None or domain == host else jid
+
+
+def _roster_entry(raw, host: str) -> RosterEntry:
+    if isinstance(raw, str):
+        return RosterEntry(jid=_localpart(raw, host))
+    subscription = raw.get("subscription", "none")
+    if subscription not in SUBSCRIPTIONS:
+        raise ValueError(f"Invalid subscription {subscription}")
+    return RosterEntry(
+        jid=_localpart(raw["jid"], host),
+        name=raw.get("name"),
+        subscription=subscription,
+    )
+
+
+def _user_entry(raw: Dict, host: str) -> UserEntry:
+    jid, password = raw.get("jid"), raw.get("password")
+    if not jid or not password:
+        raise ValueError("Missing jid or password")
+
+    roster = raw.get("roster") or ()
+    if isinstance(roster, str):
+        roster = roster.replace(";", " ").split()
+
+    return UserEntry(
+        jid=_localpart(jid, host),
+        password=password,
+        roster=tuple(_roster_entry(r, host) for r in roster),
+    )
+
+
+def parse(data: str, fmt: str, host: str = None) -> Tuple[List[UserEntry], List[str]]:
+    """
+    :param data: Content of the CSV or JSONL file
+    :param fmt: csv | jsonl
+    :param host: Domain of the server. Contacts of this domain are stored by username
+    :return: (users, errors). Lines that cannot be parsed are reported in errors
+    """
+    users, errors = [], []
+
+    if fmt == "csv":
+        reader = csv.DictReader(io.StringIO(data))
+        if not reader.fieldnames or not {"jid", "password"} <= set(reader.fieldnames):
+            raise ImportFormatError(
+                "The CSV header must include the jid and password columns"
+            )
+        lines = ((reader.line_num, row) for row in reader)
+    elif fmt == "jsonl":
+        lines = (
+            (num, line) for num, line in enumerate(data.splitlines(), 1) if line.strip()
+        )
+    else:
+        raise ImportFormatError(f"Unknown format {fmt}")
+
+    for num, raw in lines:
+        try:
+            if fmt == "jsonl":
+                raw = json.loads(raw)
+            users.append(_user_entry(raw, host))
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            errors.append(f"line {num}: {e}")
+
+    return users, errors
+
+
+def hash_passwords(passwords: List[Tuple[str, bytes]], iterations: int) -> List[str]:
+    """
+    SCRAM credentials of each (password, salt). Runs on the executor workers
+    """
+    return [
+        SCRAM.format_credentials(
+            iterations,
+            salt,
+            hashlib.pbkdf2_hmac("sha256", password.encode(), salt, iterations),
+            hashlib.pbkdf2_hmac("sha1", password.encode(), salt, iterations),
+        )
+        for password, salt in passwords
+    ]
+
+
+def roster_item(entry: RosterEntry) -> str:
+    attrib = {"jid": entry.jid, "subscription": entry.subscription}
+    if entry.name:
+        attrib["name"] = entry.name
+    return ET.tostring(ET.Element("{jabber:iq:roster}item", attrib=attrib)).decode()
+
+
+async def _existing(jids: List[str]) -> set:
+    async with DB.reader() as con:
+        res = await con.execute(
+            select(Model.Credentials.c.jid).where(Model.Credentials.c.jid.in_(jids))
+        )
+        return {row[0] for row in res.fetchall()}
+
+
+async def _hash_batch(
+    users: List[UserEntry], iterations: int, executor: Optional[Executor]
+) -> List[str]:
+    loop = asyncio.get_running_loop()
+    passwords = [(u.password, secrets.token_bytes(16)) for u in users]
+    chunks = await asyncio.gather(
+        *[
+            loop.run_in_executor(
+                executor,
+                hash_passwords,
+                passwords[i : i + HASH_CHUNK],
+                iterations,
+            )
+            for i in range(0, len(passwords), HASH_CHUNK)
+        ]
+    )
+    return [credentials for chunk in chunks for credentials in chunk]
+
+
+async def _store_batch(users: List[UserEntry], hashes: List[str]) -> Tuple[int, int]:
+    """
+    Only the accounts created get their roster items. Without shards, both
+    are stored in the same transaction
+
+    :return: (accounts created, roster items created)
+    """
+    # Shard -> user -> roster items
+    by_shard: Dict[int, Dict[str, List[str]]] = {}
+    ids: Dict[str, List[int]] = {}
+    sharded = bool(DB.shard_paths())
+
+    async with DB.writer() as con:
+        res = await con.execute(
+            sqlite_insert(Model.Credentials)
+            .on_conflict_do_nothing()
+            .returning(Model.Credentials.c.jid),
+            [{"jid": u.jid, "hash_pwd": h} for u, h in zip(users, hashes)],
+        )
+        created = set(res.scalars())
+
+        for user in users:
+            if user.roster and user.jid in created:
+                by_shard.setdefault(DB.shard_of(user.jid), {})[user.jid] = [
+                    roster_item(entry) for entry in user.roster
+                ]
+
+        if not sharded:
+            await _store_rosters(con, by_shard.get(0, {}), ids)
+
+    if sharded:
+        for shard, rosters in by_shard.items():
+            async with DB.writer(shard=shard) as con:
+                await _store_rosters(con, rosters, ids)
+
+    # Once committed
+    for shard, rosters in by_shard.items():
+        for jid, items in rosters.items():
+            Roster().add_in_memory(jid, shard, ids[jid], items)
+
+    return len(created), sum(len(items) for items in ids.values())
+
+
+async def _store_rosters(
+    con: AsyncConnection, rosters: Dict[str, List[str]], ids: Dict[str, List[int]]
+):
+    for jid, items in rosters.items():
+        _, ids[jid] = await Roster.insert_items(con, jid, items)  # Versioned
+
+
+async def import_users(
+    users: Iterable[UserEntry],
+    executor: Optional[Executor] = None,
+    iterations: int = ITERATIONS,
+    batch_size: int = BATCH_SIZE,
+    progress: Callable[[ImportResult], Awaitable[None]] = None,
+) -> ImportResult:
+    """
+    Creates the accounts (and their roster items) that do not exist yet.
+
+    The hashing of a batch runs while the previous one is inserted.
+
+    :param executor: Executor for the password hashing. None uses the default one
+    of the loop
+    :param progress: Called after every batch with the partial result
+    """
+    start = time.perf_counter()
+    result = ImportResult()
+
+    unique: Dict[str, UserEntry] = {}
+    for user in users:
+        result.total += 1
+        if user.jid in unique:
+            result.skipped += 1
+        else:
+            unique[user.jid] = user
+
+    pending = list(unique.values())
+    batches = [pending[i : i + batch_size] for i in range(0, len(pending), batch_size)]
+
+    async def prepare(batch: List[UserEntry]) -> Tuple[List[UserEntry], List[str]]:
+        existing = await _existing([u.jid for u in batch])
+        new = [u for u in batch if u.jid not in existing]
+        return new, await _hash_batch(new, iterations, executor)
+
+    hashing = asyncio.ensure_future(prepare(batches[0])) if batches else None
+    try:
+        for i, batch in enumerate(batches):
+            new, hashes = await hashing
+            if i + 1 < len(batches):
+                hashing = asyncio.ensure_future(prepare(batches[i + 1]))
+
+            created, roster_items = await _store_batch(new, hashes) if new else (0, 0)
+            result.created += created
+            result.skipped += len(batch) - created
+            result.roster_items += roster_items
+            result.elapsed = time.perf_counter() - start
+
+            if progress:
+                await progress(result)
+    finally:
+        if hashing is not None and not hashing.done():
+            hashing.cancel()
+
+    result.elapsed = time.perf_counter() - start
+    logger.info(
+        f"Imported {result.created} accounts ({result.skipped} skipped, "
+        f"{result.roster_items} roster items) in {result.elapsed:.1f}s"
+    )
+    return result
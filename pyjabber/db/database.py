@@ -1,35 +1,336 @@
+import asyncio
+import hashlib
 import logging
 import os
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, List, Optional, Sequence, Tuple
 
-import sqlalchemy
 from alembic import command
 from alembic.config import Config
 from loguru import logger
-from sqlalchemy import StaticPool, event
+from sqlalchemy import AsyncAdaptedQueuePool, Table, event, literal, select
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.exc import TimeoutError as PoolTimeout
 from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine, create_async_engine
 
 from pyjabber import AppConfig
 from pyjabber.db.model import Model
 
 
+class DatabaseTimeout(Exception):
+    """
+    A reader or the writer could not get its connection within the configured timeout
+    """
+
+
+class ShardingError(Exception):
+    """
+    The main database still holds rows of the user tables, which the shards
+    would hide
+    """
+
+
+class RoleMetrics:
+    __slots__ = ("acquired", "waiting", "wait_total", "wait_max", "timeouts", "errors")
+
+    def __init__(self):
+        self.acquired = 0
+        self.waiting = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.timeouts = 0
+        self.errors = 0
+
+    def waited(self, wait: float):
+        self.acquired += 1
+        self.wait_total += wait
+        self.wait_max = max(self.wait_max, wait)
+
+    def as_dict(self) -> Dict[str, float]:
+        return {
+            "acquired": self.acquired,
+            "waiting": self.waiting,
+            "wait_avg_ms": (self.wait_total / self.acquired * 1e3)
+            if self.acquired
+            else 0.0,
+            "wait_max_ms": self.wait_max * 1e3,
+            "timeouts": self.timeouts,
+            "errors": self.errors,
+        }
+
+
+class Shard:
+    """
+    One SQLite database file, accessed in two roles:
+     - A single writer connection. Writes are serialized in FIFO order by a lock,
+       so concurrent writers never contend on the SQLite write lock.
+     - A pool of read-only connections. With WAL, readers do not wait for the writer.
+
+    With the database in memory, there is no WAL to isolate the readers from the
+    writer, so both roles take turns on the writer connection.
+    """
+
+    __slots__ = ("path", "engine", "read_engine", "write_lock", "writing", "metrics")
+
+    def __init__(self, path: str = None):
+        self.path = path
+        self.engine: AsyncEngine = None
+        self.read_engine: AsyncEngine = None
+        self.write_lock = asyncio.Lock()
+        # Task and connection of the write transaction in course, for its own reads
+        self.writing: Optional[Tuple[asyncio.Task, AsyncConnection]] = None
+        self.metrics = {"read": RoleMetrics(), "write": RoleMetrics()}
+
+    def open_in_memory(self):
+        """
+        A single connection for both roles. A read waits for the write
+        transaction in course to end, so it never sees it half applied
+        """
+        self.engine = create_async_engine(
+            url="sqlite+aiosqlite:///:memory:",
+            echo=AppConfig.app_config.database_debug,
+            poolclass=AsyncAdaptedQueuePool,  # Not the default of a memory database
+            pool_size=1,
+            max_overflow=0,
+            pool_timeout=AppConfig.app_config.database_write_timeout,
+        )
+        self.read_engine = self.engine
+
+    def open_writer(self):
+        # Single connection, reused by every write. The lock of writer() serializes
+        # the writes, the busy timeout only covers other processes (e.g., alembic)
+        self.engine = create_async_engine(
+            url=f"sqlite+aiosqlite:///{self.path}",
+            echo=AppConfig.app_config.database_debug,
+            pool_size=1,
+            max_overflow=0,
+            pool_timeout=AppConfig.app_config.database_write_timeout,
+            connect_args={"timeout": AppConfig.app_config.database_write_timeout},
+        )
+
+        @event.listens_for(self.engine.sync_engine, "connect")
+        def set_sqlite_pragma(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            cursor.execute("PRAGMA journal_mode=WAL")
+            cursor.execute("PRAGMA synchronous=NORMAL")
+            cursor.execute("PRAGMA cache_size=-20000")
+            cursor.close()
+
+    def open_readers(self):
+        """
+        Must be called once the file exists, after the writer created the schema
+        """
+        self.read_engine = create_async_engine(
+            url=f"sqlite+aiosqlite:///file:{self.path}?mode=ro&uri=true",
+            echo=AppConfig.app_config.database_debug,
+            pool_size=AppConfig.app_config.database_readers,
+            max_overflow=0,
+            pool_timeout=AppConfig.app_config.database_read_timeout,
+            connect_args={"timeout": AppConfig.app_config.database_read_timeout},
+        )
+
+        @event.listens_for(self.read_engine.sync_engine, "connect")
+        def set_sqlite_pragma_reader(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            cursor.execute("PRAGMA query_only=ON")
+            cursor.execute("PRAGMA cache_size=-20000")
+            cursor.close()
+
+    @asynccontextmanager
+    async def writer(self) -> AsyncIterator[AsyncConnection]:
+        metrics = self.metrics["write"]
+
+        start = time.monotonic()
+        metrics.waiting += 1
+        try:
+            await asyncio.wait_for(
+                self.write_lock.acquire(), AppConfig.app_config.database_write_timeout
+            )
+        except asyncio.TimeoutError:
+            metrics.timeouts += 1
+            raise DatabaseTimeout("Timeout waiting for the database writer")
+        finally:
+            metrics.waiting -= 1
+        metrics.waited(time.monotonic() - start)
+
+        try:
+            async with self.engine.connect() as con:
+                async with con.begin():
+                    self.writing = (asyncio.current_task(), con)
+                    try:
+                        yield con
+                    finally:
+                        self.writing = None
+        except SQLAlchemyError:
+            metrics.errors += 1  # Only the errors of the database, not of the caller
+            raise
+        finally:
+            self.write_lock.release()
+
+    @asynccontextmanager
+    async def reader(self) -> AsyncIterator[AsyncConnection]:
+        metrics = self.metrics["read"]
+
+        if self.read_engine is self.engine and self.writing is not None:
+            task, writing = self.writing
+            if task is asyncio.current_task():
+                # In memory, inside a write transaction: it reads its own writes
+                metrics.waited(0.0)
+                yield writing
+                return
+
+        start = time.monotonic()
+        con = self.read_engine.connect()
+        metrics.waiting += 1
+        try:
+            await con.start()
+        except PoolTimeout:
+            metrics.timeouts += 1
+            raise DatabaseTimeout("Timeout waiting for a database reader")
+        finally:
+            metrics.waiting -= 1
+        metrics.waited(time.monotonic() - start)
+
+        try:
+            yield con
+        except SQLAlchemyError:
+            metrics.errors += 1
+            raise
+        finally:
+            await con.close()
+
+    async def dispose(self):
+        if self.read_engine is not self.engine:
+            await self.read_engine.dispose()
+        await self.engine.dispose()
+
+
 class DB:
+    """
+    Access to the SQLite database of the server.
+
+    The tables of each user (Model.user_tables: roster, its versions, pending
+    subscriptions and PEP items) can be split across several files
+    (database_shards), by a hash of the JID stored in their jid column. Every shard
+    has its own writer, so writes of users in different shards do not wait for
+    each other. The shards only hold those tables, the rest live in the main
+    file. Shard files are named after it (pyjabber.shard0.db, ...).
+
+    The number of shards must not change once the shards hold data: the rows
+    are not moved between files. For the same reason, the shards are refused on
+    a main database whose user tables hold rows.
+    """
+
     _engine = None
+    _read_engine = None
+    _main: Shard = None
+    _shards: List[Shard] = []
+
+    @staticmethod
+    def shard_of(jid: str) -> int:
+        """
+        Shard that stores the rows of a jid. The hash is stable across restarts
+        """
+        if len(DB._shards) <= 1:
+            return 0
+        digest = hashlib.blake2b(jid.encode(), digest_size=8).digest()
+        return int.from_bytes(digest, "big") % len(DB._shards)
 
     @staticmethod
-    def connection() -> sqlalchemy.Connection:  # pragma: no cover
+    def row_key(shard: int, id_: int) -> int:
         """
-        Returns an already crafted connection with the database.
-        It takes the parameters from the protocols class instance (i.e., DB path | DB in memory)
+        Unique id across shards, for the autoincrement id of a sharded table.
+        Without shards it is the id itself
         """
-        return DB._engine.connect()
+        return id_ * max(len(DB._shards), 1) + shard
 
     @staticmethod
-    async def connection_async() -> AsyncConnection:  # pragma: no cover
+    def split_row_key(key: int) -> Tuple[int, int]:
         """
-        Returns an already crafted connection with the database.
-        It takes the parameters from the protocols class instance (i.e., DB path | DB in memory)
+        :return: (shard, id) of a key built by row_key
         """
-        return DB._engine.connect()
+        shard_id, shard = divmod(key, max(len(DB._shards), 1))
+        return shard, shard_id
+
+    @staticmethod
+    def _route(jid: str = None, shard: int = None) -> Shard:
+        if shard is None and jid is not None:
+            shard = DB.shard_of(jid)
+        if shard is None or not DB._shards:
+            return DB._main
+        return DB._shards[shard]
+
+    @staticmethod
+    def writer(jid: str = None, shard: int = None) -> AsyncIterator[AsyncConnection]:
+        """
+        Waits for the turn in the write queue and yields the writer connection,
+        inside a transaction. The transaction is committed when the block exits,
+        or rolled back if it raises.
+        Writes to the tables of a user must pass its jid (or shard), the rest go
+        to the main database
+        :raises DatabaseTimeout: the turn did not come within database_write_timeout
+        """
+        return DB._route(jid, shard).writer()
+
+    @staticmethod
+    def reader(jid: str = None, shard: int = None) -> AsyncIterator[AsyncConnection]:
+        """
+        Yields a read-only connection from the readers pool.
+        Reads of the tables of a user must pass its jid (or shard)
+        :raises DatabaseTimeout: no reader was free within database_read_timeout
+        """
+        return DB._route(jid, shard).reader()
+
+    @staticmethod
+    async def query_shards(query) -> List[list]:
+        """
+        Runs a read query on every shard, concurrently
+        :return: The rows of each shard, indexed by shard
+        """
+
+        async def fetch(shard: int) -> list:
+            async with DB.reader(shard=shard) as con:
+                res = await con.execute(query)
+                return res.fetchall()
+
+        return list(
+            await asyncio.gather(*[fetch(i) for i in range(max(len(DB._shards), 1))])
+        )
+
+    @staticmethod
+    async def execute_shards(query) -> int:
+        """
+        Runs a write query on every shard, concurrently
+        :return: Total of affected rows
+        """
+
+        async def execute(shard: int) -> int:
+            async with DB.writer(shard=shard) as con:
+                res = await con.execute(query)
+                return res.rowcount
+
+        return sum(
+            await asyncio.gather(*[execute(i) for i in range(max(len(DB._shards), 1))])
+        )
+
+    @staticmethod
+    def metrics() -> Dict[str, Dict[str, float]]:
+        res = {role: m.as_dict() for role, m in DB._main.metrics.items()}
+        if DB._shards:
+            res["shards"] = [
+                {role: m.as_dict() for role, m in shard.metrics.items()}
+                for shard in DB._shards
+            ]
+        return res
+
+    @staticmethod
+    def shard_paths() -> List[str]:
+        shards = AppConfig.app_config.database_shards
+        if AppConfig.app_config.database_in_memory or shards <= 1:
+            return []
+        root, ext = os.path.splitext(AppConfig.app_config.database_path)
+        return [f"{root}.shard{i}{ext or '.db'}" for i in range(shards)]
 
     @staticmethod
     def close_engine():
@@ -43,7 +344,9 @@ class DB:
         """
         Safely dispose the global engine instance used across the protocols
         """
-        await DB._engine.dispose()
+        for shard in DB._shards:
+            await shard.dispose()
+        await DB._main.dispose()
 
     @staticmethod
     async def setup_database() -> AsyncEngine:
@@ -59,67 +362,85 @@ class DB:
             logging.getLogger("sqlite3").setLevel(logging.WARNING)
             logging.getLogger("aiosqlite").setLevel(logging.WARNING)
 
+        DB._shards = []
+
         if AppConfig.app_config.database_in_memory:
             logger.info(
                 "Using database on memory. ANY CHANGE WILL BE LOST AFTER SERVER SHUTDOWN!"
             )
-            DB._engine = create_async_engine(
-                url="sqlite+aiosqlite:///:memory:",
-                isolation_level="AUTOCOMMIT",
-                poolclass=StaticPool,
-                echo=AppConfig.app_config.database_debug,
-            )
-
-            @event.listens_for(DB._engine.sync_engine, "connect")
-            def set_sqlite_pragma(dbapi_connection, connection_record):
-                cursor = dbapi_connection.cursor()
-                cursor.execute("PRAGMA synchronous=FULL")
-                cursor.execute("PRAGMA journal_mode=MEMORY")
-                cursor.close()
+            DB._main = Shard()
+            DB._main.open_in_memory()
+            await DB._init_metadata(DB._main.engine)
 
-            await DB._init_metadata(DB._engine)
+            DB._engine = DB._main.engine
+            DB._read_engine = DB._main.read_engine
             return DB._engine
 
-        if os.path.isfile(AppConfig.app_config.database_path):
-            DB._engine = create_async_engine(
-                url=f"sqlite+aiosqlite:///{AppConfig.app_config.database_path}",
-                echo=AppConfig.app_config.database_debug,
-            )
-
-        else:
+        if not os.path.isfile(AppConfig.app_config.database_path):
             logger.info("No database found. Initializing one...")
-            DB._engine = create_async_engine(
-                f"sqlite+aiosqlite:///{AppConfig.app_config.database_path}",
-                echo=AppConfig.app_config.database_debug,
-            )
 
-        @event.listens_for(DB._engine.sync_engine, "connect")
-        def set_sqlite_pragma(dbapi_connection, connection_record):
-            cursor = dbapi_connection.cursor()
-            cursor.execute("PRAGMA journal_mode=WAL")
-            cursor.execute("PRAGMA synchronous=NORMAL")
-            cursor.execute("PRAGMA cache_size=-20000")
-            cursor.close()
+        DB._main = Shard(AppConfig.app_config.database_path)
+        DB._shards = [Shard(path) for path in DB.shard_paths()]
+        if DB._shards:
+            logger.info(f"User tables sharded across {len(DB._shards)} databases")
 
-        await DB._init_metadata(DB._engine)
+        DB._main.open_writer()
+        await DB._init_metadata(DB._main.engine)
+        DB._main.open_readers()
+        if DB._shards:
+            await DB._check_unsharded()
+
+        for shard in DB._shards:
+            shard.open_writer()
+            await DB._init_metadata(shard.engine, Model.user_tables)
+            shard.open_readers()
+
+        DB._engine = DB._main.engine
+        DB._read_engine = DB._main.read_engine
         return DB._engine
 
     @staticmethod
-    async def _init_metadata(engine: AsyncEngine):
+    async def _check_unsharded():
+        """
+        With shards, the user tables of the main database must be empty: its
+        rows are not moved into the shards, and would not be read anymore
+        :raises ShardingError: some user table of the main database has rows
+        """
+        async with DB._main.reader() as con:
+            used = [
+                table.name
+                for table in Model.user_tables
+                if await con.scalar(select(literal(1)).select_from(table).limit(1))
+            ]
+        if used:
+            await DB._main.dispose()
+            raise ShardingError(
+                f"{AppConfig.app_config.database_path} holds rows of "
+                f"{', '.join(used)}, which the shards would hide. Disable "
+                "database_shards, or shard a new database"
+            )
+
+    @staticmethod
+    async def _init_metadata(engine: AsyncEngine, tables: Sequence[Table] = None):
         def sync_create_all(connection):
-            Model.server_metadata.create_all(connection)
+            Model.server_metadata.create_all(connection, tables=tables)
 
         async with engine.begin() as conn:
             await conn.run_sync(sync_create_all)
 
     @staticmethod
     def run_db_migrations() -> None:
-        cfg = Config()
-        cfg.set_main_option(
-            "script_location",
-            os.path.join(AppConfig.app_config.root_path, "..", "alembic_local"),
-        )
-        cfg.set_main_option(
-            "sqlalchemy.url", f"sqlite:///{AppConfig.app_config.database_path}"
-        )
-        command.upgrade(cfg, "head")
+        """
+        Upgrades the main database and every shard to the last revision.
+        The migrations skip the tables that the shards do not hold
+        """
+        paths = [AppConfig.app_config.database_path, *DB.shard_paths()]
+        for i, path in enumerate(paths):
+            cfg = Config()
+            cfg.attributes["user_tables_only"] = i > 0
+            cfg.set_main_option(
+                "script_location",
+                os.path.join(AppConfig.app_config.root_path, "..", "alembic_local"),
+            )
+            cfg.set_main_option("sqlalchemy.url", f"sqlite:///{path}")
+            command.upgrade(cfg, "head")
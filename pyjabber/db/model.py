@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, MetaData, String, Table
+from sqlalchemy import Column, Index, Integer, MetaData, String, Table
 
 
 class Model:
@@ -10,6 +10,7 @@ class Model:
         Column("id", Integer, primary_key=True),
         Column("jid", String, nullable=False),
         Column("hash_pwd", String, nullable=False),
+        Index("ix_credentials_jid", "jid", unique=True),
     )
 
     Roster = Table(
@@ -18,6 +19,26 @@ class Model:
         Column("id", Integer, primary_key=True, autoincrement=True),
         Column("jid", String, nullable=False),
         Column("roster_item", String, nullable=False),
+        Index("ix_roster_jid", "jid"),
+    )
+
+    # Roster versioning (XEP-0237): version of each roster, and the last
+    # changes, to send only the delta to a client with an older version
+    RosterVersions = Table(
+        "roster_versions",
+        server_metadata,
+        Column("jid", String, primary_key=True),
+        Column("version", Integer, nullable=False),
+    )
+
+    RosterChanges = Table(
+        "roster_changes",
+        server_metadata,
+        Column("id", Integer, primary_key=True, autoincrement=True),
+        Column("jid", String, nullable=False),
+        Column("version", Integer, nullable=False),
+        Column("item", String, nullable=False),
+        Index("ix_roster_changes_jid_version", "jid", "version"),
     )
 
     Pubsub = Table(
@@ -38,6 +59,7 @@ class Model:
         Column("subid", String, primary_key=True),
         Column("subscription", String, nullable=False),
         Column("affiliation", String, nullable=False),
+        Index("ix_pubsub_subscribers_jid", "jid"),
     )
 
     PubsubItems = Table(
@@ -47,6 +69,27 @@ class Model:
         Column("publisher", String, nullable=False),
         Column("item_id", String, primary_key=True),
         Column("payload", String, nullable=False),
+        Column("seq", Integer, nullable=False),
+        Column("published", Integer, nullable=False),
+        Index("ix_pubsub_items_node_seq", "node", "seq", unique=True),
+    )
+
+    PepItems = Table(
+        "pep_items",
+        server_metadata,
+        Column("jid", String, primary_key=True),
+        Column("node", String, primary_key=True),
+        Column("item_id", String, nullable=False),
+        Column("payload", String, nullable=False),
+        Column("published", Integer, nullable=False),
+    )
+
+    CapsFeatures = Table(
+        "caps_features",
+        server_metadata,
+        Column("ver", String, primary_key=True),
+        Column("hash", String, nullable=False),
+        Column("features", String, nullable=False),
     )
 
     PendingSubs = Table(
@@ -55,3 +98,21 @@ class Model:
         Column("jid", String, primary_key=True),
         Column("item", String, primary_key=True),
     )
+
+    FastTokens = Table(
+        "fast_tokens",
+        server_metadata,
+        Column("id", Integer, primary_key=True, autoincrement=True),
+        Column("jid", String, nullable=False),
+        Column("client_id", String, nullable=False),
+        Column("token_hash", String, nullable=False, unique=True),
+        Column("responder", String, nullable=False),
+        Column("count", Integer, nullable=False, default=0),
+        Column("issued", Integer, nullable=False),
+        Column("expiry", Integer, nullable=False),
+        Index("ix_fast_tokens_jid_client", "jid", "client_id"),
+    )
+
+    # Tables of the users, split across the shards (see DB). The shards hold
+    # only these, the rest of the tables live in the main database
+    user_tables = (Roster, RosterVersions, RosterChanges, PendingSubs, PepItems)
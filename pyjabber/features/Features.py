@@ -8,6 +8,24 @@ def resource_binding_feature():
     return ET.Element("{urn:ietf:params:xml:ns:xmpp-bind}bind")
 
 
+def csi_feature():
+    return ET.Element("{urn:xmpp:csi:0}csi")
+
+
+def roster_versioning_feature():
+    """
+    XEP-0237: Roster Versioning
+    """
+    return ET.Element("{urn:xmpp:features:rosterver}ver")
+
+
+def stream_management_feature():
+    """
+    XEP-0198: Stream Management
+    """
+    return ET.Element("{urn:xmpp:sm:3}sm")
+
+
 def in_band_registration_feature():
     return ET.Element("{http://jabber.org/features/iq-register}register")
 
@@ -26,6 +44,33 @@ def SASL_feature(mechanism_list: Optional[List[MECHANISM]] = None):
     return element
 
 
+def SASL2_feature(
+    mechanism_list: List[MECHANISM], fast_mechanism_list: List[MECHANISM] = None
+):
+    """
+    XEP-0388: Extensible SASL Profile, with the XEP-0484 (FAST) mechanisms
+    offered inline
+    """
+    element = ET.Element("{urn:xmpp:sasl:2}authentication")
+    for m in mechanism_list:
+        ET.SubElement(element, "{urn:xmpp:sasl:2}mechanism").text = m.value
+
+    if fast_mechanism_list:
+        inline = ET.SubElement(element, "{urn:xmpp:sasl:2}inline")
+        fast = ET.SubElement(inline, "{urn:xmpp:fast:0}fast")
+        for m in fast_mechanism_list:
+            ET.SubElement(fast, "{urn:xmpp:fast:0}mechanism").text = m.value
+
+    return element
+
+
+def bidi_feature():
+    """
+    XEP-0288: Bidirectional Server-to-Server Connections
+    """
+    return ET.Element("{urn:xmpp:features:bidi}bidi")
+
+
 def start_tls_feature(required: bool = True):
     element = ET.Element("{urn:ietf:params:xml:ns:xmpp-tls}starttls")
     if required:
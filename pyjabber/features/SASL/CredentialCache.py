@@ -0,0 +1,89 @@
+import time
+from collections import OrderedDict
+from typing import Dict, Tuple, Union
+
+from pyjabber import AppConfig
+from pyjabber.features.SASL.SCRAM import Credentials
+from pyjabber.utils import Singleton
+
+
+class CredentialCache(metaclass=Singleton):
+    """
+    Bounded LRU cache of the parsed credentials, in front of the credentials
+    table.
+
+    Unknown users are cached too (as None) for a short time, so repeated
+    attempts against accounts that do not exist do not reach the database.
+    Any write to the credentials of a user must invalidate its entry.
+    """
+
+    __slots__ = (
+        "_entries",
+        "_max_size",
+        "_negative_ttl",
+        "_generation",
+        "hits",
+        "misses",
+    )
+
+    def __init__(self):
+        self._entries: OrderedDict[str, Tuple[Union[Credentials, None], float]] = (
+            OrderedDict()
+        )
+        self._max_size = AppConfig.app_config.credential_cache_size
+        self._negative_ttl = AppConfig.app_config.credential_cache_negative_ttl
+        self._generation = 0
+
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def generation(self) -> int:
+        """
+        Changes on every invalidation. A value read from the database must be
+        stored with the generation taken before the query, so it is dropped if
+        the user was invalidated in the meantime
+        """
+        return self._generation
+
+    def get(self, jid: str) -> Tuple[bool, Union[Credentials, None]]:
+        """
+        :return: (found, credentials). Credentials is None for a cached unknown user
+        """
+        entry = self._entries.get(jid)
+        if entry is not None:
+            credentials, expiry = entry
+            if credentials is not None or expiry > time.monotonic():
+                self._entries.move_to_end(jid)
+                self.hits += 1
+                return True, credentials
+            del self._entries[jid]
+
+        self.misses += 1
+        return False, None
+
+    def put(
+        self, jid: str, credentials: Union[Credentials, None], generation: int = None
+    ):
+        if self._max_size <= 0:
+            return
+        if generation is not None and generation != self._generation:
+            return
+
+        expiry = 0 if credentials else time.monotonic() + self._negative_ttl
+        self._entries[jid] = (credentials, expiry)
+        self._entries.move_to_end(jid)
+
+        while len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, jid: str):
+        self._generation += 1
+        self._entries.pop(jid, None)
+
+    def clear(self):
+        self._generation += 1
+        self._entries.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._entries)}
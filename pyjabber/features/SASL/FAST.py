@@ -0,0 +1,190 @@
+"""
+XEP-0484: Fast Authentication Streamlining Tokens.
+
+A token is issued to a client (identified by the user-agent id sent on SASL2)
+after a successful authentication, and the client uses it to authenticate
+again with HT-SHA-256-NONE, without a password.
+
+The token itself is never stored. The client proves the token sending
+HMAC(token, "Initiator"); the database keeps the SHA-256 of that value, so a
+login is a single lookup by hash, and HMAC(token, "Responder"), returned to
+the client as proof of the server knowledge of the token.
+
+Each client keeps up to two tokens: the current one, and a new one issued on
+rotation. Using the new token revokes the previous one.
+"""
+
+import hashlib
+import hmac
+import secrets
+import time
+from datetime import datetime, timezone
+from typing import Tuple, Union
+
+from attrs import define
+from sqlalchemy import delete, insert, select, update
+
+from pyjabber import AppConfig
+from pyjabber.db.database import DB
+from pyjabber.db.model import Model
+from pyjabber.features.SASL.Mechanism import MECHANISM
+
+MECHANISMS = [MECHANISM.HT_SHA_256_NONE]
+
+TOKENS_PER_CLIENT = 2
+
+
+@define(frozen=True, slots=True)
+class FastToken:
+    jid: str
+    client_id: str
+    responder: bytes
+    count: int
+    issued: int
+    expiry: int
+
+    def must_rotate(self, now: int = None) -> bool:
+        """
+        The token is past half of its lifetime, and a new one is issued
+        """
+        now = now or int(time.time())
+        return self.expiry - now < (self.expiry - self.issued) // 2
+
+
+def initiator(token: str) -> bytes:
+    return hmac.digest(token.encode(), b"Initiator", "sha256")
+
+
+def responder(token: str) -> bytes:
+    return hmac.digest(token.encode(), b"Responder", "sha256")
+
+
+def token_hash(initiator_hashed_token: bytes) -> str:
+    return hashlib.sha256(initiator_hashed_token).hexdigest()
+
+
+def expiry_stamp(expiry: int) -> str:
+    """
+    XEP-0082 DateTime of an expiry timestamp
+    """
+    return datetime.fromtimestamp(expiry, timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+async def issue_token(jid: str, client_id: str) -> Tuple[str, int]:
+    """
+    Create a new token for the client, dropping the expired ones and the
+    tokens older than the previous one
+
+    :return: The token and its expiry timestamp
+    """
+    token = secrets.token_urlsafe(32)
+    now = int(time.time())
+    expiry = now + AppConfig.app_config.fast_token_ttl
+
+    async with DB.writer() as con:
+        await con.execute(
+            insert(Model.FastTokens).values(
+                {
+                    "jid": jid,
+                    "client_id": client_id,
+                    "token_hash": token_hash(initiator(token)),
+                    "responder": responder(token).hex(),
+                    "count": 0,
+                    "issued": now,
+                    "expiry": expiry,
+                }
+            )
+        )
+
+        await con.execute(
+            delete(Model.FastTokens).where(
+                Model.FastTokens.c.jid == jid, Model.FastTokens.c.expiry <= now
+            )
+        )
+
+        keep = (
+            select(Model.FastTokens.c.id)
+            .where(
+                Model.FastTokens.c.jid == jid,
+                Model.FastTokens.c.client_id == client_id,
+            )
+            .order_by(Model.FastTokens.c.id.desc())
+            .limit(TOKENS_PER_CLIENT)
+        )
+        await con.execute(
+            delete(Model.FastTokens).where(
+                Model.FastTokens.c.jid == jid,
+                Model.FastTokens.c.client_id == client_id,
+                Model.FastTokens.c.id.not_in(keep),
+            )
+        )
+
+    return token, expiry
+
+
+async def verify_token(
+    jid: str, client_id: str, initiator_hashed_token: bytes, count: int
+) -> Union[FastToken, None]:
+    """
+    Check the HT-SHA-256-NONE proof of a client. The count must be greater
+    than the one used on the previous authentication with the token (replay
+    protection)
+
+    :return: The token, or None if the authentication fails
+    """
+    now = int(time.time())
+
+    async with DB.writer() as con:
+        res = await con.execute(
+            select(
+                Model.FastTokens.c.id,
+                Model.FastTokens.c.responder,
+                Model.FastTokens.c.count,
+                Model.FastTokens.c.issued,
+                Model.FastTokens.c.expiry,
+            ).where(
+                Model.FastTokens.c.token_hash == token_hash(initiator_hashed_token),
+                Model.FastTokens.c.jid == jid,
+                Model.FastTokens.c.client_id == client_id,
+            )
+        )
+        row = res.fetchone()
+
+        if row is None or row.expiry <= now or count <= row.count:
+            return None
+
+        await con.execute(
+            update(Model.FastTokens)
+            .where(Model.FastTokens.c.id == row.id)
+            .values({"count": count})
+        )
+
+        # The client moved to this token. The previous one is revoked
+        await con.execute(
+            delete(Model.FastTokens).where(
+                Model.FastTokens.c.jid == jid,
+                Model.FastTokens.c.client_id == client_id,
+                Model.FastTokens.c.id < row.id,
+            )
+        )
+
+    return FastToken(
+        jid=jid,
+        client_id=client_id,
+        responder=bytes.fromhex(row.responder),
+        count=count,
+        issued=row.issued,
+        expiry=row.expiry,
+    )
+
+
+async def invalidate_tokens(jid: str, client_id: str = None):
+    """
+    Revoke the tokens of a client, or every token of the account
+    """
+    query = delete(Model.FastTokens).where(Model.FastTokens.c.jid == jid)
+    if client_id is not None:
+        query = query.where(Model.FastTokens.c.client_id == client_id)
+
+    async with DB.writer() as con:
+        await con.execute(query)
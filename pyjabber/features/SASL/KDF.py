@@ -0,0 +1,193 @@
+"""
+Key derivation (PBKDF2) for the password logins and registrations.
+
+hashlib.pbkdf2_hmac releases the GIL, so the default thread pool runs the
+derivations in parallel without the IPC and the memory of a process pool.
+The executor is only created on the first derivation.
+
+Every derivation goes through the login admission: a token bucket per IP
+(the logins from a single address cannot starve the others), and a limit of
+concurrent derivations. A request that cannot be served within the maximum
+wait is rejected, instead of piling up on the executor.
+"""
+
+import asyncio
+import hashlib
+import multiprocessing
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from enum import Enum
+from typing import Dict, Union
+
+from loguru import logger
+
+from pyjabber import AppConfig
+from pyjabber.utils import Singleton
+
+
+class KDFMode(Enum):
+    THREAD = "thread"
+    PROCESS = "process"
+    INLINE = "inline"
+
+
+class AdmissionRejected(Exception):
+    """
+    The login could not be admitted within the maximum wait
+    """
+
+    pass
+
+
+class TokenBucket:
+    __slots__ = ("tokens", "stamp")
+
+    def __init__(self, tokens: float, stamp: float):
+        self.tokens = tokens
+        self.stamp = stamp
+
+
+class LoginAdmission:
+    """
+    Fair admission of the key derivations.
+
+    :param rate: Logins per second allowed to each IP
+    :param burst: Logins an IP can start at once
+    :param max_wait: Maximum seconds a login waits to be admitted
+    :param concurrency: Derivations running at the same time
+    """
+
+    __slots__ = ("_rate", "_burst", "_max_wait", "_semaphore", "_buckets")
+
+    # Idle buckets are dropped once the table reaches this size
+    MAX_BUCKETS = 4096
+
+    def __init__(self, rate: float, burst: int, max_wait: float, concurrency: int):
+        self._rate = rate
+        self._burst = burst
+        self._max_wait = max_wait
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._buckets: Dict[str, TokenBucket] = {}
+
+    def reserve(self, ip: str, now: float = None) -> float:
+        """
+        Take a token from the bucket of the IP
+
+        :return: Seconds to wait until the token is available
+        :raises AdmissionRejected: The wait would be over the maximum
+        """
+        now = now if now is not None else time.monotonic()
+
+        bucket = self._buckets.get(ip)
+        if bucket is None:
+            if len(self._buckets) >= self.MAX_BUCKETS:
+                self._prune(now)
+            bucket = self._buckets[ip] = TokenBucket(self._burst, now)
+
+        bucket.tokens = min(
+            self._burst, bucket.tokens + (now - bucket.stamp) * self._rate
+        )
+        bucket.stamp = now
+
+        # A negative balance queues the login behind the ones already waiting
+        wait = max(0.0, (1 - bucket.tokens) / self._rate)
+        if wait > self._max_wait:
+            raise AdmissionRejected(ip)
+
+        bucket.tokens -= 1
+        return wait
+
+    @asynccontextmanager
+    async def admit(self, ip: Union[str, None]):
+        start = time.monotonic()
+
+        wait = self.reserve(ip or "", start)
+        if wait:
+            await asyncio.sleep(wait)
+
+        try:
+            await asyncio.wait_for(
+                self._semaphore.acquire(),
+                self._max_wait - (time.monotonic() - start),
+            )
+        except (asyncio.TimeoutError, ValueError):
+            raise AdmissionRejected(ip)
+
+        try:
+            yield
+        finally:
+            self._semaphore.release()
+
+    def _prune(self, now: float):
+        idle = self._burst / self._rate
+        self._buckets = {
+            ip: bucket
+            for ip, bucket in self._buckets.items()
+            if now - bucket.stamp < idle
+        }
+
+
+class KDFExecutor(metaclass=Singleton):
+    """
+    Runs the PBKDF2 derivations in the executor selected by the kdf_mode
+    parameter (thread | process | inline)
+    """
+
+    __slots__ = ("_mode", "_workers", "_executor", "_admission")
+
+    def __init__(self):
+        self._mode = KDFMode(AppConfig.app_config.kdf_mode)
+        self._workers = AppConfig.app_config.kdf_workers or multiprocessing.cpu_count()
+        self._executor: Union[Executor, None] = None
+        self._admission = LoginAdmission(
+            rate=AppConfig.app_config.login_rate,
+            burst=AppConfig.app_config.login_burst,
+            max_wait=AppConfig.app_config.login_max_wait,
+            concurrency=self._workers,
+        )
+
+    @property
+    def executor(self) -> Union[Executor, None]:
+        if self._executor is None and self._mode != KDFMode.INLINE:
+            if self._mode == KDFMode.PROCESS:
+                self._executor = ProcessPoolExecutor(self._workers)
+            else:
+                self._executor = ThreadPoolExecutor(
+                    self._workers, thread_name_prefix="kdf"
+                )
+            logger.debug(f"KDF {self._mode.value} executor started")
+        return self._executor
+
+    async def pbkdf2(
+        self,
+        hash_name: str,
+        password: str,
+        salt: bytes,
+        iterations: int,
+        ip: str = None,
+    ) -> bytes:
+        """
+        Derive a key once the login is admitted
+
+        :raises AdmissionRejected: The login was not admitted within the maximum wait
+        """
+        async with self._admission.admit(ip):
+            if self._mode == KDFMode.INLINE:
+                return hashlib.pbkdf2_hmac(
+                    hash_name, password.encode(), salt, iterations
+                )
+
+            return await asyncio.get_running_loop().run_in_executor(
+                self.executor,
+                hashlib.pbkdf2_hmac,
+                hash_name,
+                password.encode(),
+                salt,
+                iterations,
+            )
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
@@ -4,4 +4,8 @@ from enum import Enum
 class MECHANISM(Enum):
     PLAIN = "PLAIN"
     SCRAM_SHA_1 = "SCRAM-SHA-1"
+    SCRAM_SHA_1_PLUS = "SCRAM-SHA-1-PLUS"
+    SCRAM_SHA_256 = "SCRAM-SHA-256"
+    SCRAM_SHA_256_PLUS = "SCRAM-SHA-256-PLUS"
     EXTERNAL = "EXTERNAL"
+    HT_SHA_256_NONE = "HT-SHA-256-NONE"
@@ -1,20 +1,23 @@
 import asyncio
 import base64
 import binascii
-import hashlib
-import hmac
 from typing import Union
 from xml.etree import ElementTree as ET
 
 import bcrypt
 from loguru import logger
-from sqlalchemy import insert, select
+from sqlalchemy import insert, select, update
 
 from pyjabber import AppConfig
 from pyjabber.db.database import DB
 from pyjabber.db.model import Model
+from pyjabber.features.SASL import SCRAM
+from pyjabber.features.SASL.CredentialCache import CredentialCache
+from pyjabber.features.SASL.KDF import AdmissionRejected, KDFExecutor
 from pyjabber.features.SASL.Mechanism import MECHANISM
 from pyjabber.features.SASL.utils import (
+    challenge_response,
+    failure_response,
     iq_register_result,
     not_authorized_response,
     success_response,
@@ -45,10 +48,8 @@ class SASL:
         "_peer",
         "_from_claim",
         "_connection_manager",
-        "_loop",
-        "_semaphore",
-        "_pool_executor",
         "_handlers",
+        "_scram",
     )
 
     def __init__(self, transport, parser, peer, from_claim=None):
@@ -58,12 +59,14 @@ class SASL:
         self._from_claim = from_claim
 
         self._connection_manager = ConnectionManager()
-        self._loop = asyncio.get_running_loop()
+        self._scram: Union[SCRAM.ScramExchange, None] = None
 
-        self._semaphore = AppConfig.app_config.semaphore
-        self._pool_executor = AppConfig.app_config.process_pool_exe
-
-        self._handlers = {"iq": self.handle_iq, "auth": self.handle_auth}
+        self._handlers = {
+            "iq": self.handle_iq,
+            "auth": self.handle_auth,
+            "response": self.handle_response,
+            "abort": self.handle_abort,
+        }
 
     async def feed(self, element: ET.Element) -> Union[Stage, None]:
         _, tag = CN.break_down(element.tag)
@@ -81,7 +84,7 @@ class SASL:
 
             new_jid = new_jid.text
 
-            async with await DB.connection_async() as con:
+            async with DB.reader() as con:
                 query_db = select(Model.Credentials).where(
                     Model.Credentials.c.jid == new_jid
                 )
@@ -92,7 +95,13 @@ class SASL:
                 self._transport.write(SE.conflict_error(element.attrib.get("id")))
             else:
                 pwd = query.find("{jabber:iq:register}password").text
-                await self._store_hash_task(pwd, new_jid)
+                try:
+                    await self._store_hash_task(pwd, new_jid)
+                except AdmissionRejected:
+                    self._transport.write(
+                        SE.resource_constraint(element.attrib.get("id"))
+                    )
+                    return
                 self._transport.write(iq_register_result(element.attrib["id"]))
 
         elif element.attrib.get("type") == IQ.TYPE.GET.value:
@@ -108,65 +117,163 @@ class SASL:
             self._transport.write(ET.tostring(iq))
 
     async def handle_auth(self, element: ET.Element) -> Union[Stage, None]:
-        mechanism = element.attrib.get("mechanism")
+        return await self._authenticate(element.attrib.get("mechanism"), element.text)
+
+    async def handle_response(self, element: ET.Element) -> Union[Stage, None]:
+        """
+        Final step of a SCRAM exchange. The server only computes HMACs over the
+        keys stored at registration
+        """
+        if self._scram is None:
+            self._failure("malformed-request")
+            return
 
+        scram, self._scram = self._scram, None
+        try:
+            server_final = scram.client_final(
+                base64.b64decode(element.text or "", validate=True)
+            )
+        except binascii.Error:
+            self._failure("incorrect-encoding")
+            return
+        except SCRAM.ScramError as e:
+            self._failure(e.condition)
+            return
+
+        return await self._authorized(scram.username, server_final)
+
+    async def handle_abort(self, _) -> None:
+        self._scram = None
+        self._failure("aborted")
+
+    async def _authenticate(
+        self, mechanism: str, data: Union[str, None]
+    ) -> Union[Stage, None]:
         if mechanism == MECHANISM.EXTERNAL.value:  # S2S SASL process
-            if not self._from_claim:
-                raise BadRequestException()
+            return await self._handle_external()
 
-            cert = self._connection_manager.get_connection_ssl_certificate(self._peer)
-            if not cert:
-                logger.error(f"Error retrieving TLS cert from {self._peer}")
-                self._transport.write(not_authorized_response())
-                return
+        try:
+            mechanism = MECHANISM(mechanism)
+        except ValueError:
+            mechanism = None
 
-            if not validate_cert(self._from_claim, cert):
-                logger.error(
-                    f"Host claim cannot be verified with presented cert. Verify host used on stream or cert: {self._peer}"
-                )
-                self._transport.write(not_authorized_response())
-                return
+        if mechanism in SCRAM.HASHES:
+            return await self._handle_scram_first(mechanism, data)
+
+        if mechanism == MECHANISM.PLAIN:
+            return await self._handle_plain(data)
+
+        self._failure("invalid-mechanism")
+
+    async def _handle_external(self) -> Union[Stage, None]:
+        if not self._from_claim:
+            raise BadRequestException()
 
-            self._transport.write(success_response())
-            self._parser.reset_stack()
-            return Stage.AUTH
+        cert = self._connection_manager.get_connection_ssl_certificate(self._peer)
+        if not cert:
+            logger.error(f"Error retrieving TLS cert from {self._peer}")
+            self._transport.write(not_authorized_response())
+            return
 
+        if not validate_cert(self._from_claim, cert):
+            logger.error(
+                f"Host claim cannot be verified with presented cert. Verify host used on stream or cert: {self._peer}"
+            )
+            self._transport.write(not_authorized_response())
+            return
+
+        self._transport.write(success_response())
+        self._parser.reset_stack()
+        return Stage.AUTH
+
+    async def _handle_scram_first(
+        self, mechanism: MECHANISM, data: Union[str, None]
+    ) -> None:
+        self._scram = SCRAM.ScramExchange(
+            mechanism, SCRAM.channel_binding(self._transport)
+        )
+        try:
+            username = self._scram.client_first(
+                base64.b64decode(data or "", validate=True)
+            )
+        except binascii.Error:
+            self._scram = None
+            self._failure("incorrect-encoding")
+            return
+        except SCRAM.ScramError as e:
+            self._scram = None
+            self._failure(e.condition)
+            return
+
+        credentials = await self._get_credentials(username)
+        self._challenge(self._scram.server_first(credentials))
+
+    async def _handle_plain(self, data: Union[str, None]) -> Union[Stage, None]:
         try:  # C2S SASL process
-            data = base64.b64decode(element.text).split("\x00".encode())
+            data = base64.b64decode(data).split("\x00".encode())
             jid = data[1].decode()
             pwd = data[2].decode()
 
-            async with await DB.connection_async() as con:
-                query = select(Model.Credentials.c.hash_pwd).where(
-                    Model.Credentials.c.jid == jid
-                )
-                hashed_pwd = await con.execute(query)
-                hashed_pwd = hashed_pwd.fetchone()
-
-            if not hashed_pwd:
-                self._transport.write(SE.not_authorized_sasl())
-                self._connection_manager.close(self._peer)
+            credentials = await self._get_credentials(jid)
+            if not credentials:
+                self._reject()
+                return
 
-            authorized = await self._verify_password_async(
-                stored_password=hashed_pwd[0], provided_password=pwd
-            )
+            authorized = await self._verify_password_async(credentials, pwd)
             if authorized:
-                self._connection_manager.set_jid(
-                    self._peer, JID(user=jid, domain=AppConfig.app_config.host)
-                )
-                self._transport.write(success_response())
-                self._parser.reset_stack()
-                self._transport.resume_reading()
-                return Stage.AUTH
+                if credentials.legacy:
+                    await self._upgrade_credentials(jid, pwd, credentials)
+                return await self._authorized(jid)
             else:
-                self._transport.write(SE.not_authorized_sasl())
-                self._connection_manager.close(self._peer)
+                self._reject()
+
+        except AdmissionRejected:
+            logger.warning(f"Login from {self._peer} not admitted. Too many attempts")
+            self._failure("temporary-auth-failure")
 
         except Exception as e:
-            logger.error(
-                f"Exception during auth process for {element.attrib.get('from')}: {e}"
+            logger.error(f"Exception during auth process for {self._peer}: {e}")
+            self._failure("not-authorized")
+
+    def _challenge(self, data: bytes):
+        self._transport.write(challenge_response(data))
+
+    def _failure(self, condition: str):
+        self._transport.write(failure_response(condition))
+
+    def _reject(self):
+        """
+        A failed PLAIN authentication closes the stream
+        """
+        self._failure("not-authorized")
+        self._connection_manager.close(self._peer)
+
+    async def _authorized(self, jid: str, additional_data: bytes = None) -> Stage:
+        self._connection_manager.set_jid(
+            self._peer, JID(user=jid, domain=AppConfig.app_config.host)
+        )
+        self._transport.write(success_response(additional_data))
+        self._parser.reset_stack()
+        self._transport.resume_reading()
+        return Stage.AUTH
+
+    async def _get_credentials(self, jid: str) -> Union[SCRAM.Credentials, None]:
+        cache = CredentialCache()
+        found, credentials = cache.get(jid)
+        if found:
+            return credentials
+
+        generation = cache.generation
+        async with DB.reader() as con:
+            query = select(Model.Credentials.c.hash_pwd).where(
+                Model.Credentials.c.jid == jid
             )
-            self._transport.write(SE.not_authorized_sasl())
+            hashed_pwd = await con.execute(query)
+            hashed_pwd = hashed_pwd.fetchone()
+
+        credentials = SCRAM.parse_credentials(hashed_pwd[0]) if hashed_pwd else None
+        cache.put(jid, credentials, generation)
+        return credentials
 
     ###############################################################################################
     async def _store_hash_task(self, password: str, jid_str: str):
@@ -174,7 +281,7 @@ class SASL:
 
         This coroutine executes the CPU-intensive password hashing and the I/O-bound
         database insertion, ensuring neither operation blocks the main event loop.
-        It concludes the registration by sending an XMPP success response to the client.
+        The SCRAM keys are derived here, so the logins do not need to run PBKDF2.
 
         Args:
             password: The user's plain text password to be hashed and stored.
@@ -188,47 +295,71 @@ class SASL:
             else bcrypt.gensalt(),
         )
 
-        async with await DB.connection_async() as con:
-            async with con.begin():
-                query_insert = insert(Model.Credentials).values(
-                    {"jid": jid_str, "hash_pwd": hashed_pwd}
-                )
-                await con.execute(query_insert)
+        async with DB.writer() as con:
+            query_insert = insert(Model.Credentials).values(
+                {"jid": jid_str, "hash_pwd": hashed_pwd}
+            )
+            await con.execute(query_insert)
+
+        CredentialCache().invalidate(jid_str)
+
+    async def _upgrade_credentials(
+        self, jid: str, password: str, credentials: SCRAM.Credentials
+    ):
+        """Rewrites the credentials stored in the previous format (salted password
+        only), adding the SCRAM keys. Same salt and iterations are kept.
+        """
+        hashed_pwd = await self._hash_scram_async(
+            password, credentials.salt, credentials.iterations
+        )
+
+        async with DB.writer() as con:
+            query_update = (
+                update(Model.Credentials)
+                .where(Model.Credentials.c.jid == jid)
+                .values({"hash_pwd": hashed_pwd})
+            )
+            await con.execute(query_update)
+
+        CredentialCache().invalidate(jid)
 
     async def _verify_password_async(
-        self, stored_password: str, provided_password: str
+        self, credentials: SCRAM.Credentials, provided_password: str
     ) -> bool:
         """
-        Verifies a password against the stored string.
+        Verifies a password against the stored credentials (PLAIN mechanism).
 
         Args:
-            stored_password: The full string from the database (e.g., "sha256$100000$salt_hex$hash_hex").
+            credentials: The parsed credentials of the user.
             provided_password: The password entered by the user.
 
         Returns:
             bool: True if the passwords match, False otherwise.
         """
-        try:
-            _, iter_str, salt_hex, hash_hex = stored_password.split("$")
-
-            iterations = int(iter_str)
-            salt = binascii.unhexlify(salt_hex)
-
-            new_hash = await self._hash_scram_async(provided_password, salt, iterations)
-            _, _, _, new_hash = new_hash.split("$")
-
-            return hmac.compare_digest(new_hash, hash_hex)
-
-        except (ValueError, IndexError, binascii.Error):
-            return False
+        salted_password = await self._pbkdf2_async(
+            "sha256", provided_password, credentials.salt, credentials.iterations
+        )
+        return credentials.verify("sha256", salted_password)
+
+    async def _pbkdf2_async(
+        self, hash_name: str, password: str, salt: bytes, iterations: int
+    ) -> bytes:
+        """Calculates the PBKDF2 derived key (SCRAM SaltedPassword) asynchronously.
+        The CPU-intensive PBKDF2-HMAC operation runs on the KDF executor, once
+        the login admission lets the peer in.
+        """
+        return await KDFExecutor().pbkdf2(
+            hash_name,
+            password,
+            salt,
+            iterations,
+            ip=self._peer[0] if self._peer else None,
+        )
 
     async def _hash_scram_async(
         self, password: str, salt: bytes, iterations: int
     ) -> str:
-        """Calculates the PBKDF2 derived key (used in SCRAM) asynchronously.
-        This function offloads the CPU-intensive PBKDF2-HMAC operation to a
-        process pool executor to prevent blocking the asyncio event loop.
-        It then encodes the result into a single secure string for storage.
+        """Calculates the SCRAM credentials of a password.
 
         Args:
             password: The user's plain text password.
@@ -237,22 +368,11 @@ class SASL:
 
         Returns:
             str: A formatted string containing the algorithm, iterations, salt (in hex),
-                 and the resulting hash (in hex), separated by '$' (e.g., "sha256$100000$salt_hex$hash_hex").
-                 This format is ideal for securely storing credentials in a single
-                 database column.
+                 and the StoredKey/ServerKey pairs (in hex) for SCRAM-SHA-256 and
+                 SCRAM-SHA-1, separated by '$'. See SCRAM.format_credentials.
         """
-        hashed_pwd = None
-        async with self._semaphore:
-            hashed_pwd = await self._loop.run_in_executor(
-                self._pool_executor,
-                hashlib.pbkdf2_hmac,
-                "sha256",
-                password.encode(),
-                salt,
-                iterations,
-            )
-
-        salt_hex = binascii.hexlify(salt).decode("ascii")
-        hash_hex = binascii.hexlify(hashed_pwd).decode("ascii")
-
-        return f"sha256${iterations}${salt_hex}${hash_hex}"
+        salted_sha256, salted_sha1 = await asyncio.gather(
+            self._pbkdf2_async("sha256", password, salt, iterations),
+            self._pbkdf2_async("sha1", password, salt, iterations),
+        )
+        return SCRAM.format_credentials(iterations, salt, salted_sha256, salted_sha1)
@@ -0,0 +1,128 @@
+import base64
+import binascii
+from typing import Union
+from xml.etree import ElementTree as ET
+
+from loguru import logger
+
+from pyjabber import AppConfig
+from pyjabber.features.SASL import FAST
+from pyjabber.features.SASL.Mechanism import MECHANISM
+from pyjabber.features.SASL.SASL import SASL
+from pyjabber.features.SASL.utils import (
+    sasl2_challenge_response,
+    sasl2_failure_response,
+    sasl2_success_response,
+)
+from pyjabber.stream.JID import JID
+from pyjabber.stream.utils.Enums import Stage
+
+
+class SASL2(SASL):
+    """
+    XEP-0388: Extensible SASL Profile.
+
+    Same mechanisms as SASL, plus the XEP-0484 (FAST) tokens: a client can ask
+    for a token on any authentication, and use it on the next reconnections
+    with HT-SHA-256-NONE instead of the password. The stream is not restarted
+    after the success.
+    """
+
+    __slots__ = ("_client_id", "_token_requested")
+
+    def __init__(self, transport, parser, peer):
+        super().__init__(transport, parser, peer)
+
+        self._client_id = None
+        self._token_requested = False
+
+        self._handlers = {
+            "authenticate": self.handle_authenticate,
+            "response": self.handle_response,
+            "abort": self.handle_abort,
+        }
+
+    async def handle_authenticate(self, element: ET.Element) -> Union[Stage, None]:
+        mechanism = element.attrib.get("mechanism")
+        initial_response = element.findtext("{urn:xmpp:sasl:2}initial-response")
+
+        user_agent = element.find("{urn:xmpp:sasl:2}user-agent")
+        self._client_id = (
+            user_agent.attrib.get("id") if user_agent is not None else None
+        )
+
+        request_token = element.find("{urn:xmpp:fast:0}request-token")
+        self._token_requested = False
+        if request_token is not None:
+            token_mechanism = request_token.attrib.get("mechanism")
+            self._token_requested = token_mechanism in [
+                m.value for m in FAST.MECHANISMS
+            ]
+
+        if mechanism == MECHANISM.HT_SHA_256_NONE.value:
+            return await self._handle_fast(
+                element.find("{urn:xmpp:fast:0}fast"), initial_response
+            )
+
+        return await self._authenticate(mechanism, initial_response)
+
+    async def _handle_fast(
+        self, fast: Union[ET.Element, None], data: Union[str, None]
+    ) -> Union[Stage, None]:
+        """
+        HT-SHA-256-NONE: the client sends the username and HMAC(token, "Initiator").
+        No key derivation is run, the proof is checked with a lookup by hash
+        """
+        if fast is None or not self._client_id:
+            self._failure("malformed-request")
+            return
+
+        try:
+            count = int(fast.attrib["count"])
+            username, initiator_hashed_token = base64.b64decode(
+                data or "", validate=True
+            ).split(b"\x00", 1)
+            username = username.decode()
+        except (KeyError, ValueError, binascii.Error, UnicodeDecodeError):
+            self._failure("malformed-request")
+            return
+
+        token = await FAST.verify_token(
+            username, self._client_id, initiator_hashed_token, count
+        )
+        if token is None:
+            logger.debug(f"FAST authentication failed for {self._peer}")
+            self._failure("not-authorized")
+            return
+
+        if fast.attrib.get("invalidate") in ("true", "1"):
+            await FAST.invalidate_tokens(username, self._client_id)
+            self._token_requested = False
+        elif token.must_rotate():
+            self._token_requested = True
+
+        return await self._authorized(username, token.responder)
+
+    def _challenge(self, data: bytes):
+        self._transport.write(sasl2_challenge_response(data))
+
+    def _failure(self, condition: str):
+        self._transport.write(sasl2_failure_response(condition))
+
+    def _reject(self):
+        # The client can retry, the stream is kept open
+        self._failure("not-authorized")
+
+    async def _authorized(self, jid: str, additional_data: bytes = None) -> Stage:
+        bare_jid = JID(user=jid, domain=AppConfig.app_config.host)
+        self._connection_manager.set_jid(self._peer, bare_jid)
+
+        token, expiry = None, None
+        if self._token_requested and self._client_id:
+            token, expiry = await FAST.issue_token(jid, self._client_id)
+            expiry = FAST.expiry_stamp(expiry)
+
+        self._transport.write(
+            sasl2_success_response(str(bare_jid), additional_data, token, expiry)
+        )
+        return Stage.AUTH
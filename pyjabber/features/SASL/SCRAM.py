@@ -0,0 +1,291 @@
+"""
+SCRAM (RFC 5802, RFC 7677) server side.
+
+The credentials are stored as
+    sha256$iterations$salt_hex$stored_key_sha256$server_key_sha256$stored_key_sha1$server_key_sha1
+
+The keys are derived from the same salt and iteration count at registration,
+so a login only costs a few HMACs on the server. Rows in the previous format
+(sha256$iterations$salt_hex$salted_password_hex) are still valid: their
+SHA-256 keys are derived on the fly, and they are upgraded on the next PLAIN
+login.
+"""
+
+import base64
+import binascii
+import hashlib
+import hmac
+import secrets
+from typing import Dict, List, Optional
+
+from attrs import define
+
+from pyjabber.features.SASL.Mechanism import MECHANISM
+
+HASHES = {
+    MECHANISM.SCRAM_SHA_1: "sha1",
+    MECHANISM.SCRAM_SHA_1_PLUS: "sha1",
+    MECHANISM.SCRAM_SHA_256: "sha256",
+    MECHANISM.SCRAM_SHA_256_PLUS: "sha256",
+}
+
+PLUS = (MECHANISM.SCRAM_SHA_1_PLUS, MECHANISM.SCRAM_SHA_256_PLUS)
+
+CHANNEL_BINDING = "tls-unique"
+
+NONCE_SIZE = 24
+
+# Used to answer with a stable, fake salt for unknown users
+_SECRET = secrets.token_bytes(32)
+
+
+class ScramError(Exception):
+    """
+    The exchange must be aborted. The value is the SASL failure condition
+    """
+
+    def __init__(self, condition: str = "not-authorized"):
+        super().__init__(condition)
+        self.condition = condition
+
+
+@define(frozen=True, slots=True)
+class ScramKeys:
+    stored_key: bytes
+    server_key: bytes
+
+
+@define(frozen=True, slots=True)
+class Credentials:
+    iterations: int
+    salt: bytes
+    keys: Dict[str, ScramKeys]
+    legacy: bool = False
+
+    def verify(self, hash_name: str, salted_password: bytes) -> bool:
+        """
+        Check a salted password (PBKDF2 of the password provided on a PLAIN
+        login) against the stored keys
+        """
+        keys = self.keys.get(hash_name)
+        if keys is None:
+            return False
+        return hmac.compare_digest(
+            derive_keys(hash_name, salted_password).stored_key, keys.stored_key
+        )
+
+
+def derive_keys(hash_name: str, salted_password: bytes) -> ScramKeys:
+    client_key = hmac.digest(salted_password, b"Client Key", hash_name)
+    return ScramKeys(
+        stored_key=hashlib.new(hash_name, client_key).digest(),
+        server_key=hmac.digest(salted_password, b"Server Key", hash_name),
+    )
+
+
+def format_credentials(
+    iterations: int, salt: bytes, salted_sha256: bytes, salted_sha1: bytes
+) -> str:
+    keys_256 = derive_keys("sha256", salted_sha256)
+    keys_1 = derive_keys("sha1", salted_sha1)
+    return "$".join(
+        [
+            "sha256",
+            str(iterations),
+            salt.hex(),
+            keys_256.stored_key.hex(),
+            keys_256.server_key.hex(),
+            keys_1.stored_key.hex(),
+            keys_1.server_key.hex(),
+        ]
+    )
+
+
+def parse_credentials(stored: str) -> Optional[Credentials]:
+    try:
+        fields = stored.split("$")
+        iterations = int(fields[1])
+        salt = binascii.unhexlify(fields[2])
+
+        if len(fields) == 4:
+            return Credentials(
+                iterations=iterations,
+                salt=salt,
+                keys={"sha256": derive_keys("sha256", binascii.unhexlify(fields[3]))},
+                legacy=True,
+            )
+
+        if len(fields) == 7:
+            sk_256, svk_256, sk_1, svk_1 = map(binascii.unhexlify, fields[3:])
+            return Credentials(
+                iterations=iterations,
+                salt=salt,
+                keys={
+                    "sha256": ScramKeys(sk_256, svk_256),
+                    "sha1": ScramKeys(sk_1, svk_1),
+                },
+            )
+
+    except (ValueError, IndexError, binascii.Error):
+        pass
+
+    return None
+
+
+def channel_binding(transport) -> Optional[bytes]:
+    """
+    tls-unique channel binding data of the transport. Not defined for TLS 1.3
+    """
+    ssl_object = transport.get_extra_info("ssl_object") if transport else None
+    if ssl_object is None or ssl_object.version() == "TLSv1.3":
+        return None
+    return ssl_object.get_channel_binding(CHANNEL_BINDING)
+
+
+def mechanisms(transport) -> List[MECHANISM]:
+    """
+    Mechanisms offered to a client, in order of preference
+    """
+    res = []
+    if channel_binding(transport):
+        res += [MECHANISM.SCRAM_SHA_256_PLUS, MECHANISM.SCRAM_SHA_1_PLUS]
+    return res + [MECHANISM.SCRAM_SHA_256, MECHANISM.SCRAM_SHA_1, MECHANISM.PLAIN]
+
+
+def _b64(data: bytes) -> str:
+    return base64.b64encode(data).decode()
+
+
+def _attributes(message: str) -> Dict[str, str]:
+    res = {}
+    for attr in message.split(","):
+        if len(attr) < 2 or attr[1] != "=":
+            raise ScramError("malformed-request")
+        res[attr[0]] = attr[2:]
+    return res
+
+
+class ScramExchange:
+    """
+    Server side of a single SCRAM authentication exchange.
+
+    :param mechanism: Any of the SCRAM mechanisms
+    :param cb_data: Channel binding data of the stream (None if not available)
+    """
+
+    __slots__ = (
+        "_mechanism",
+        "_hash",
+        "_cb_data",
+        "_gs2_header",
+        "_client_first_bare",
+        "_server_first",
+        "_nonce",
+        "_keys",
+        "username",
+    )
+
+    def __init__(self, mechanism: MECHANISM, cb_data: Optional[bytes] = None):
+        self._mechanism = mechanism
+        self._hash = HASHES[mechanism]
+        self._cb_data = cb_data
+
+        self._gs2_header = None
+        self._client_first_bare = None
+        self._server_first = None
+        self._nonce = None
+        self._keys = None
+        self.username = None
+
+    def client_first(self, message: bytes) -> str:
+        """
+        Process the client-first-message
+
+        :return: The username to authenticate
+        """
+        try:
+            message = message.decode()
+            cbind_flag, authzid, client_first_bare = message.split(",", 2)
+        except (UnicodeDecodeError, ValueError):
+            raise ScramError("malformed-request")
+
+        if cbind_flag.startswith("p="):
+            if self._mechanism not in PLUS or cbind_flag[2:] != CHANNEL_BINDING:
+                raise ScramError("malformed-request")
+        elif self._mechanism in PLUS:
+            raise ScramError("malformed-request")
+        elif cbind_flag == "y" and self._cb_data is not None:
+            # The client supports channel binding, and thinks we do not. Downgrade
+            raise ScramError("not-authorized")
+        elif cbind_flag not in ("n", "y"):
+            raise ScramError("malformed-request")
+
+        if cbind_flag.startswith("p=") and self._cb_data is None:
+            raise ScramError("not-authorized")
+
+        attrs = _attributes(client_first_bare)
+        if "m" in attrs or not attrs.get("n") or not attrs.get("r"):
+            raise ScramError("malformed-request")
+
+        self._gs2_header = f"{cbind_flag},{authzid},"
+        self._client_first_bare = client_first_bare
+        self._nonce = attrs["r"] + secrets.token_urlsafe(NONCE_SIZE)
+        self.username = attrs["n"].replace("=2C", ",").replace("=3D", "=")
+        return self.username
+
+    def server_first(self, credentials: Optional[Credentials]) -> bytes:
+        """
+        Build the server-first-message. Unknown users get a stable fake salt,
+        and the exchange fails on the proof
+        """
+        keys = credentials.keys.get(self._hash) if credentials else None
+        if keys is None:
+            salt = hmac.digest(_SECRET, self.username.encode(), "sha256")[:16]
+            iterations = credentials.iterations if credentials else 100000
+        else:
+            salt, iterations = credentials.salt, credentials.iterations
+
+        self._keys = keys
+        self._server_first = f"r={self._nonce},s={_b64(salt)},i={iterations}"
+        return self._server_first.encode()
+
+    def client_final(self, message: bytes) -> bytes:
+        """
+        Verify the client-final-message
+
+        :return: The server-final-message, to be sent within the success
+        """
+        try:
+            message = message.decode()
+            without_proof, proof = message.rsplit(",p=", 1)
+            proof = base64.b64decode(proof, validate=True)
+        except (UnicodeDecodeError, ValueError, binascii.Error):
+            raise ScramError("malformed-request")
+
+        attrs = _attributes(without_proof)
+        cbind_input = self._gs2_header.encode()
+        if self._gs2_header.startswith("p="):
+            cbind_input += self._cb_data
+
+        if attrs.get("c") != _b64(cbind_input) or attrs.get("r") != self._nonce:
+            raise ScramError("not-authorized")
+
+        if self._keys is None:
+            raise ScramError("not-authorized")
+
+        auth_message = ",".join(
+            [self._client_first_bare, self._server_first, without_proof]
+        ).encode()
+
+        client_signature = hmac.digest(self._keys.stored_key, auth_message, self._hash)
+        if len(proof) != len(client_signature):
+            raise ScramError("not-authorized")
+
+        client_key = bytes(a ^ b for a, b in zip(proof, client_signature))
+        if not hmac.compare_digest(
+            hashlib.new(self._hash, client_key).digest(), self._keys.stored_key
+        ):
+            raise ScramError("not-authorized")
+
+        server_signature = hmac.digest(self._keys.server_key, auth_message, self._hash)
+        return f"v={_b64(server_signature)}".encode()
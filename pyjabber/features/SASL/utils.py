@@ -1,6 +1,12 @@
+import base64
+import os
+from functools import lru_cache
 from uuid import uuid4
 from xml.etree import ElementTree as ET
 
+from cryptography import x509
+from cryptography.exceptions import InvalidSignature
+
 from pyjabber import AppConfig
 
 
@@ -21,6 +27,50 @@ def validate_cert(from_claim, cert):
     return from_claim in cert_names
 
 
+@lru_cache(maxsize=4)
+def _load_ca(path: str, mtime_ns: int) -> x509.Certificate:
+    """
+    The CA certificate, parsed once per version of its file
+    """
+    with open(path, "rb") as f:
+        return x509.load_pem_x509_certificate(f.read())
+
+
+def verify_peer_cert(host, ssl_object) -> bool:
+    """
+    Verify the certificate presented by a server we dialed, which is not
+    checked during the TLS handshake. It must be issued by the CA of the
+    server (ca_cert.pem in the certs path) and name the given host
+    """
+    der = ssl_object.getpeercert(binary_form=True) if ssl_object else None
+    if not der:
+        return False
+
+    ca_path = os.path.join(AppConfig.app_config.cert_path, "ca_cert.pem")
+    try:
+        ca_cert = _load_ca(ca_path, os.stat(ca_path).st_mtime_ns)
+    except OSError:
+        return False
+
+    try:
+        peer_cert = x509.load_der_x509_certificate(der)
+        peer_cert.verify_directly_issued_by(ca_cert)
+    except (ValueError, TypeError, InvalidSignature):
+        return False
+
+    cert_names = {
+        attr.value
+        for attr in peer_cert.subject.get_attributes_for_oid(x509.NameOID.COMMON_NAME)
+    }
+    try:
+        san = peer_cert.extensions.get_extension_for_class(x509.SubjectAlternativeName)
+        cert_names.update(san.value.get_values_for_type(x509.DNSName))
+    except x509.ExtensionNotFound:
+        pass
+
+    return host in cert_names
+
+
 def iq_register_result(iq_id: str) -> bytes:
     iq = ET.Element(
         "iq",
@@ -34,8 +84,67 @@ def iq_register_result(iq_id: str) -> bytes:
 
 
 def not_authorized_response() -> bytes:
-    return b"<failure xmlns='urn:ietf:params:xml:ns:xmpp-sasl'><not-authorized/></failure></stream>"
+    return (
+        b"<failure xmlns='urn:ietf:params:xml:ns:xmpp-sasl'><not-authorized/></failure>"
+        b"</stream>"
+    )
 
 
-def success_response() -> bytes:
+def success_response(additional_data: bytes = None) -> bytes:
+    if additional_data:
+        return (
+            b"<success xmlns='urn:ietf:params:xml:ns:xmpp-sasl'>"
+            + base64.b64encode(additional_data)
+            + b"</success>"
+        )
     return b"<success xmlns='urn:ietf:params:xml:ns:xmpp-sasl'/>"
+
+
+def challenge_response(data: bytes) -> bytes:
+    return (
+        b"<challenge xmlns='urn:ietf:params:xml:ns:xmpp-sasl'>"
+        + base64.b64encode(data)
+        + b"</challenge>"
+    )
+
+
+def failure_response(condition: str = "not-authorized") -> bytes:
+    return (
+        f"<failure xmlns='urn:ietf:params:xml:ns:xmpp-sasl'><{condition}/></failure>"
+    ).encode()
+
+
+def sasl2_challenge_response(data: bytes) -> bytes:
+    return (
+        b"<challenge xmlns='urn:xmpp:sasl:2'>"
+        + base64.b64encode(data)
+        + b"</challenge>"
+    )
+
+
+def sasl2_failure_response(condition: str = "not-authorized") -> bytes:
+    return (
+        f"<failure xmlns='urn:xmpp:sasl:2'>"
+        f"<{condition} xmlns='urn:ietf:params:xml:ns:xmpp-sasl'/></failure>"
+    ).encode()
+
+
+def sasl2_success_response(
+    authorization_identifier: str,
+    additional_data: bytes = None,
+    token: str = None,
+    expiry: str = None,
+) -> bytes:
+    success = ET.Element("{urn:xmpp:sasl:2}success")
+    if additional_data:
+        ET.SubElement(
+            success, "{urn:xmpp:sasl:2}additional-data"
+        ).text = base64.b64encode(additional_data).decode()
+    ET.SubElement(
+        success, "{urn:xmpp:sasl:2}authorization-identifier"
+    ).text = authorization_identifier
+    if token:
+        ET.SubElement(
+            success, "{urn:xmpp:fast:0}token", attrib={"token": token, "expiry": expiry}
+        )
+    return ET.tostring(success)
@@ -1,8 +1,9 @@
-import asyncio
 import xml.etree.ElementTree as ET
-from typing import List, Tuple, Union
+from asyncio import Transport
+from typing import Dict, Iterable, List, Optional, Tuple, Union
 from uuid import uuid4
 from xml.etree.ElementTree import Element
+from xml.sax.saxutils import quoteattr
 
 from sqlalchemy import delete, select
 
@@ -10,8 +11,15 @@ from pyjabber import AppConfig
 from pyjabber.db.database import DB
 from pyjabber.db.model import Model
 from pyjabber.features.presence.Enums import PresenceShow, PresenceType
-from pyjabber.network.ConnectionManager import ConnectionManager
+from pyjabber.features.presence.ResourceTable import (
+    Resource,
+    ResourceTable,
+    parse_priority,
+)
+from pyjabber.network.ConnectionManager import Client, ConnectionManager
 from pyjabber.plugins.roster.Roster import Roster
+from pyjabber.plugins.xep_0115.xep_0115 import Caps
+from pyjabber.plugins.xep_0163.xep_0163 import PEP
 from pyjabber.queues.NewConnection import NewConnectionWrapper
 from pyjabber.queues.QueueManager import QueueName, get_queue
 from pyjabber.stanzas.IQ import IQ
@@ -28,6 +36,8 @@ class Presence(metaclass=Singleton):
         "_connection_queue",
         "_internal_queue",
         "_online_status",
+        "_caps",
+        "_pep",
     )
 
     def __init__(self) -> None:
@@ -41,18 +51,23 @@ class Presence(metaclass=Singleton):
 
         self._connections = ConnectionManager()
         self._connection_queue = get_queue(QueueName.CONNECTIONS)
-        self._internal_queue = asyncio.Queue()
+        self._internal_queue = get_queue(QueueName.PRESENCE)
 
         self._roster = Roster()
         self._pending = {}
 
-        self._online_status = {}
+        self._online_status: Dict[str, ResourceTable] = {}
+        self._caps = Caps()
+        self._pep = None
+        if any(
+            p.startswith("http://jabber.org/protocol/pubsub")
+            for p in AppConfig.app_config.plugins
+        ):
+            self._pep = PEP()
 
     async def get_all_pending_presence(self):
-        async with await DB.connection_async() as con:
-            query = select(Model.PendingSubs.c.jid, Model.PendingSubs.c.item)
-            res = await con.execute(query)
-            res = res.fetchall()
+        query = select(Model.PendingSubs.c.jid, Model.PendingSubs.c.item)
+        res = [row for rows in await DB.query_shards(query) for row in rows]
 
         for jid_from, jid_to, item in res:
             if jid_to not in self._pending:
@@ -64,30 +79,22 @@ class Presence(metaclass=Singleton):
         pass
 
     async def delete_pending_presence(self, jid: str):
-        async with await DB.connection_async() as con:
+        async with DB.writer(jid) as con:
             query = delete(Model.PendingSubs).where(Model.PendingSubs.c.jid == jid)
             await con.execute(query)
-            if not AppConfig.app_config.database_in_memory:
-                await con.commit()
 
         self._pending[jid].pop()
 
-    def priority_by_jid(self, jid: JID):
-        try:
-            return self._online_status[jid.bare()]
-        except KeyError:
-            return []
+    def priority_by_jid(self, jid: JID) -> List[Resource]:
+        table = self._online_status.get(jid.bare())
+        return table.resources() if table is not None else []
 
-    def most_priority(
-        self, jid: JID
-    ) -> List[
-        Tuple[str, PresenceType, Union[str, None], Union[str, None], Union[str, None]]
-    ]:
-        priority = self.priority_by_jid(jid)
-
-        values = [item[-1] for item in priority if item[-1] is not None]
-        max_value = max(values) if values else None
-        return [item for item in priority if item[-1] == max_value]
+    def most_priority(self, jid: JID) -> Tuple[Resource, ...]:
+        """
+        :return: The resources that get the messages sent to the bare JID
+        """
+        table = self._online_status.get(jid.bare())
+        return table.top if table is not None else ()
 
     async def put(self, value):
         await self._internal_queue.put(value)
@@ -104,91 +111,110 @@ class Presence(metaclass=Singleton):
             else:
                 return await self._handle_directed_presence(jid, element)
 
-    async def _present_in_online_list(self, jid: JID):
-        if jid.bare() not in self._online_status:
-            return None, None
-
-        present = [
-            (i, p)
-            for i, p in enumerate(self._online_status[jid.bare()])
-            if p[0] == jid.resource
-        ]
-        if present:
-            return present[0]
-        return None, None
-
-    def _handle_lost_connection(self, jid: Union[JID, str], element: Element):
-        if isinstance(jid, JID):
-            if jid.bare() not in self._online_status:
-                return None
+    async def _handle_lost_connection(self, jid: Union[JID, str], element: Element):
+        for transport, stanzas in self.lost_connections([jid]).items():
+            transport.write(b"".join(stanzas))
+
+    def lost_connections(
+        self,
+        jids: Iterable[Union[JID, str]],
+        outbox: Optional[Dict[Transport, List[bytes]]] = None,
+    ) -> Dict[Transport, List[bytes]]:
+        """
+        Drops the lost sessions from the online status, and builds the
+        unavailable presences for the contacts and the other resources of
+        each account. Nothing is written, so the presences of many sessions
+        lost together reach every receiver in a single write
+
+        :param outbox: Presences already pending, extended in place
+        :return: The presences, grouped by the transport of their receiver
+        """
+        outbox = {} if outbox is None else outbox
+        tail = f' type="{PresenceType.UNAVAILABLE.value}" />'.encode()
+
+        # Roster item -> (serialized bare JID, online sessions) of a contact
+        # that must get the presences. The contacts of a batch repeat a lot
+        receivers: Dict[str, Optional[Tuple[bytes, List[Client]]]] = {}
+
+        def send(clients: List[Client], stanza: bytes):
+            for client in clients:
+                if client.transport.is_closing():
+                    continue  # Lost too, or closing
+                outbox.setdefault(client.transport, []).append(stanza)
+
+        for jid in jids:
+            if not isinstance(jid, JID):
+                continue  # TODO: presence for remote server lost
+
+            table = self._online_status.get(jid.bare())
+            if table is None:
+                continue
 
-            index, present = self._present_in_online_list(jid)
-            if present:
-                if (
-                    self._online_status[jid.bare()][index][1]
-                    == PresenceType.UNAVAILABLE
-                ):
-                    self._online_status[jid.bare()].pop(index)
-                    if len(self._online_status[jid.bare()]) == 0:
-                        self._online_status.pop(jid.bare())
-                    return None
+            # The session is gone, so it leaves the routing either way
+            present = table.remove(jid.resource)
+            if not table:
+                self._online_status.pop(jid.bare())
+            if present is None or present.type == PresenceType.UNAVAILABLE:
+                continue
 
+            head = f"<presence from={quoteattr(str(jid))} to=".encode()
             for contact in self._roster.roster_by_jid(jid):
-                item = ET.fromstring(contact.get("item"))
-                if item.attrib.get("subscription") not in ["from", "both"]:
-                    continue
-
-                contact_jid = item.attrib.get("jid")
-
-                if len(contact_jid.split("@")) < 2:
-                    contact_jid = JID(contact_jid + f"@{AppConfig.app_config.host}")
-                else:
-                    contact_jid = JID(contact_jid)
-
-                if contact_jid.bare() in self._online_status:
-                    for user_connected in [
-                        i
-                        for i in self._online_status[contact_jid.bare()]
-                        if i[1] == PresenceType.AVAILABLE
-                    ]:
-                        resource = user_connected[0]
-                        client = self._connections.get_transport(
-                            JID(
-                                user=contact_jid.user,
-                                domain=contact_jid.domain,
-                                resource=resource,
-                            )
-                        )[0]
-
-                        presence = ET.Element(
-                            "presence",
-                            attrib={
-                                "from": str(jid),
-                                "to": client.jid.bare(),
-                                "type": PresenceType.UNAVAILABLE.value,
-                            },
-                        )
-                        client.transport.write(ET.tostring(presence))
-
-            for client in self._connections.get_transport(JID(jid.bare())):
-                presence = ET.Element(
-                    "presence",
-                    attrib={
-                        "from": str(jid),
-                        "to": jid.bare(),
-                        "type": PresenceType.UNAVAILABLE.value,
-                    },
-                )
-                client.transport.write(ET.tostring(presence))
+                item = contact.get("item")
+                if item not in receivers:
+                    receivers[item] = self._subscriber(item)
+                if receivers[item] is not None:
+                    to, clients = receivers[item]
+                    send(clients, head + to + tail)
+
+            send(
+                [
+                    client
+                    for client in self._connections.get_transport_online(
+                        JID(jid.bare())
+                    )
+                    if client.jid.resource != jid.resource
+                ],
+                head + quoteattr(jid.bare()).encode() + tail,
+            )
+
+        return outbox
+
+    def _subscriber(self, item: str) -> Optional[Tuple[bytes, List[Client]]]:
+        """
+        :return: The serialized bare JID and the available sessions of a
+        contact subscribed to the presence, if any
+        """
+        item = ET.fromstring(item)
+        if item.attrib.get("subscription") not in ["from", "both"]:
+            return None
+
+        contact_jid = item.attrib.get("jid")
+
+        if len(contact_jid.split("@")) < 2:
+            contact_jid = JID(contact_jid + f"@{AppConfig.app_config.host}")
         else:
-            pass  # TODO: presence for remote server lost
+            contact_jid = JID(contact_jid)
+
+        contacts = self._online_status.get(contact_jid.bare())
+        if contacts is None:
+            return None
+
+        clients = []
+        for resource, *_ in contacts.available():
+            clients += self._connections.get_transport_online(
+                JID(
+                    user=contact_jid.user,
+                    domain=contact_jid.domain,
+                    resource=resource,
+                )
+            )
+        return quoteattr(contact_jid.bare()).encode(), clients
 
     async def _handle_lost_connection_server(self, host: str, element: Element):
         pass
 
     async def _handle_global_presence(self, jid: JID, element: ET.Element):
-        if jid.bare() not in self._online_status:
-            self._online_status[jid.bare()] = []
+        table = self._online_status.setdefault(jid.bare(), ResourceTable())
 
         show = next(
             (
@@ -206,41 +232,30 @@ class Presence(metaclass=Singleton):
             (c.text for c in element if c.tag == "{jabber:client}priority"), None
         )
 
-        index, present = await self._present_in_online_list(jid)
         if element.attrib.get("type") == PresenceType.UNAVAILABLE.value:
-            if present:
-                self._online_status[jid.bare()][index] = (
+            table.update(
+                Resource(
                     jid.resource,
                     PresenceType.UNAVAILABLE,
                     show,
                     status,
-                    priority,
-                )
-            else:
-                self._online_status[jid.bare()].append(
-                    (jid.resource, PresenceType.UNAVAILABLE, show, status, priority)
+                    parse_priority(priority),
                 )
+            )
 
             self._connections.online(jid, False)
+            self._caps.forget(jid)
         else:
-            if present:
-                previous_status = self._online_status[jid.bare()][index][1]
-                self._online_status[jid.bare()][index] = (
+            previous = table.update(
+                Resource(
                     jid.resource,
                     PresenceType.AVAILABLE,
                     show,
                     status,
-                    priority,
-                )
-                if previous_status == PresenceType.UNAVAILABLE:
-                    await self._connection_queue.put(
-                        NewConnectionWrapper(jid)
-                        # ('CONNECTION', jid)
-                    )
-            else:
-                self._online_status[jid.bare()].append(
-                    (jid.resource, PresenceType.AVAILABLE, show, status, priority)
+                    parse_priority(priority),
                 )
+            )
+            if previous is None or previous.type == PresenceType.UNAVAILABLE:
                 await self._connection_queue.put(
                     NewConnectionWrapper(jid)
                     # ('CONNECTION', jid)
@@ -248,6 +263,10 @@ class Presence(metaclass=Singleton):
 
             self._connections.online(jid)
 
+            namespaces = self._caps.presence(jid, element)
+            if namespaces and self._pep:
+                await self._pep.send_last_items(jid, namespaces)
+
         for contact in self._roster.roster_by_jid(jid):
             item = ET.fromstring(contact.get("item"))
             if item.attrib.get("subscription") not in ["from", "both"]:
@@ -261,12 +280,8 @@ class Presence(metaclass=Singleton):
                 contact_jid = JID(contact_jid)
 
             if contact_jid.bare() in self._online_status:
-                for user_connected in [
-                    i
-                    for i in self._online_status[contact_jid.bare()]
-                    if i[1] == PresenceType.AVAILABLE
-                ]:
-                    resource = user_connected[0]
+                contacts = self._online_status[contact_jid.bare()]
+                for resource, *_ in contacts.available():
                     online = self._connections.get_transport_online(
                         JID(
                             user=contact_jid.user,
@@ -403,6 +418,8 @@ class Presence(metaclass=Singleton):
 
             roster_push_sender = None
             roster_push_receiver = None
+            ver_sender = None
+            ver_receiver = None
 
             item_sender = [  # Sender appears in receiver roster
                 item
@@ -427,7 +444,9 @@ class Presence(metaclass=Singleton):
                         new_item_sender.attrib.pop("ask")
 
                     new_item_sender.attrib["subscription"] = "to"
-                    await self._roster.update_item(new_item_sender, item_id)
+                    ver_sender = await self._roster.update_item(
+                        new_item_sender, item_id
+                    )
 
                     new_item_sender.attrib["jid"] = (
                         new_item_sender.attrib["jid"] + f"@{AppConfig.app_config.host}"
@@ -440,7 +459,9 @@ class Presence(metaclass=Singleton):
                         new_item_sender.attrib.pop("ask")
 
                     new_item_sender.attrib["subscription"] = "both"
-                    await self._roster.update_item(new_item_sender, item_id)
+                    ver_sender = await self._roster.update_item(
+                        new_item_sender, item_id
+                    )
 
                     new_item_sender.attrib["jid"] = (
                         new_item_sender.attrib["jid"] + f"@{AppConfig.app_config.host}"
@@ -458,7 +479,9 @@ class Presence(metaclass=Singleton):
                 if et_item_receiver.attrib.get("subscription") == "none":
                     new_item_receiver = et_item_receiver.__copy__()
                     new_item_receiver.attrib["subscription"] = "from"
-                    await self._roster.update_item(new_item_receiver, item_id)
+                    ver_receiver = await self._roster.update_item(
+                        new_item_receiver, item_id
+                    )
 
                     new_item_receiver.attrib["jid"] = (
                         new_item_receiver.attrib["jid"]
@@ -469,7 +492,9 @@ class Presence(metaclass=Singleton):
                 elif et_item_receiver.attrib["subscription"] == "to":
                     new_item_receiver = et_item_receiver.__copy__()
                     new_item_receiver.attrib["subscription"] = "both"
-                    await self._roster.update_item(new_item_receiver, item_id)
+                    ver_receiver = await self._roster.update_item(
+                        new_item_receiver, item_id
+                    )
 
                     new_item_receiver.attrib["jid"] = (
                         new_item_receiver.attrib["jid"]
@@ -500,6 +525,8 @@ class Presence(metaclass=Singleton):
                     query = ET.SubElement(
                         res, "query", attrib={"xmlns": "jabber:iq:roster"}
                     )
+                    if ver_sender is not None:
+                        query.attrib["ver"] = str(ver_sender)
                     query.append(roster_push_sender)
 
                     sender.transport.write(ET.tostring(res))
@@ -510,6 +537,8 @@ class Presence(metaclass=Singleton):
                     query = ET.SubElement(
                         res, "query", attrib={"xmlns": "jabber:iq:roster"}
                     )
+                    if ver_receiver is not None:
+                        query.attrib["ver"] = str(ver_receiver)
                     query.append(roster_push_receiver)
 
                     receiver.transport.write(ET.tostring(res))
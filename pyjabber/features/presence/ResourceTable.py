@@ -0,0 +1,100 @@
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from pyjabber.features.presence.Enums import PresenceType
+
+PRIORITY_MIN = -128
+PRIORITY_MAX = 127
+
+
+class Resource(NamedTuple):
+    """
+    Last presence of a session of an account
+    """
+
+    resource: str
+    type: PresenceType
+    show: Optional[str]
+    status: Optional[str]
+    priority: int
+
+
+def parse_priority(text: Optional[str]) -> int:
+    """
+    Priority of a presence (RFC 6121, 4.7.2.3). An integer between -128 and
+    127, and 0 when the presence has none or it is not a number
+    """
+    try:
+        return min(max(int(text), PRIORITY_MIN), PRIORITY_MAX)
+    except (TypeError, ValueError):
+        return 0
+
+
+class ResourceTable:
+    """
+    Sessions of an account, by resource.
+
+    The available resources with the highest priority are kept apart, and
+    refreshed only when a presence of the account changes, so a message to
+    the bare JID is routed without going through the sessions. Following
+    RFC 6121 (8.5.2.1.1), a resource with a negative priority never gets
+    those messages, and every resource tied at the highest priority does.
+    """
+
+    __slots__ = ("_resources", "_top")
+
+    def __init__(self):
+        self._resources: Dict[str, Resource] = {}
+        self._top: Tuple[Resource, ...] = ()
+
+    def __len__(self) -> int:
+        return len(self._resources)
+
+    def __contains__(self, resource: str) -> bool:
+        return resource in self._resources
+
+    def get(self, resource: str) -> Optional[Resource]:
+        return self._resources.get(resource)
+
+    def resources(self) -> List[Resource]:
+        return list(self._resources.values())
+
+    def available(self) -> List[Resource]:
+        return [r for r in self._resources.values() if r.type == PresenceType.AVAILABLE]
+
+    @property
+    def top(self) -> Tuple[Resource, ...]:
+        """
+        The available resources with the highest non-negative priority
+        """
+        return self._top
+
+    def update(self, entry: Resource) -> Optional[Resource]:
+        """
+        :return: The previous presence of the resource, if any
+        """
+        previous = self._resources.get(entry.resource)
+        self._resources[entry.resource] = entry
+        self._refresh()
+        return previous
+
+    def remove(self, resource: str) -> Optional[Resource]:
+        """
+        :return: The last presence of the resource, if any
+        """
+        previous = self._resources.pop(resource, None)
+        if previous is not None:
+            self._refresh()
+        return previous
+
+    def _refresh(self):
+        candidates = [
+            r
+            for r in self._resources.values()
+            if r.type == PresenceType.AVAILABLE and r.priority >= 0
+        ]
+        if not candidates:
+            self._top = ()
+            return
+
+        highest = max(r.priority for r in candidates)
+        self._top = tuple(r for r in candidates if r.priority == highest)
@@ -1,8 +1,6 @@
-import re
 from asyncio import Transport
-from ssl import SSLContext
-from typing import List, NamedTuple, Optional, Union
-from xml.etree.ElementTree import Element
+from ssl import SSLObject
+from typing import List, NamedTuple, Optional, Tuple, Union
 
 from loguru import logger
 
@@ -25,18 +23,29 @@ class Client(NamedTuple):
 class Server(NamedTuple):
     host: str
     transport: Transport
+    bidi: bool = False
+    ready: bool = False
 
 
 class ConnectionManager(metaclass=Singleton):
     """
-    A singleton class used as a repository of connections during the protocols' lifecycle.
+    A singleton class used as a repository of connections during the protocols'
+    lifecycle.
 
-    It keeps track of both client and protocols connections using the following data structures:
+    It keeps track of both client and protocols connections using the following
+    data structures:
+
+    Remote domains are served by a single logical link: the outgoing stream
+    dialed to the domain or, with XEP-0288, the bidirectional incoming stream
+    authenticated for it.
     """
 
     def __init__(self) -> None:
         self._peerList: dict[Peer, Client] = {}
+        self._jidIndex: dict[str, dict[Optional[str], Peer]] = {}
+        self._peerIndex: dict[Peer, Tuple[str, Optional[str]]] = {}
         self._remoteList: dict[Peer, Server] = {}
+        self._links: dict[str, Tuple[Peer, bool]] = {}
         self._remoteIncomingList: dict[Peer, Server] = {}
 
         self._orphan_jids: dict[Peer, JID] = {}
@@ -56,6 +65,7 @@ class ConnectionManager(metaclass=Singleton):
         """
         try:
             client = self._peerList.pop(peer)
+            self._unindex_jid(peer)
             client.transport.write("</stream:stream>".encode())
             if client.jid:
                 self._orphan_jids[peer] = client.jid
@@ -64,45 +74,82 @@ class ConnectionManager(metaclass=Singleton):
         except KeyError:
             logger.error(f"{peer} not present in the peer list")
 
+    def disconnection(self, peer: Peer) -> Optional[Client]:
+        """Deletes a connection from the peers list, without writing to its
+        transport. Used when its session moves to another connection
+        """
+        client = self._peerList.pop(peer, None)
+        self._unindex_jid(peer)
+        return client
+
     def online(self, jid: JID, online: bool = True):
-        for peer, client in self._peerList.items():
+        for peer in self._peers_by_jid(jid):
+            client = self._peerList[peer]
             if client.jid == jid and client.online != online:
-                self._peerList[peer] = self._peerList[peer]._replace(online=online)
+                self._peerList[peer] = client._replace(online=online)
+
+    def _index_jid(self, peer: Peer, jid: Optional[JID]) -> None:
+        self._unindex_jid(peer)
+        if jid is None:
+            return
+
+        key = (jid.bare(), jid.resource)
+        self._jidIndex.setdefault(key[0], {})[key[1]] = peer
+        self._peerIndex[peer] = key
+
+    def _unindex_jid(self, peer: Peer) -> None:
+        try:
+            bare, resource = self._peerIndex.pop(peer)
+        except KeyError:
+            return
+
+        resources = self._jidIndex.get(bare)
+        if resources and resources.get(resource) == peer:
+            resources.pop(resource)
+            if not resources:
+                self._jidIndex.pop(bare)
+
+    def _peers_by_jid(self, jid: JID) -> List[Peer]:
+        """
+        Peers bound to the given JID, resolved through the bare JID index
+        instead of scanning the whole peer list
+        """
+        resources = self._jidIndex.get(jid.bare())
+        if not resources:
+            return []
+        if jid.resource:
+            peer = resources.get(jid.resource)
+            return [peer] if peer else []
+        return list(resources.values())
 
     def get_transport(self, jid: JID) -> List[Client]:
         """Get all the available buffers associated with a JID.
 
-            - If the JID is in the full format <username@domain/resource>, it will only return one buffer (or empty list).
-            - If the JID is in the bare format <username@domain>, it will return a list of the buffers for each resource available.
+            - If the JID is in the full format <username@domain/resource>, it will
+              only return one buffer (or empty list).
+            - If the JID is in the bare format <username@domain>, it will return a
+              list of the buffers for each resource available.
 
         Both cases return a list.
         """
-        if jid.resource:
-            return [c for c in self._peerList.values() if jid == c.jid]
-        else:
-            return [
-                c
-                for c in self._peerList.values()
-                if re.match(f"{str(jid)}/*", str(c.jid))
-            ]
+        return [self._peerList[peer] for peer in self._peers_by_jid(jid)]
 
     def get_transport_online(self, jid: JID) -> List[Client]:
         """Get all the available buffers associated with a JID
         that are ready to receive messages (online).
 
-            - If the JID is in the full format <username@domain/resource>, it will only return one buffer (or empty list).
-            - If the JID is in the bare format <username@domain>, it will return a list of the buffers for each resource available.
+            - If the JID is in the full format <username@domain/resource>, it will
+              only return one buffer (or empty list).
+            - If the JID is in the bare format <username@domain>, it will return a
+              list of the buffers for each resource available.
 
         Both cases return a list.
         """
-        if jid.resource:
-            return [c for c in self._peerList.values() if jid == c.jid and c.online]
-        else:
-            return [
-                c
-                for c in self._peerList.values()
-                if re.match(f"{str(jid)}/*", str(c.jid)) and c.online
-            ]
+        return [
+            client
+            for client in map(self._peerList.__getitem__, self._peers_by_jid(jid))
+            if client.online
+        ]
 
     def update_transport_peer(
         self, new_transport: Union[Transport, TransportProxy], peer: Peer
@@ -122,9 +169,7 @@ class ConnectionManager(metaclass=Singleton):
         if jid.resource is None:
             raise ValueError("JID must have a resource to update transport")
 
-        match = next(
-            (peer for peer, client in self._peerList.items() if client.jid == jid), None
-        )
+        match = next(iter(self._peers_by_jid(jid)), None)
         if match:
             self._peerList[match] = self._peerList[match]._replace(
                 transport=new_transport
@@ -143,19 +188,23 @@ class ConnectionManager(metaclass=Singleton):
     def set_jid(self, peer: Peer, jid: JID, transport: Transport = None) -> None:
         """Set/update the jid of a registered connection.
 
-        An optional transport argument can be provided, in order to set/update the stored buffer
+        An optional transport argument can be provided, in order to set/update the
+        stored buffer
         """
         try:
             self._peerList[peer] = self._peerList[peer]._replace(
                 jid=jid,
                 transport=transport if transport else self._peerList[peer].transport,
             )
+            self._index_jid(peer, jid)
         except KeyError:
             raise KeyError(f"Unable to find {peer} during jid/transport update")
 
     def update_resource(self, peer: Peer, resource: str):
         try:
-            self._peerList[peer].jid.resource = resource
+            jid = self._peerList[peer].jid
+            jid.resource = resource
+            self._index_jid(peer, jid)
         except KeyError:
             raise KeyError(f"Unable to find {peer} during resource update")
 
@@ -178,9 +227,61 @@ class ConnectionManager(metaclass=Singleton):
             client.transport.write("</stream:stream>".encode())
             if client.host:
                 self._orphan_hosts[peer] = client.host
+                self._unindex_host(client.host, peer)
         except KeyError:
             logger.error(f"{peer} not present in the remote list")
 
+    def disconnection_server(self, peer: Peer) -> None:
+        """Deletes a lost connection from the remote list, without writing to
+        the (already closed) transport
+        """
+        client = self._remoteList.pop(peer, None)
+        if client and client.host:
+            self._orphan_hosts[peer] = client.host
+            self._unindex_host(client.host, peer)
+
+    def ready_server(self, peer: Peer) -> None:
+        """Called once the negotiation of an outgoing stream is done. From now
+        on, the stream can be used as link with the remote domain
+        """
+        try:
+            host = self._remoteList[peer].host
+        except KeyError:
+            raise KeyError(f"Unable to find {peer} during stream ready")
+
+        self._remoteList[peer] = self._remoteList[peer]._replace(ready=True)
+        if host:
+            self._link(host, peer, False)
+
+    def _index_host(self, host: str, peer: Peer) -> None:
+        old_host = self._remoteList[peer].host
+        if old_host != host and self._links.get(old_host) == (peer, False):
+            self._unindex_host(old_host, peer)
+            if host:
+                self._link(host, peer, False)
+
+    def _unindex_host(self, host: str, peer: Peer, incoming: bool = False) -> None:
+        if self._links.get(host) != (peer, incoming):
+            return
+
+        self._links.pop(host)
+
+        # Fall back to another live stream with the domain, if any
+        for other, server in self._remoteList.items():
+            if other != peer and server.host == host and server.ready:
+                self._links[host] = (other, False)
+                return
+        for other, server in self._remoteIncomingList.items():
+            if other != peer and server.host == host and server.bidi:
+                self._links[host] = (other, True)
+                return
+
+    def _link(self, host: str, peer: Peer, incoming: bool) -> None:
+        """The first stream established with a domain becomes its link.
+        Later streams only take over once the link is lost
+        """
+        self._links.setdefault(host, (peer, incoming))
+
     def get_host(self, peer: Peer) -> Union[str, None]:
         try:
             return self._remoteList[peer].host
@@ -190,9 +291,11 @@ class ConnectionManager(metaclass=Singleton):
     def set_host(self, peer: Peer, host: str, transport: Transport = None) -> None:
         """Set/update the host of a registered server connection.
 
-        An optional transport argument can be provided, in order to set/update the stored buffer
+        An optional transport argument can be provided, in order to set/update the
+        stored buffer
         """
         try:
+            self._index_host(host, peer)
             self._remoteList[peer] = self._remoteList[peer]._replace(
                 host=host,
                 transport=transport if transport else self._remoteList[peer].transport,
@@ -202,10 +305,12 @@ class ConnectionManager(metaclass=Singleton):
 
     def update_host(self, peer: Peer, host: str) -> None:
         try:
+            self._index_host(host, peer)
             self._remoteList[peer] = self._remoteList[peer]._replace(host=host)
         except KeyError:
             logger.warning(
-                "Unable to find protocols with given peer during host update. Check this inconsistency"
+                "Unable to find protocols with given peer during host update. "
+                "Check this inconsistency"
             )
 
     def get_server_transport_peer(
@@ -217,9 +322,29 @@ class ConnectionManager(metaclass=Singleton):
             return None
 
     def get_server_transport_host(self, host: str = None) -> Union[Transport, None]:
-        return next(
-            (s.transport for s in self._remoteList.values() if s.host == host), None
-        )
+        """Transport of the link used to send stanzas to a remote domain. It can
+        be an outgoing stream or a bidirectional incoming one
+        """
+        try:
+            peer, incoming = self._links[host]
+            if incoming:
+                return self._remoteIncomingList[peer].transport
+            return self._remoteList[peer].transport
+        except KeyError:
+            return None
+
+    def set_bidi_server(self, peer: Peer) -> None:
+        """Mark an outgoing stream as bidirectional (XEP-0288). The remote
+        domain may send its stanzas through it
+        """
+        try:
+            self._remoteList[peer] = self._remoteList[peer]._replace(bidi=True)
+        except KeyError:
+            raise KeyError(f"Unable to find {peer} during bidi update")
+
+    def is_bidi_server(self, peer: Peer) -> bool:
+        server = self._remoteList.get(peer)
+        return server is not None and server.bidi
 
     def update_transport_server(self, new_transport: Transport, peer: Peer):
         try:
@@ -239,15 +364,16 @@ class ConnectionManager(metaclass=Singleton):
 
     def set_host_server(self, peer: Peer, host: str):
         try:
+            self._index_host(host, peer)
             self._remoteList[peer] = self._remoteList[peer]._replace(host=host)
         except KeyError:
             raise KeyError(f"Unable to find {peer} during host update")
 
-    def get_connection_ssl_certificate(self, peer: Peer) -> Union[SSLContext, None]:
-        try:
-            self._remoteList.get(peer).transport.get_extra_info("ssl_object")
-        except KeyError:
+    def get_connection_ssl_certificate(self, peer: Peer) -> Union[SSLObject, None]:
+        server = self._remoteIncomingList.get(peer) or self._remoteList.get(peer)
+        if server is None or server.transport is None:
             return None
+        return server.transport.get_extra_info("ssl_object")
 
     ###########################################################################
     ############################# REMOTE SERVER ###############################
@@ -259,19 +385,62 @@ class ConnectionManager(metaclass=Singleton):
         if peer not in self._remoteIncomingList:
             self._remoteIncomingList[peer] = Server(host, transport)
 
+    def get_server_incoming_host(self, peer: Peer) -> Union[str, None]:
+        """Domain authenticated on an incoming server stream (None until the
+        SASL negotiation succeeds)
+        """
+        try:
+            return self._remoteIncomingList[peer].host
+        except KeyError:
+            return None
+
+    def set_host_incoming(self, peer: Peer, host: str, bidi: bool = False) -> None:
+        """Register the domain authenticated on an incoming stream. A
+        bidirectional stream (XEP-0288) becomes a link to send stanzas to the
+        domain as well
+        """
+        try:
+            self._remoteIncomingList[peer] = self._remoteIncomingList[peer]._replace(
+                host=host, bidi=bidi
+            )
+        except KeyError:
+            raise KeyError(f"Unable to find {peer} during incoming host update")
+
+        if bidi:
+            self._link(host, peer, True)
+
+    def is_bidi_server_incoming(self, peer: Peer) -> bool:
+        server = self._remoteIncomingList.get(peer)
+        return server is not None and server.bidi
+
+    def update_transport_server_incoming(self, new_transport: Transport, peer: Peer):
+        try:
+            self._remoteIncomingList[peer] = self._remoteIncomingList[peer]._replace(
+                transport=new_transport
+            )
+        except KeyError:
+            logger.warning(
+                "Unable to find incoming protocols with given peer. "
+                "Check this inconsistency"
+            )
+
+    def disconnection_server_incoming(self, peer: Peer) -> None:
+        """Deletes a lost connection from the remote incoming list, without
+        writing to the (already closed) transport
+        """
+        client = self._remoteIncomingList.pop(peer, None)
+        if client and client.host:
+            self._unindex_host(client.host, peer, True)
+
     def close_server_incoming(self, peer: Peer) -> None:
         """Closes a connection by sending a '</stream:stream> message' and
         deletes it from the remote incoming list
         """
         try:
             client = self._remoteIncomingList.pop(peer)
-            client.transport.write("</stream:stream>".encode())
-
             if client.host:
-                self._presence_manager.put_nowait(
-                    (client.host, Element("presence", attrib={"type": "INTERNAL"}))
-                )
-
+                self._unindex_host(client.host, peer, True)
+            client.transport.write("</stream:stream>".encode())
             client.transport.close()
         except KeyError:
             logger.error(f"{peer} not present in the remote incoming list")
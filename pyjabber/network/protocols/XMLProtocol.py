@@ -13,6 +13,8 @@ from pyjabber.network.ConnectionManager import ConnectionManager
 from pyjabber.network.parsers.XMLParser import XMLParser
 from pyjabber.network.StreamAlivenessMonitor import StreamAlivenessMonitor
 from pyjabber.network.utils.TransportProxy import TransportProxy
+from pyjabber.plugins.xep_0115.xep_0115 import Caps
+from pyjabber.plugins.xep_0198.xep_0198 import StreamManagement
 from pyjabber.stream.handlers.ServerStanzaHandler import ServerStanzaHandler
 from pyjabber.stream.handlers.StanzaHandler import InternalServerError
 from pyjabber.stream.negotiators.ServerIncomingStreamNegotiator import (
@@ -35,6 +37,8 @@ class XMLProtocol(asyncio.Protocol):
         "_cert_path",
         "_connection_manager",
         "_presence_manager",
+        "_caps",
+        "_stream_management",
         "_tls_queue",
         "_transport",
         "_peer",
@@ -56,6 +60,8 @@ class XMLProtocol(asyncio.Protocol):
 
         self._connection_manager = ConnectionManager()
         self._presence_manager = Presence()
+        self._caps = Caps()
+        self._stream_management = StreamManagement()
 
         self._transport: Union[Transport, TransportProxy, None] = None
         self._peer = None
@@ -133,20 +139,22 @@ class XMLProtocol(asyncio.Protocol):
 
         logger.info(f"Connection lost <{self._peer}>: Reason {exc or ''}")
 
+        transport = self._transport
         self._transport = None
         self._xml_parser.getContentHandler().cancel_queue_bridge()
         self._xml_parser = None
         self._timeout_monitor.cancel()
 
         if self._server_incoming:
-            host = self._connection_manager.get_host(self._peer)
-            self._presence_manager.put_nowait(
-                (host, Element("presence", attrib={"type": "INTERNAL"}))
-            )
-            # self._connection_manager.close_server_incoming(self._peer)
+            self._connection_manager.disconnection_server_incoming(self._peer)
         else:
             jid = self._connection_manager.get_jid(self._peer)
-            if jid and jid.user and jid.domain:
+            if jid is None:  # Stream closed, the session ends
+                self._stream_management.drop(transport)
+            elif self._stream_management.detach(transport):
+                logger.info(f"Session of {jid} kept for a resumption")
+            elif jid.user and jid.domain:
+                self._caps.forget(jid)
                 self._presence_manager.put_nowait(
                     (jid, Element("presence", attrib={"type": "INTERNAL"}))
                 )
@@ -9,6 +9,8 @@ from pyjabber.plugins.roster.Roster import Roster
 from pyjabber.plugins.xep_0009.xep_0009 import RPC
 from pyjabber.plugins.xep_0030.xep_0030 import Disco
 from pyjabber.plugins.xep_0060.xep_0060 import PubSub
+from pyjabber.plugins.xep_0115.xep_0115 import Caps
+from pyjabber.plugins.xep_0163.xep_0163 import PEP
 from pyjabber.plugins.xep_0199.xep_0199 import Ping
 from pyjabber.plugins.xep_0363.xep_0363 import HTTPFieldUpload
 from pyjabber.stanzas.error import StanzaError as SE
@@ -17,10 +19,12 @@ from pyjabber.utils import ClarkNotation as CN
 
 
 class PluginManager:
-    __slots__ = ("_jid", "_plugins")
+    __slots__ = ("_jid", "_plugins", "_caps", "_pep")
 
     def __init__(self, jid: JID) -> None:
         self._jid = jid
+        self._caps = Caps()
+        self._pep = None
 
         self._plugins: Dict[str, object] = {
             "jabber:iq:roster": Roster(),
@@ -39,8 +43,18 @@ class PluginManager:
             for p in AppConfig.app_config.plugins
         ):
             self._plugins["http://jabber.org/protocol/pubsub*"] = PubSub()
+            self._pep = PEP()
 
     async def feed(self, element: ET.Element):
+        if element.attrib.get("type") in ("result", "error"):
+            # Answer to the caps query of the server
+            learned = await self._caps.response(self._jid, element)
+            if learned is not None:
+                if self._pep:
+                    for jid, namespaces in learned:
+                        await self._pep.send_last_items(jid, namespaces)
+                return None
+
         try:
             child = element[0]
         except IndexError:
@@ -55,6 +69,8 @@ class PluginManager:
             ns = list(
                 filter(lambda regex: re.search(regex, ns), list(self._plugins.keys()))
             )[-1]
+            if ns == "http://jabber.org/protocol/pubsub*" and PEP.addressed(element):
+                return await self._pep.feed(self._jid, element)
             return await self._plugins[ns].feed(self._jid, element)
         except (KeyError, IndexError):
             return SE.feature_not_implemented(tag, ns)
@@ -1,6 +1,9 @@
 import xml.etree.ElementTree as ET
+from typing import Dict, List, Optional, Tuple
 
 from sqlalchemy import and_, delete, insert, select, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import AsyncConnection
 
 from pyjabber import AppConfig
 from pyjabber.db.database import DB
@@ -8,9 +11,12 @@ from pyjabber.db.model import Model
 from pyjabber.stanzas.error import StanzaError as SE
 from pyjabber.stanzas.IQ import IQ
 from pyjabber.stream.JID import JID
+from pyjabber.utils import Singleton
 
+CHANGELOG_SIZE = 50  # Roster changes kept per user, to answer with a delta
 
-class Roster:
+
+class Roster(metaclass=Singleton):
     """
     Roster plugin.
 
@@ -20,9 +26,18 @@ class Roster:
     and subscription requests.
     It enables real-time presence updates, contact organization, and synchronization across devices,
     ensuring seamless and private communication.
+
+    Rosters are versioned (XEP-0237): every change bumps the version of the
+    roster and is logged, keeping the last CHANGELOG_SIZE ones. A client that
+    asks with the current version gets an empty result, and one a few
+    changes behind only gets the pushes of the changes it missed.
+
+    The rosters are loaded in memory on first use, and then follow the changes
+    made through the plugin. The ones written elsewhere (bulk imports, account
+    deletion) are applied with add_in_memory and forget.
     """
 
-    __slots__ = ("_handlers", "_roster_in_memory", "_initial_update")
+    __slots__ = ("_handlers", "_roster_in_memory", "_items_by_id", "_initial_update")
 
     def __init__(self) -> None:
         self._handlers = {
@@ -31,29 +46,40 @@ class Roster:
             "result": self.handle_result,
         }
 
-        self._roster_in_memory = {}
+        self._roster_in_memory: Dict[str, List[dict]] = {}
+        # Row key -> (user, entry of its roster in memory)
+        self._items_by_id: Dict[int, Tuple[str, dict]] = {}
         self._initial_update = False
 
     async def feed(self, jid: JID, element: ET.Element):
-        if not self._initial_update:
-            await self._update_roster()
         if len(element) != 1:
             return SE.invalid_xml()
 
         return await self._handlers[element.attrib.get("type")](jid, element)
 
     async def handle_get(self, jid: JID, element: ET.Element):
-        if jid.domain == AppConfig.app_config.host:
-            jid = jid.user
-        else:
-            jid = jid.bare()
+        user = jid.user if jid.domain == AppConfig.app_config.host else jid.bare()
 
-        roster = self._roster_in_memory.get(jid)
+        request = element.find("{jabber:iq:roster}query")
+        ver = request.attrib.get("ver") if request is not None else None
 
         iq = IQ(type_=IQ.TYPE.RESULT, id_=element.attrib.get("id"))
+
+        if ver is not None:
+            version, changes = await self._changes(user, ver)
+            if changes is not None:
+                return ET.tostring(iq) + b"".join(
+                    self._push(jid, version, item) for version, item in changes
+                )
+
+        if not self._initial_update:
+            await self._update_roster()
+
         query = ET.SubElement(iq, "{jabber:iq:roster}query")
+        if ver is not None:
+            query.attrib["ver"] = str(version)
 
-        for item in roster or []:
+        for item in self._roster_in_memory.get(user) or []:
             query.append(ET.fromstring(item.get("item")))
 
         return ET.tostring(iq)
@@ -69,67 +95,51 @@ class Roster:
         if len(new_item) != 1:
             return SE.invalid_xml()
 
-        new_item = new_item[0]
-
-        roster = self._roster_in_memory.get(jid)
-        if roster:
-            match_item = [
-                i
-                for i in roster
-                if ET.fromstring(i.get("item")).get("jid") == new_item.attrib.get("jid")
-            ]
-            if match_item:  # UPDATE EXISTING ENTRY
-                match_item = match_item[0]
-                if new_item.attrib.get("remove") == "remove":  # DELETE ENTRY
-                    async with await DB.connection_async() as con:
-                        query = delete(Model.Roster).where(
-                            and_(
-                                Model.Roster.c.jid == jid,
-                                Model.Roster.c.roster_item
-                                == ET.tostring(match_item.get("item")).decode(),
-                            )
-                        )
-                        await con.execute(query)
-                        if not AppConfig.app_config.database_in_memory:
-                            await con.commit()
-
-                else:  # UPDATE FIELDS OF ENTRY
-                    async with await DB.connection_async() as con:
-                        query = (
-                            update(Model.Roster)
-                            .where(
-                                and_(
-                                    Model.Roster.c.jid == jid,
-                                    Model.Roster.c.roster_item
-                                    == match_item.get("item"),
-                                )
-                            )
-                            .values({"roster_item": ET.tostring(new_item).decode()})
-                        )
-                        await con.execute(query)
-                        if not AppConfig.app_config.database_in_memory:
-                            await con.commit()
-
-            else:  # CREATE NEW ENTRY
-                if new_item.attrib.get("remove") != "remove":
-                    async with await DB.connection_async() as con:
-                        query = insert(Model.Roster).values(
-                            {"jid": jid, "roster_item": ET.tostring(new_item).decode()}
-                        )
-                        await con.execute(query)
-                        if not AppConfig.app_config.database_in_memory:
-                            await con.commit()
+        if not self._initial_update:
+            await self._update_roster()
 
-        else:
-            async with await DB.connection_async() as con:
-                query = insert(Model.Roster).values(
-                    {"jid": jid, "roster_item": ET.tostring(new_item).decode()}
+        new_item = new_item[0]
+        remove = new_item.attrib.get("subscription") == "remove"  # RFC 6121 2.5
+
+        roster = self._roster_in_memory.get(jid) or []
+        match_item = [
+            i
+            for i in roster
+            if ET.fromstring(i.get("item")).get("jid") == new_item.attrib.get("jid")
+        ]
+        if match_item:  # UPDATE EXISTING ENTRY
+            where = and_(
+                Model.Roster.c.jid == jid,
+                Model.Roster.c.roster_item == match_item[0].get("item"),
+            )
+            if remove:  # DELETE ENTRY
+                removed = ET.Element(
+                    "{jabber:iq:roster}item",
+                    attrib={
+                        "jid": new_item.attrib.get("jid"),
+                        "subscription": "remove",
+                    },
                 )
-                await con.execute(query)
-                if not AppConfig.app_config.database_in_memory:
-                    await con.commit()
+                async with DB.writer(jid) as con:
+                    version = await self.delete_items(
+                        con, where, ET.tostring(removed).decode()
+                    )
+                if version is not None:
+                    self._remove_in_memory(jid, match_item[0])
+
+            else:  # UPDATE FIELDS OF ENTRY
+                item = ET.tostring(new_item).decode()
+                async with DB.writer(jid) as con:
+                    version = await self.update_items(con, where, item)
+                if version is not None:
+                    match_item[0].update(self._entry(match_item[0]["id"], item))
+
+        elif not remove:  # CREATE NEW ENTRY
+            item = ET.tostring(new_item).decode()
+            async with DB.writer(jid) as con:
+                _, ids = await self.insert_items(con, jid, [item])
+            self.add_in_memory(jid, DB.shard_of(jid), ids, [item])
 
-        await self._update_roster()
         res = IQ(id_=element.attrib.get("id"), type_=IQ.TYPE.RESULT)
         return ET.tostring(res)
 
@@ -157,40 +167,244 @@ class Roster:
 
     @staticmethod
     async def store_pending_sub(to_: str, item: ET.Element) -> None:
-        async with await DB.connection_async() as con:
+        async with DB.writer(to_) as con:
             query = insert(Model.PendingSubs).values(
                 {"jid": to_, "item": ET.tostring(item).decode()}
             )
             await con.execute(query)
-            if not AppConfig.app_config.database_in_memory:
-                await con.commit()
 
-    async def update_item(self, item: ET.Element, id_: int):
-        async with await DB.connection_async() as con:
-            query = (
+    async def contacts(self, jid: JID, subscriptions: Tuple[str, ...]) -> List[str]:
+        """
+        Bare JIDs of the contacts of a local user with one of the given
+        subscription states, from the rosters in memory
+        """
+        if not self._initial_update:
+            await self._update_roster()
+
+        return [
+            entry["contact"]
+            for entry in self._roster_in_memory.get(jid.user) or []
+            if entry["subscription"] in subscriptions
+        ]
+
+    async def update_item(self, item: ET.Element, id_: int) -> Optional[int]:
+        """
+        :return: The new version of the roster. None if the item is gone
+        """
+        key = id_
+        item = ET.tostring(item).decode()
+        shard, id_ = DB.split_row_key(key)
+        async with DB.writer(shard=shard) as con:
+            version = await self.update_items(con, Model.Roster.c.id == id_, item)
+
+        if key in self._items_by_id:
+            user, entry = self._items_by_id[key]
+            if version is None:
+                self._remove_in_memory(user, entry)
+            else:
+                entry.update(self._entry(key, item))
+        return version
+
+    def add_in_memory(self, jid: str, shard: int, ids: List[int], items: List[str]):
+        """
+        Adds the items inserted in a roster to its copy in memory
+        :param ids: Ids of the rows, in the given shard
+        """
+        if not self._initial_update:  # They come with the first load
+            return
+        roster = self._roster_in_memory.setdefault(jid, [])
+        for id_, item in zip(ids, items):
+            entry = self._entry(DB.row_key(shard, id_), item)
+            roster.append(entry)
+            self._items_by_id[entry["id"]] = (jid, entry)
+
+    def forget(self, jid: str):
+        """
+        Drops the roster in memory of a deleted user
+        """
+        for entry in self._roster_in_memory.pop(jid, []):
+            self._items_by_id.pop(entry["id"], None)
+
+    @staticmethod
+    def _entry(key: int, item: str) -> dict:
+        """
+        Item of a roster in memory, with the bare JID and subscription of the
+        contact at hand
+        """
+        attrib = ET.fromstring(item).attrib
+        contact = attrib.get("jid") or ""
+        if "@" not in contact:
+            contact = f"{contact}@{AppConfig.app_config.host}"
+        return {
+            "id": key,
+            "item": item,
+            "contact": contact,
+            "subscription": attrib.get("subscription"),
+        }
+
+    def _remove_in_memory(self, jid: str, entry: dict):
+        self._roster_in_memory[jid].remove(entry)
+        self._items_by_id.pop(entry["id"], None)
+
+    # Every change of a roster goes through these, in the transaction of the
+    # caller, so the version and the change log never miss one
+
+    @staticmethod
+    async def insert_items(
+        con: AsyncConnection, jid: str, items: List[str]
+    ) -> Tuple[int, List[int]]:
+        """
+        Adds the items to the roster of the user
+
+        :return: The new version of the roster, and the ids of the items
+        """
+        res = await con.execute(
+            insert(Model.Roster).returning(
+                Model.Roster.c.id, sort_by_parameter_order=True
+            ),
+            [{"jid": jid, "roster_item": i} for i in items],
+        )
+        ids = list(res.scalars())
+        return await Roster._bump(con, jid, items), ids
+
+    @staticmethod
+    async def update_items(con: AsyncConnection, where, item: str) -> Optional[int]:
+        """
+        Replaces the items of a roster that match the clause
+
+        :return: The new version of the roster. None if no item matched
+        """
+        jid = (
+            await con.execute(
                 update(Model.Roster)
-                .where(Model.Roster.c.id == id_)
-                .values({"roster_item": ET.tostring(item).decode()})
+                .where(where)
+                .values({"roster_item": item})
+                .returning(Model.Roster.c.jid)
             )
-            await con.execute(query)
-            if not AppConfig.app_config.database_in_memory:
-                await con.commit()
+        ).scalar()
+        return await Roster._bump(con, jid, [item]) if jid is not None else None
 
-        await self._update_roster()
+    @staticmethod
+    async def delete_items(con: AsyncConnection, where, item: str) -> Optional[int]:
+        """
+        Deletes the items of a roster that match the clause. The change is
+        logged as the given item, with subscription="remove"
+
+        :return: The new version of the roster. None if no item matched
+        """
+        jid = (
+            await con.execute(
+                delete(Model.Roster).where(where).returning(Model.Roster.c.jid)
+            )
+        ).scalar()
+        return await Roster._bump(con, jid, [item]) if jid is not None else None
 
-    async def _update_roster(self):
-        async with await DB.connection_async() as con:
-            query = select(
-                Model.Roster.c.id, Model.Roster.c.jid, Model.Roster.c.roster_item
+    @staticmethod
+    async def _bump(con: AsyncConnection, jid: str, items: List[str]) -> int:
+        """
+        Bumps the version of the roster once per changed item, and logs them
+
+        :return: The new version
+        """
+        version = (
+            await con.execute(
+                sqlite_insert(Model.RosterVersions)
+                .values(jid=jid, version=len(items))
+                .on_conflict_do_update(
+                    index_elements=[Model.RosterVersions.c.jid],
+                    set_={"version": Model.RosterVersions.c.version + len(items)},
+                )
+                .returning(Model.RosterVersions.c.version)
             )
-            res = await con.execute(query)
-            res = res.fetchall()
+        ).scalar()
+
+        first = version - len(items) + 1
+        await con.execute(
+            insert(Model.RosterChanges),
+            [
+                {"jid": jid, "version": first + i, "item": item}
+                for i, item in enumerate(items)
+            ],
+        )
+        await con.execute(
+            delete(Model.RosterChanges).where(
+                and_(
+                    Model.RosterChanges.c.jid == jid,
+                    Model.RosterChanges.c.version <= version - CHANGELOG_SIZE,
+                )
+            )
+        )
+        return version
+
+    @staticmethod
+    async def _changes(
+        jid: str, ver: str
+    ) -> Tuple[int, Optional[List[Tuple[int, str]]]]:
+        """
+        The changes of the roster after the version of the client
+
+        :return: (current version, [(version, item), ...]). The changes are
+        None if the version is unknown or too old for the log, and the client
+        needs the whole roster
+        """
+        async with DB.reader(jid) as con:
+            res = await con.execute(
+                select(Model.RosterVersions.c.version).where(
+                    Model.RosterVersions.c.jid == jid
+                )
+            )
+            version = res.scalar() or 0
+
+            if not ver.isdigit():
+                return version, None
+            ver = int(ver)
+            if ver > version or ver < version - CHANGELOG_SIZE:
+                return version, None
+            if ver == version:
+                return version, []
+
+            res = await con.execute(
+                select(Model.RosterChanges.c.version, Model.RosterChanges.c.item)
+                .where(
+                    and_(
+                        Model.RosterChanges.c.jid == jid,
+                        Model.RosterChanges.c.version > ver,
+                    )
+                )
+                .order_by(Model.RosterChanges.c.version)
+            )
+            changes = res.fetchall()
+
+        # A gap in the log, the client gets the whole roster
+        if len(changes) != version - ver:
+            return version, None
+        return version, changes
+
+    @staticmethod
+    def _push(jid: JID, version: int, item: str) -> bytes:
+        push = IQ(type_=IQ.TYPE.SET, to=str(jid))
+        query = ET.SubElement(
+            push, "{jabber:iq:roster}query", attrib={"ver": str(version)}
+        )
+        query.append(ET.fromstring(item))
+        return ET.tostring(push)
+
+    async def _update_roster(self):
+        query = select(
+            Model.Roster.c.id, Model.Roster.c.jid, Model.Roster.c.roster_item
+        )
+        shards = await DB.query_shards(query)
 
         self._roster_in_memory.clear()
-        for id_, jid, item in res:
-            if jid not in self._roster_in_memory:
-                self._roster_in_memory[jid] = []
-            self._roster_in_memory[jid].append({"id": id_, "item": item})
+        self._items_by_id.clear()
+        for shard, res in enumerate(shards):
+            for id_, jid, item in res:
+                if jid not in self._roster_in_memory:
+                    self._roster_in_memory[jid] = []
+                entry = self._entry(DB.row_key(shard, id_), item)
+                self._roster_in_memory[jid].append(entry)
+                self._items_by_id[entry["id"]] = (jid, entry)
+        self._initial_update = True
 
     def roster_by_jid(self, jid: JID):
         if jid.domain == AppConfig.app_config.host:
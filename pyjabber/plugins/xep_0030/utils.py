@@ -1,5 +1,7 @@
-from typing import Literal
+from typing import Literal, Optional
+from uuid import uuid4
 from xml.etree import ElementTree as ET
+from xml.sax.saxutils import escape
 
 from pyjabber import AppConfig
 from pyjabber.stanzas.IQ import IQ
@@ -17,8 +19,30 @@ def iq_skeleton(element: ET.Element, disco_type: Literal["info", "items"]):
     )
 
 
-def server_info(element: ET.Element):
-    iq_res, query = iq_skeleton(element, "info")
+def result(element: ET.Element, query: bytes) -> bytes:
+    """
+    Result IQ of a disco request, around an already serialized query. Only
+    the addressing of the request is written for each response
+    """
+    attrib = (
+        ("id", element.get("id") or str(uuid4())),
+        ("from", element.get("to")),
+        ("to", element.get("from")),
+        ("type", IQ.TYPE.RESULT.value),
+    )
+    head = "".join(
+        f' {k}="{escape(v, {chr(34): "&quot;"})}"' for k, v in attrib if v is not None
+    )
+    return b"<iq" + head.encode() + b">" + query + b"</iq>"
+
+
+def server_info_query(node: Optional[str] = None) -> ET.Element:
+    query = ET.Element("{http://jabber.org/protocol/disco#info}query")
+
+    # The caps node#ver of the server gets the same info
+    if node:
+        query.attrib["node"] = node
+
     ET.SubElement(
         query,
         "{http://jabber.org/protocol/disco#info}identity",
@@ -32,11 +56,11 @@ def server_info(element: ET.Element):
             attrib={"var": feature},
         )
 
-    return ET.tostring(iq_res)
+    return query
 
 
-def server_items(element: ET.Element):
-    iq_res, query = iq_skeleton(element, "items")
+def server_items_query() -> ET.Element:
+    query = ET.Element("{http://jabber.org/protocol/disco#items}query")
     ET.SubElement(
         query,
         "{http://jabber.org/protocol/disco#items}identity",
@@ -51,4 +75,14 @@ def server_items(element: ET.Element):
             attrib={"jid": jid, "name": info["name"]},
         )
 
-    return ET.tostring(iq_res)
+    return query
+
+
+def server_info(element: ET.Element):
+    request = element.find("{http://jabber.org/protocol/disco#info}query")
+    node = request.attrib.get("node") if request is not None else None
+    return result(element, ET.tostring(server_info_query(node)))
+
+
+def server_items(element: ET.Element):
+    return result(element, ET.tostring(server_items_query()))
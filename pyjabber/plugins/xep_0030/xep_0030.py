@@ -1,17 +1,38 @@
-from typing import Callable, Dict
+from typing import Callable, Dict, Optional, Tuple
 from xml.etree import ElementTree as ET
 
 from pyjabber import AppConfig
 from pyjabber.plugins.xep_0004.field import FieldRequest, FieldTypes
 from pyjabber.plugins.xep_0004.xep_0004 import FormType, generate_form
-from pyjabber.plugins.xep_0030.utils import iq_skeleton, server_info, server_items
-from pyjabber.plugins.xep_0060.xep_0060 import NodeAttrib, PubSub
+from pyjabber.plugins.xep_0030.utils import (
+    result,
+    server_info_query,
+    server_items_query,
+)
+from pyjabber.plugins.xep_0060.xep_0060 import PubSub
+from pyjabber.plugins.xep_0163.xep_0163 import PEP
 from pyjabber.stanzas.error import StanzaError as SE
 from pyjabber.stream.JID import JID
 from pyjabber.utils import Singleton
 
+CACHE_SIZE = 1024  # Serialized responses kept for each kind of entity
+
+# (query type, target, node) of a response. Every account gets the same info,
+# and the server answers the rest of the targets
+Key = Tuple[str, Optional[str], Optional[str]]
+ACCOUNT = "account"
+
 
 class Disco(metaclass=Singleton):
+    """
+    Service Discovery (XEP-0030).
+
+    The responses only change with the configuration, or with the nodes of the
+    pubsub service, so the query of each one is serialized once and kept. A
+    request only adds its own id and addresses around it. The pubsub
+    responses are dropped when a node is created or deleted.
+    """
+
     __slots__ = (
         "_handlers",
         "_config_path",
@@ -19,6 +40,9 @@ class Disco(metaclass=Singleton):
         "_pubsub_jid",
         "_0363_jid",
         "_0363_max_size",
+        "_responses",
+        "_pubsub_responses",
+        "_pubsub_revision",
     )
 
     def __init__(self):
@@ -28,6 +52,10 @@ class Disco(metaclass=Singleton):
         }
         self._config_path: str = AppConfig.app_config.config_path
 
+        self._pubsub = None
+        self._pubsub_jid = None
+        self._0363_jid = None
+
         if "http://jabber.org/protocol/pubsub" in AppConfig.app_config.plugins:
             self._pubsub_jid = next(
                 (s for s in AppConfig.app_config.items if "pubsub" in s), None
@@ -44,6 +72,10 @@ class Disco(metaclass=Singleton):
             ]
             self._0363_jid = self._0363_jid.replace("$", AppConfig.app_config.host)
 
+        self._responses: Dict[Key, bytes] = {}
+        self._pubsub_responses: Dict[Key, bytes] = {}
+        self._pubsub_revision: Optional[int] = None
+
     async def feed(self, jid: JID, element: ET.Element):
         if len(element) != 1:
             return SE.invalid_xml()
@@ -57,96 +89,173 @@ class Disco(metaclass=Singleton):
         else:
             return SE.bad_request()
 
+    def _respond(
+        self,
+        element: ET.Element,
+        responses: Dict[Key, bytes],
+        key: Key,
+        build: Callable[[], ET.Element],
+    ) -> bytes:
+        """
+        Result of the request, with the kept query of the key. The query is
+        built and serialized the first time
+        """
+        query = responses.get(key)
+        if query is None:
+            query = ET.tostring(build())
+            if len(responses) < CACHE_SIZE:
+                responses[key] = query
+        return result(element, query)
+
+    def _pubsub_cache(self) -> Dict[Key, bytes]:
+        """
+        The kept pubsub responses, dropped if the nodes changed since
+        """
+        if self._pubsub_revision != self._pubsub.revision:
+            self._pubsub_responses.clear()
+            self._pubsub_revision = self._pubsub.revision
+        return self._pubsub_responses
+
     async def handle_info(self, _, element: ET.Element):
         to = element.attrib.get("to")
+        query = element.find("{http://jabber.org/protocol/disco#info}query")
+        node = query.attrib.get("node")
 
         # Pubsub info
         if self._pubsub_jid and to == self._pubsub_jid:
-            iq_res, query_res = iq_skeleton(element, "info")
-            query = element.find("{http://jabber.org/protocol/disco#info}query")
-            node = query.attrib.get("node")
+            if node and self._pubsub.discover_info(node) is None:
+                return SE.item_not_found()
+
+            return self._respond(
+                element,
+                self._pubsub_cache(),
+                ("info", to, node),
+                lambda: self._pubsub_info(node),
+            )
 
-            if node:
-                info = self._pubsub.discover_info(node)
+        # Account info, with its PEP service
+        elif self._pubsub_jid and to and "@" in to and PEP.addressed(element):
+            return self._respond(
+                element, self._responses, ("info", ACCOUNT, None), self._account_info
+            )
 
-                ET.SubElement(
-                    query_res,
-                    "{http://jabber.org/protocol/disco#info}identity",
-                    attrib={"category": "pubsub", "type": info[-1]},
-                )
-                return ET.tostring(iq_res)
+        # XEP 0363 (HTTP File Upload) info
+        elif self._0363_jid and to == self._0363_jid:
+            return self._respond(
+                element, self._responses, ("info", to, None), self._upload_info
+            )
 
-            ET.SubElement(
-                query_res,
-                "{http://jabber.org/protocol/disco#info}identity",
-                attrib={"category": "pubsub", "type": "service"},
+        else:
+            return self._respond(
+                element,
+                self._responses,
+                ("info", None, node),
+                lambda: server_info_query(node),
             )
-            ET.SubElement(
-                query_res,
-                "{http://jabber.org/protocol/disco#info}feature",
-                attrib={"var": "http://jabber.org/protocol/pubsub"},
+
+    async def handle_items(self, _, element: ET.Element):
+        to = element.attrib.get("to")
+
+        if self._pubsub_jid and to == self._pubsub_jid:
+            return self._respond(
+                element, self._pubsub_cache(), ("items", to, None), self._pubsub_items
+            )
+
+        else:
+            return self._respond(
+                element, self._responses, ("items", None, None), server_items_query
             )
 
-            return ET.tostring(iq_res)
+    def _pubsub_info(self, node: Optional[str]) -> ET.Element:
+        query_res = ET.Element("{http://jabber.org/protocol/disco#info}query")
+
+        if node:
+            info = self._pubsub.discover_info(node)
 
-        # XEP 0363 (HTTP File Upload) info
-        elif self._0363_jid and to == self._0363_jid:
-            iq_res, query_res = iq_skeleton(element, "info")
             ET.SubElement(
                 query_res,
                 "{http://jabber.org/protocol/disco#info}identity",
-                attrib={
-                    "category": "store",
-                    "type": "file",
-                    "name": "HTTP File Upload",
-                },
+                attrib={"category": "pubsub", "type": info[-1]},
             )
-            ET.SubElement(
-                query_res,
-                "{http://jabber.org/protocol/disco#info}feature",
-                attrib={"var": "urn:xmpp:http:upload:0"},
-            )
-
-            dataform = generate_form(
-                form_type=FormType.RESULT,
-                fields=[
-                    FieldRequest(
-                        var="FORM_TYPE",
-                        field_type=FieldTypes.HIDDEN,
-                        values=["urn:xmpp:http:upload:0"],
-                    ),
-                    FieldRequest(
-                        var="max-file-size", values=[str(self._0363_max_size)]
-                    ),
-                ],
-            )
-            query_res.append(dataform)
+            return query_res
 
-            return ET.tostring(iq_res)
+        ET.SubElement(
+            query_res,
+            "{http://jabber.org/protocol/disco#info}identity",
+            attrib={"category": "pubsub", "type": "service"},
+        )
+        ET.SubElement(
+            query_res,
+            "{http://jabber.org/protocol/disco#info}feature",
+            attrib={"var": "http://jabber.org/protocol/pubsub"},
+        )
+        ET.SubElement(
+            query_res,
+            "{http://jabber.org/protocol/disco#info}feature",
+            attrib={"var": "http://jabber.org/protocol/rsm"},
+        )
+        return query_res
 
-        else:
-            return server_info(element)
+    @staticmethod
+    def _account_info() -> ET.Element:
+        query_res = ET.Element("{http://jabber.org/protocol/disco#info}query")
+        ET.SubElement(
+            query_res,
+            "{http://jabber.org/protocol/disco#info}identity",
+            attrib={"category": "account", "type": "registered"},
+        )
+        ET.SubElement(
+            query_res,
+            "{http://jabber.org/protocol/disco#info}identity",
+            attrib={"category": "pubsub", "type": "pep"},
+        )
+        ET.SubElement(
+            query_res,
+            "{http://jabber.org/protocol/disco#info}feature",
+            attrib={"var": "http://jabber.org/protocol/pubsub"},
+        )
+        return query_res
 
-    def handle_items(self, _, element: ET.Element):
-        to = element.attrib.get("to")
+    def _upload_info(self) -> ET.Element:
+        query_res = ET.Element("{http://jabber.org/protocol/disco#info}query")
+        ET.SubElement(
+            query_res,
+            "{http://jabber.org/protocol/disco#info}identity",
+            attrib={
+                "category": "store",
+                "type": "file",
+                "name": "HTTP File Upload",
+            },
+        )
+        ET.SubElement(
+            query_res,
+            "{http://jabber.org/protocol/disco#info}feature",
+            attrib={"var": "urn:xmpp:http:upload:0"},
+        )
 
-        if self._pubsub_jid and to == self._pubsub_jid:
-            # query = element.find('{http://jabber.org/protocol/disco#items}query')
-            # node = query.attrib.get('node')
-            items = self._pubsub.discover_items()
-
-            iq_res, query = iq_skeleton(element, "items")
-            for n in items:
-                ET.SubElement(
-                    query,
-                    "{http://jabber.org/protocol/disco#items}item",
-                    attrib={
-                        "jid": self._pubsub_jid,
-                        "node": n[NodeAttrib.NODE.value],
-                        "name": n[NodeAttrib.NAME.value],
-                    },
-                )
-            return ET.tostring(iq_res)
+        dataform = generate_form(
+            form_type=FormType.RESULT,
+            fields=[
+                FieldRequest(
+                    var="FORM_TYPE",
+                    field_type=FieldTypes.HIDDEN,
+                    values=["urn:xmpp:http:upload:0"],
+                ),
+                FieldRequest(var="max-file-size", values=[str(self._0363_max_size)]),
+            ],
+        )
+        query_res.append(dataform)
+        return query_res
 
-        else:
-            return server_items(element)
+    def _pubsub_items(self) -> ET.Element:
+        query = ET.Element("{http://jabber.org/protocol/disco#items}query")
+        for node, name, _ in self._pubsub.discover_items():
+            item = ET.SubElement(
+                query,
+                "{http://jabber.org/protocol/disco#items}item",
+                attrib={"jid": self._pubsub_jid, "node": node},
+            )
+            # Nodes created without configuration have no name
+            if name is not None:
+                item.attrib["name"] = name
+        return query
@@ -0,0 +1,114 @@
+"""
+Result Set Management (XEP-0059).
+
+The plugins that return large lists parse the <set/> of the request with
+parse_request, select a page of the result and append the <set/> built by
+result_set to the response.
+"""
+
+from typing import List, Optional, Tuple
+from xml.etree import ElementTree as ET
+
+from attrs import define
+
+NAMESPACE = "http://jabber.org/protocol/rsm"
+MAX_PAGE = 100  # Largest page served, whatever the client asks for
+
+
+class ItemNotFound(Exception):
+    """
+    The after/before UID is not in the result set
+    """
+
+
+@define(frozen=True, slots=True)
+class ResultSetRequest:
+    max: Optional[int] = None
+    after: Optional[str] = None
+    before: Optional[str] = None  # An empty string asks for the last page
+    index: Optional[int] = None
+
+    @property
+    def page_size(self) -> int:
+        return MAX_PAGE if self.max is None else min(self.max, MAX_PAGE)
+
+
+def parse_request(parent: ET.Element) -> Optional[ResultSetRequest]:
+    """
+    :param parent: Element holding the <set/> of the request
+    :return: None if the request does not use RSM
+    :raise ValueError: Malformed <set/>
+    """
+    rsm = parent.find(f"{{{NAMESPACE}}}set")
+    if rsm is None:
+        return None
+
+    def number(tag: str) -> Optional[int]:
+        child = rsm.find(f"{{{NAMESPACE}}}{tag}")
+        if child is None:
+            return None
+        value = int(child.text or "")
+        if value < 0:
+            raise ValueError(f"Negative {tag}")
+        return value
+
+    def uid(tag: str) -> Optional[str]:
+        child = rsm.find(f"{{{NAMESPACE}}}{tag}")
+        return None if child is None else (child.text or "")
+
+    request = ResultSetRequest(
+        max=number("max"),
+        after=uid("after"),
+        before=uid("before"),
+        index=number("index"),
+    )
+    if request.after == "" or (request.after is not None and request.before):
+        raise ValueError("Invalid after/before")
+    return request
+
+
+def select_page(uids: List[str], request: ResultSetRequest) -> Tuple[int, int]:
+    """
+    Page of a result set held in memory.
+
+    :param uids: UIDs of the whole result set, in order
+    :return: (start, end) slice of the page
+    :raise ItemNotFound: The after/before UID is not in the result set
+    """
+    size = request.page_size
+
+    try:
+        if request.after is not None:
+            start = uids.index(request.after) + 1
+            return start, min(start + size, len(uids))
+
+        if request.before is not None:
+            end = uids.index(request.before) if request.before else len(uids)
+            return max(end - size, 0), end
+
+    except ValueError:
+        raise ItemNotFound(request.after or request.before)
+
+    start = min(request.index or 0, len(uids))
+    return start, min(start + size, len(uids))
+
+
+def result_set(
+    count: int,
+    first: Optional[str] = None,
+    last: Optional[str] = None,
+    index: Optional[int] = None,
+) -> ET.Element:
+    """
+    <set/> of the response. first and last are omitted for an empty page.
+    The index of the first item is optional, for results where it is costly
+    """
+    rsm = ET.Element(f"{{{NAMESPACE}}}set")
+    if first is not None:
+        first_el = ET.SubElement(rsm, f"{{{NAMESPACE}}}first")
+        first_el.text = first
+        if index is not None:
+            first_el.attrib["index"] = str(index)
+        ET.SubElement(rsm, f"{{{NAMESPACE}}}last").text = last
+    ET.SubElement(rsm, f"{{{NAMESPACE}}}count").text = str(count)
+    return rsm
@@ -0,0 +1,90 @@
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+from xml.etree import ElementTree as ET
+
+MAX_ITEMS = 1024  # Default max_items of a node
+CACHED_ITEMS = 32  # Newest items of a node kept in memory
+EVICT_BATCH = 64  # Items over max_items deleted at once
+
+
+class NodeItems:
+    """
+    Items of a node. The newest ones are kept in memory, oldest first, up to
+    the size of the ring. The count of stored items is tracked to enforce
+    max_items: once the node holds EVICT_BATCH items over the limit, the
+    oldest ones must be deleted from the database.
+
+    Items are ordered by their sequence in the node, which only grows: a new
+    item, or one published again with the same id, gets the next one.
+
+    The ring always holds the newest items of the node, so any request for
+    no more than len(recent) items, or for every item if the ring holds all
+    of them, is served from memory.
+    """
+
+    __slots__ = ("recent", "size", "max_items", "stored", "seq")
+
+    def __init__(
+        self,
+        max_items: Optional[int],
+        stored: int = 0,
+        recent: List[Tuple[str, ET.Element]] = (),
+        seq: int = 0,
+    ):
+        self.max_items = max_items or MAX_ITEMS
+        self.size = min(self.max_items, CACHED_ITEMS)
+        self.stored = stored
+        self.seq = seq
+        self.recent: OrderedDict[str, ET.Element] = OrderedDict(recent)
+
+    @property
+    def last(self) -> Optional[Tuple[str, ET.Element]]:
+        return next(reversed(self.recent.items()), None)
+
+    @property
+    def overflow(self) -> int:
+        """
+        Number of items to evict from the database, once there are enough
+        """
+        excess = self.stored - self.max_items
+        return excess if excess >= EVICT_BATCH else 0
+
+    def newest(
+        self, count: Optional[int] = None
+    ) -> Optional[List[Tuple[str, ET.Element]]]:
+        """
+        :param count: Number of items requested. None for every item of the node
+        :return: The newest items, oldest first. None if they are not all in memory
+        """
+        available = min(self.stored, self.max_items)
+        count = available if count is None else min(count, available)
+        if count > len(self.recent):
+            return None
+        return list(self.recent.items())[len(self.recent) - count :]
+
+    def next_seq(self) -> int:
+        self.seq += 1
+        return self.seq
+
+    def push(self, item_id: str, payload: ET.Element, replaced: bool):
+        """
+        :param replaced: The item id was already stored, and the item is only
+        moved to the newest position
+        """
+        self.recent.pop(item_id, None)
+        self.recent[item_id] = payload
+        while len(self.recent) > self.size:
+            self.recent.popitem(last=False)
+        if not replaced:
+            self.stored += 1
+
+    def remove(self, item_id: str):
+        self.recent.pop(item_id, None)
+        self.stored -= 1
+
+    def evicted(self, count: int):
+        self.stored -= count
+
+    def clear(self):
+        self.recent.clear()
+        self.stored = 0
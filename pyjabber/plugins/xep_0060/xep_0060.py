@@ -1,16 +1,23 @@
-from asyncio import Transport
-from itertools import chain
-from typing import List, Optional, Tuple
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
 from uuid import uuid4
 from xml.etree import ElementTree as ET
 
 from loguru import logger
-from sqlalchemy import and_, delete, insert, select, update
+from sqlalchemy import and_, delete, func, insert, select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 
 from pyjabber import AppConfig
 from pyjabber.db.database import DB
 from pyjabber.db.model import Model
-from pyjabber.network.ConnectionManager import ConnectionManager
+from pyjabber.plugins.xep_0059.xep_0059 import (
+    MAX_PAGE,
+    ItemNotFound,
+    ResultSetRequest,
+    parse_request,
+    result_set,
+    select_page,
+)
 from pyjabber.plugins.xep_0060.enum import (
     Affiliation,
     NodeAttrib,
@@ -18,30 +25,37 @@ from pyjabber.plugins.xep_0060.enum import (
     Subscription,
 )
 from pyjabber.plugins.xep_0060.error import ErrorType, error_response
+from pyjabber.plugins.xep_0060.items import NodeItems
 from pyjabber.plugins.xep_0060.utils import success_response
+from pyjabber.queues.PendingNotification import PendingNotificationWrapper
+from pyjabber.queues.QueueManager import QueueName, get_queue
+from pyjabber.queues.workers.NotificationWorker import NotificationMetrics
 from pyjabber.stanzas.error import StanzaError
-from pyjabber.stanzas.Message import Message
 from pyjabber.stream.JID import JID
 from pyjabber.utils import ClarkNotation as CN
 from pyjabber.utils import Singleton
 
+NOTIFIED_AFFILIATIONS = (Affiliation.MEMBER, Affiliation.PUBLISHER, Affiliation.OWNER)
+
 
 class PubSub(metaclass=Singleton):
     __slots__ = (
-        "_connections",
         "_jid",
         "_category",
         "_var",
         "_nodes",
         "_subscribers",
+        "_subscriptions",
+        "_subids",
+        "_items",
+        "_revision",
+        "_notifications",
         "_operations",
     )
 
     def __init__(self):
         super().__init__()
 
-        self._connections = ConnectionManager()
-
         pubsub_item = next(
             (
                 (key, item)
@@ -55,8 +69,16 @@ class PubSub(metaclass=Singleton):
         self._category = pubsub_item[1]["category"]
         self._var = pubsub_item[1]["var"]
 
-        self._nodes = None
-        self._subscribers = None
+        # In memory registry of the service, kept in sync with every write
+        # to the database. The rows follow NodeAttrib and SubscribersAttrib
+        self._nodes: Dict[str, tuple] = {}  # node -> node row
+        self._subscribers: Dict[str, Dict[str, tuple]] = {}  # node -> subid -> row
+        self._subscriptions: Dict[str, Dict[str, tuple]] = {}  # jid -> subid -> row
+        self._subids: Dict[str, tuple] = {}  # subid -> row
+        self._items: Dict[str, NodeItems] = {}  # node -> items, loaded on first use
+        self._revision = 0  # Changes with every node created or deleted
+
+        self._notifications = get_queue(QueueName.NOTIFICATIONS)
 
         self._operations = {
             "create": self.create_node,
@@ -71,14 +93,104 @@ class PubSub(metaclass=Singleton):
         }
 
     async def update_memory_from_database(self):
-        async with await DB.connection_async() as con:
-            query = select(Model.Pubsub)
-            res = await con.execute(query)
-            self._nodes = res.fetchall()
+        """
+        Builds the registry from the database. Only needed at startup, the
+        operations of the service update it afterwards
+        """
+        async with DB.reader() as con:
+            res = await con.execute(select(Model.Pubsub))
+            nodes = res.fetchall()
+
+            res = await con.execute(select(Model.PubsubSubscribers))
+            subscribers = res.fetchall()
+
+        self._nodes, self._subscribers = {}, {}
+        self._subscriptions, self._subids = {}, {}
+        self._items = {}
+
+        for node in nodes:
+            self._index_node(tuple(node))
+        for sub in subscribers:
+            self._index_subscription(tuple(sub))
+
+    @property
+    def revision(self) -> int:
+        return self._revision
+
+    def _index_node(self, node: tuple):
+        self._revision += 1
+        self._nodes[node[NodeAttrib.NODE.value]] = node
+        self._subscribers.setdefault(node[NodeAttrib.NODE.value], {})
+
+    def _drop_node(self, node: str):
+        self._revision += 1
+        self._nodes.pop(node, None)
+        self._items.pop(node, None)
+        for sub in list(self._subscribers.get(node, {}).values()):
+            self._drop_subscription(sub)
+        self._subscribers.pop(node, None)
+
+    def _index_subscription(self, sub: tuple):
+        subid = sub[SubscribersAttrib.SUBID.value]
+        node, jid = sub[SubscribersAttrib.NODE.value], sub[SubscribersAttrib.JID.value]
+
+        self._subscribers.setdefault(node, {})[subid] = sub
+        self._subscriptions.setdefault(jid, {})[subid] = sub
+        self._subids[subid] = sub
+
+    def _drop_subscription(self, sub: tuple):
+        subid = sub[SubscribersAttrib.SUBID.value]
+        node, jid = sub[SubscribersAttrib.NODE.value], sub[SubscribersAttrib.JID.value]
+
+        self._subscribers.get(node, {}).pop(subid, None)
+        self._subids.pop(subid, None)
+
+        by_jid = self._subscriptions.get(jid)
+        if by_jid is not None:
+            by_jid.pop(subid, None)
+            if not by_jid:
+                del self._subscriptions[jid]
+
+    async def _items_of(self, node: str) -> NodeItems:
+        """
+        Items of a node. The first use reads the newest items of the node
+        """
+        items = self._items.get(node)
+        if items is not None:
+            return items
+
+        items = NodeItems(self._nodes[node][NodeAttrib.MAXITEMS.value])
+        async with DB.reader() as con:
+            res = await con.execute(
+                select(func.count(), func.max(Model.PubsubItems.c.seq)).where(
+                    Model.PubsubItems.c.node == node
+                )
+            )
+            stored, seq = res.one()
 
-            query = select(Model.PubsubSubscribers)
-            res = await con.execute(query)
-            self._subscribers = res.fetchall()
+            res = await con.execute(
+                select(Model.PubsubItems.c.item_id, Model.PubsubItems.c.payload)
+                .where(Model.PubsubItems.c.node == node)
+                .order_by(Model.PubsubItems.c.seq.desc())
+                .limit(items.size)
+            )
+            recent = res.fetchall()
+
+        items.stored, items.seq = stored, seq or 0
+        for item_id, payload in reversed(recent):
+            items.push(item_id, ET.fromstring(payload), replaced=True)
+
+        # Another request may have loaded the node meanwhile
+        return self._items.setdefault(node, items)
+
+    def _subscriptions_of(self, jid: str, node: Optional[str] = None) -> List[tuple]:
+        """
+        Subscriptions of a user (by username), optionally limited to a node
+        """
+        subs: Iterable[tuple] = self._subscriptions.get(jid, {}).values()
+        if node is None:
+            return list(subs)
+        return [s for s in subs if s[SubscribersAttrib.NODE.value] == node]
 
     async def feed(self, jid: JID, element: ET.Element):
         try:
@@ -106,7 +218,7 @@ class PubSub(metaclass=Singleton):
                 node[NodeAttrib.NAME.value],
                 node[NodeAttrib.TYPE.value],
             )
-            for node in self._nodes
+            for node in self._nodes.values()
         ]
 
     def discover_info(self, node: str) -> Optional[Tuple[str, str]]:
@@ -114,9 +226,8 @@ class PubSub(metaclass=Singleton):
         Return the info for a given node
         :return: A 2-tuple in the format of (name, type)
         """
-        match_node = [n for n in self._nodes if n[NodeAttrib.NODE.value] == node]
+        match_node = self._nodes.get(node)
         if match_node:
-            match_node = match_node.pop()
             return match_node[NodeAttrib.NAME.value], match_node[NodeAttrib.TYPE.value]
 
         return None
@@ -136,7 +247,7 @@ class PubSub(metaclass=Singleton):
             return error_response(element, jid, ErrorType.NOT_ACCEPTABLE)
 
         # Node already exists
-        if [node for node in self._nodes if node[NodeAttrib.NODE.value] == new_node]:
+        if new_node in self._nodes:
             return error_response(element, jid, ErrorType.CONFLICT)
 
         if config:  # pragma: no cover
@@ -150,13 +261,14 @@ class PubSub(metaclass=Singleton):
             "max_items": 1024,
         }
 
-        async with await DB.connection_async() as con:
-            query = insert(Model.Pubsub).values(item)
-            await con.execute(query)
-            if not AppConfig.app_config.database_in_memory:
-                await con.commit()
+        # The name may be taken while waiting for the writer
+        async with DB.writer() as con:
+            query = sqlite_insert(Model.Pubsub).values(item).on_conflict_do_nothing()
+            res = await con.execute(query)
+        if not res.rowcount:
+            return error_response(element, jid, ErrorType.CONFLICT)
 
-        self.update_memory_from_database()
+        self._index_node(tuple(item.values()))
 
         iq_res, pubsub = success_response(element)
         ET.SubElement(pubsub, "create", attrib={"node": new_node})
@@ -174,30 +286,28 @@ class PubSub(metaclass=Singleton):
         if not del_node:
             return error_response(element, jid, ErrorType.NOT_ACCEPTABLE)
 
-        node_match = [
-            node for node in self._nodes if node[NodeAttrib.NODE.value] == del_node
-        ]
+        node_match = self._nodes.get(del_node)
         if not node_match:
             return error_response(element, jid, ErrorType.ITEM_NOT_FOUND)
 
-        node_match = node_match.pop()
         if node_match[NodeAttrib.OWNER.value] != jid.user:
             return error_response(element, jid, ErrorType.FORBIDDEN)
 
-        async with await DB.connection_async() as con:
+        async with DB.writer() as con:
             query = delete(Model.Pubsub).where(Model.Pubsub.c.node == del_node)
             await con.execute(query)
-            if not AppConfig.app_config.database_in_memory:
-                await con.commit()
 
             query = delete(Model.PubsubItems).where(
                 Model.PubsubItems.c.node == del_node
             )
             await con.execute(query)
-            if not AppConfig.app_config.database_in_memory:
-                await con.commit()
 
-        self.update_memory_from_database()
+            query = delete(Model.PubsubSubscribers).where(
+                Model.PubsubSubscribers.c.node == del_node
+            )
+            await con.execute(query)
+
+        self._drop_node(del_node)
         iq_res, _ = success_response(element)
         return ET.tostring(iq_res)
 
@@ -209,39 +319,51 @@ class PubSub(metaclass=Singleton):
         if node is None:
             return error_response(element, jid, ErrorType.NOT_ACCEPTABLE)
 
-        match_node = [
-            n[NodeAttrib.NODE.value]
-            for n in self._nodes
-            if n[NodeAttrib.NODE.value] == node
-        ]
+        max_items = items.attrib.get("max_items")
+        try:
+            max_items = int(max_items) if max_items is not None else None
+            if max_items is not None and max_items < 1:
+                raise ValueError
+            rsm = parse_request(pubsub)
+        except ValueError:
+            return error_response(element, jid, ErrorType.BAD_REQUEST)
+
+        match_node = self._nodes.get(node)
         if not match_node:
             return error_response(element, jid, ErrorType.ITEM_NOT_FOUND)
 
-        target_node: str = match_node.pop()
-        is_owner = any(
-            n[NodeAttrib.NODE.value] == target_node
-            and n[NodeAttrib.OWNER.value] == jid.user
-            for n in self._nodes
-        )
+        target_node: str = match_node[NodeAttrib.NODE.value]
+        is_owner = match_node[NodeAttrib.OWNER.value] == jid.user
 
         if not is_owner:
             subscribed = any(
-                s[SubscribersAttrib.JID.value] == jid.user
-                and s[SubscribersAttrib.NODE.value] == target_node
-                and s[SubscribersAttrib.SUBSCRIPTION.value]
-                in [Affiliation.MEMBER, Affiliation.PUBLISHER]
-                for s in self._subscribers
+                s[SubscribersAttrib.SUBSCRIPTION.value] == Subscription.SUBSCRIBED.value
+                and s[SubscribersAttrib.AFFILIATION.value] != Affiliation.OUTCAST
+                for s in self._subscriptions_of(jid.user, target_node)
             )
 
             if not subscribed:
                 return error_response(element, jid, ErrorType.FORBIDDEN)
 
-        async with await DB.connection_async() as con:
-            query = select(Model.PubsubItems).where(
-                Model.PubsubItems.c.node == target_node
-            )
-            res = await con.execute(query)
-            res = res.fetchall()
+        node_items = await self._items_of(target_node)
+        window = min(max_items or node_items.max_items, node_items.max_items)
+        count = min(node_items.stored, window)
+        paged = rsm is not None
+        if rsm is None:
+            # The newest items. A result set is added if they do not fit a page
+            rsm = ResultSetRequest(max=count, before="")
+            paged = rsm.page_size < count
+
+        res, index = None, None
+        if rsm.before == "":
+            res = node_items.newest(rsm.page_size)
+            index = count - len(res) if res is not None else None
+
+        if res is None:
+            try:
+                res, index = await self._items_page(target_node, window, count, rsm)
+            except ItemNotFound:
+                return error_response(element, jid, ErrorType.ITEM_NOT_FOUND)
 
         iq_res, pubsub_res = success_response(element)
         items_res = ET.SubElement(
@@ -250,16 +372,93 @@ class PubSub(metaclass=Singleton):
             attrib={"node": target_node},
         )
 
-        for i in res:
+        for item_id, payload in res:
             item = ET.SubElement(
                 items_res,
                 "{http://jabber.org/protocol/pubsub}item",
-                attrib={"id": i[2]},
+                attrib={"id": item_id},
+            )
+            item.append(payload)
+
+        if paged:
+            pubsub_res.append(
+                result_set(
+                    count,
+                    res[0][0] if res else None,
+                    res[-1][0] if res else None,
+                    index,
+                )
             )
-            item.append(ET.fromstring(i[3]))
 
         return ET.tostring(iq_res)
 
+    async def _items_page(
+        self, node: str, window: int, count: int, rsm: ResultSetRequest
+    ) -> Tuple[List[Tuple[str, ET.Element]], Optional[int]]:
+        """
+        Page of the items of a node, with keyset queries on their sequence.
+        The result set is made of the newest <window> items, oldest first,
+        and the UIDs are the item ids.
+
+        :param count: Items in the result set
+        :return: (items, index of the first one, if known without counting)
+        :raise ItemNotFound: The after/before item is not in the result set
+        """
+        items = Model.PubsubItems
+        seq = items.c.seq
+        size = rsm.page_size
+        conditions = [items.c.node == node]
+        reverse, index = False, None
+
+        if size == 0:
+            return [], None
+
+        async with DB.reader() as con:
+            floor = None
+            if count == window:
+                # Items over the window (or over max_items, waiting to be evicted)
+                res = await con.execute(
+                    select(seq)
+                    .where(items.c.node == node)
+                    .order_by(seq.desc())
+                    .offset(window - 1)
+                    .limit(1)
+                )
+                floor = res.scalar()
+                if floor is not None:
+                    conditions.append(seq >= floor)
+
+            cursor = rsm.after or rsm.before
+            if cursor:
+                res = await con.execute(
+                    select(seq).where(items.c.node == node, items.c.item_id == cursor)
+                )
+                cursor = res.scalar()
+                if cursor is None or (floor is not None and cursor < floor):
+                    raise ItemNotFound(rsm.after or rsm.before)
+
+            query = select(items.c.item_id, items.c.payload).where(*conditions)
+            if rsm.after is not None:
+                query = query.where(seq > cursor).order_by(seq)
+            elif rsm.before is not None:
+                reverse = True
+                query = query.order_by(seq.desc())
+                if rsm.before:
+                    query = query.where(seq < cursor)
+            else:
+                index = min(rsm.index or 0, count)
+                query = query.order_by(seq).offset(index)
+
+            res = await con.execute(query.limit(size))
+            rows = res.fetchall()
+
+        if reverse:
+            rows.reverse()
+            if not rsm.before:
+                index = count - len(rows)
+
+        return [(item_id, ET.fromstring(payload)) for item_id, payload in rows], index
+
     async def subscribe(self, element: ET.Element, jid: JID):
         """
         Subscribe to a specific node
@@ -280,19 +479,11 @@ class PubSub(metaclass=Singleton):
         if jid_request.bare() != jid.bare():
             return error_response(element, jid, ErrorType.INVALID_JID)
 
-        try:
-            target_node = [n for n in self._nodes if n[NodeAttrib.NODE.value] == node][
-                0
-            ]
-        except IndexError:
+        target_node = self._nodes.get(node)
+        if target_node is None:
             return error_response(element, jid, ErrorType.ITEM_NOT_FOUND)
 
-        current_state = [
-            s
-            for s in self._subscribers
-            if s[SubscribersAttrib.JID.value] == jid_request.user
-            and s[SubscribersAttrib.NODE.value] == node
-        ]
+        current_state = self._subscriptions_of(jid_request.user, node)
         if len(current_state) >= 1:
             current_state = current_state.pop()
             if current_state[SubscribersAttrib.SUBSCRIPTION.value] in [
@@ -329,13 +520,30 @@ class PubSub(metaclass=Singleton):
             "affiliation": Affiliation.PUBLISHER,
         }
 
-        async with await DB.connection_async() as con:
+        async with DB.writer() as con:
             query = insert(Model.PubsubSubscribers).values(item)
             await con.execute(query)
-            if not AppConfig.app_config.database_in_memory:
-                await con.commit()
 
-        self.update_memory_from_database()
+        self._index_subscription(tuple(item.values()))
+
+        node_items = await self._items_of(node)
+        last = node_items.newest(1)
+        if last is None:
+            # Retracted from memory, but the node still has items
+            last, _ = await self._items_page(
+                node,
+                node_items.max_items,
+                min(node_items.stored, node_items.max_items),
+                ResultSetRequest(max=1, before=""),
+            )
+        if last:
+            item_id, payload = last[0]
+            self.send_notification(
+                node=node,
+                payload=payload,
+                item_id=item_id,
+                receivers=(jid_request.user,),
+            )
 
         iq_res, pubsub = success_response(element)
         ET.SubElement(
@@ -370,29 +578,25 @@ class PubSub(metaclass=Singleton):
         if jid_request.bare() != jid.bare():
             return error_response(element, jid, ErrorType.INVALID_JID)
 
-        target_node = [n for n in self._nodes if n[NodeAttrib.NODE.value] == node]
+        target_node = self._nodes.get(node)
         if not target_node:
             return error_response(element, jid, ErrorType.ITEM_NOT_FOUND)
-        target_node = target_node.pop()
 
-        number_subscriptions = sum(
-            s[SubscribersAttrib.JID.value] == jid_request.user
-            for s in self._subscribers
-        )
+        current_subs = self._subscriptions_of(jid_request.user, node)
 
-        if number_subscriptions == 0:
+        if len(current_subs) == 0:
             return error_response(element, jid, ErrorType.NOT_SUBSCRIBED)
 
-        if number_subscriptions > 1:
+        if len(current_subs) > 1:
             subid = unsubscribe.attrib.get("subid")
             if subid is None:
                 return error_response(element, jid, ErrorType.SUBID_REQUIRED)
 
-            if not any(
-                s[SubscribersAttrib.SUBID.value] == subid for s in self._subscribers
-            ):
+            if self._subids.get(subid) not in current_subs:
                 return error_response(element, jid, ErrorType.INVALID_SUBID)
 
+            current_subs = [self._subids[subid]]
+
             query = delete(Model.PubsubSubscribers).where(
                 and_(
                     Model.PubsubSubscribers.c.node
@@ -411,12 +615,11 @@ class PubSub(metaclass=Singleton):
                 )
             )
 
-        async with await DB.connection_async() as con:
+        async with DB.writer() as con:
             await con.execute(query)
-            if not AppConfig.app_config.database_in_memory:
-                await con.commit()
 
-        self.update_memory_from_database()
+        for sub in current_subs:
+            self._drop_subscription(sub)
 
         iq_res, pubsub = success_response(element)
         sub = ET.SubElement(
@@ -432,8 +635,7 @@ class PubSub(metaclass=Singleton):
             sub.attrib["subid"] = subid
         return ET.tostring(iq_res)
 
-    @staticmethod
-    async def retrieve_subscriptions(element: ET.Element, jid: JID):
+    async def retrieve_subscriptions(self, element: ET.Element, jid: JID):
         pubsub = element.find("{http://jabber.org/protocol/pubsub}pubsub")
         subscriptions = pubsub.find("{http://jabber.org/protocol/pubsub}subscriptions")
         target_node = subscriptions.attrib.get("node")
@@ -442,45 +644,51 @@ class PubSub(metaclass=Singleton):
         if from_stanza is not None and JID(from_stanza).user != jid.user:
             return error_response(element, jid, ErrorType.FORBIDDEN)
 
+        try:
+            rsm = parse_request(pubsub)
+        except ValueError:
+            return error_response(element, jid, ErrorType.BAD_REQUEST)
+
+        subs = self._subscriptions_of(str(jid.user), target_node or None)
+        rsm_res = None
+        if rsm is not None or len(subs) > MAX_PAGE:
+            try:
+                start, end = select_page(
+                    [s[SubscribersAttrib.SUBID.value] for s in subs],
+                    rsm or ResultSetRequest(),
+                )
+            except ItemNotFound:
+                return error_response(element, jid, ErrorType.ITEM_NOT_FOUND)
+
+            page = subs[start:end]
+            rsm_res = result_set(
+                len(subs),
+                page[0][SubscribersAttrib.SUBID.value] if page else None,
+                page[-1][SubscribersAttrib.SUBID.value] if page else None,
+                start,
+            )
+            subs = page
+
         iq_res, pubsub = success_response(element)
         subscriptions_res = ET.SubElement(
             pubsub, "{http://jabber.org/protocol/pubsub}subscriptions"
         )
 
-        if target_node is not None and target_node != "":
-            query = select(
-                Model.PubsubSubscribers.c.node,
-                Model.PubsubSubscribers.c.subscription,
-                Model.PubsubSubscribers.c.subid,
-            ).where(
-                and_(
-                    Model.PubsubSubscribers.c.jid == str(jid.user),
-                    Model.PubsubSubscribers.c.node == target_node,
-                )
-            )
-        else:
-            query = select(
-                Model.PubsubSubscribers.c.node,
-                Model.PubsubSubscribers.c.subscription,
-                Model.PubsubSubscribers.c.subid,
-            ).where(Model.PubsubSubscribers.c.jid == str(jid.user))
-
-        async with await DB.connection_async() as con:
-            res = await con.execute(query)
-            res = res.fetchall()
-
-        for sub in res:
+        for sub in subs:
             ET.SubElement(
                 subscriptions_res,
                 "{http://jabber.org/protocol/pubsub}subscription",
                 attrib={
-                    "node": sub[0],
+                    "node": sub[SubscribersAttrib.NODE.value],
                     "jid": jid.bare(),
-                    "subscription": sub[1],
-                    "subid": sub[2],
+                    "subscription": sub[SubscribersAttrib.SUBSCRIPTION.value],
+                    "subid": sub[SubscribersAttrib.SUBID.value],
                 },
             )
 
+        if rsm_res is not None:
+            pubsub.append(rsm_res)
+
         return ET.tostring(iq_res)
 
     def retrieve_affiliations(self, element: ET.Element, jid: str):  # pragma: no cover
@@ -494,19 +702,19 @@ class PubSub(metaclass=Singleton):
         if node is None:
             return error_response(element, jid, ErrorType.NODEID_REQUIRED)
 
-        target_node = [n for n in self._nodes if n[NodeAttrib.NODE.value] == node]
-        if len(target_node) == 0:
+        target_node = self._nodes.get(node)
+        if target_node is None:
             return error_response(element, jid, ErrorType.ITEM_NOT_FOUND)
 
-        target_node = target_node.pop()
         if target_node[NodeAttrib.OWNER.value] != jid.user:
             return error_response(element, jid, ErrorType.FORBIDDEN)
 
-        async with await DB.connection_async() as con:
+        node_items = await self._items_of(node)
+        async with DB.writer() as con:
             query = delete(Model.PubsubItems).where(Model.PubsubItems.c.node == node)
             await con.execute(query)
-            if not AppConfig.app_config.database_in_memory:
-                await con.commit()
+
+        node_items.clear()
 
         iq_res, _ = success_response(element, True)
         return ET.tostring(iq_res)
@@ -524,31 +732,30 @@ class PubSub(metaclass=Singleton):
         if item is None or item_id is None:
             return error_response(element, jid, ErrorType.ITEM_REQUIRED)
 
-        target_node = [n for n in self._nodes if n[NodeAttrib.NODE.value] == node]
-        if len(target_node) == 0:
+        target_node = self._nodes.get(node)
+        if target_node is None:
             return error_response(element, jid, ErrorType.ITEM_NOT_FOUND)
-        target_node = target_node.pop()
 
         current_sub = any(
-            s
-            for s in self._subscribers
-            if s[SubscribersAttrib.JID.value] == jid.user
-            and s[SubscribersAttrib.AFFILIATION.value] == Affiliation.PUBLISHER
+            s[SubscribersAttrib.AFFILIATION.value] == Affiliation.PUBLISHER
+            for s in self._subscriptions_of(jid.user, node)
         )
 
         if jid.user != target_node[NodeAttrib.OWNER.value] and not current_sub:
             return error_response(element, jid, ErrorType.FORBIDDEN)
 
-        async with await DB.connection_async() as con:
+        node_items = await self._items_of(node)
+        async with DB.writer() as con:
             query = delete(Model.PubsubItems).where(
                 and_(
                     Model.PubsubItems.c.item_id == item_id,
                     Model.PubsubItems.c.node == node,
                 )
             )
-            await con.execute(query)
-            if not AppConfig.app_config.database_in_memory:
-                await con.commit()
+            res = await con.execute(query)
+
+        if res.rowcount:
+            node_items.remove(item_id)
 
         iq_res, pubsub_iq = success_response(element)
 
@@ -575,16 +782,12 @@ class PubSub(metaclass=Singleton):
 
         node = publish.attrib.get("node")
 
-        target_node = [n for n in self._nodes if n[NodeAttrib.NODE.value] == node]
-        if len(target_node) == 0:
+        target_node = self._nodes.get(node)
+        if target_node is None:
             return error_response(element, jid, ErrorType.ITEM_NOT_FOUND)
 
-        current_sub = [
-            s
-            for s in self._subscribers
-            if s[SubscribersAttrib.AFFILIATION.value] == jid.user
-        ]
-        if jid.user != target_node[0][NodeAttrib.OWNER.value] or (
+        current_sub = self._subscriptions_of(jid.user, node)
+        if jid.user != target_node[NodeAttrib.OWNER.value] or (
             current_sub
             and current_sub[0][SubscribersAttrib.AFFILIATION.value]
             != Affiliation.PUBLISHER
@@ -592,60 +795,11 @@ class PubSub(metaclass=Singleton):
             return error_response(element, jid, ErrorType.FORBIDDEN)
 
         if payload is not None:
-            async with await DB.connection_async() as con:
-                if item_id is not None:
-                    query = select(Model.PubsubItems.c.item_id).where(
-                        and_(
-                            Model.PubsubItems.c.item_id == item_id,
-                            Model.PubsubItems.c.node == node,
-                        )
-                    )
-                    res = await con.execute(query)
-                    res = res.fetchone
-
-                    if res:
-                        query = (
-                            update(Model.PubsubItems)
-                            .where(
-                                and_(
-                                    Model.PubsubItems.c.node
-                                    == target_node[NodeAttrib.NODE.value],
-                                    Model.PubsubItems.c.item_id == item_id,
-                                )
-                            )
-                            .values(payload=item_id)
-                        )
-
-                    else:
-                        query = insert(Model.PubsubItems).values(
-                            {
-                                "node": target_node[0][NodeAttrib.NODE.value],
-                                "publisher": jid.bare(),
-                                "item_id": item_id,
-                                "payload": ET.tostring(payload),
-                            }
-                        )
-
-                    await con.execute(query)
-                    if not AppConfig.app_config.database_in_memory:
-                        await con.commit()
-
-                else:
-                    item_id = str(uuid4())
-                    query = insert(Model.PubsubItems).values(
-                        {
-                            "node": target_node[0][NodeAttrib.NODE.value],
-                            "publisher": jid.bare(),
-                            "item_id": item_id,
-                            "payload": ET.tostring(payload),
-                        }
-                    )
-                    await con.execute(query)
-                    if not AppConfig.app_config.database_in_memory:
-                        await con.commit()
+            item_id = item_id or str(uuid4())
+            await self._store_item(node, item_id, jid, payload)
 
         self.send_notification(
-            node=target_node[0][NodeAttrib.NODE.value], payload=payload
+            node=target_node[NodeAttrib.NODE.value], payload=payload, item_id=item_id
         )
 
         iq_res, pubsub = success_response(element)
@@ -654,31 +808,78 @@ class PubSub(metaclass=Singleton):
             ET.SubElement(publish, "item", attrib={"id": item_id})
         return ET.tostring(iq_res)
 
+    async def _store_item(self, node: str, item_id: str, jid: JID, payload: ET.Element):
+        """
+        Stores the item as the newest of the node, replacing any item with the
+        same id. The oldest items over max_items are deleted in batches
+        """
+        node_items = await self._items_of(node)
+
+        async with DB.writer() as con:
+            res = await con.execute(
+                delete(Model.PubsubItems).where(
+                    and_(
+                        Model.PubsubItems.c.node == node,
+                        Model.PubsubItems.c.item_id == item_id,
+                    )
+                )
+            )
+            await con.execute(
+                insert(Model.PubsubItems).values(
+                    {
+                        "node": node,
+                        "publisher": jid.bare(),
+                        "item_id": item_id,
+                        "payload": ET.tostring(payload),
+                        "seq": node_items.next_seq(),
+                        "published": int(time.time()),
+                    }
+                )
+            )
+            node_items.push(item_id, payload, replaced=res.rowcount > 0)
+
+            overflow = node_items.overflow
+            if overflow:
+                oldest = (
+                    select(Model.PubsubItems.c.seq)
+                    .where(Model.PubsubItems.c.node == node)
+                    .order_by(Model.PubsubItems.c.seq)
+                    .limit(overflow)
+                )
+                res = await con.execute(
+                    delete(Model.PubsubItems).where(
+                        and_(
+                            Model.PubsubItems.c.node == node,
+                            Model.PubsubItems.c.seq.in_(oldest.scalar_subquery()),
+                        )
+                    )
+                )
+                node_items.evicted(res.rowcount)
+
     def send_notification(
         self,
         node: str,
         payload: Optional[ET.Element],
         item_id: Optional[str] = None,
         retract: bool = False,
+        receivers: Optional[Tuple[str, ...]] = None,
     ):
-        receivers = [
-            s
-            for s in self._subscribers
-            if s[SubscribersAttrib.NODE.value] == node
-            and s[SubscribersAttrib.AFFILIATION.value]
-            in [Affiliation.MEMBER, Affiliation.PUBLISHER, Affiliation.OWNER]
-        ]
+        """
+        Enqueues the event for the subscribers of the node. The notification
+        worker delivers it in the background
 
-        receivers_jid = [r[1] for r in receivers]
-        receivers_buffer = [
-            self._connections.get_transport(
-                JID(user=r, domain=AppConfig.app_config.host)
-            )
-            for r in receivers_jid
-        ]
-        receivers_buffer_single_iterator: List[Tuple[JID, Transport]] = list(
-            chain.from_iterable(receivers_buffer)
+        :param receivers: Usernames to notify, instead of the subscribers of the node
+        """
+        jid, affiliation = (
+            SubscribersAttrib.JID.value,
+            SubscribersAttrib.AFFILIATION.value,
         )
+        if receivers is None:
+            receivers = tuple(
+                s[jid]
+                for s in self._subscribers.get(node, {}).values()
+                if s[affiliation] in NOTIFIED_AFFILIATIONS
+            )
 
         event = ET.Element(
             "event", attrib={"xmlns": "http://jabber.org/protocol/pubsub#event"}
@@ -697,12 +898,12 @@ class PubSub(metaclass=Singleton):
             if payload is not None:
                 item.append(payload)
 
-        for jid, buffer, _ in receivers_buffer_single_iterator:
-            message = Message(
-                mto=jid.bare(),
-                mfrom=AppConfig.app_config.host,
-                id=str(uuid4()),
-                mtype=None,
-                body=event,
+        NotificationMetrics().pending_receivers += len(receivers)
+        self._notifications.put_nowait(
+            PendingNotificationWrapper(
+                node=node,
+                event=event,
+                receivers=receivers,
+                created=time.monotonic(),
             )
-            buffer.write(ET.tostring(message))
+        )
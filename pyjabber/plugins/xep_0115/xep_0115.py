@@ -0,0 +1,340 @@
+import base64
+import hashlib
+from typing import Dict, FrozenSet, List, Optional, Tuple
+from xml.etree import ElementTree as ET
+
+from loguru import logger
+from sqlalchemy import select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from pyjabber import AppConfig
+from pyjabber.db.database import DB
+from pyjabber.db.model import Model
+from pyjabber.network.ConnectionManager import ConnectionManager
+from pyjabber.plugins.xep_0030.utils import server_info_query
+from pyjabber.stanzas.IQ import IQ
+from pyjabber.stream.JID import JID
+from pyjabber.utils import Singleton
+
+NAMESPACE = "http://jabber.org/protocol/caps"
+DISCO_INFO = "http://jabber.org/protocol/disco#info"
+DATA_FORMS = "jabber:x:data"
+XML_LANG = "{http://www.w3.org/XML/1998/namespace}lang"
+NOTIFY = "+notify"  # Suffix of the features that ask for PEP notifications
+NODE = "https://github.com/DinoThor/PyJabber"  # Caps node of the server
+
+# Hash functions of the verification string, by their IANA name
+HASHES = {
+    "sha-1": hashlib.sha1,
+    "sha-224": hashlib.sha224,
+    "sha-256": hashlib.sha256,
+    "sha-384": hashlib.sha384,
+    "sha-512": hashlib.sha512,
+}
+
+CACHE_SIZE = 10000  # Verified versions kept in memory
+
+
+def verification_string(query: ET.Element) -> Optional[str]:
+    """
+    Verification string of the identities, features and extended forms of a
+    disco#info query (XEP-0115, 5.1)
+
+    :return: None if the query repeats an identity, a feature or a form type,
+    so its hash must not be trusted
+    """
+    identities = sorted(
+        "/".join(
+            (
+                i.attrib.get("category", ""),
+                i.attrib.get("type", ""),
+                i.attrib.get(XML_LANG, ""),
+                i.attrib.get("name", ""),
+            )
+        )
+        for i in query.iterfind(f"{{{DISCO_INFO}}}identity")
+    )
+    features = sorted(
+        f.attrib.get("var", "") for f in query.iterfind(f"{{{DISCO_INFO}}}feature")
+    )
+    if len(set(identities)) != len(identities) or len(set(features)) != len(features):
+        return None
+
+    forms = {}
+    for form in query.iterfind(f"{{{DATA_FORMS}}}x"):
+        fields = {
+            field.attrib.get("var", ""): sorted(
+                v.text or "" for v in field.iterfind(f"{{{DATA_FORMS}}}value")
+            )
+            for field in form.iterfind(f"{{{DATA_FORMS}}}field")
+        }
+        form_type = fields.pop("FORM_TYPE", None)
+        if not form_type:
+            continue  # Forms without FORM_TYPE are left out
+        if form_type[0] in forms:
+            return None
+        forms[form_type[0]] = fields
+
+    string = "".join(f"{i}<" for i in identities)
+    string += "".join(f"{f}<" for f in features)
+    for form_type, fields in sorted(forms.items()):
+        string += f"{form_type}<"
+        for var, values in sorted(fields.items()):
+            string += f"{var}<" + "".join(f"{v}<" for v in values)
+    return string
+
+
+def caps_hash(query: ET.Element, algorithm: str = "sha-1") -> Optional[str]:
+    """
+    :return: The caps version of a disco#info query. None if it has no valid
+    verification string
+    """
+    string = verification_string(query)
+    if string is None:
+        return None
+    return base64.b64encode(HASHES[algorithm](string.encode()).digest()).decode()
+
+
+class Caps(metaclass=Singleton):
+    """
+    Entity capabilities (XEP-0115) of the online sessions.
+
+    A client asks for the PEP notifications of a namespace advertising the
+    <namespace>+notify feature in its caps. The features of a caps version
+    are queried once for the whole server: the first session that brings a
+    version not seen before gets a disco#info, and the sessions with the same
+    version that come meanwhile wait for its answer. An answer that matches
+    its hash is cached (and stored, if the cache is persistent), so the next
+    sessions of the version need no query. An answer that does not match is
+    only trusted for its session, and the next waiting one is queried.
+
+    Legacy caps, without hash, cannot be verified: every session of them is
+    queried. The namespaces each session wants are kept in memory, so the
+    receivers of a PEP event are resolved without queries.
+    """
+
+    __slots__ = (
+        "_connections",
+        "_features",
+        "_interests",
+        "_versions",
+        "_queries",
+        "_waiting",
+        "_persistent",
+        "_server",
+    )
+
+    def __init__(self):
+        self._connections = ConnectionManager()
+        # Verified version -> features
+        self._features: Dict[str, FrozenSet[str]] = {}
+        # Bare JID -> resource -> namespaces of the wanted notifications
+        self._interests: Dict[str, Dict[str, FrozenSet[str]]] = {}
+        # Full JID -> caps node#ver of the last presence
+        self._versions: Dict[str, str] = {}
+        # Full JID -> (id, version, hash) of the pending disco#info query.
+        # Version and hash are None for legacy caps
+        self._queries: Dict[str, Tuple[str, Optional[str], Optional[str]]] = {}
+        # Version queried -> sessions waiting for its answer
+        self._waiting: Dict[str, List[JID]] = {}
+
+        self._persistent = False
+        self._server: Optional[str] = None
+
+    async def load(self):
+        """
+        Reads the versions verified by previous runs. From now on, the new
+        ones are stored too
+        """
+        async with DB.reader() as con:
+            res = await con.execute(
+                select(Model.CapsFeatures.c.ver, Model.CapsFeatures.c.features)
+            )
+            for ver, features in res.fetchall():
+                self._features[ver] = frozenset(
+                    features.split("\n") if features else ()
+                )
+        self._persistent = True
+
+    def server_caps(self) -> ET.Element:
+        """
+        The <c/> element of the server, hashed from its disco#info
+        """
+        if self._server is None:
+            self._server = caps_hash(server_info_query())
+        return ET.Element(
+            f"{{{NAMESPACE}}}c",
+            attrib={"hash": "sha-1", "node": NODE, "ver": self._server},
+        )
+
+    def interested(self, bare: str, namespace: str) -> List[str]:
+        """
+        :return: Full JIDs of the sessions of the account that want the
+        notifications of the namespace
+        """
+        return [
+            f"{bare}/{resource}"
+            for resource, namespaces in self._interests.get(bare, {}).items()
+            if namespace in namespaces
+        ]
+
+    def presence(self, jid: JID, element: ET.Element) -> Optional[FrozenSet[str]]:
+        """
+        Reads the caps of an available presence of a session, and queries
+        the session if its version is unknown
+
+        :return: The namespaces of the notifications the session wants, if
+        its version was already verified. None if the caps did not change, or
+        the features are still to come
+        """
+        c = element.find(f"{{{NAMESPACE}}}c")
+        if c is None:
+            return None
+
+        full = str(jid)
+        ver, algorithm = c.attrib.get("ver"), c.attrib.get("hash")
+        caps = f"{c.attrib.get('node')}#{ver}"
+        if self._versions.get(full) == caps:
+            return None
+        self._release(jid)
+        self._versions[full] = caps
+
+        if not ver or algorithm not in HASHES:
+            self._query(jid, None, None)
+            return None
+
+        features = self._features.get(ver)
+        if features is not None:
+            return self._learn(jid, features)
+
+        waiting = self._waiting.get(ver)
+        if waiting is not None:
+            waiting.append(jid)
+            return None
+
+        self._waiting[ver] = []
+        self._query(jid, ver, algorithm)
+        return None
+
+    async def response(
+        self, jid: JID, element: ET.Element
+    ) -> Optional[List[Tuple[JID, FrozenSet[str]]]]:
+        """
+        Reads the answer of a session to the disco#info query
+
+        :return: The sessions whose features are now known (the one that
+        answered and, for a verified version, the ones waiting for it), with
+        the namespaces of the notifications they want. None if the stanza does
+        not answer a query of the index
+        """
+        full = str(jid)
+        pending = self._queries.get(full)
+        if pending is None or pending[0] != element.attrib.get("id"):
+            return None
+        del self._queries[full]
+        _, ver, algorithm = pending
+
+        query = None
+        if element.attrib.get("type") == IQ.TYPE.RESULT.value:
+            query = element.find(f"{{{DISCO_INFO}}}query")
+        features = frozenset(
+            f.attrib.get("var", "")
+            for f in (
+                query.iterfind(f"{{{DISCO_INFO}}}feature") if query is not None else ()
+            )
+        )
+
+        learned = [(jid, self._learn(jid, features))]
+        if ver is None:
+            return learned
+
+        waiting = self._waiting.pop(ver, [])
+        if query is not None and caps_hash(query, algorithm) == ver:
+            if len(self._features) >= CACHE_SIZE:
+                del self._features[next(iter(self._features))]
+            self._features[ver] = features
+            learned.extend((w, self._learn(w, features)) for w in waiting)
+
+            if self._persistent:
+                await self._store(ver, algorithm, features)
+
+        else:
+            logger.warning(f"Caps {ver} of {jid} not verified")
+            if waiting:
+                self._waiting[ver] = waiting[1:]
+                self._query(waiting[0], ver, algorithm)
+
+        return learned
+
+    def forget(self, jid: JID):
+        """
+        The session went offline
+        """
+        self._release(jid)
+        self._versions.pop(str(jid), None)
+
+        resources = self._interests.get(jid.bare())
+        if resources is not None:
+            resources.pop(jid.resource, None)
+            if not resources:
+                del self._interests[jid.bare()]
+
+    def _query(self, jid: JID, ver: Optional[str], algorithm: Optional[str]):
+        full = str(jid)
+        iq = IQ(type_=IQ.TYPE.GET, from_=AppConfig.app_config.host, to=full)
+        ET.SubElement(
+            iq, f"{{{DISCO_INFO}}}query", attrib={"node": self._versions[full]}
+        )
+        self._queries[full] = (iq.attrib["id"], ver, algorithm)
+
+        query = ET.tostring(iq)
+        for client in self._connections.get_transport(jid):
+            client.transport.write(query)
+
+    def _release(self, jid: JID):
+        """
+        Drops the pending query of the session, handing it to the next session
+        waiting for the same version, or its place among the waiting ones
+        """
+        full = str(jid)
+        pending = self._queries.pop(full, None)
+        caps = self._versions.get(full)
+        if caps is None:
+            return
+
+        ver = caps.rpartition("#")[2]
+        waiting = self._waiting.get(ver)
+        if waiting is None:
+            return
+
+        if pending is None:
+            if jid in waiting:
+                waiting.remove(jid)
+        elif pending[1] == ver:
+            if waiting:
+                self._query(waiting.pop(0), ver, pending[2])
+            else:
+                del self._waiting[ver]
+
+    def _learn(self, jid: JID, features: FrozenSet[str]) -> FrozenSet[str]:
+        namespaces = frozenset(
+            var[: -len(NOTIFY)] for var in features if var.endswith(NOTIFY)
+        )
+
+        resources = self._interests.setdefault(jid.bare(), {})
+        if namespaces:
+            resources[jid.resource] = namespaces
+        else:
+            resources.pop(jid.resource, None)
+            if not resources:
+                del self._interests[jid.bare()]
+        return namespaces
+
+    @staticmethod
+    async def _store(ver: str, algorithm: str, features: FrozenSet[str]):
+        async with DB.writer() as con:
+            await con.execute(
+                sqlite_insert(Model.CapsFeatures)
+                .values(ver=ver, hash=algorithm, features="\n".join(sorted(features)))
+                .on_conflict_do_nothing()
+            )
@@ -0,0 +1,316 @@
+import time
+from collections import OrderedDict, defaultdict
+from typing import Dict, FrozenSet, Iterable, Optional, Tuple
+from uuid import uuid4
+from xml.etree import ElementTree as ET
+
+from loguru import logger
+from sqlalchemy import and_, delete, insert, select
+
+from pyjabber import AppConfig
+from pyjabber.db.database import DB
+from pyjabber.db.model import Model
+from pyjabber.plugins.roster.Roster import Roster
+from pyjabber.plugins.xep_0060.error import ErrorType, error_response
+from pyjabber.plugins.xep_0060.utils import success_response
+from pyjabber.plugins.xep_0115.xep_0115 import Caps
+from pyjabber.queues.PendingNotification import PendingNotificationWrapper
+from pyjabber.queues.QueueManager import QueueName, get_queue
+from pyjabber.queues.workers.NotificationWorker import NotificationMetrics
+from pyjabber.stanzas.error import StanzaError
+from pyjabber.stream.JID import JID
+from pyjabber.utils import ClarkNotation as CN
+from pyjabber.utils import Singleton
+
+PUBSUB = "http://jabber.org/protocol/pubsub"
+EVENT = "http://jabber.org/protocol/pubsub#event"
+
+# Roster subscriptions of the contacts that can see the items of a user
+PRESENCE_SUBSCRIBERS = ("from", "both")
+# Roster subscriptions of the contacts whose items a user can see
+PRESENCE_SUBSCRIPTIONS = ("to", "both")
+# Users whose last items are kept in memory. The least recently used are dropped
+LAST_ITEMS_USERS = 10000
+
+
+class PEP(metaclass=Singleton):
+    """
+    Personal Eventing Protocol (XEP-0163).
+
+    Every account is a pubsub service, addressed with its bare JID (or without
+    'to', for its own one). A node is created by the first publication to it,
+    and keeps the last published item. Its items can be read by the owner and
+    by the contacts subscribed to the owner's presence.
+
+    The notifications go to the sessions of those contacts, and of the owner,
+    that advertised <node>+notify in their entity capabilities. The receivers
+    are resolved with the caps index and the rosters in memory, without
+    querying the clients nor the database.
+    """
+
+    __slots__ = ("_caps", "_roster", "_last", "_notifications", "_operations")
+
+    def __init__(self):
+        self._caps = Caps()
+        self._roster = Roster()
+        # Username -> node -> (item id, payload). Loaded on first use, in least
+        # recently used order
+        self._last: OrderedDict[str, Dict[str, Tuple[str, ET.Element]]] = OrderedDict()
+        self._notifications = get_queue(QueueName.NOTIFICATIONS)
+
+        self._operations = {
+            "publish": self.publish,
+            "items": self.retrieve_items,
+            "retract": self.retract,
+        }
+
+    @staticmethod
+    def addressed(element: ET.Element) -> bool:
+        """
+        The pubsub request goes to an account (PEP) instead of the pubsub service
+        """
+        to = element.attrib.get("to")
+        if to is None:
+            return True
+        try:
+            to = JID(to)
+        except ValueError:
+            return False
+        return to.resource is None and to.domain == AppConfig.app_config.host
+
+    async def feed(self, jid: JID, element: ET.Element):
+        try:
+            _, tag = CN.break_down(element[0].tag)
+
+            if tag != "pubsub":
+                return StanzaError.invalid_xml()
+
+            _, operation = CN.break_down(element[0][0].tag)
+            return await self._operations[operation](element, jid)
+        except KeyError as e:
+            logger.error(f"PEP operation not supported: {e}")
+            return StanzaError.feature_not_implemented(
+                feature=str(e), namespace="{http://jabber.org/protocol/pubsub}pubsub"
+            )
+
+    @staticmethod
+    def _owner(element: ET.Element, jid: JID) -> JID:
+        to = element.attrib.get("to")
+        return JID(to) if to else JID(jid.bare())
+
+    def forget(self, user: str):
+        """
+        Drops the items in memory of a deleted account
+        """
+        self._last.pop(user, None)
+
+    async def _items_of(self, users: Iterable[str]) -> Dict[str, Dict[str, tuple]]:
+        """
+        Last items of the nodes of the users. The ones not in memory are read
+        with a query per shard
+        """
+        res = {}
+        missing = defaultdict(list)
+        for user in users:
+            if user in self._last:
+                res[user] = self._last[user]
+            else:
+                missing[DB.shard_of(user)].append(user)
+
+        for shard, shard_users in missing.items():
+            async with DB.reader(shard=shard) as con:
+                rows = await con.execute(
+                    select(
+                        Model.PepItems.c.jid,
+                        Model.PepItems.c.node,
+                        Model.PepItems.c.item_id,
+                        Model.PepItems.c.payload,
+                    ).where(Model.PepItems.c.jid.in_(shard_users))
+                )
+                rows = rows.fetchall()
+
+            loaded = {user: {} for user in shard_users}
+            for user, node, item_id, payload in rows:
+                loaded[user][node] = (item_id, ET.fromstring(payload))
+            for user, nodes in loaded.items():
+                # Another request may have loaded the user meanwhile
+                res[user] = self._last.setdefault(user, nodes)
+
+        for user, nodes in res.items():
+            self._last[user] = nodes
+            self._last.move_to_end(user)
+        while len(self._last) > LAST_ITEMS_USERS:
+            self._last.popitem(last=False)
+        return res
+
+    async def publish(self, element: ET.Element, jid: JID):
+        owner = self._owner(element, jid)
+        if owner.bare() != jid.bare():
+            return error_response(element, jid, ErrorType.FORBIDDEN)
+
+        publish = element[0].find(f"{{{PUBSUB}}}publish")
+        node = publish.attrib.get("node")
+        if not node:
+            return error_response(element, jid, ErrorType.NODEID_REQUIRED)
+
+        item = publish.find(f"{{{PUBSUB}}}item")
+        if item is None or len(item) != 1:
+            return error_response(element, jid, ErrorType.INVALID_PAYLOAD)
+
+        item_id = item.attrib.get("id") or uuid4().hex
+        payload = item[0]
+
+        nodes = (await self._items_of([owner.user]))[owner.user]
+        async with DB.writer(owner.user) as con:
+            await con.execute(
+                delete(Model.PepItems).where(
+                    and_(
+                        Model.PepItems.c.jid == owner.user,
+                        Model.PepItems.c.node == node,
+                    )
+                )
+            )
+            await con.execute(
+                insert(Model.PepItems).values(
+                    jid=owner.user,
+                    node=node,
+                    item_id=item_id,
+                    payload=ET.tostring(payload),
+                    published=int(time.time()),
+                )
+            )
+        nodes[node] = (item_id, payload)
+
+        await self._notify(owner, node, item_id, payload)
+
+        iq_res, pubsub = success_response(element)
+        iq_res.attrib["from"] = owner.bare()
+        publish_res = ET.SubElement(
+            pubsub, f"{{{PUBSUB}}}publish", attrib={"node": node}
+        )
+        ET.SubElement(publish_res, f"{{{PUBSUB}}}item", attrib={"id": item_id})
+        return ET.tostring(iq_res)
+
+    async def retrieve_items(self, element: ET.Element, jid: JID):
+        owner = self._owner(element, jid)
+        items = element[0].find(f"{{{PUBSUB}}}items")
+        node = items.attrib.get("node")
+        if not node:
+            return error_response(element, jid, ErrorType.NODEID_REQUIRED)
+
+        if owner.bare() != jid.bare() and jid.bare() not in await self._roster.contacts(
+            owner, PRESENCE_SUBSCRIBERS
+        ):
+            return error_response(element, jid, ErrorType.FORBIDDEN)
+
+        last = (await self._items_of([owner.user]))[owner.user].get(node)
+        if last is None:
+            return error_response(element, jid, ErrorType.ITEM_NOT_FOUND)
+
+        item_id, payload = last
+        requested = {i.attrib.get("id") for i in items.iter(f"{{{PUBSUB}}}item")}
+
+        iq_res, pubsub = success_response(element)
+        iq_res.attrib["from"] = owner.bare()
+        items_res = ET.SubElement(pubsub, f"{{{PUBSUB}}}items", attrib={"node": node})
+        if not requested or item_id in requested:
+            item = ET.SubElement(items_res, f"{{{PUBSUB}}}item", attrib={"id": item_id})
+            item.append(payload)
+        return ET.tostring(iq_res)
+
+    async def retract(self, element: ET.Element, jid: JID):
+        owner = self._owner(element, jid)
+        if owner.bare() != jid.bare():
+            return error_response(element, jid, ErrorType.FORBIDDEN)
+
+        retract = element[0].find(f"{{{PUBSUB}}}retract")
+        node = retract.attrib.get("node")
+        item = retract.find(f"{{{PUBSUB}}}item")
+        if not node:
+            return error_response(element, jid, ErrorType.NODEID_REQUIRED)
+        if item is None or item.attrib.get("id") is None:
+            return error_response(element, jid, ErrorType.ITEM_REQUIRED)
+
+        nodes = (await self._items_of([owner.user]))[owner.user]
+        last = nodes.get(node)
+        if last is None or last[0] != item.attrib["id"]:
+            return error_response(element, jid, ErrorType.ITEM_NOT_FOUND)
+
+        async with DB.writer(owner.user) as con:
+            await con.execute(
+                delete(Model.PepItems).where(
+                    and_(
+                        Model.PepItems.c.jid == owner.user,
+                        Model.PepItems.c.node == node,
+                    )
+                )
+            )
+        del nodes[node]
+
+        await self._notify(owner, node, last[0], None)
+
+        iq_res, _ = success_response(element)
+        iq_res.attrib["from"] = owner.bare()
+        iq_res.remove(iq_res[0])
+        return ET.tostring(iq_res)
+
+    async def _notify(
+        self, owner: JID, node: str, item_id: str, payload: Optional[ET.Element]
+    ):
+        """
+        Enqueues the event of the node for the interested sessions of the
+        owner and of its presence subscribers. A retraction without payload
+        """
+        receivers = self._caps.interested(owner.bare(), node)
+        for contact in await self._roster.contacts(owner, PRESENCE_SUBSCRIBERS):
+            receivers.extend(self._caps.interested(contact, node))
+
+        if receivers:
+            self._enqueue(owner, node, item_id, payload, tuple(receivers))
+
+    async def send_last_items(self, jid: JID, namespaces: FrozenSet[str]):
+        """
+        Sends to a session that just told its interests the last items of
+        those nodes, from its own account and from the contacts whose
+        presence it is subscribed to
+        """
+        if not namespaces:
+            return
+
+        owners = [jid.bare()] + [
+            contact
+            for contact in await self._roster.contacts(jid, PRESENCE_SUBSCRIPTIONS)
+            if contact.endswith(f"@{AppConfig.app_config.host}")
+        ]
+        last = await self._items_of(JID(owner).user for owner in owners)
+
+        for owner in owners:
+            for node, (item_id, payload) in last[JID(owner).user].items():
+                if node in namespaces:
+                    self._enqueue(JID(owner), node, item_id, payload, (str(jid),))
+
+    def _enqueue(
+        self,
+        owner: JID,
+        node: str,
+        item_id: str,
+        payload: Optional[ET.Element],
+        receivers: Tuple[str, ...],
+    ):
+        event = ET.Element("event", attrib={"xmlns": EVENT})
+        items = ET.SubElement(event, "items", attrib={"node": node})
+        if payload is None:
+            ET.SubElement(items, "retract", attrib={"id": item_id})
+        else:
+            ET.SubElement(items, "item", attrib={"id": item_id}).append(payload)
+
+        NotificationMetrics().pending_receivers += len(receivers)
+        self._notifications.put_nowait(
+            PendingNotificationWrapper(
+                node=node,
+                event=event,
+                receivers=receivers,
+                created=time.monotonic(),
+                sender=owner.bare(),
+            )
+        )
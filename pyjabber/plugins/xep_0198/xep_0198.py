@@ -0,0 +1,384 @@
+import asyncio
+import re
+from collections import deque
+from typing import Deque, Dict, List, Optional
+from uuid import uuid4
+from xml.etree import ElementTree as ET
+
+from loguru import logger
+
+from pyjabber import AppConfig
+from pyjabber.features.presence.PresenceFeature import Presence
+from pyjabber.network.ConnectionManager import Peer
+from pyjabber.plugins.xep_0115.xep_0115 import Caps
+from pyjabber.plugins.xep_0352.xep_0352 import CSITransport, _local
+from pyjabber.queues.PendingMessage import PendingMessageWrapper
+from pyjabber.queues.QueueManager import QueueName, get_queue
+from pyjabber.stream.JID import JID
+from pyjabber.utils import Singleton
+
+NAMESPACE = "urn:xmpp:sm:3"
+
+ACK_INTERVAL = 10  # Stanzas sent between two ack requests
+H_MAX = 2**32  # The handled counters wrap around (XEP-0198 4)
+
+_STANZAS = ("message", "presence", "iq")
+
+# Start and end tags of the stanzas, with any prefix. A '<' is always
+# escaped in text and attributes, and no stream element shares their names
+_STANZA_TAG = re.compile(
+    rb"<(/?)(?:[\w.-]+:)?(message|presence|iq)(?=[\s/>])[^>]*?(/?)>"
+)
+
+
+def is_stanza(element: ET.Element) -> bool:
+    """
+    Only the stanzas are counted and acked, not the stream elements
+    """
+    namespace, tag = _local(element.tag)
+    return tag in _STANZAS and namespace in ("", "jabber:client")
+
+
+def split_stanzas(data: bytes) -> List[bytes]:
+    """
+    The stanzas in the data written, without an XML parse: only the tags of
+    the stanzas are looked at. Anything around them (stream elements,
+    whitespace, the end of the stream...) is left out
+    """
+    stanzas = []
+    depth = 0
+    top = start = None
+    for tag in _STANZA_TAG.finditer(data):
+        end, name, empty = tag.groups()
+        if depth and name != top:
+            continue  # Only the nesting of the top stanza matters
+        if end:
+            if depth:
+                depth -= 1
+                if not depth:
+                    stanzas.append(data[start : tag.end()])
+        elif empty:
+            if not depth:
+                stanzas.append(data[tag.start() : tag.end()])
+        else:
+            if not depth:
+                top, start = name, tag.start()
+            depth += 1
+    return stanzas
+
+
+def enabled(id_: str, resume: bool, max_: int) -> bytes:
+    element = ET.Element(f"{{{NAMESPACE}}}enabled", attrib={"id": id_})
+    if resume:
+        element.attrib["resume"] = "true"
+        element.attrib["max"] = str(max_)
+    return ET.tostring(element)
+
+
+def resumed(previd: str, h: int) -> bytes:
+    return ET.tostring(
+        ET.Element(f"{{{NAMESPACE}}}resumed", attrib={"previd": previd, "h": str(h)})
+    )
+
+
+def failed(condition: str, h: Optional[int] = None) -> bytes:
+    element = ET.Element(f"{{{NAMESPACE}}}failed")
+    if h is not None:
+        element.attrib["h"] = str(h)
+    ET.SubElement(element, f"{{urn:ietf:params:xml:ns:xmpp-stanzas}}{condition}")
+    return ET.tostring(element)
+
+
+def answer(h: int) -> bytes:
+    return ET.tostring(ET.Element(f"{{{NAMESPACE}}}a", attrib={"h": str(h)}))
+
+
+REQUEST = ET.tostring(ET.Element(f"{{{NAMESPACE}}}r"))
+
+
+class SMMetrics(metaclass=Singleton):
+    """
+    Counters of the managed streams, and of what the resumptions saved
+    """
+
+    __slots__ = (
+        "enabled",
+        "detached",
+        "resumed",
+        "failed",
+        "expired",
+        "resent",
+        "overflows",
+    )
+
+    def __init__(self):
+        self.enabled = 0
+        self.detached = 0
+        self.resumed = 0
+        self.failed = 0  # Resumptions refused, the client had a full login
+        self.expired = 0
+        self.resent = 0  # Unacked stanzas sent again after a resumption
+        self.overflows = 0  # Sessions that lost the resumption, buffer full
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "enabled": self.enabled,
+            "detached": self.detached,
+            "resumed": self.resumed,
+            "failed": self.failed,
+            "expired": self.expired,
+            "resent": self.resent,
+            "overflows": self.overflows,
+        }
+
+
+class SMTransport:
+    """
+    Transport of a session with Stream Management (XEP-0198).
+
+    In a resumable session, the stanzas written are counted, and kept until
+    the client acks them, up to a bounded number. Past that bound, the
+    session can't be resumed.
+
+    When its connection is lost, a resumable session is detached: the
+    stanzas for it keep coming and are buffered, and they go out after the
+    ones not acked once the client resumes the session on a new connection
+    """
+
+    __slots__ = (
+        "_transport",
+        "_unacked",
+        "_max_unacked",
+        "_metrics",
+        "id",
+        "jid",
+        "peer",
+        "resume",
+        "sent",
+        "inbound",
+        "detached",
+        "timer",
+    )
+
+    def __init__(self, transport, jid: JID, peer: Peer, resume: bool):
+        self._transport = transport
+        self._unacked: Deque[bytes] = deque()
+        self._max_unacked = AppConfig.app_config.sm_max_unacked
+        self._metrics = SMMetrics()
+
+        self.id = str(uuid4())
+        self.jid = jid
+        self.peer = peer
+        self.resume = resume
+        self.sent = 0
+        self.inbound = 0
+        self.detached = False
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+    @property
+    def original_transport(self):
+        return self._transport
+
+    def __len__(self) -> int:
+        return len(self._unacked)
+
+    def write(self, data: bytes):
+        if not self.resume:
+            # Nothing is kept, so neither counted nor acked
+            if not self.detached:
+                self._transport.write(data)
+            return
+
+        stanzas = split_stanzas(data)
+        if stanzas:
+            self._unacked.extend(stanzas)
+            if len(self._unacked) > self._max_unacked:
+                logger.warning(f"Unacked stanzas of {self.jid} over the limit")
+                self._metrics.overflows += 1
+                self.resume = False
+                self._unacked.clear()
+
+        before = self.sent
+        self.sent = (self.sent + len(stanzas)) % H_MAX
+
+        if self.detached:
+            return
+
+        # Ask for an ack every ACK_INTERVAL stanzas, in the same write
+        if stanzas and self.sent // ACK_INTERVAL != before // ACK_INTERVAL:
+            data += REQUEST
+        self._transport.write(data)
+
+    def ack(self, h: int):
+        """
+        Drops the stanzas handled by the client
+        """
+        if not self.resume:
+            return  # Nothing kept
+
+        acked = (h - (self.sent - len(self._unacked))) % H_MAX
+        if acked > len(self._unacked):
+            logger.warning(f"{self.jid} acked more stanzas than the ones sent")
+            acked = len(self._unacked)
+        for _ in range(acked):
+            self._unacked.popleft()
+
+    def handled(self):
+        self.inbound = (self.inbound + 1) % H_MAX
+
+    def attach(self, transport, peer: Peer) -> bytes:
+        """
+        Moves the session to the transport of a new connection
+
+        :return: The unacked stanzas, to send again after the <resumed/>
+        """
+        self._transport = transport
+        self.peer = peer
+        self.detached = False
+
+        self._metrics.resent += len(self._unacked)
+        return b"".join(self._unacked)
+
+    def unacked(self):
+        return iter(self._unacked)
+
+    def is_closing(self) -> bool:
+        # A detached session still takes stanzas, until it expires
+        if self.detached:
+            return not self.resume
+        return self._transport.is_closing()
+
+    def __getattr__(self, name):
+        return getattr(self._transport, name)
+
+
+class StreamManagement(metaclass=Singleton):
+    """
+    Stream Management (XEP-0198).
+
+    Once enabled, the transport of the session is replaced in the
+    ConnectionManager by a SMTransport, which keeps the stanzas not acked by
+    the client.
+
+    If the connection is lost, a resumable session is kept detached for
+    `sm_resume_timeout` seconds: the session stays bound, with its presence,
+    and a resumption from a new connection only swaps its transport. No
+    bind, roster or presence broadcast, and no stanza lost in between.
+
+    An expired session goes through the path of a lost connection, and its
+    unacked messages are stored for the next login of the user
+    """
+
+    __slots__ = ("_sessions", "_transports", "_metrics")
+
+    def __init__(self):
+        self._sessions: Dict[str, SMTransport] = {}
+        self._transports: Dict[object, SMTransport] = {}
+        self._metrics = SMMetrics()
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def enable(self, jid: JID, transport, peer: Peer, resume: bool) -> SMTransport:
+        """
+        Wraps the transport of the session. A client state held by CSI is
+        left, the stanzas must be counted once they are actually written
+        """
+        if isinstance(transport, CSITransport):
+            transport.flush()
+            transport = transport.original_transport
+
+        resume = resume and AppConfig.app_config.sm_resume_timeout > 0
+        session = SMTransport(transport, jid, peer, resume)
+        self._sessions[session.id] = session
+        self._transports[transport] = session
+        self._metrics.enabled += 1
+        return session
+
+    def detach(self, transport) -> bool:
+        """
+        The connection of a session is lost
+
+        :return: True if the session is kept for a resumption. Otherwise,
+        the session ends as any other lost connection
+        """
+        session = self._transports.pop(transport, None)
+        if session is None or session.original_transport is not transport:
+            return False
+
+        if not session.resume:
+            self._sessions.pop(session.id, None)
+            return False
+
+        session.detached = True
+        session.timer = asyncio.get_running_loop().call_later(
+            AppConfig.app_config.sm_resume_timeout, self.expire, session
+        )
+        self._metrics.detached += 1
+        logger.debug(f"Session of {session.jid} detached")
+        return True
+
+    def drop(self, transport):
+        """
+        The stream was closed by the client, without resumption
+        """
+        session = self._transports.pop(transport, None)
+        if session is not None:
+            self._sessions.pop(session.id, None)
+
+    def resume(self, jid: JID, previd: str, h: int) -> Optional[SMTransport]:
+        """
+        Takes a session back, from the user that owns it.
+
+        A session still attached belongs to a connection not yet known as
+        lost. It's closed, and the new connection takes over
+
+        :return: The session, with the stanzas handled by the client acked.
+        None if the session is unknown, expired or from another user
+        """
+        session = self._sessions.get(previd)
+        if session is None or not session.resume or session.jid.bare() != jid.bare():
+            self._metrics.failed += 1
+            return None
+
+        if session.timer is not None:
+            session.timer.cancel()
+            session.timer = None
+
+        old = session.original_transport
+        self._transports.pop(old, None)
+        if not session.detached:
+            session.detached = True
+            old.close()
+
+        session.ack(h)
+        self._metrics.resumed += 1
+        return session
+
+    def attached(self, session: SMTransport):
+        self._transports[session.original_transport] = session
+
+    def expire(self, session: SMTransport):
+        """
+        The session wasn't resumed in time. It's lost for good
+        """
+        if self._sessions.pop(session.id, None) is None:
+            return
+
+        session.resume = False
+        self._metrics.expired += 1
+        logger.debug(f"Session of {session.jid} expired")
+
+        if AppConfig.app_config.message_persistence:
+            queue = get_queue(QueueName.MESSAGES)
+            bare = JID(session.jid.bare())
+            for payload in session.unacked():
+                stanza = ET.fromstring(payload)
+                _, tag = _local(stanza.tag)
+                if tag == "message" and stanza.find("{*}body") is not None:
+                    queue.put_nowait(PendingMessageWrapper(jid=bare, payload=payload))
+
+        Caps().forget(session.jid)
+        Presence().put_nowait(
+            (session.jid, ET.Element("presence", attrib={"type": "INTERNAL"}))
+        )
@@ -0,0 +1,186 @@
+from typing import Dict, List, Optional, Tuple, Union
+from xml.etree import ElementTree as ET
+
+from pyjabber.network.ConnectionManager import ConnectionManager
+from pyjabber.stream.JID import JID
+from pyjabber.utils import Singleton
+
+NAMESPACE = "urn:xmpp:csi:0"
+CHAT_STATES = "http://jabber.org/protocol/chatstates"
+PUBSUB_EVENT = "http://jabber.org/protocol/pubsub#event"
+
+BUFFER_SIZE = 256  # Stanzas held for an inactive session before a flush
+
+# Presence types only about availability. The rest (subscriptions, errors)
+# are never held
+_AVAILABILITY = (None, "unavailable")
+
+
+def _local(tag: str) -> Tuple[str, str]:
+    """
+    :return: (namespace, tag) of a Clark notation tag, with or without namespace
+    """
+    if tag.startswith("{"):
+        namespace, _, tag = tag[1:].partition("}")
+        return namespace, tag
+    return "", tag
+
+
+def classify(stanza: ET.Element) -> Union[bool, str]:
+    """
+    Whether a stanza can wait for the session to become active
+
+    :return: False for an urgent stanza. For a presence that can wait, the
+    sender it is kept by (a newer one from the same sender replaces it).
+    True for the rest of the stanzas that can wait
+    """
+    _, tag = _local(stanza.tag)
+
+    if tag == "presence":
+        if stanza.attrib.get("type") not in _AVAILABILITY:
+            return False
+        return stanza.attrib.get("from") or True
+
+    if tag == "message" and stanza.attrib.get("type") != "error":
+        payloads = {_local(child.tag) for child in stanza}
+        if not payloads or any(tag == "body" for _, tag in payloads):
+            return False
+        # Only chat states and pubsub events (PEP included)
+        return all(ns in (CHAT_STATES, PUBSUB_EVENT) for ns, _ in payloads)
+
+    return False
+
+
+class CSIMetrics(metaclass=Singleton):
+    """
+    Counters of the stanzas held for inactive sessions
+    """
+
+    __slots__ = ("held", "suppressed", "flushed", "flushes")
+
+    def __init__(self):
+        self.held = 0
+        self.suppressed = 0  # Presences replaced by a newer one, never sent
+        self.flushed = 0
+        self.flushes = 0
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "held": self.held,
+            "suppressed": self.suppressed,
+            "flushed": self.flushed,
+            "flushes": self.flushes,
+        }
+
+
+class CSITransport:
+    """
+    Transport of an inactive session. The stanzas that can wait are kept
+    until an urgent one comes, the buffer is full or the session is active
+    again, and go in the same write, in order
+    """
+
+    __slots__ = ("_transport", "_buffer", "_presences", "_metrics")
+
+    def __init__(self, transport):
+        self._transport = transport
+        self._buffer: List[Optional[bytes]] = []
+        # Sender -> position of its presence in the buffer
+        self._presences: Dict[str, int] = {}
+        self._metrics = CSIMetrics()
+
+    @property
+    def original_transport(self):
+        return self._transport
+
+    def __len__(self) -> int:
+        return len(self._buffer) - self._buffer.count(None)
+
+    def write(self, data: bytes):
+        try:
+            stanzas = list(ET.fromstring(b"<csi>" + data + b"</csi>"))
+        except ET.ParseError:
+            stanzas = []  # Not stanzas (stream elements), never held
+
+        kinds = [classify(s) for s in stanzas]
+        if not kinds or not all(kinds):
+            return self.flush(data)
+
+        for stanza, kind in zip(stanzas, kinds):
+            payload = data if len(stanzas) == 1 else ET.tostring(stanza)
+            if kind is not True:
+                index = self._presences.get(kind)
+                if index is not None:
+                    self._buffer[index] = None
+                    self._metrics.suppressed += 1
+                self._presences[kind] = len(self._buffer)
+            self._buffer.append(payload)
+            self._metrics.held += 1
+
+        if len(self._buffer) >= BUFFER_SIZE:
+            self.flush()
+
+    def flush(self, data: bytes = b""):
+        """
+        Writes the held stanzas, followed by the given data
+        """
+        held = [s for s in self._buffer if s is not None]
+        self._buffer.clear()
+        self._presences.clear()
+
+        if held:
+            self._metrics.flushed += len(held)
+            self._metrics.flushes += 1
+            held.append(data)
+            data = b"".join(held)
+        if data:
+            self._transport.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self._transport, name)
+
+
+class CSI(metaclass=Singleton):
+    """
+    Client State Indication (XEP-0352).
+
+    A client tells the server when it is not being used (a mobile app in the
+    background). While inactive, its presence updates, chat states and
+    pubsub events are held in a buffer of the session, where the presences
+    of a sender collapse into the latest one. The buffer goes out when an
+    urgent stanza comes (a message with body, an iq...), or when the client
+    is active again.
+
+    The buffer replaces the transport of the session in the ConnectionManager,
+    so the stanzas of every feature go through it
+    """
+
+    __slots__ = ("_connections",)
+
+    def __init__(self):
+        self._connections = ConnectionManager()
+
+    def feed(self, jid: JID, element: ET.Element):
+        """
+        Reads the <active/> or <inactive/> of the session
+
+        :return: The transport the session writes through from now on. None
+        if the session is not bound
+        """
+        clients = self._connections.get_transport(jid)
+        if not clients:
+            return None
+        transport = clients[0].transport
+
+        _, tag = _local(element.tag)
+        if tag == "inactive":
+            if not isinstance(transport, CSITransport):
+                transport = CSITransport(transport)
+                self._connections.update_transport_jid(transport, jid)
+
+        elif isinstance(transport, CSITransport):
+            transport.flush()
+            transport = transport.original_transport
+            self._connections.update_transport_jid(transport, jid)
+
+        return transport
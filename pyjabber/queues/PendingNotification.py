@@ -0,0 +1,23 @@
+from typing import Optional, Tuple
+from xml.etree import ElementTree as ET
+
+from attrs import define
+
+
+@define(frozen=True, slots=True)
+class PendingNotificationWrapper:
+    """
+    Represents a pubsub event waiting to be delivered to the subscribers of
+    a node.
+
+    The event is serialized once by the notification worker, and sent to every
+    resource of the receivers. The events of a PEP node come from the bare JID
+    of its owner, and go to the sessions that asked for them.
+    """
+
+    node: str
+    event: ET.Element
+    # Usernames of the local subscribers, or full JIDs for a PEP node
+    receivers: Tuple[str, ...]
+    created: float  # time.monotonic() of the request
+    sender: Optional[str] = None  # Owner of the PEP node. None for the service
@@ -7,6 +7,8 @@ class QueueName(Enum):
     CONNECTIONS = "connections"
     MESSAGES = "messages"
     SERVERS = "servers"
+    NOTIFICATIONS = "notifications"
+    PRESENCE = "presence"
 
 
 class QueueManager:
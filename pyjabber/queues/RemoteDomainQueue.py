@@ -0,0 +1,133 @@
+import time
+from collections import deque
+from enum import Enum
+from typing import Deque, List, Tuple
+
+from pyjabber.stream.JID import JID
+
+
+class RemoteStreamState(Enum):
+    """
+    Lifecycle of the outgoing S2S stream associated to a remote domain.
+    """
+
+    IDLE = 0
+    CONNECTING = 1
+    READY = 2
+
+
+class RemoteDomainQueue:
+    """
+    Outbound queue for a single remote domain.
+
+    It owns the state of the stream towards the domain and buffers the stanzas
+    sent while the connection is being dialed. Once the stream is ready, the
+    buffer is drained in batched writes.
+
+    :param host: Remote domain served by this queue
+    :param max_size: Max number of stanzas kept while the stream is not ready
+    :param ttl: Seconds a stanza may wait for the stream before being bounced
+    :param batch_size: Max number of bytes joined in a single transport write
+    """
+
+    __slots__ = ("_host", "_max_size", "_ttl", "_batch_size", "_state", "_pending")
+
+    def __init__(
+        self, host: str, max_size: int = 1000, ttl: float = 30, batch_size: int = 65536
+    ) -> None:
+        self._host = host
+        self._max_size = max_size
+        self._ttl = ttl
+        self._batch_size = batch_size
+
+        self._state = RemoteStreamState.IDLE
+        self._pending: Deque[Tuple[float, JID, bytes]] = deque()
+
+    @property
+    def host(self) -> str:
+        return self._host
+
+    @property
+    def state(self) -> RemoteStreamState:
+        return self._state
+
+    @property
+    def ttl(self) -> float:
+        return self._ttl
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def put(self, jid: JID, payload: bytes) -> bool:
+        """
+        Buffer a stanza until the stream is ready.
+
+        :return: False if the queue is full and the stanza must be bounced
+        """
+        if len(self._pending) >= self._max_size:
+            return False
+
+        self._pending.append((time.monotonic(), jid, payload))
+        return True
+
+    def connecting(self) -> None:
+        self._state = RemoteStreamState.CONNECTING
+
+    def reset(self) -> None:
+        """
+        Mark the stream as lost. The next stanza will trigger a new dial.
+        """
+        self._state = RemoteStreamState.IDLE
+
+    def flush(self, transport) -> int:
+        """
+        Mark the stream as ready and drain the buffer into the given transport,
+        joining consecutive stanzas up to ``batch_size`` bytes per write.
+
+        :return: Number of stanzas written
+        """
+        self._state = RemoteStreamState.READY
+
+        sent = 0
+        batch, batch_len = [], 0
+        while self._pending:
+            _, _, payload = self._pending.popleft()
+            if batch and batch_len + len(payload) > self._batch_size:
+                transport.write(b"".join(batch))
+                batch, batch_len = [], 0
+
+            batch.append(payload)
+            batch_len += len(payload)
+            sent += 1
+
+        if batch:
+            transport.write(b"".join(batch))
+
+        return sent
+
+    def expired(self) -> List[Tuple[JID, bytes]]:
+        """
+        Pop the stanzas that have been waiting longer than the TTL.
+        """
+        limit = time.monotonic() - self._ttl
+        res = []
+        while self._pending and self._pending[0][0] <= limit:
+            _, jid, payload = self._pending.popleft()
+            res.append((jid, payload))
+        return res
+
+    def next_expiry(self) -> float:
+        """
+        Seconds until the oldest buffered stanza expires (0 if the queue is empty)
+        """
+        if not self._pending:
+            return 0
+        return max(self._pending[0][0] + self._ttl - time.monotonic(), 0)
+
+    def drain(self) -> List[Tuple[JID, bytes]]:
+        """
+        Pop every buffered stanza. Used to bounce them when the dial fails.
+        """
+        res = [(jid, payload) for _, jid, payload in self._pending]
+        self._pending.clear()
+        return res
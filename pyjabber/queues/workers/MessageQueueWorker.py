@@ -1,15 +1,61 @@
 import asyncio
-from typing import Dict, List, Union
+from typing import Dict, List, Tuple, Union
 from uuid import uuid4
 from xml.etree import ElementTree as ET
 
-from pyjabber.AppConfig import app_config
+from pyjabber import AppConfig
 from pyjabber.network.ConnectionManager import ConnectionManager
 from pyjabber.queues.FailedRemoteConnection import FailedRemoteConnectionWrapper
 from pyjabber.queues.NewConnection import NewConnectionWrapper
 from pyjabber.queues.PendingMessage import PendingMessageWrapper
 from pyjabber.queues.QueueManager import QueueName, get_queue
+from pyjabber.queues.RemoteDomainQueue import RemoteDomainQueue, RemoteStreamState
 from pyjabber.stream.JID import JID
+from pyjabber.utils import ClarkNotation as CN
+
+REMOTE_SERVER_TIMEOUT = "remote-server-timeout"
+
+BOUNCE_ERROR_TYPE = {
+    "remote-server-not-found": "cancel",
+    "remote-server-timeout": "wait",
+    "resource-constraint": "wait",
+    "service-unavailable": "wait",
+}
+
+
+def bounce_stanzas(stanzas: List[Tuple[JID, bytes]], reason: str) -> None:
+    """
+    Return to the local senders the stanzas that could not be delivered to
+    a remote domain, as error stanzas with the given condition.
+
+    :param stanzas: List of (receiver, payload) tuples
+    :param reason: Defined condition of the error (RFC 6120 8.3.3)
+    """
+    if reason not in BOUNCE_ERROR_TYPE:
+        reason = "service-unavailable"
+
+    connection_manager = ConnectionManager()
+
+    error = ET.Element("error", attrib={"type": BOUNCE_ERROR_TYPE[reason]})
+    ET.SubElement(error, f"{{urn:ietf:params:xml:ns:xmpp-stanzas}}{reason}")
+
+    for jid, payload in stanzas:
+        payload = ET.fromstring(payload)
+        sender = payload.attrib.get("from")
+        if not sender:
+            continue
+
+        _, tag = CN.break_down(payload.tag)
+        payload.tag = f"{{jabber:client}}{tag}"
+        payload.attrib["from"] = str(jid)
+        payload.attrib["to"] = sender
+        payload.attrib["type"] = "error"
+        payload.attrib["id"] = payload.attrib.get("id") or str(uuid4())
+        payload.append(error)
+
+        bounce = ET.tostring(payload)
+        for buffer in connection_manager.get_transport(JID(sender)):
+            buffer.transport.write(bounce)
 
 
 async def queue_worker():
@@ -19,19 +65,40 @@ async def queue_worker():
 
     - For the new connections queue, the worker checks if there are any pending
       messages in the buffer for the new connection's JID. If so, it processes
-      them.
+      them. Remote domains are served by a RemoteDomainQueue, drained in batched
+      writes once its stream is ready.
     - For the new messages queue, the worker directly enqueues incoming
       messages into the pending messages buffer.
     """
     local_pending_stanzas: Dict[str, List[bytes]] = {}
-    remote_pending_stanzas: Dict[str, List[tuple[JID, bytes]]] = {}
+    remote_queues: Dict[str, RemoteDomainQueue] = {}
 
     connection_manager = ConnectionManager()
+    loop = asyncio.get_running_loop()
 
     con_queue = get_queue(QueueName.CONNECTIONS)
     msg_queue = get_queue(QueueName.MESSAGES)
     s2s_queue = get_queue(QueueName.SERVERS)
 
+    # Remote domain -> pending expiry check of its queue. One per domain
+    timers: Dict[str, asyncio.TimerHandle] = {}
+
+    def timeout(host: str):
+        timers.pop(host, None)
+        con_queue.put_nowait(
+            FailedRemoteConnectionWrapper(value=host, reason=REMOTE_SERVER_TIMEOUT)
+        )
+
+    def schedule_timeout(host: str, delay: float):
+        if host not in timers:
+            timers[host] = loop.call_later(delay, timeout, host)
+
+    def discard(host: str):
+        remote_queues.pop(host, None)
+        timer = timers.pop(host, None)
+        if timer is not None:
+            timer.cancel()
+
     try:
         while True:
             con_task = asyncio.create_task(con_queue.get())
@@ -83,27 +150,48 @@ async def queue_worker():
 
                 else:
                     host = result.value
-                    if host in remote_pending_stanzas:
-                        stanzas_list = remote_pending_stanzas[host]
-                        buffer = connection_manager.get_server_transport_host(host)
-
-                        while remote_pending_stanzas[host]:
-                            _, stanza_bytes = stanzas_list.pop()
-                            buffer.write(stanza_bytes)
-                        remote_pending_stanzas.pop(host, None)
+                    remote_queue = remote_queues.get(host)
+                    transport = connection_manager.get_server_transport_host(host)
+                    if remote_queue and transport:
+                        remote_queue.flush(transport)
+                        discard(host)
 
             elif isinstance(result, PendingMessageWrapper):
                 jid = result.jid
                 payload = result.payload
 
                 if result.is_external:
-                    if jid.domain not in remote_pending_stanzas:
-                        remote_pending_stanzas[jid.domain] = []
-                        await s2s_queue.put(
-                            jid.domain
-                        )  # Put remote host on connection queue
+                    host = jid.domain
+                    remote_queue = remote_queues.get(host)
+                    transport = connection_manager.get_server_transport_host(host)
+
+                    # Only the domains without a stream have a queue
+                    if transport:
+                        if remote_queue is not None:
+                            remote_queue.flush(transport)
+                            discard(host)
+                        transport.write(payload)
+                        continue
+
+                    if remote_queue is None:
+                        remote_queue = RemoteDomainQueue(
+                            host,
+                            max_size=AppConfig.app_config.s2s_queue_size,
+                            ttl=AppConfig.app_config.s2s_queue_ttl,
+                        )
+                        remote_queues[host] = remote_queue
+
+                    if not remote_queue.put(jid, payload):
+                        bounce_stanzas([(jid, payload)], "resource-constraint")
+                        continue
+
+                    if len(remote_queue) == 1:
+                        schedule_timeout(host, remote_queue.ttl)
+
+                    if remote_queue.state == RemoteStreamState.IDLE:
+                        remote_queue.connecting()
+                        await s2s_queue.put(host)  # Put remote host on connection queue
 
-                    remote_pending_stanzas[jid.domain].append((jid, payload))
                 else:
                     if str(jid) not in local_pending_stanzas:
                         local_pending_stanzas[str(jid)] = []
@@ -111,35 +199,28 @@ async def queue_worker():
 
             else:  # FailedRemoteConnectionWrapper
                 host = result.value
-                error = ET.Element(
-                    "error",
-                    attrib={
-                        "type": "cancel"
-                        if result.reason == "remote-server-not-found"
-                        else "wait"
-                    },
-                )
-
-                if result.reason == "remote-server-not-found":
-                    tag = "{urn:ietf:params:xml:ns:xmpp-stanzas}remote-server-not-found"
-                else:
-                    tag = "{urn:ietf:params:xml:ns:xmpp-stanzas}service-unavailable"
-
-                ET.SubElement(error, tag)
+                remote_queue = remote_queues.get(host)
+                if remote_queue is None:
+                    continue
+
+                if result.reason == REMOTE_SERVER_TIMEOUT:
+                    expired = remote_queue.expired()
+                    bounce_stanzas(expired, REMOTE_SERVER_TIMEOUT)
+                    if not len(remote_queue):
+                        # The next stanza dials again
+                        discard(host)
+                        continue
+
+                    # A whole TTL without the stream ready: the dial failed
+                    # after the TCP connect (TLS, SASL...), with no failure
+                    # reported. Dial again for the stanzas left
+                    if expired and remote_queue.state == RemoteStreamState.CONNECTING:
+                        await s2s_queue.put(host)
+                    schedule_timeout(host, remote_queue.next_expiry())
 
-                for jid, payload in remote_pending_stanzas[host]:
-                    payload = ET.fromstring(payload)
-                    payload.attrib["from"] = app_config.host
-                    payload.attrib["to"] = str(jid)
-                    payload.attrib["type"] = "error"
-                    payload.attrib["id"] = str(uuid4())
-                    payload.append(error)
-
-                    for buffer in connection_manager.get_transport(jid):
-                        buffer.transport.write(ET.tostring(payload))
-
-                if result.reason == "remote-server-not-found":
-                    remote_pending_stanzas.pop(host, None)
+                else:
+                    bounce_stanzas(remote_queue.drain(), result.reason)
+                    discard(host)
 
     except asyncio.CancelledError:
         pass
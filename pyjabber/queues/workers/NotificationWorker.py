@@ -0,0 +1,145 @@
+import asyncio
+import time
+from typing import Dict, Optional, Tuple
+from uuid import uuid4
+from xml.etree import ElementTree as ET
+from xml.sax.saxutils import escape
+
+from loguru import logger
+
+from pyjabber import AppConfig
+from pyjabber.network.ConnectionManager import ConnectionManager
+from pyjabber.queues.PendingNotification import PendingNotificationWrapper
+from pyjabber.queues.QueueManager import QueueName, get_queue
+from pyjabber.stanzas.Message import Message
+from pyjabber.stream.JID import JID
+from pyjabber.utils import Singleton
+
+FANOUT_BATCH = 256  # Receivers served before yielding to the loop
+
+_MESSAGE_OPEN = b"<message"
+
+
+class NotificationMetrics(metaclass=Singleton):
+    """
+    Counters of the pubsub notification fan-out.
+    The latency of an event goes from the request that produced it to the
+    write of its last notification
+    """
+
+    __slots__ = (
+        "events",
+        "deliveries",
+        "pending_receivers",
+        "latency_total",
+        "latency_max",
+        "latency_last",
+    )
+
+    def __init__(self):
+        self.events = 0
+        self.deliveries = 0
+        self.pending_receivers = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        self.latency_last = 0.0
+
+    def done(self, latency: float):
+        self.events += 1
+        self.latency_total += latency
+        self.latency_max = max(self.latency_max, latency)
+        self.latency_last = latency
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "queue_depth": get_queue(QueueName.NOTIFICATIONS).qsize(),
+            "pending_receivers": self.pending_receivers,
+            "events": self.events,
+            "deliveries": self.deliveries,
+            "latency_avg_ms": (self.latency_total / self.events * 1e3)
+            if self.events
+            else 0.0,
+            "latency_max_ms": self.latency_max * 1e3,
+            "latency_last_ms": self.latency_last * 1e3,
+        }
+
+
+def serialize(event: ET.Element, sender: Optional[str] = None) -> Tuple[bytes, bytes]:
+    """
+    Serializes the notification message once, without receiver.
+
+    :param sender: Bare JID of the PEP account. The server by default
+    :return: (head, tail). The stanza of a receiver is head + to + tail
+    """
+    message = Message(
+        mto=None,
+        mfrom=sender or AppConfig.app_config.host,
+        id=str(uuid4()),
+        mtype=None,
+        body=event,
+    )
+    stanza = ET.tostring(message)
+    return stanza[: len(_MESSAGE_OPEN)], stanza[len(_MESSAGE_OPEN) :]
+
+
+async def fanout(notification: PendingNotificationWrapper):
+    """
+    Sends the event to every resource of the receivers, in batches of
+    FANOUT_BATCH receivers. The loop is released between batches.
+    The receivers of a PEP event are sessions, each one gets it once
+    """
+    connection_manager = ConnectionManager()
+    metrics = NotificationMetrics()
+    host = AppConfig.app_config.host
+    pep = notification.sender is not None
+
+    head, tail = serialize(notification.event, notification.sender)
+    receivers = notification.receivers
+
+    served = 0
+    try:
+        for start in range(0, len(receivers), FANOUT_BATCH):
+            batch = receivers[start : start + FANOUT_BATCH]
+            for receiver in batch:
+                jid = JID(receiver) if pep else JID(user=receiver, domain=host)
+                clients = connection_manager.get_transport(jid)
+                if not clients:
+                    continue
+
+                to = receiver if pep else f"{receiver}@{host}"
+                to = escape(to, {'"': "&quot;"}).encode()
+                stanza = b"".join((head, b' to="', to, b'"', tail))
+                for client in clients:
+                    client.transport.write(stanza)
+                metrics.deliveries += len(clients)
+
+            served += len(batch)
+            metrics.pending_receivers -= len(batch)
+            await asyncio.sleep(0)
+
+    finally:
+        metrics.pending_receivers -= len(receivers) - served
+
+    metrics.done(time.monotonic() - notification.created)
+
+
+async def notification_worker():
+    """
+    Returns a coroutine that delivers the pubsub events of the notifications
+    queue, in order of arrival.
+
+    Publishing only enqueues the event, so the result of the request does not
+    wait for the fan-out to the subscribers.
+    """
+    queue = get_queue(QueueName.NOTIFICATIONS)
+
+    try:
+        while True:
+            notification: PendingNotificationWrapper = await queue.get()
+            try:
+                await fanout(notification)
+            except Exception as e:
+                logger.error(f"Unable to notify node {notification.node}: {e}")
+
+    except asyncio.CancelledError:
+        pass
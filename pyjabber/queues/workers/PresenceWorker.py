@@ -0,0 +1,90 @@
+import asyncio
+from asyncio import Transport
+from typing import Dict, List, Tuple
+from xml.etree import ElementTree as ET
+
+from loguru import logger
+
+from pyjabber.features.presence.PresenceFeature import Presence
+from pyjabber.network.ConnectionManager import ConnectionManager
+from pyjabber.queues.QueueManager import QueueName, get_queue
+from pyjabber.stream.JID import JID
+
+COALESCE_WINDOW = 0.5  # Seconds a lost session has to come back unnoticed
+PRESENCE_BATCH = 1024  # Lost sessions processed before yielding to the loop
+
+
+def coalesce(events: List[Tuple[JID, ET.Element]]) -> List[JID]:
+    """
+    The sessions to announce as unavailable, once each. A session bound
+    again meanwhile (a reconnection with the same resource) is left out, so
+    its contacts never see it leave
+    """
+    connection_manager = ConnectionManager()
+
+    lost: Dict[str, JID] = {}
+    for jid, _ in events:
+        if isinstance(jid, JID):
+            lost[str(jid)] = jid
+
+    return [
+        jid
+        for jid in lost.values()
+        if not any(
+            not client.transport.is_closing()
+            for client in connection_manager.get_transport_online(jid)
+        )
+    ]
+
+
+def flush(outbox: Dict[Transport, List[bytes]]) -> int:
+    """
+    Writes the pending presences, joined in one write per receiver
+
+    :return: Number of writes
+    """
+    for transport, stanzas in outbox.items():
+        transport.write(b"".join(stanzas))
+    return len(outbox)
+
+
+async def presence_worker():
+    """
+    Returns a coroutine that processes the connections lost by the clients.
+
+    The protocol only enqueues the session when its connection drops. The
+    worker waits COALESCE_WINDOW after the first event, so a network outage
+    is processed as one batch: each session once, without the ones that came
+    back, and each receiver gets all its unavailable presences in one write.
+    """
+    queue = get_queue(QueueName.PRESENCE)
+
+    try:
+        while True:
+            events = [await queue.get()]
+            await asyncio.sleep(COALESCE_WINDOW)
+            while not queue.empty():
+                events.append(queue.get_nowait())
+
+            try:
+                presence = Presence()
+                lost = coalesce(events)
+
+                outbox: Dict[Transport, List[bytes]] = {}
+                for start in range(0, len(lost), PRESENCE_BATCH):
+                    presence.lost_connections(
+                        lost[start : start + PRESENCE_BATCH], outbox
+                    )
+                    await asyncio.sleep(0)
+
+                flush(outbox)
+                logger.debug(
+                    f"{len(lost)} sessions lost, "
+                    f"{len(events) - len(lost)} coalesced, "
+                    f"{len(outbox)} receivers notified"
+                )
+            except Exception as e:
+                logger.error(f"Unable to process {len(events)} lost connections: {e}")
+
+    except asyncio.CancelledError:
+        pass
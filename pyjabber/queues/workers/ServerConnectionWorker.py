@@ -9,6 +9,7 @@ from pyjabber.network.protocols.XMLProtocolServerOutgoing import (
     XMLProtocolServerOutgoing,
 )
 from pyjabber.queues.FailedRemoteConnection import FailedRemoteConnectionWrapper
+from pyjabber.queues.NewConnection import NewConnectionWrapper
 from pyjabber.queues.QueueManager import QueueName, get_queue
 
 
@@ -16,18 +17,23 @@ async def server_connection_worker():
     """
     Returns a coroutine that watches a queue for connection requests to
     external servers (S2S).
+
+    A failed dial is reported to the message queue worker as a
+    FailedRemoteConnectionWrapper, so the pending stanzas get bounced, and the
+    worker keeps serving the next requests.
     """
     server_queue = get_queue(QueueName.SERVERS)
     connection_queue = get_queue(QueueName.CONNECTIONS)
     connection_manager = ConnectionManager()
     loop = asyncio.get_running_loop()
 
-    try:
-        while True:
+    while True:
+        try:
             host = await server_queue.get()
 
             already_open = connection_manager.get_server_transport_host(host)
             if already_open:
+                await connection_queue.put(NewConnectionWrapper(host, False))
                 continue
 
             await loop.create_connection(
@@ -41,17 +47,25 @@ async def server_connection_worker():
                 family=AppConfig.app_config.family,
             )
 
-    except asyncio.CancelledError:
-        pass
+        except asyncio.CancelledError:
+            break
 
-    except (ConnectionRefusedError, asyncio.TimeoutError):
-        logger.info(f"Remote server <{host}> rejected connection")
-        await connection_queue.put(
-            FailedRemoteConnectionWrapper(value=host, reason="service-unavailable")
-        )
+        except (ConnectionRefusedError, asyncio.TimeoutError):
+            logger.info(f"Remote server <{host}> rejected connection")
+            await connection_queue.put(
+                FailedRemoteConnectionWrapper(value=host, reason="service-unavailable")
+            )
 
-    except socket.gaierror:
-        logger.info(f"Remote server <{host}> not found in the DNS lookup")
-        await connection_queue.put(
-            FailedRemoteConnectionWrapper(value=host, reason="remote-server-not-found")
-        )
+        except socket.gaierror:
+            logger.info(f"Remote server <{host}> not found in the DNS lookup")
+            await connection_queue.put(
+                FailedRemoteConnectionWrapper(
+                    value=host, reason="remote-server-not-found"
+                )
+            )
+
+        except OSError as e:
+            logger.info(f"Unable to reach remote server <{host}>: {e}")
+            await connection_queue.put(
+                FailedRemoteConnectionWrapper(value=host, reason="service-unavailable")
+            )
@@ -1,23 +1,25 @@
 import asyncio
-import multiprocessing
 import os
 import signal
 import ssl
-from concurrent.futures.process import ProcessPoolExecutor
 
 from loguru import logger
 
 from pyjabber import AppConfig
-from pyjabber.db.database import DB
+from pyjabber.db.database import DB, ShardingError
 from pyjabber.features.presence.PresenceFeature import Presence
+from pyjabber.features.SASL.KDF import KDFExecutor, KDFMode
 from pyjabber.http_server import HttpServer
 from pyjabber.network import CertGenerator
 from pyjabber.network.protocols.XMLProtocol import XMLProtocol
 from pyjabber.plugins.xep_0060.xep_0060 import PubSub
+from pyjabber.plugins.xep_0115.xep_0115 import Caps
 from pyjabber.plugins.xep_0363.upload_server import UploadHttpServer
 from pyjabber.plugins.xep_0363.xep_0363 import HTTPFieldUpload
 from pyjabber.queues.QueueManager import QueueName, get_queue
 from pyjabber.queues.workers.MessageQueueWorker import queue_worker
+from pyjabber.queues.workers.NotificationWorker import notification_worker
+from pyjabber.queues.workers.PresenceWorker import presence_worker
 from pyjabber.queues.workers.ServerConnectionWorker import server_connection_worker
 from pyjabber.server_parameters import Parameters
 from pyjabber.utils.ServerUtils import setup_ip_by_host, setup_query_local_ip
@@ -29,8 +31,8 @@ SERVER_FILE_PATH = os.path.dirname(os.path.abspath(__file__))
 class Server:
     """Server class
 
-    :param param: Instance of Parameter class, with all the configuration available for the protocols. If not provided,
-    a default profile will be loaded
+    :param param: Instance of Parameter class, with all the configuration available
+    for the protocols. If not provided, a default profile will be loaded
     """
 
     def __init__(self, param: Parameters = Parameters()):
@@ -57,8 +59,17 @@ class Server:
                 CertGenerator.generate_hostname_cert(param.host, cert_path)
         except FileNotFoundError as e:
             logger.error(
-                f"{e.__class__.__name__}: Pass an existing directory in your system to load the certs. "
-                f"Closing protocols"
+                f"{e.__class__.__name__}: Pass an existing directory in your system "
+                "to load the certs. Closing protocols"
+            )
+            raise SystemExit
+
+        try:
+            KDFMode(param.kdf_mode)
+        except ValueError:
+            logger.error(
+                f"Unknown KDF mode '{param.kdf_mode}'. "
+                f"Use one of {[m.value for m in KDFMode]}"
             )
             raise SystemExit
 
@@ -76,6 +87,19 @@ class Server:
             keyfile=os.path.join(cert_path, f"{param.host}_key.pem"),
         )
 
+        # Incoming server streams authenticate with SASL EXTERNAL,
+        # so the certificate of the remote server is requested
+        ssl_context_s2s_incoming = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        ssl_context_s2s_incoming.verify_mode = ssl.CERT_OPTIONAL
+        ssl_context_s2s_incoming.load_cert_chain(
+            certfile=os.path.join(cert_path, f"{param.host}_cert.pem"),
+            keyfile=os.path.join(cert_path, f"{param.host}_key.pem"),
+        )
+        if os.path.isfile(os.path.join(cert_path, "ca_cert.pem")):
+            ssl_context_s2s_incoming.load_verify_locations(
+                cafile=os.path.join(cert_path, "ca_cert.pem")
+            )
+
         AppConfig.app_config = AppConfig.AppConfig(
             host=param.host,
             ip=[self._host_ip, self._public_ip],
@@ -94,11 +118,27 @@ class Server:
             cert_path=cert_path,
             root_path=SERVER_FILE_PATH,
             message_persistence=param.message_persistence or False,
-            semaphore=asyncio.Semaphore(multiprocessing.cpu_count()),
-            process_pool_exe=ProcessPoolExecutor(multiprocessing.cpu_count()),
             verbose=param.verbose,
             plugins=param.plugins,
             items=param.items,
+            s2s_queue_size=param.s2s_queue_size,
+            s2s_queue_ttl=param.s2s_queue_ttl,
+            ssl_context_s2s_incoming=ssl_context_s2s_incoming,
+            fast_token_ttl=param.fast_token_ttl,
+            kdf_mode=param.kdf_mode,
+            kdf_workers=param.kdf_workers,
+            login_rate=param.login_rate,
+            login_burst=param.login_burst,
+            login_max_wait=param.login_max_wait,
+            credential_cache_size=param.credential_cache_size,
+            credential_cache_negative_ttl=param.credential_cache_negative_ttl,
+            database_write_timeout=param.database_write_timeout,
+            database_read_timeout=param.database_read_timeout,
+            database_readers=param.database_readers,
+            database_shards=param.database_shards,
+            caps_persistence=param.caps_persistence,
+            sm_resume_timeout=param.sm_resume_timeout,
+            sm_max_unacked=param.sm_max_unacked,
         )
 
         # HTTP Server
@@ -124,7 +164,11 @@ class Server:
         try:
             logger.info("Starting protocols...")
 
-            await DB.setup_database()
+            try:
+                await DB.setup_database()
+            except ShardingError as e:
+                logger.error(e)
+                self.raise_exit()
             if not self._database_in_memory:
                 DB.run_db_migrations()
 
@@ -134,6 +178,9 @@ class Server:
             pubsub = PubSub()
             await pubsub.update_memory_from_database()
 
+            if AppConfig.app_config.caps_persistence:
+                await Caps().load()
+
             loop = asyncio.get_running_loop()
 
             try:
@@ -153,9 +200,8 @@ class Server:
                 self.raise_exit()
 
             logger.info(f"Client domain => {self._host}")
-            logger.info(
-                f"Server is listening clients on {[s.getsockname() for s in self._client_listener.sockets if s]}"
-            )
+            sockets = [s.getsockname() for s in self._client_listener.sockets if s]
+            logger.info(f"Server is listening clients on {sockets}")
 
             try:
                 self._server_listener = await loop.create_server(
@@ -173,20 +219,20 @@ class Server:
                 logger.error(e)
                 raise SystemExit
 
-            logger.info(
-                f"Server is listening servers on {[s.getsockname() for s in self._server_listener.sockets if s]}"
-            )
+            sockets = [s.getsockname() for s in self._server_listener.sockets if s]
+            logger.info(f"Server is listening servers on {sockets}")
             logger.success("Server started...")
             self._ready.set()
 
             while True:
-                # Keep the coroutine alive, in order to catch the CancelledError exception
+                # Keep the coroutine alive, in order to catch the CancelledError
                 await asyncio.sleep(3600)
 
         except asyncio.CancelledError:
             logger.info("Stopping server...")
 
             await DB.close_engine_async()
+            KDFExecutor().shutdown()
 
             if self._client_listener and self._client_listener.is_serving():
                 self._client_listener.close()
@@ -208,6 +254,8 @@ class Server:
         _ = get_queue(QueueName.CONNECTIONS)
         _ = get_queue(QueueName.MESSAGES)
         _ = get_queue(QueueName.SERVERS)
+        _ = get_queue(QueueName.NOTIFICATIONS)
+        _ = get_queue(QueueName.PRESENCE)
 
         signal.signal(signal.SIGINT, self.raise_exit)
         signal.signal(signal.SIGABRT, self.raise_exit)
@@ -219,6 +267,8 @@ class Server:
             tasks = [
                 asyncio.create_task(queue_worker()),
                 asyncio.create_task(server_connection_worker()),
+                asyncio.create_task(notification_worker()),
+                asyncio.create_task(presence_worker()),
                 asyncio.create_task(self.run_server()),
             ]
 
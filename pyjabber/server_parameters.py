@@ -19,6 +19,23 @@ class Parameters:
     database_debug: bool = False
     cert_path: str = None
     message_persistence: bool = True
+    s2s_queue_size: int = 1000
+    s2s_queue_ttl: int = 30
+    fast_token_ttl: int = 14 * 24 * 3600
+    kdf_mode: str = "thread"
+    kdf_workers: int = None
+    login_rate: float = 10.0
+    login_burst: int = 20
+    login_max_wait: float = 5.0
+    credential_cache_size: int = 10000
+    credential_cache_negative_ttl: float = 30.0
+    database_write_timeout: float = 5.0
+    database_read_timeout: float = 5.0
+    database_readers: int = 4
+    database_shards: int = 1
+    caps_persistence: bool = False
+    sm_resume_timeout: int = 300
+    sm_max_unacked: int = 1000
     verbose: bool = False
     plugins: List[str] = [
         "http://jabber.org/protocol/disco#info",
@@ -34,6 +51,8 @@ class Parameters:
         "urn:xmpp:ping",
         "jabber:iq:rpc",
         "urn:xmpp:http:upload:0",
+        "urn:xmpp:csi:0",
+        "urn:xmpp:sm:3",
     ]
 
     items: Dict[str, Dict[str, str]] = {
@@ -26,7 +26,10 @@ def bad_request() -> bytes:  # pragma: no cover
         <bad-request xmlns='urn:ietf:params:xml:ns:xmpp-stanzas'/>
     </error>
     """
-    return "<error type='modify'><bad-request xmlns='urn:ietf:params:xml:ns:xmpp-stanzas'/></error>".encode()
+    return (
+        "<error type='modify'>"
+        "<bad-request xmlns='urn:ietf:params:xml:ns:xmpp-stanzas'/></error>"
+    ).encode()
 
 
 def conflict_error(id: str) -> bytes:
@@ -44,6 +47,19 @@ def conflict_error(id: str) -> bytes:
     return ET.tostring(iq)
 
 
+def resource_constraint(id: str) -> bytes:
+    iq = ET.Element(
+        "iq", attrib={"id": id, "type": "error", "from": AppConfig.app_config.host}
+    )
+    error = ET.SubElement(iq, "error", attrib={"type": "wait"})
+    ET.SubElement(
+        error,
+        "resource-constraint",
+        attrib={"xmlns": "urn:ietf:params:xml:ns:xmpp-stanzas"},
+    )
+    return ET.tostring(iq)
+
+
 def feature_not_implemented(feature: str, namespace: str) -> bytes:  # pragma: no cover
     """
     <error type='cancel'>
@@ -54,8 +70,9 @@ def feature_not_implemented(feature: str, namespace: str) -> bytes:  # pragma: n
     </error>
     """
     return (
-        f"<error type='cancel'><feature-not-implemented xmlns='urn:ietf:params:xml:ns:xmpp-stanzas'/><unsupported "
-        f"xmlns='{namespace}' feature='{feature}'/></error>"
+        "<error type='cancel'>"
+        "<feature-not-implemented xmlns='urn:ietf:params:xml:ns:xmpp-stanzas'/>"
+        f"<unsupported xmlns='{namespace}' feature='{feature}'/></error>"
     ).encode()
 
 
@@ -67,7 +84,9 @@ def invalid_xml() -> bytes:  # pragma: no cover
     </stream:error>
     </stream:stream>
     """
-    return f"<stream:error><invalid-xml xmlns='{XMLNS}'/></stream:error></stream:stream>".encode()
+    return (
+        f"<stream:error><invalid-xml xmlns='{XMLNS}'/></stream:error></stream:stream>"
+    ).encode()
 
 
 def internal_server_error() -> bytes:  # pragma: no cover
@@ -77,7 +96,36 @@ def internal_server_error() -> bytes:  # pragma: no cover
             xmlns='urn:ietf:params:xml:ns:xmpp-streams'/>
     </stream:error>
     """
-    return "<stream:error><internal-protocols-error xmlns='urn:ietf:params:xml:ns:xmpp-streams'/></stream:error>".encode()
+    return (
+        "<stream:error>"
+        "<internal-protocols-error xmlns='urn:ietf:params:xml:ns:xmpp-streams'/>"
+        "</stream:error>"
+    ).encode()
+
+
+def invalid_from() -> bytes:
+    """
+    <stream:error>
+      <invalid-from xmlns='urn:ietf:params:xml:ns:xmpp-streams'/>
+    </stream:error>
+    """
+    return (
+        "<stream:error><invalid-from xmlns='urn:ietf:params:xml:ns:xmpp-streams'/>"
+        "</stream:error>"
+    ).encode()
+
+
+def improper_addressing() -> bytes:
+    """
+    <stream:error>
+      <improper-addressing xmlns='urn:ietf:params:xml:ns:xmpp-streams'/>
+    </stream:error>
+    """
+    return (
+        "<stream:error>"
+        "<improper-addressing xmlns='urn:ietf:params:xml:ns:xmpp-streams'/>"
+        "</stream:error>"
+    ).encode()
 
 
 def item_not_found() -> bytes:  # pragma: no cover
@@ -101,9 +149,16 @@ def not_acceptable(text: str = None) -> bytes:
     </error>
     """
     if text:
-        return f"<error type='modify'><not-acceptable xmlns='urn:ietf:params:xml:ns:xmpp-stanzas'><text>{text}</text></not-acceptable></error>".encode()
+        return (
+            "<error type='modify'>"
+            "<not-acceptable xmlns='urn:ietf:params:xml:ns:xmpp-stanzas'>"
+            f"<text>{text}</text></not-acceptable></error>"
+        ).encode()
     else:
-        return "<error type='modify'><not-acceptable xmlns='urn:ietf:params:xml:ns:xmpp-stanzas'/></error>".encode()
+        return (
+            "<error type='modify'>"
+            "<not-acceptable xmlns='urn:ietf:params:xml:ns:xmpp-stanzas'/></error>"
+        ).encode()
 
 
 def not_authorized_sasl() -> bytes:  # pragma: no cover
@@ -112,7 +167,9 @@ def not_authorized_sasl() -> bytes:  # pragma: no cover
         <not-authorized/>
     </failure>
     """
-    return "<failure xmlns='urn:ietf:params:xml:ns:xmpp-sasl'><not-authorized/></failure>".encode()
+    return (
+        "<failure xmlns='urn:ietf:params:xml:ns:xmpp-sasl'><not-authorized/></failure>"
+    ).encode()
 
 
 def not_authorized() -> bytes:
@@ -121,14 +178,21 @@ def not_authorized() -> bytes:
       <not-authorized xmlns='urn:ietf:params:xml:ns:xmpp-streams'/>
     </stream:error>
     """
-    return "<stream:error><not-authorized xmlns='urn:ietf:params:xml:ns:xmpp-streams'/></stream:error>".encode()
+    return (
+        "<stream:error><not-authorized xmlns='urn:ietf:params:xml:ns:xmpp-streams'/>"
+        "</stream:error>"
+    ).encode()
 
 
 def not_well_formed() -> bytes:
     """
     Implicit closes the connection
     """
-    return "<stream:error><xml-not-well-formed xmlns='urn:ietf:params:xml:ns:xmpp-streams'/></stream:error></stream:stream>"
+    return (
+        "<stream:error>"
+        "<xml-not-well-formed xmlns='urn:ietf:params:xml:ns:xmpp-streams'/>"
+        "</stream:error></stream:stream>"
+    )
 
 
 def service_unavaliable():  # pragma: no cover
@@ -138,4 +202,7 @@ def service_unavaliable():  # pragma: no cover
             xmlns='urn:ietf:params:xml:ns:xmpp-stanzas'/>
     </error>
     """
-    return "<error type='cancel'><service-unavailable xmlns='urn:ietf:params:xml:ns:xmpp-stanzas'/></error>".encode()
+    return (
+        "<error type='cancel'>"
+        "<service-unavailable xmlns='urn:ietf:params:xml:ns:xmpp-stanzas'/></error>"
+    ).encode()
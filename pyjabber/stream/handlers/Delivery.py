@@ -0,0 +1,93 @@
+import xml.etree.ElementTree as ET
+from typing import List
+
+from pyjabber import AppConfig
+from pyjabber.features.presence.PresenceFeature import Presence
+from pyjabber.network.ConnectionManager import Client, ConnectionManager
+from pyjabber.queues.PendingMessage import PendingMessageWrapper
+from pyjabber.queues.QueueManager import QueueName, get_queue
+from pyjabber.stream.JID import JID
+from pyjabber.utils import ClarkNotation as CN
+
+
+def local_buffers(jid: JID, broadcast: bool = False) -> List[Client]:
+    """
+    Get the local sessions that must receive a stanza addressed to the given JID.
+
+        - Full JID <username@domain/resource>: the session bound to that resource,
+          if online.
+        - Bare JID <username@domain>: the online sessions with the highest priority,
+          or every online session if broadcast is set (e.g. presence stanzas).
+
+    Both cases are resolved through the indexed lookup of the ConnectionManager.
+    """
+    connections = ConnectionManager()
+    if jid.resource or broadcast:
+        return connections.get_transport_online(jid)
+
+    buffers = []
+    for resource, *_ in Presence().most_priority(jid):
+        buffers += connections.get_transport_online(
+            JID(user=jid.user, domain=jid.domain, resource=resource)
+        )
+    return buffers
+
+
+async def deliver_local(
+    jid: JID, element: ET.Element, spool: bool = False, broadcast: bool = False
+) -> bool:
+    """
+    Deliver a stanza to the local sessions of a JID. The stanza is serialized
+    once, and the same payload is written to every session.
+
+    :param jid: Local receiver (bare or full JID)
+    :param element: Stanza in the jabber:client namespace
+    :param spool: If no session is online, queue the stanza for the next connection
+    of the receiver
+    :param broadcast: Deliver a stanza addressed to a bare JID to every online session
+    :return: True if at least one session received the stanza
+    """
+    buffers = local_buffers(jid, broadcast)
+    if buffers:
+        payload = ET.tostring(element)
+        for buffer in buffers:
+            buffer.transport.write(payload)
+        return True
+
+    if spool:
+        await get_queue(QueueName.MESSAGES).put(
+            PendingMessageWrapper(
+                jid=jid if jid.resource else JID(jid.bare()),
+                payload=ET.tostring(element),
+            )
+        )
+    return False
+
+
+async def deliver_remote(jid: JID, element: ET.Element) -> None:
+    """
+    Deliver a stanza to a remote domain. If there is no outgoing stream with
+    the domain, the stanza is handed to the message queue, which will dial it.
+
+    :param jid: Remote receiver
+    :param element: Stanza to deliver. Moved to the jabber:server namespace
+    """
+    CN.switch_namespace("jabber:client", "jabber:server", element)
+    payload = ET.tostring(element)
+
+    transport = ConnectionManager().get_server_transport_host(jid.domain)
+    if transport:
+        transport.write(payload)
+    else:
+        await get_queue(QueueName.MESSAGES).put(
+            PendingMessageWrapper(jid, payload, external_host=jid.domain)
+        )
+
+
+def is_local(jid: JID) -> bool:
+    """
+    Check if the domain of the JID is served by this server
+    """
+    return (
+        jid.domain == AppConfig.app_config.host or jid.domain in AppConfig.app_config.ip
+    )
@@ -1,49 +1,183 @@
-import asyncio
 import xml.etree.ElementTree as ET
 from asyncio import Transport
+from typing import Union
+
+from loguru import logger
 
 from pyjabber import AppConfig
-from pyjabber.features.presence.PresenceFeature import Presence
 from pyjabber.network.ConnectionManager import ConnectionManager
 from pyjabber.queues.NewConnection import NewConnectionWrapper
 from pyjabber.queues.QueueManager import QueueName, get_queue
+from pyjabber.stanzas.error import StanzaError as SE
+from pyjabber.stream.handlers import Delivery
+from pyjabber.stream.JID import JID
+from pyjabber.utils import ClarkNotation as CN
+
+
+def domain_of(address: Union[str, None]) -> Union[str, None]:
+    """
+    Domain part of a JID in string format (it can be a domain itself)
+    """
+    if not address:
+        return None
+    return address.split("/")[0].rpartition("@")[2]
 
 
 class ServerStanzaHandler:
+    """
+    Handles the stanzas received through a server stream.
+
+    On an incoming stream, the stanzas are routed to the local sessions, once
+    their 'from' domain is verified against the domain authenticated during
+    the stream negotiation. An outgoing stream notifies the message queue that
+    the remote domain is ready to receive the pending stanzas.
+
+    Bidirectional streams (XEP-0288) do both: an incoming one also carries our
+    stanzas to the remote domain, and an outgoing one also routes the stanzas
+    sent by the remote domain.
+    """
+
+    __slots__ = (
+        "_transport",
+        "_peername",
+        "_connections",
+        "_host",
+        "_incoming",
+        "_inbound",
+        "_message_persistence",
+        "_functions",
+    )
+
     def __init__(self, transport: Transport) -> None:
-        self._ip = AppConfig.app_config.ip
         self._transport = transport
         self._peername = transport.get_extra_info("peername")
 
         self._connections = ConnectionManager()
+        self._message_persistence = AppConfig.app_config.message_persistence
 
-        self._host = self._connections.get_host(self._peername)
+        self._host = self._connections.get_server_incoming_host(self._peername)
+        self._incoming = self._host is not None
 
-        self._presenceManager = Presence()
+        self._functions = {
+            "{jabber:server}iq": self.handle_iq,
+            "{jabber:server}message": self.handle_msg,
+            "{jabber:server}presence": self.handle_pre,
+        }
 
-        self._message_queue = get_queue(QueueName.MESSAGES)
-        self._connection_queue: asyncio.Queue = get_queue(QueueName.CONNECTIONS)
+        if self._incoming:
+            self._inbound = True
+            bidi = self._connections.is_bidi_server_incoming(self._peername)
+        else:
+            self._host = self._connections.get_host(self._peername)
+            self._connections.ready_server(self._peername)
+            self._inbound = self._connections.is_bidi_server(self._peername)
+            bidi = True
 
-        self._message_persistence = AppConfig.app_config.message_persistence
+        if bidi:  # The stream can carry our stanzas to the remote domain
+            get_queue(QueueName.CONNECTIONS).put_nowait(
+                NewConnectionWrapper(self._host, False)
+            )
 
-        self._functions = {
-            "{jabber:client}iq": self.handle_iq,
-            "{jabber:client}message": self.handle_msg,
-            "{jabber:client}presence": self.handle_pre,
-        }
+    async def feed(self, element: ET.Element):
+        if not self._inbound:
+            return
+
+        try:
+            handler = self._functions[element.tag]
+        except KeyError:
+            logger.warning(f"Unexpected element from <{self._host}>: {element.tag}")
+            return
 
-        get_queue(QueueName.CONNECTIONS).put_nowait(
-            NewConnectionWrapper(self._host, False)
+        if domain_of(element.attrib.get("from")) != self._host:
+            logger.warning(
+                f"<{self._host}> sent a stanza from {element.attrib.get('from')}. "
+                "Closing stream"
+            )
+            self._close(SE.invalid_from())
+            return
+
+        to = element.attrib.get("to")
+        if not to:  # Mandatory over a server stream (RFC 6120 8.1.1.2)
+            logger.warning(f"<{self._host}> sent a stanza without 'to'. Closing stream")
+            self._close(SE.improper_addressing())
+            return
+
+        if domain_of(to) not in [AppConfig.app_config.host] + AppConfig.app_config.ip:
+            await self._reply_error(element, "item-not-found", "cancel")
+            return
+
+        CN.switch_namespace("jabber:server", "jabber:client", element)
+        await handler(element, JID(to) if "@" in to else None)
+
+    async def handle_iq(self, element: ET.Element, jid: Union[JID, None]):
+        """
+        Deliver an iq to a local session. Requests addressed to an account or
+        to the server itself are not served to remote entities
+        """
+        if jid and jid.resource:
+            if await Delivery.deliver_local(self._local(jid), element):
+                return
+
+        if element.attrib.get("type") in ("get", "set"):
+            await self._reply_error(element, "service-unavailable", "cancel")
+
+    async def handle_msg(self, element: ET.Element, jid: Union[JID, None]):
+        """
+        Deliver a message to the local sessions of the receiver, or queue it
+        until the receiver connects again
+        """
+        if jid is None:
+            return
+
+        await Delivery.deliver_local(
+            self._local(jid), element, spool=self._message_persistence
         )
 
-    async def feed(self, element: ET.Element):
-        pass
+    async def handle_pre(self, element: ET.Element, jid: Union[JID, None]):
+        """
+        Deliver a presence to every online session of the receiver
+        """
+        if jid is None:
+            return
+
+        await Delivery.deliver_local(self._local(jid), element, broadcast=True)
+
+    def _close(self, error: bytes):
+        self._transport.write(error)
+        if self._incoming:
+            self._connections.close_server_incoming(self._peername)
+        else:
+            self._connections.close_server(self._peername)
+
+    @staticmethod
+    def _local(jid: JID) -> JID:
+        if jid.domain in AppConfig.app_config.ip:
+            jid.domain = AppConfig.app_config.host
+        return jid
 
-    async def handle_iq(self, element: ET.Element):
-        pass
+    async def _reply_error(self, element: ET.Element, condition: str, type_: str):
+        """
+        Return the stanza to the remote sender as an error (RFC 6120 8.3)
+        """
+        sender = element.attrib.get("from")
+        if element.attrib.get("type") == "error" or "@" not in sender:
+            return
 
-    async def handle_msg(self, element: ET.Element):
-        pass
+        _, tag = CN.break_down(element.tag)
+        error = ET.Element(
+            f"{{jabber:client}}{tag}",
+            attrib={
+                "from": element.attrib.get("to"),
+                "to": sender,
+                "type": "error",
+            },
+        )
+        if "id" in element.attrib:
+            error.attrib["id"] = element.attrib["id"]
+
+        condition_elem = ET.SubElement(
+            error, "{jabber:client}error", attrib={"type": type_}
+        )
+        ET.SubElement(condition_elem, f"{{{SE.XMLNS}}}{condition}")
 
-    async def handle_pre(self, element: ET.Element):
-        pass
+        await Delivery.deliver_remote(JID(sender), error)
@@ -8,11 +8,13 @@ from pyjabber import AppConfig
 from pyjabber.features.presence.PresenceFeature import Presence
 from pyjabber.network.ConnectionManager import ConnectionManager
 from pyjabber.plugins.PluginManager import PluginManager
+from pyjabber.plugins.xep_0198 import xep_0198 as SM
+from pyjabber.plugins.xep_0352.xep_0352 import CSI
+from pyjabber.plugins.xep_0352.xep_0352 import NAMESPACE as CSI_NAMESPACE
 from pyjabber.queues.NewConnection import NewConnectionWrapper
-from pyjabber.queues.PendingMessage import PendingMessageWrapper
 from pyjabber.queues.QueueManager import QueueName, get_queue
+from pyjabber.stream.handlers import Delivery
 from pyjabber.stream.JID import JID
-from pyjabber.utils import ClarkNotation as CN
 from pyjabber.utils.Exceptions import InternalServerError
 
 
@@ -33,17 +35,29 @@ class StanzaHandler:
 
         self._message_persistence = AppConfig.app_config.message_persistence
 
+        # A resumed session (XEP-0198) comes with its managed transport
+        self._sm = transport if isinstance(transport, SM.SMTransport) else None
+
         self._functions = {
             "{jabber:client}iq": self.handle_iq,
             "{jabber:client}message": self.handle_msg,
             "{jabber:client}presence": self.handle_pre,
         }
+        if CSI_NAMESPACE in AppConfig.app_config.plugins:
+            self._functions[f"{{{CSI_NAMESPACE}}}active"] = self.handle_csi
+            self._functions[f"{{{CSI_NAMESPACE}}}inactive"] = self.handle_csi
+        if SM.NAMESPACE in AppConfig.app_config.plugins:
+            self._functions[f"{{{SM.NAMESPACE}}}enable"] = self.handle_sm_enable
+            self._functions[f"{{{SM.NAMESPACE}}}r"] = self.handle_sm_request
+            self._functions[f"{{{SM.NAMESPACE}}}a"] = self.handle_sm_ack
 
         get_queue(QueueName.CONNECTIONS).put_nowait(NewConnectionWrapper(self._jid))
 
     async def feed(self, element: ET.Element):
         try:
             await self._functions[element.tag](element)
+            if self._sm is not None and SM.is_stanza(element):
+                self._sm.handled()
         except (KeyError, InternalServerError) as e:
             logger.error(
                 f"Internal protocols error {self._peername}. Closing connection for protocols stability. Reason: ${e}"
@@ -76,54 +90,14 @@ class StanzaHandler:
         if "from" not in element.attrib:
             element.attrib["from"] = str(self._jid)
 
-        if jid.domain == AppConfig.app_config.host or jid.domain in self._ip:
+        if Delivery.is_local(jid):
             if jid.domain in self._ip:
                 jid.domain = AppConfig.app_config.host
-            if not jid.resource:
-                priority = self._presenceManager.most_priority(jid)
-                if not priority:
-                    if self._message_persistence:
-                        await self._message_queue.put(
-                            PendingMessageWrapper(
-                                jid=JID(jid.bare()), payload=ET.tostring(element)
-                            )
-                        )
-                else:
-                    all_resources_online = []
-                    for user in priority:
-                        buffer_online = self._connections.get_transport_online(
-                            JID(user=jid.user, domain=jid.domain, resource=user[0])
-                        )
-                        all_resources_online += buffer_online
-
-                    for buffer in all_resources_online:
-                        buffer[1].write(ET.tostring(element))
-
-            else:
-                resource_online = self._connections.get_transport_online(jid)
-                if not resource_online and self._message_persistence:
-                    await self._message_queue.put(
-                        PendingMessageWrapper(jid, ET.tostring(element))
-                    )
-                else:
-                    for buffer in resource_online:
-                        buffer[1].write(ET.tostring(element))
+            await Delivery.deliver_local(jid, element, spool=self._message_persistence)
 
         # Remote protocols
         else:
-            ns, tag = CN.break_down(element.tag)
-            if ns == "jabber:client":
-                CN.update_namespace("jabber:server", element)
-
-            buffer = self._connections.get_server_transport_host(jid.domain)
-            if buffer:
-                buffer.write(ET.tostring(element))
-            else:
-                await self._message_queue.put(
-                    PendingMessageWrapper(
-                        jid, ET.tostring(element), external_host=jid.domain
-                    )
-                )
+            await Delivery.deliver_remote(jid, element)
 
     async def handle_pre(self, element: ET.Element):
         """
@@ -132,3 +106,49 @@ class StanzaHandler:
         res = await self._presenceManager.feed(self._jid, element)
         if res:
             self._transport.write(res)
+
+    async def handle_csi(self, element: ET.Element):
+        """
+        Handle the client state (XEP-0352). The answers to the session go
+        through the same transport, so they keep their order with the held
+        stanzas
+        """
+        transport = CSI().feed(self._jid, element)
+        if transport is not None:
+            self._transport = transport
+
+    async def handle_sm_enable(self, element: ET.Element):
+        """
+        Enable Stream Management (XEP-0198) for the session. From now on, the
+        stanzas go through a transport that keeps them until acked
+        """
+        if self._sm is not None:
+            self._transport.write(SM.failed("unexpected-request"))
+            return
+
+        self._sm = SM.StreamManagement().enable(
+            self._jid,
+            self._transport,
+            self._peername,
+            element.attrib.get("resume") in ("true", "1"),
+        )
+        self._connections.update_transport_jid(self._sm, self._jid)
+        self._transport = self._sm
+        self._transport.write(
+            SM.enabled(
+                self._sm.id, self._sm.resume, AppConfig.app_config.sm_resume_timeout
+            )
+        )
+
+    async def handle_sm_request(self, _):
+        # Straight to the connection, an answer is never held by CSI
+        if self._sm is not None:
+            self._sm.original_transport.write(SM.answer(self._sm.inbound))
+
+    async def handle_sm_ack(self, element: ET.Element):
+        if self._sm is None:
+            return
+        try:
+            self._sm.ack(int(element.attrib.get("h")))
+        except (TypeError, ValueError):
+            logger.warning(f"Invalid ack from {self._jid}")
@@ -5,8 +5,13 @@ from xml.etree import ElementTree as ET
 from loguru import logger
 
 from pyjabber import AppConfig
-from pyjabber.features.Features import SASL_feature, start_tls_proceed_response
+from pyjabber.features.Features import (
+    SASL_feature,
+    bidi_feature,
+    start_tls_proceed_response,
+)
 from pyjabber.features.SASL.Mechanism import MECHANISM
+from pyjabber.features.SASL.SASL import SASL
 from pyjabber.network.utils.TransportProxy import TransportProxy
 from pyjabber.stanzas.error import StanzaError as SE
 from pyjabber.stream.handlers.StanzaHandler import InternalServerError
@@ -18,24 +23,37 @@ from pyjabber.utils.Exceptions import NotAuthorizerStreamNegotiationException
 
 
 class ServerIncomingStreamNegotiator(StreamNegotiator):
+    __slots__ = ("_from_claim", "_bidi")
+
     def __init__(self, transport, protocol, parser, handler) -> None:
         super().__init__(transport, protocol, parser, handler)
+        self._from_claim = None
+        self._bidi = False
         self._stages_handlers[Stage.AUTH] = self._handle_done_negotiation
 
     async def handle_open_stream(self, elem: ET.Element = None) -> Union[Signal, None]:
         try:
             if elem.tag == "{http://etherx.jabber.org/streams}stream":
-                self._transport.write(Stream.responseStream(elem.attrib))
+                self._from_claim = elem.attrib.get("from") or self._from_claim
+                self._transport.write(
+                    Stream.responseStream(
+                        {
+                            (None, "from"): elem.attrib.get("from"),
+                            (None, "to"): elem.attrib.get("to") or self._host,
+                        },
+                        server=True,
+                    )
+                )
             return await self._stages_handlers[self._stage](elem)
         except EX.NotAuthorizerStreamNegotiationException:
             self._transport.write(SE.not_authorized())
-            self._connection_manager.close_server(self._peer)
+            self._connection_manager.close_server_incoming(self._peer)
         except EX.BadRequestException:
             self._transport.write(SE.bad_request())
-            self._connection_manager.close_server(self._peer)
+            self._connection_manager.close_server_incoming(self._peer)
         except InternalServerError:
             self._transport.write(SE.internal_server_error())
-            self._connection_manager.close_server(self._peer)
+            self._connection_manager.close_server_incoming(self._peer)
         except Exception as e:
             logger.error(e)
 
@@ -56,7 +74,8 @@ class ServerIncomingStreamNegotiator(StreamNegotiator):
                 new_transport = await loop.start_tls(
                     transport=original_transport,
                     protocol=self._protocol,
-                    sslcontext=AppConfig.app_config.ssl_context,
+                    sslcontext=AppConfig.app_config.ssl_context_s2s_incoming
+                    or AppConfig.app_config.ssl_context,
                     server_side=True,
                 )
 
@@ -67,7 +86,7 @@ class ServerIncomingStreamNegotiator(StreamNegotiator):
                 self._protocol.transport = new_transport
                 self._parser.transport = new_transport
                 self._handler.transport = new_transport
-                self._connection_manager.update_transport_server(
+                self._connection_manager.update_transport_server_incoming(
                     new_transport, self._peer
                 )
 
@@ -81,7 +100,7 @@ class ServerIncomingStreamNegotiator(StreamNegotiator):
                 logger.error(
                     f"Error during TLS upgrade with <{self._peer}> Reason: {e}"
                 )
-                self._connection_manager.close_server(self._peer)
+                self._connection_manager.close_server_incoming(self._peer)
                 return Signal.FORCE_CLOSE
 
         else:
@@ -91,9 +110,36 @@ class ServerIncomingStreamNegotiator(StreamNegotiator):
         self._stream_feature.reset()
 
         self._stream_feature.register(SASL_feature([MECHANISM.EXTERNAL]))
+        self._stream_feature.register(bidi_feature())
         self._transport.write(self._stream_feature.to_bytes())
 
         self._stage = Stage.SASL
 
-    async def _handle_done_negotiation(self):
+    async def _handle_ssl(self, element: ET.Element):
+        if element.tag == "{urn:xmpp:bidi}bidi":
+            # XEP-0288. The initiating server asks to use this stream both ways,
+            # before the authentication
+            if self._sasl is None:
+                self._bidi = True
+            else:
+                logger.warning(f"<{self._peer}> asked for bidi during SASL. Ignored")
+            return
+
+        if self._sasl is None:
+            self._sasl = SASL(
+                self._transport, self._parser, self._peer, self._from_claim
+            )
+
+        res = await self._sasl.feed(element)
+
+        if res and res == Stage.AUTH:
+            self._connection_manager.set_host_incoming(
+                self._peer, self._from_claim, self._bidi
+            )
+            self._stage = Stage.AUTH
+
+    async def _handle_done_negotiation(self, _):
+        self._stream_feature.reset()
+        self._transport.write(self._stream_feature.to_bytes())
+
         return Signal.DONE
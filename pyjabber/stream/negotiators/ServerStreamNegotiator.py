@@ -5,6 +5,7 @@ from xml.etree import ElementTree as ET
 from loguru import logger
 
 from pyjabber import AppConfig
+from pyjabber.features.SASL.utils import verify_peer_cert
 from pyjabber.network.utils.TransportProxy import TransportProxy
 from pyjabber.queues.QueueManager import QueueName, get_queue
 from pyjabber.stream.negotiators.StreamNegotiator import Signal, Stage, StreamNegotiator
@@ -25,6 +26,8 @@ class StreamServerNegotiator(StreamNegotiator):
             Stage.BIND: self._handle_resource_bind,
         }
 
+        self._bidi = False
+
         self._stages_flags = {
             "starttls": False,
             "starttls_handshake": False,
@@ -52,6 +55,15 @@ class StreamServerNegotiator(StreamNegotiator):
                     m for m in elem.find("{urn:ietf:params:xml:ns:xmpp-sasl}mechanisms")
                 ]
                 if any("EXTERNAL" == m.text for m in mechanisms_offered):
+                    if "{urn:xmpp:features:bidi}bidi" in children and verify_peer_cert(
+                        self._connection_manager.get_host(self._peer),
+                        self._transport.get_extra_info("ssl_object"),
+                    ):
+                        # XEP-0288. The remote domain may use this stream to send its
+                        # stanzas. Only requested if its identity has been verified
+                        self._transport.write(b"<bidi xmlns='urn:xmpp:bidi'/>")
+                        self._bidi = True
+
                     self._transport.write(
                         "<auth xmlns='urn:ietf:params:xml:ns:xmpp-sasl' mechanism='EXTERNAL'>=</auth>".encode()
                     )
@@ -69,6 +81,8 @@ class StreamServerNegotiator(StreamNegotiator):
             self._stages_flags["auth"] = True
 
         if all(self._stages_flags.values()):
+            if self._bidi:
+                self._connection_manager.set_bidi_server(self._peer)
             self._parser.reset_stack()
             return Signal.DONE
         else:
@@ -7,21 +7,32 @@ from loguru import logger
 
 from pyjabber import AppConfig
 from pyjabber.features.Features import (
+    SASL2_feature,
     SASL_feature,
+    csi_feature,
     in_band_registration_feature,
     resource_binding_feature,
+    roster_versioning_feature,
     start_tls_feature,
     start_tls_proceed_response,
+    stream_management_feature,
 )
+from pyjabber.features.SASL import FAST, SCRAM
 from pyjabber.features.SASL.SASL import SASL
+from pyjabber.features.SASL.SASL2 import SASL2
 from pyjabber.features.StreamFeature import StreamFeature
 from pyjabber.network.ConnectionManager import ConnectionManager
 from pyjabber.network.utils.TransportProxy import TransportProxy
+from pyjabber.plugins.xep_0115.xep_0115 import Caps
+from pyjabber.plugins.xep_0198 import xep_0198 as SM
+from pyjabber.plugins.xep_0352.xep_0352 import NAMESPACE as CSI
+from pyjabber.plugins.xep_0352.xep_0352 import CSITransport
 from pyjabber.stanzas.error import StanzaError as SE
 from pyjabber.stanzas.IQ import IQ
 from pyjabber.stream.handlers.StanzaHandler import InternalServerError
 from pyjabber.stream.utils.Enums import Signal, Stage
 from pyjabber.stream.utils.Stream import Stream
+from pyjabber.utils import ClarkNotation as CN
 from pyjabber.utils import Exceptions as EX
 from pyjabber.utils.Exceptions import NotAuthorizerStreamNegotiationException
 
@@ -39,6 +50,7 @@ class StreamNegotiator:
         "_stage",
         "_ibr_feature",
         "_sasl",
+        "_sasl2",
         "_stages_handlers",
     )
 
@@ -58,6 +70,7 @@ class StreamNegotiator:
         self._ibr_feature = "jabber:iq:register" in AppConfig.app_config.plugins
 
         self._sasl = None
+        self._sasl2 = None
 
         self._stages_handlers = {
             Stage.CONNECTED: self._handle_init,
@@ -146,12 +159,24 @@ class StreamNegotiator:
         if self._ibr_feature:
             self._stream_feature.register(in_band_registration_feature())
 
-        self._stream_feature.register(SASL_feature())
+        mechanisms = SCRAM.mechanisms(self._transport)
+        self._stream_feature.register(SASL_feature(mechanisms))
+        self._stream_feature.register(SASL2_feature(mechanisms, FAST.MECHANISMS))
         self._transport.write(self._stream_feature.to_bytes())
 
         self._stage = Stage.SASL
 
     async def _handle_ssl(self, element: ET.Element):
+        namespace, _ = CN.break_down(element.tag)
+        if namespace == "urn:xmpp:sasl:2":
+            if self._sasl2 is None:
+                self._sasl2 = SASL2(self._transport, self._parser, self._peer)
+
+            # No stream restart after a SASL2 success, the features follow
+            if await self._sasl2.feed(element) == Stage.AUTH:
+                await self._handle_init_resource_bind(None)
+            return
+
         if self._sasl is None:
             self._sasl = SASL(self._transport, self._parser, self._peer)
 
@@ -163,6 +188,12 @@ class StreamNegotiator:
     async def _handle_init_resource_bind(self, _):
         self._stream_feature.reset()
         self._stream_feature.register(resource_binding_feature())
+        self._stream_feature.register(roster_versioning_feature())
+        self._stream_feature.register(Caps().server_caps())
+        if CSI in AppConfig.app_config.plugins:
+            self._stream_feature.register(csi_feature())
+        if SM.NAMESPACE in AppConfig.app_config.plugins:
+            self._stream_feature.register(stream_management_feature())
         self._transport.write(self._stream_feature.to_bytes())
 
         self._stage = Stage.BIND
@@ -191,5 +222,47 @@ class StreamNegotiator:
             self._connection_manager.set_jid(peername, new_jid, self._transport)
             return Signal.DONE
 
+        elif (
+            element.tag == f"{{{SM.NAMESPACE}}}resume"
+            and SM.NAMESPACE in AppConfig.app_config.plugins
+        ):
+            return await self._handle_resume(element)
+
         else:
             raise NotAuthorizerStreamNegotiationException()
+
+    async def _handle_resume(self, element: ET.Element):
+        """
+        XEP-0198 resumption, instead of the resource binding. The detached
+        session moves to this connection, keeping its resource, presence and
+        the stanzas not acked by the client
+        """
+        try:
+            h = int(element.attrib.get("h"))
+        except (TypeError, ValueError):
+            raise EX.BadRequestException()
+
+        jid = self._connection_manager.get_jid(self._peer)
+        session = SM.StreamManagement().resume(jid, element.attrib.get("previd"), h)
+        if session is None:
+            # The client can still bind a new resource
+            self._transport.write(SM.failed("item-not-found"))
+            return
+
+        old = self._connection_manager.disconnection(session.peer)
+        if old is not None and isinstance(old.transport, CSITransport):
+            old.transport.flush()  # Into the unacked stanzas
+
+        self._connection_manager.set_jid(self._peer, session.jid)
+        self._connection_manager.online(
+            session.jid, old.online if old is not None else False
+        )
+        unacked = session.attach(self._transport, self._peer)
+        self._connection_manager.update_transport_jid(session, session.jid)
+        SM.StreamManagement().attached(session)
+
+        self._transport.write(SM.resumed(session.id, session.inbound) + unacked)
+        self._transport = session
+        self._handler.transport = session
+        logger.debug(f"Session of {session.jid} resumed by <{self._peer}>")
+        return Signal.DONE
@@ -32,6 +32,21 @@ def update_namespace(ns: str, element: Element):
         update_namespace(ns, child)
 
 
+def switch_namespace(old_ns: str, new_ns: str, element: Element):
+    """
+    Move the element, and the children that share its namespace, from one
+    namespace to another. Children qualified by an extension namespace are
+    left untouched (e.g. jabber:server <-> jabber:client on S2S routing)
+    """
+    if not element.tag.startswith(f"{{{old_ns}}}"):
+        return
+
+    _, tag = break_down(element.tag)
+    element.tag = f"{{{new_ns}}}{tag}"
+    for child in element:
+        switch_namespace(old_ns, new_ns, child)
+
+
 def is_clark(tag: str) -> bool:
     """
     Regex to check if a string is in the clark notation format
@@ -10,7 +10,13 @@ def api_adminpage_app():
     app.router.add_get('/users', api.handleUser)
     app.router.add_get('/roster/{id}', api.handleRoster)
     app.router.add_post('/createuser', api.handleRegister)
+    app.router.add_post('/users/import', api.handleImport)
     app.router.add_delete('/users/{id}', api.handleDelete)
+    app.router.add_get('/stats/credentials', api.handleCredentialCache)
+    app.router.add_get('/stats/database', api.handleDatabase)
+    app.router.add_get('/stats/notifications', api.handleNotifications)
+    app.router.add_get('/stats/csi', api.handleCSI)
+    app.router.add_get('/stats/sm', api.handleSM)
 
     return '/api', app
 
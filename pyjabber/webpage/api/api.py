@@ -1,42 +1,126 @@
-import hashlib
 import json
 
 from aiohttp import web
 from loguru import logger
-from sqlalchemy import select, delete, insert
+from sqlalchemy import select, delete
 
+from pyjabber import AppConfig
+from pyjabber.db import BulkImport
 from pyjabber.db.database import DB
 from pyjabber.db.model import Model
+from pyjabber.features.SASL.CredentialCache import CredentialCache
+from pyjabber.features.SASL.KDF import KDFExecutor
+from pyjabber.plugins.roster.Roster import Roster
+from pyjabber.plugins.xep_0163.xep_0163 import PEP
+from pyjabber.plugins.xep_0198.xep_0198 import SMMetrics
+from pyjabber.plugins.xep_0352.xep_0352 import CSIMetrics
+from pyjabber.queues.workers.NotificationWorker import NotificationMetrics
 
+# Rows read per query while streaming a listing
+BATCH_SIZE = 500
+MAX_PAGE_SIZE = 1000
 
-async def handleUser(_):
-    with DB.connection() as con:
-        query = select(Model.Credentials.c.id, Model.Credentials.c.jid)
-        res = con.execute(query).fetchall()
 
-    users = [{"id": i, "jid": v} for i, v in res]
-    return web.Response(text=json.dumps(users))
+async def _users_after(after: int, limit: int) -> list:
+    """
+    Keyset page of the credentials table, by id
+    """
+    async with DB.reader() as con:
+        res = await con.execute(
+            select(Model.Credentials.c.id, Model.Credentials.c.jid)
+            .where(Model.Credentials.c.id > after)
+            .order_by(Model.Credentials.c.id)
+            .limit(limit)
+        )
+        return res.fetchall()
+
+
+async def _user_jid(con, user_id: int):
+    res = await con.execute(
+        select(Model.Credentials.c.jid).where(Model.Credentials.c.id == user_id)
+    )
+    return res.scalar()
+
+
+async def handleUser(request):
+    """
+    Without a limit, every user is streamed as a JSON array, read in batches.
+    With ?limit=N[&after=ID] a single page is returned, and the X-Next-After
+    header holds the cursor of the next page, if any
+    """
+    try:
+        after = int(request.query.get('after', 0))
+        limit = request.query.get('limit')
+        limit = min(int(limit), MAX_PAGE_SIZE) if limit is not None else None
+        if after < 0 or (limit is not None and limit < 1):
+            raise ValueError
+    except ValueError:
+        return web.json_response({"status": "error", "message": "Invalid pagination"}, status=400)
+
+    if limit is not None:
+        res = await _users_after(after, limit + 1)
+        headers = {}
+        if len(res) > limit:
+            res = res[:limit]
+            headers['X-Next-After'] = str(res[-1][0])
+        return web.json_response([{"id": i, "jid": v} for i, v in res], headers=headers)
+
+    response = web.StreamResponse(headers={'Content-Type': 'application/json'})
+    await response.prepare(request)
+
+    separator = b'['
+    while True:
+        res = await _users_after(after, BATCH_SIZE)
+        if res:
+            chunk = ','.join(json.dumps({"id": i, "jid": v}) for i, v in res)
+            await response.write(separator + chunk.encode())
+            separator = b','
+            after = res[-1][0]
+        if len(res) < BATCH_SIZE:
+            break
+
+    await response.write(b'[]' if separator == b'[' else b']')
+    await response.write_eof()
+    return response
+
+
+async def handleCredentialCache(_):
+    return web.json_response(CredentialCache().stats())
+
+
+async def handleDatabase(_):
+    return web.json_response(DB.metrics())
+
+
+async def handleNotifications(_):
+    return web.json_response(NotificationMetrics().stats())
+
+
+async def handleCSI(_):
+    return web.json_response(CSIMetrics().stats())
+
+
+async def handleSM(_):
+    return web.json_response(SMMetrics().stats())
 
 
 async def handleRoster(request):
     try:
         user_id = int(request.match_info['id'])
 
-        with DB.connection() as con:
-            user_jid = con.execute(
-                select(Model.Credentials.c.jid).where(Model.Credentials.c.id == user_id)
-            ).fetchone()[0]
-
-            if not user_jid:
-                return web.json_response({"status": "error", "message": "User not found"}, status=404)
+        async with DB.reader() as con:
+            user_jid = await _user_jid(con, user_id)
 
-            roster = con.execute(
-                select(Model.Roster.c.roster_item).where(Model.Roster.c.jid.like(f"{user_jid}%"))
-            ).fetchall()
+        if not user_jid:
+            return web.json_response({"status": "error", "message": "User not found"}, status=404)
 
-            response = [{"item": r[0]} for r in roster]
+        async with DB.reader(user_jid) as con:
+            roster = await con.execute(
+                select(Model.Roster.c.roster_item).where(Model.Roster.c.jid == user_jid)
+            )
+            response = [{"item": r[0]} for r in roster.fetchall()]
 
-        return web.Response(text=json.dumps(response))
+        return web.json_response(response)
 
     except ValueError:
         return web.json_response({"status": "error", "message": "Invalid user ID"}, status=400)
@@ -53,25 +137,40 @@ async def handleDelete(request):
     try:
         user_id = int(request.match_info['id'])
 
-        with DB.connection() as con:
-            res = con.execute(
-                select(Model.Credentials.c.id)
-            ).fetchall()
+        async with DB.writer() as con:
+            user_jid = await _user_jid(con, user_id)
 
-            if user_id not in [r[0] for r in res]:
+            if not user_jid:
                 return web.json_response({"status": "error", "message": "User not found"}, status=404)
 
-            user_jid = con.execute(
-                select(Model.Credentials.c.jid).where(Model.Credentials.c.id == user_id)
-            ).fetchone()[0]
-
-            con.execute(
+            await con.execute(
                 delete(Model.Credentials).where(Model.Credentials.c.id == user_id)
             )
-            con.execute(
-                delete(Model.Roster).where(Model.Roster.c.jid.like(f"{user_jid}%"))
+            await con.execute(
+                delete(Model.FastTokens).where(Model.FastTokens.c.jid == user_jid)
+            )
+
+        async with DB.writer(user_jid) as con:
+            await con.execute(
+                delete(Model.Roster).where(Model.Roster.c.jid == user_jid)
+            )
+            await con.execute(
+                delete(Model.RosterVersions).where(
+                    Model.RosterVersions.c.jid == user_jid
+                )
+            )
+            await con.execute(
+                delete(Model.RosterChanges).where(
+                    Model.RosterChanges.c.jid == user_jid
+                )
             )
-            con.commit()
+            await con.execute(
+                delete(Model.PepItems).where(Model.PepItems.c.jid == user_jid)
+            )
+
+        CredentialCache().invalidate(user_jid)
+        Roster().forget(user_jid)
+        PEP().forget(user_jid)
 
         logger.info(f"User with ID {user_id} deleted")
         return web.json_response({"status": "success", "message": "User deleted"}, status=200)
@@ -89,25 +188,16 @@ async def handleDelete(request):
 async def handleRegister(request):
     try:
         data = await request.json()
+        jid = BulkImport._localpart(data['jid'], AppConfig.app_config.host)
 
-        with DB.connection() as con:
-            res = con.execute(
-                select(Model.Credentials.c.jid)
-            ).fetchall()
-
-        if any(r[0] == data["jid"] for r in res):
+        result = await BulkImport.import_users(
+            [BulkImport.UserEntry(jid=jid, password=data['pwd'])],
+            executor=KDFExecutor().executor,
+        )
+        if not result.created:
             raise Exception("JID already in use")
 
-        hash_pwd = hashlib.sha256(data["pwd"].encode()).hexdigest()
-
-        with DB.connection() as con:
-            con.execute(
-                insert(Model.Credentials).values({
-                    'jid': data['jid'],
-                    'hash_pwd': hash_pwd
-                })
-            )
-            con.commit()
+        CredentialCache().invalidate(jid)
 
         response_data = {
             "status": "success",
@@ -124,3 +214,48 @@ async def handleRegister(request):
             "message": str(e)
         }
         return web.json_response(error_response, status=500)
+
+
+async def handleImport(request):
+    """
+    Bulk import of users from a CSV or JSONL body (see BulkImport).
+    The progress is streamed as a JSON line per batch, the last line holds the result
+    """
+    fmt = request.query.get('format') or ('csv' if request.content_type == 'text/csv' else 'jsonl')
+    try:
+        iterations = int(request.query.get('iterations', BulkImport.ITERATIONS))
+        if iterations < BulkImport.MIN_ITERATIONS:
+            raise ValueError
+        users, errors = BulkImport.parse(await request.text(), fmt, AppConfig.app_config.host)
+    except ValueError:
+        return web.json_response({"status": "error", "message": "Invalid iterations"}, status=400)
+    except BulkImport.ImportFormatError as e:
+        return web.json_response({"status": "error", "message": str(e)}, status=400)
+
+    response = web.StreamResponse(headers={'Content-Type': 'application/x-ndjson'})
+    await response.prepare(request)
+
+    async def progress(result: BulkImport.ImportResult):
+        await response.write(json.dumps({
+            "status": "progress",
+            "done": result.created + result.skipped,
+            "total": result.total
+        }).encode() + b'\n')
+
+    try:
+        result = await BulkImport.import_users(
+            users,
+            executor=KDFExecutor().executor,
+            iterations=iterations,
+            progress=progress
+        )
+        result.invalid = errors
+        CredentialCache().clear()
+        await response.write(json.dumps({"status": "success", **result.as_dict()}).encode() + b'\n')
+
+    except Exception as e:
+        logger.error(e)
+        await response.write(json.dumps({"status": "error", "message": str(e)}).encode() + b'\n')
+
+    await response.write_eof()
+    return response
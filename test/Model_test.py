@@ -46,6 +46,8 @@ class ModelTest:
         Column("publisher", String, nullable=False),
         Column("item_id", String, primary_key=True),
         Column("payload", String, nullable=False),
+        Column("seq", Integer, nullable=False),
+        Column("published", Integer, nullable=False),
     )
 
     PendingSubs = Table(
@@ -0,0 +1,229 @@
+import asyncio
+import json
+import time
+from types import SimpleNamespace
+from unittest.mock import patch
+from xml.etree import ElementTree as ET
+
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+from sqlalchemy import func, insert, select
+
+from pyjabber.db.database import DB
+from pyjabber.db.model import Model
+from pyjabber.features.SASL import SCRAM
+from pyjabber.plugins.roster.Roster import Roster
+from pyjabber.plugins.xep_0163.xep_0163 import PEP
+from pyjabber.stream.JID import JID
+from pyjabber.utils import Singleton
+from pyjabber.webpage.adminPage import api_adminpage_app
+from pyjabber.webpage.api import api
+
+USERS = 2000
+PUBSUB = "http://jabber.org/protocol/pubsub"
+MOOD = "http://jabber.org/protocol/mood"
+ERRORS = "urn:ietf:params:xml:ns:xmpp-stanzas"
+
+
+def pep_request(operation: str, item: str = None) -> ET.Element:
+    element = ET.Element("iq", attrib={"type": "set", "id": "pep"})
+    pubsub = ET.SubElement(element, f"{{{PUBSUB}}}pubsub")
+    operation = ET.SubElement(pubsub, f"{{{PUBSUB}}}{operation}", attrib={"node": MOOD})
+    if item is not None:
+        item = ET.SubElement(operation, f"{{{PUBSUB}}}item", attrib={"id": item})
+        ET.SubElement(item, f"{{{MOOD}}}mood").text = "happy"
+    return element
+
+
+@pytest.fixture
+async def client(tmp_path):
+    config = SimpleNamespace(
+        host="localhost",
+        kdf_mode="thread",
+        kdf_workers=1,
+        login_rate=10.0,
+        login_burst=20,
+        login_max_wait=5.0,
+        database_path=str(tmp_path / "pyjabber.db"),
+        database_in_memory=False,
+        database_debug=False,
+        database_write_timeout=5.0,
+        database_read_timeout=5.0,
+        database_readers=2,
+        database_shards=2,
+        credential_cache_size=10,
+        credential_cache_negative_ttl=30,
+    )
+    with patch("pyjabber.AppConfig.app_config", config):
+        Singleton._instances.pop(Roster, None)
+        await DB.setup_database()
+        async with DB.writer() as con:
+            await con.execute(
+                insert(Model.Credentials),
+                [{"jid": f"user{i}", "hash_pwd": "x"} for i in range(USERS)],
+            )
+        async with DB.writer("user0") as con:
+            await con.execute(
+                insert(Model.Roster).values({"jid": "user0", "roster_item": "<item/>"})
+            )
+
+        _, app = api_adminpage_app()
+        async with TestClient(TestServer(app)) as client:
+            yield client
+
+        await DB.close_engine_async()
+        Singleton._instances.pop(Roster, None)
+
+
+async def test_users_streamed(client):
+    with patch.object(api, "BATCH_SIZE", 300):
+        res = await client.get("/users")
+        users = await res.json()
+
+    assert res.status == 200
+    assert [u["jid"] for u in users] == [f"user{i}" for i in range(USERS)]
+
+
+async def test_users_keyset_pages(client):
+    jids, after = [], 0
+    while True:
+        res = await client.get("/users", params={"limit": 700, "after": after})
+        page = await res.json()
+        jids += [u["jid"] for u in page]
+        if "X-Next-After" not in res.headers:
+            break
+        after = res.headers["X-Next-After"]
+
+    assert jids == [f"user{i}" for i in range(USERS)]
+    assert (await client.get("/users", params={"limit": 0})).status == 400
+
+
+async def test_roster(client):
+    res = await client.get("/roster/1")
+    assert await res.json() == [{"item": "<item/>"}]
+
+    assert (await client.get(f"/roster/{USERS + 1}")).status == 404
+
+
+async def test_register_delete(client):
+    with patch.object(api.CredentialCache, "invalidate") as invalidate:
+        res = await client.post(
+            "/createuser", json={"jid": "new@localhost", "pwd": "pencil"}
+        )
+        assert res.status == 200
+        invalidate.assert_called_once_with("new")  # Stored by username
+    res = await client.post("/createuser", json={"jid": "new", "pwd": "pencil"})
+    assert res.status == 500
+
+    async with DB.reader() as con:
+        res = await con.execute(
+            select(Model.Credentials.c.hash_pwd).where(Model.Credentials.c.jid == "new")
+        )
+        assert SCRAM.parse_credentials(res.scalar()) is not None
+
+    assert (await client.delete("/users/1")).status == 200
+    assert (await client.delete("/users/1")).status == 404
+
+    async with DB.reader() as con:
+        res = await con.execute(select(func.count()).select_from(Model.Credentials))
+        assert res.scalar() == USERS
+    assert await DB.query_shards(select(Model.Roster)) == [[], []]
+
+
+async def test_delete_drops_pep_items(client):
+    Singleton._instances.pop(PEP, None)
+    new = JID("new@localhost/phone")
+    try:
+        assert (
+            await client.post("/createuser", json={"jid": "new", "pwd": "pencil"})
+        ).status == 200
+        await PEP().feed(new, pep_request("publish", item="m1"))
+        async with DB.reader() as con:
+            res = await con.execute(
+                select(Model.Credentials.c.id).where(Model.Credentials.c.jid == "new")
+            )
+            user_id = res.scalar()
+
+        assert (await client.delete(f"/users/{user_id}")).status == 200
+        assert await DB.query_shards(select(Model.PepItems)) == [[], []]
+
+        # The name registered again does not inherit the items
+        await client.post("/createuser", json={"jid": "new", "pwd": "pencil"})
+        res = ET.fromstring(await PEP().feed(new, pep_request("items")))
+        assert res.find(f".//{{{ERRORS}}}item-not-found") is not None
+    finally:
+        Singleton._instances.pop(PEP, None)
+
+
+async def test_listing_does_not_stall_loop(client):
+    """
+    The event loop keeps serving other connections while a large listing is
+    read and sent
+    """
+    lag = 0
+    done = asyncio.Event()
+
+    async def ticks():
+        nonlocal lag
+        while not done.is_set():
+            start = time.perf_counter()
+            await asyncio.sleep(0.001)
+            lag = max(lag, time.perf_counter() - start - 0.001)
+
+    ticker = asyncio.create_task(ticks())
+    with patch.object(api, "BATCH_SIZE", 100):
+        for _ in range(5):
+            res = await client.get("/users")
+            assert len(await res.json()) == USERS
+    done.set()
+    await ticker
+
+    assert lag < 0.1
+
+
+async def test_import(client):
+    body = "jid,password,roster\nuser1,pwd,\nnew1,pwd,user1\nnew2,pwd,\n"
+    res = await client.post(
+        "/users/import",
+        data=body,
+        params={"iterations": 4096},
+        headers={"Content-Type": "text/csv"},
+    )
+    lines = [json.loads(line) for line in (await res.text()).splitlines()]
+
+    assert lines[0] == {"status": "progress", "done": 3, "total": 3}
+    assert lines[-1]["status"] == "success"
+    assert (lines[-1]["created"], lines[-1]["skipped"]) == (2, 1)
+
+    res = await client.post("/users/import", data=body, params={"iterations": 1})
+    assert res.status == 400
+
+
+async def test_notification_stats(client):
+    res = await client.get("/stats/notifications")
+    stats = await res.json()
+
+    assert res.status == 200
+    assert {"queue_depth", "pending_receivers", "latency_avg_ms"} <= set(stats)
+
+
+async def test_csi_stats(client):
+    res = await client.get("/stats/csi")
+
+    assert res.status == 200
+    assert set(await res.json()) == {"held", "suppressed", "flushed", "flushes"}
+
+
+async def test_sm_stats(client):
+    res = await client.get("/stats/sm")
+
+    assert res.status == 200
+    assert set(await res.json()) == {
+        "enabled",
+        "detached",
+        "resumed",
+        "failed",
+        "expired",
+        "resent",
+        "overflows",
+    }
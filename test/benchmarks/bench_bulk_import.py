@@ -0,0 +1,108 @@
+"""
+Accounts per second of the bulk import, against one registration at a time.
+
+The one-at-a-time baseline hashes each password and inserts it in its own
+transaction, as the in-band registration does. The bulk import hashes in
+chunks over a process pool and inserts batches of BulkImport.BATCH_SIZE
+accounts per transaction. The iterations are lowered to the RFC 7677 minimum
+so 100k accounts can be imported in a reasonable time; the hashing is still
+most of the cost.
+
+    python -m test.benchmarks.bench_bulk_import [users] [iterations]
+"""
+
+import asyncio
+import os
+import secrets
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from types import SimpleNamespace
+
+from sqlalchemy import insert
+
+from pyjabber import AppConfig
+from pyjabber.db import BulkImport
+from pyjabber.db.database import DB
+from pyjabber.db.model import Model
+
+BASELINE_USERS = 1000
+
+
+async def setup(path: str, name: str):
+    AppConfig.app_config = SimpleNamespace(
+        database_path=os.path.join(path, name),
+        database_in_memory=False,
+        database_debug=False,
+        database_write_timeout=60.0,
+        database_read_timeout=60.0,
+        database_readers=4,
+        database_shards=1,
+    )
+    await DB.setup_database()
+
+
+async def one_at_a_time(users: int, iterations: int) -> float:
+    loop = asyncio.get_running_loop()
+    start = time.perf_counter()
+    for i in range(users):
+        hashed = await loop.run_in_executor(
+            None,
+            BulkImport.hash_passwords,
+            [(f"password{i}", secrets.token_bytes(16))],
+            iterations,
+        )
+        async with DB.writer() as con:
+            await con.execute(
+                insert(Model.Credentials).values(
+                    {"jid": f"user{i}", "hash_pwd": hashed[0]}
+                )
+            )
+    return users / (time.perf_counter() - start)
+
+
+async def run(users: int, iterations: int):
+    print(f"{os.cpu_count()} CPUs, {iterations} PBKDF2 iterations")
+    entries = [
+        BulkImport.UserEntry(
+            jid=f"user{i}",
+            password=f"password{i}",
+            roster=(BulkImport.RosterEntry(jid=f"user{(i + 1) % users}"),),
+        )
+        for i in range(users)
+    ]
+
+    with tempfile.TemporaryDirectory() as path:
+        await setup(path, "baseline.db")
+        rate = await one_at_a_time(BASELINE_USERS, iterations)
+        await DB.close_engine_async()
+        print(f"one at a time: {rate:8.1f} accounts/s ({BASELINE_USERS} accounts)")
+
+        await setup(path, "bulk.db")
+
+        async def progress(result: BulkImport.ImportResult):
+            done = result.created + result.skipped
+            if done % 20000 < BulkImport.BATCH_SIZE:
+                print(f"  {done:>7}/{result.total} ({done / result.elapsed:.0f}/s)")
+
+        with ProcessPoolExecutor() as executor:
+            result = await BulkImport.import_users(
+                entries, executor, iterations, progress=progress
+            )
+        await DB.close_engine_async()
+
+        print(
+            f"  bulk import: {result.created / result.elapsed:8.1f} accounts/s "
+            f"({result.created} accounts, {result.roster_items} roster items, "
+            f"{result.elapsed:.1f} s)"
+        )
+
+
+if __name__ == "__main__":
+    asyncio.run(
+        run(
+            int(sys.argv[1]) if len(sys.argv) > 1 else 100_000,
+            int(sys.argv[2]) if len(sys.argv) > 2 else BulkImport.MIN_ITERATIONS,
+        )
+    )
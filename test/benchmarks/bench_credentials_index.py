@@ -0,0 +1,87 @@
+"""
+Login lookup over a credentials table of 1M rows, before and after the
+lookup indexes migration.
+
+A database with the previous schema (no index on credentials.jid) is filled
+and queried with the login query of SASL. Then the alembic migrations are
+applied to the same file, and the queries are repeated.
+
+    python -m test.benchmarks.bench_credentials_index [rows] [lookups]
+"""
+
+import os
+import random
+import sys
+import tempfile
+import time
+
+from alembic import command
+from alembic.config import Config
+from sqlalchemy import create_engine, select, text
+
+from pyjabber.db.model import Model
+
+ALEMBIC_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+    "alembic_local",
+)
+
+
+def lookups(engine, jids: list) -> float:
+    query = select(Model.Credentials.c.hash_pwd).where(
+        Model.Credentials.c.jid == text(":jid")
+    )
+    start = time.perf_counter()
+    with engine.connect() as con:
+        for jid in jids:
+            assert con.execute(query, {"jid": jid}).fetchone()
+    return (time.perf_counter() - start) / len(jids)
+
+
+def run(rows: int, count: int):
+    with tempfile.TemporaryDirectory() as path:
+        database = os.path.join(path, "bench.db")
+        engine = create_engine(f"sqlite:///{database}")
+
+        with engine.begin() as con:
+            con.execute(
+                text(
+                    "CREATE TABLE credentials (id INTEGER PRIMARY KEY, "
+                    "jid VARCHAR NOT NULL, hash_pwd VARCHAR NOT NULL)"
+                )
+            )
+            for table in ("roster", "pubsub_subscribers"):
+                con.execute(
+                    text(f"CREATE TABLE {table} (id INTEGER PRIMARY KEY, jid VARCHAR)")
+                )
+            con.exec_driver_sql(
+                "INSERT INTO credentials (jid, hash_pwd) VALUES (?, ?)",
+                [(f"user{i}", "sha256$100000$00$00") for i in range(rows)],
+            )
+
+        jids = [f"user{random.randrange(rows)}" for _ in range(count)]
+
+        before = lookups(engine, jids)
+        print(f"   no index: {before * 1e3:9.3f} ms per login lookup ({rows} rows)")
+
+        cfg = Config()
+        cfg.set_main_option("script_location", ALEMBIC_PATH)
+        cfg.set_main_option("sqlalchemy.url", f"sqlite:///{database}")
+        start = time.perf_counter()
+        command.upgrade(cfg, "head")
+        print(f"  migration: {time.perf_counter() - start:9.3f} s")
+
+        after = lookups(engine, jids)
+        print(
+            f"ix_cred_jid: {after * 1e3:9.3f} ms per login lookup "
+            f"({before / after:.0f}x faster)"
+        )
+
+        engine.dispose()
+
+
+if __name__ == "__main__":
+    run(
+        int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000,
+        int(sys.argv[2]) if len(sys.argv) > 2 else 200,
+    )
@@ -0,0 +1,71 @@
+"""
+Roster write throughput with the user tables in 1, 4 and 8 database files.
+
+Many users add roster items at the same time, each write in its own
+transaction through DB.writer. With one file every write waits for the single
+writer; with shards, users in different files are written in parallel.
+
+    python -m test.benchmarks.bench_db_shards [users] [writes_per_user]
+"""
+
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+from sqlalchemy import insert
+
+from pyjabber import AppConfig
+from pyjabber.db.database import DB
+from pyjabber.db.model import Model
+
+
+async def user_writes(jid: str, writes: int):
+    for i in range(writes):
+        async with DB.writer(jid) as con:
+            await con.execute(
+                insert(Model.Roster).values(
+                    {"jid": jid, "roster_item": f'<item jid="contact{i}"/>'}
+                )
+            )
+
+
+async def run_shards(path: str, shards: int, users: int, writes: int) -> float:
+    AppConfig.app_config = SimpleNamespace(
+        database_path=os.path.join(path, f"bench{shards}.db"),
+        database_in_memory=False,
+        database_debug=False,
+        database_write_timeout=60.0,
+        database_read_timeout=60.0,
+        database_readers=4,
+        database_shards=shards,
+    )
+    await DB.setup_database()
+
+    start = time.perf_counter()
+    await asyncio.gather(*[user_writes(f"user{u}", writes) for u in range(users)])
+    elapsed = time.perf_counter() - start
+
+    await DB.close_engine_async()
+    return users * writes / elapsed
+
+
+async def run(users: int, writes: int):
+    print(f"{os.cpu_count()} CPUs, {users} users x {writes} roster writes")
+    with tempfile.TemporaryDirectory() as path:
+        base = None
+        for shards in (1, 4, 8):
+            rate = await run_shards(path, shards, users, writes)
+            base = base or rate
+            print(f"{shards:>2} shards: {rate:8.1f} writes/s ({rate / base:.2f}x)")
+
+
+if __name__ == "__main__":
+    asyncio.run(
+        run(
+            int(sys.argv[1]) if len(sys.argv) > 1 else 200,
+            int(sys.argv[2]) if len(sys.argv) > 2 else 10,
+        )
+    )
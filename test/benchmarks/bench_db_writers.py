@@ -0,0 +1,140 @@
+"""
+Concurrent writers and readers on the SQLite database, with one engine
+connection per call (the previous access) and with the writer queue plus the
+read-only pool of DB.
+
+Every writer inserts a roster item and commits, while readers load the roster
+of a user. The SQLite busy timeout is kept short, as a loaded server would
+hit it, so contention on the write lock shows up as "database is locked".
+
+    python -m test.benchmarks.bench_db_writers [writers] [readers]
+"""
+
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+from sqlalchemy import event, insert, select
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from pyjabber import AppConfig
+from pyjabber.db.database import DB
+from pyjabber.db.model import Model
+
+BUSY_TIMEOUT = 0.1
+
+
+def item(i: int):
+    return insert(Model.Roster).values(
+        {"jid": f"user{i % 100}", "roster_item": f'<item jid="contact{i}"/>'}
+    )
+
+
+ROSTER = select(Model.Roster.c.roster_item).where(Model.Roster.c.jid == "user0")
+
+
+async def timed(coro) -> float:
+    start = time.perf_counter()
+    await coro
+    return time.perf_counter() - start
+
+
+def report(name: str, elapsed: float, writes: list, reads: list, errors: int):
+    ok = [w for w in writes if w is not None]
+    print(
+        f"{name:>12}: {len(ok) / elapsed:8.1f} writes/s | {errors:4d} locked "
+        f"| write p99 {statistics.quantiles(ok, n=100)[98] * 1e3:7.1f} ms "
+        f"| read p99 {statistics.quantiles(reads, n=100)[98] * 1e3:7.1f} ms"
+    )
+
+
+async def per_call(database: str, writers: int, readers: int):
+    engine = create_async_engine(
+        f"sqlite+aiosqlite:///{database}", connect_args={"timeout": BUSY_TIMEOUT}
+    )
+
+    @event.listens_for(engine.sync_engine, "connect")
+    def wal(dbapi_connection, _):
+        dbapi_connection.execute("PRAGMA journal_mode=WAL")
+
+    errors = 0
+
+    async def write(i: int):
+        async with engine.connect() as con:
+            await con.execute(item(i))
+            await con.commit()
+
+    async def write_or_fail(i: int):
+        nonlocal errors
+        try:
+            return await timed(write(i))
+        except OperationalError:
+            errors += 1
+
+    async def read():
+        async with engine.connect() as con:
+            (await con.execute(ROSTER)).fetchall()
+
+    start = time.perf_counter()
+    writes, reads = await asyncio.gather(
+        asyncio.gather(*[write_or_fail(i) for i in range(writers)]),
+        asyncio.gather(*[timed(read()) for _ in range(readers)]),
+    )
+    report("per call", time.perf_counter() - start, writes, reads, errors)
+    await engine.dispose()
+
+
+async def roles(database: str, writers: int, readers: int):
+    AppConfig.app_config = SimpleNamespace(
+        database_path=database,
+        database_in_memory=False,
+        database_debug=False,
+        database_write_timeout=30.0,
+        database_read_timeout=30.0,
+        database_readers=4,
+    )
+    await DB.setup_database()
+
+    async def write(i: int):
+        async with DB.writer() as con:
+            await con.execute(item(i))
+
+    async def read():
+        async with DB.reader() as con:
+            (await con.execute(ROSTER)).fetchall()
+
+    start = time.perf_counter()
+    writes, reads = await asyncio.gather(
+        asyncio.gather(*[timed(write(i)) for i in range(writers)]),
+        asyncio.gather(*[timed(read()) for _ in range(readers)]),
+    )
+    report("writer queue", time.perf_counter() - start, writes, reads, 0)
+    print(f"     metrics: {DB.metrics()}")
+    await DB.close_engine_async()
+
+
+async def run(writers: int, readers: int):
+    print(f"{writers} writers, {readers} readers, busy timeout {BUSY_TIMEOUT} s")
+    with tempfile.TemporaryDirectory() as path:
+        database = os.path.join(path, "per_call.db")
+        engine = create_async_engine(f"sqlite+aiosqlite:///{database}")
+        async with engine.begin() as con:
+            await con.run_sync(Model.server_metadata.create_all)
+        await engine.dispose()
+        await per_call(database, writers, readers)
+
+        await roles(os.path.join(path, "roles.db"), writers, readers)
+
+
+if __name__ == "__main__":
+    asyncio.run(
+        run(
+            int(sys.argv[1]) if len(sys.argv) > 1 else 500,
+            int(sys.argv[2]) if len(sys.argv) > 2 else 500,
+        )
+    )
@@ -0,0 +1,139 @@
+"""
+Service discovery queries per second, with the responses kept serialized.
+
+Before, every query built the elements of its response again (the upload
+info with its data form, the pubsub items with a node each) and serialized
+them. Now the query of each response is serialized once, and a request only
+writes its id and addresses around it. Rebuilt below drops the kept
+responses before each query.
+
+    python -m test.benchmarks.bench_disco [nodes] [queries]
+"""
+
+import asyncio
+import sys
+import time
+from types import SimpleNamespace
+from unittest.mock import patch
+from xml.etree import ElementTree as ET
+
+from sqlalchemy import insert
+
+from pyjabber.db.database import DB
+from pyjabber.db.model import Model
+from pyjabber.plugins.xep_0030.xep_0030 import Disco
+from pyjabber.plugins.xep_0060.xep_0060 import PubSub
+
+PUBSUB = "http://jabber.org/protocol/pubsub"
+UPLOAD = "urn:xmpp:http:upload:0"
+
+CONFIG = SimpleNamespace(
+    host="localhost",
+    config_path="",
+    plugins=[
+        "http://jabber.org/protocol/disco#info",
+        "http://jabber.org/protocol/disco#items",
+        PUBSUB,
+        "http://jabber.org/protocol/pubsub#publish",
+        "http://jabber.org/protocol/pubsub#subscribe",
+        "jabber:iq:register",
+        "jabber:x:data",
+        "urn:xmpp:ping",
+        "jabber:iq:rpc",
+        UPLOAD,
+    ],
+    items={
+        "pubsub.$": {
+            "name": "Pubsub Service",
+            "category": "pubsub",
+            "type": "service",
+            "var": PUBSUB,
+        },
+        "upload.$": {
+            "name": "HTTP File Upload",
+            "category": "store",
+            "type": "file",
+            "var": UPLOAD,
+            "extra": {"max-size": 5242880},
+        },
+    },
+    database_in_memory=True,
+    database_debug=False,
+    database_write_timeout=5.0,
+    database_read_timeout=5.0,
+    database_readers=1,
+    database_shards=1,
+)
+
+TARGETS = (
+    ("info", "localhost"),
+    ("info", "upload.localhost"),
+    ("info", "juliet@localhost"),
+    ("items", "localhost"),
+    ("items", "pubsub.localhost"),
+)
+
+
+def request(kind: str, to: str, id_: int) -> ET.Element:
+    element = ET.Element(
+        "iq",
+        attrib={"type": "get", "id": str(id_), "from": "romeo@localhost/r", "to": to},
+    )
+    ET.SubElement(element, f"{{http://jabber.org/protocol/disco#{kind}}}query")
+    return element
+
+
+async def measure(disco: Disco, queries: int, rebuilt: bool) -> dict:
+    rates = {}
+    for kind, to in TARGETS:
+        requests = [request(kind, to, i) for i in range(queries)]
+        start = time.perf_counter()
+        for element in requests:
+            if rebuilt:
+                disco._responses.clear()
+                disco._pubsub_responses.clear()
+            await disco.feed(None, element)
+        rates[(kind, to)] = queries / (time.perf_counter() - start)
+    return rates
+
+
+async def run(nodes: int, queries: int):
+    with patch("pyjabber.AppConfig.app_config", CONFIG):
+        await DB.setup_database()
+        async with DB.writer() as con:
+            await con.execute(
+                insert(Model.Pubsub),
+                [
+                    {
+                        "node": f"node{i}",
+                        "owner": "demo",
+                        "name": f"Node {i}",
+                        "type": "leaf",
+                        "max_items": 1024,
+                    }
+                    for i in range(nodes)
+                ],
+            )
+        await PubSub().update_memory_from_database()
+        disco = Disco()
+
+        before = await measure(disco, queries, rebuilt=True)
+        after = await measure(disco, queries, rebuilt=False)
+
+        print(f"{'query':>32} {'rebuilt':>12} {'kept':>12}")
+        for target in TARGETS:
+            print(
+                f"{' '.join(target):>32} {before[target]:10.0f}/s "
+                f"{after[target]:10.0f}/s  x{after[target] / before[target]:.1f}"
+            )
+
+        await DB.close_engine_async()
+
+
+if __name__ == "__main__":
+    asyncio.run(
+        run(
+            int(sys.argv[1]) if len(sys.argv) > 1 else 200,
+            int(sys.argv[2]) if len(sys.argv) > 2 else 5000,
+        )
+    )
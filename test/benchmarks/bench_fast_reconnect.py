@@ -0,0 +1,142 @@
+"""
+Reconnection latency, with and without FAST (XEP-0484) tokens.
+
+Each reconnection authenticates over SASL2 against an in-memory database,
+with the key derivation running on the KDF executor as on a live server.
+The latency covers both ends of the exchange: a SCRAM client runs PBKDF2
+too, while a token only costs an HMAC to the client and a lookup by hash to
+the server.
+
+    python -m test.benchmarks.bench_fast_reconnect [reconnections]
+"""
+
+import asyncio
+import base64
+import socket
+import statistics
+import sys
+import time
+from xml.etree import ElementTree as ET
+
+from pyjabber import AppConfig
+from pyjabber.db.database import DB
+from pyjabber.features.SASL import FAST
+from pyjabber.features.SASL.KDF import KDFExecutor
+from pyjabber.features.SASL.SASL2 import SASL2
+from pyjabber.network.ConnectionManager import ConnectionManager
+from pyjabber.stream.utils.Enums import Stage
+from test.benchmarks.scram_client import ScramClient
+
+CLIENT = "d4565fa7-4d72-4749-b3d3-740edbf87770"
+PASSWORD = "pencil"
+
+
+class Transport:
+    def __init__(self):
+        self.last = None
+
+    def write(self, data: bytes):
+        self.last = data
+
+    def get_extra_info(self, _):
+        return None
+
+    def close(self):
+        pass
+
+
+def authenticate(mechanism: str, initial_response: bytes, **fast) -> ET.Element:
+    element = ET.Element(
+        "{urn:xmpp:sasl:2}authenticate", attrib={"mechanism": mechanism}
+    )
+    ET.SubElement(element, "{urn:xmpp:sasl:2}initial-response").text = base64.b64encode(
+        initial_response
+    ).decode()
+    ET.SubElement(element, "{urn:xmpp:sasl:2}user-agent", attrib={"id": CLIENT})
+    if fast:
+        ET.SubElement(element, "{urn:xmpp:fast:0}fast", attrib=fast)
+    return element
+
+
+async def reconnect(port: int, mechanism: str, token: str = None) -> float:
+    transport = Transport()
+    peer = ("127.0.0.1", port)
+    ConnectionManager().connection(peer, transport)
+
+    start = time.perf_counter()
+    sasl = SASL2(transport, None, peer)
+
+    if mechanism == "PLAIN":
+        res = await sasl.feed(authenticate("PLAIN", f"\x00user\x00{PASSWORD}".encode()))
+
+    elif mechanism == "SCRAM-SHA-256":
+        client = ScramClient("user", PASSWORD)
+        await sasl.feed(authenticate("SCRAM-SHA-256", client.first()))
+        response = ET.Element("{urn:xmpp:sasl:2}response")
+        response.text = base64.b64encode(
+            client.final(base64.b64decode(ET.fromstring(transport.last).text))
+        ).decode()
+        res = await sasl.feed(response)
+
+    else:
+        res = await sasl.feed(
+            authenticate(
+                "HT-SHA-256-NONE",
+                b"user\x00" + FAST.initiator(token),
+                count=str(port),
+            )
+        )
+
+    elapsed = time.perf_counter() - start
+    assert res == Stage.AUTH, transport.last
+    ConnectionManager().close(peer)
+    return elapsed
+
+
+async def run(reconnections: int):
+    AppConfig.app_config = AppConfig.AppConfig(
+        host="localhost",
+        ip=[],
+        ssl_context=None,
+        ssl_context_s2s=None,
+        connection_timeout=60,
+        server_port=5269,
+        family=socket.AF_INET,
+        config_path="",
+        cert_path="",
+        root_path="",
+        database_path="",
+        database_in_memory=True,
+        database_purge=False,
+        database_debug=False,
+        message_persistence=False,
+        verbose=False,
+        plugins=[],
+        items={},
+    )
+    await DB.setup_database()
+
+    transport = Transport()
+    ConnectionManager().connection(("127.0.0.1", 0), transport)
+    sasl = SASL2(transport, None, ("127.0.0.1", 0))
+    await sasl._store_hash_task(PASSWORD, "user")
+
+    token, _ = await FAST.issue_token("user", CLIENT)
+
+    for mechanism in ("PLAIN", "SCRAM-SHA-256", "HT-SHA-256-NONE"):
+        latencies = [
+            await reconnect(port, mechanism, token)
+            for port in range(1, reconnections + 1)
+        ]
+        print(
+            f"{mechanism:>16}: mean {statistics.mean(latencies) * 1e3:8.2f} ms "
+            f"| p50 {statistics.median(latencies) * 1e3:8.2f} ms "
+            f"| max {max(latencies) * 1e3:8.2f} ms"
+        )
+
+    KDFExecutor().shutdown()
+    await DB.close_engine_async()
+
+
+if __name__ == "__main__":
+    asyncio.run(run(int(sys.argv[1]) if len(sys.argv) > 1 else 50))
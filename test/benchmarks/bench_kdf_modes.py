@@ -0,0 +1,82 @@
+"""
+Password logins per second and p99 latency, for each KDF executor mode.
+
+A burst of PLAIN logins (one PBKDF2 of 100k iterations each, from distinct
+IPs) goes through the login admission and the KDF executor. The event loop
+lag is measured too: the inline mode runs the derivation on the loop, and
+every other connection of the server waits for it.
+
+    python -m test.benchmarks.bench_kdf_modes [logins]
+"""
+
+import asyncio
+import multiprocessing
+import statistics
+import sys
+import time
+from types import SimpleNamespace
+
+from pyjabber import AppConfig
+from pyjabber.features.SASL.KDF import KDFExecutor, KDFMode
+
+ITERATIONS = 100000
+
+
+def kdf_executor(mode: KDFMode) -> KDFExecutor:
+    AppConfig.app_config = SimpleNamespace(
+        kdf_mode=mode.value,
+        kdf_workers=multiprocessing.cpu_count(),
+        login_rate=10.0,
+        login_burst=20,
+        login_max_wait=600.0,
+    )
+    executor = object.__new__(KDFExecutor)
+    executor.__init__()
+    return executor
+
+
+async def login(executor: KDFExecutor, ip: str) -> float:
+    start = time.perf_counter()
+    await executor.pbkdf2("sha256", "pencil", b"0123456789abcdef", ITERATIONS, ip)
+    return time.perf_counter() - start
+
+
+async def loop_lag(stop: asyncio.Event) -> float:
+    lag = 0
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(0.001)
+        lag = max(lag, time.perf_counter() - start - 0.001)
+    return lag
+
+
+async def run(logins: int):
+    print(f"{multiprocessing.cpu_count()} CPUs, {logins} logins of {ITERATIONS} iter")
+
+    for mode in KDFMode:
+        executor = kdf_executor(mode)
+        await login(executor, "warm-up")  # Executor start-up is not measured
+
+        stop = asyncio.Event()
+        lag_task = asyncio.create_task(loop_lag(stop))
+        await asyncio.sleep(0)
+
+        start = time.perf_counter()
+        latencies = await asyncio.gather(
+            *[login(executor, f"10.0.{i // 256}.{i % 256}") for i in range(logins)]
+        )
+        elapsed = time.perf_counter() - start
+
+        stop.set()
+        lag = await lag_task
+        executor.shutdown()
+
+        p99 = statistics.quantiles(latencies, n=100)[98]
+        print(
+            f"{mode.value:>8}: {logins / elapsed:7.1f} logins/s "
+            f"| p99 {p99 * 1e3:8.1f} ms | max loop lag {lag * 1e3:8.1f} ms"
+        )
+
+
+if __name__ == "__main__":
+    asyncio.run(run(int(sys.argv[1]) if len(sys.argv) > 1 else 64))
@@ -0,0 +1,207 @@
+"""
+PEP publication of an account with a 300-contact roster. Every contact is
+online with two sessions, and one of them advertises mood+notify.
+
+Before: without a caps index, the receivers of each event had to be found
+asking every online session for its features (one disco#info per session
+and publication, network round trips not included here), or the event went
+to every session. After: the receivers come from the caps index, and only the
+interested sessions get the event. The index asks one session of each caps
+version for its features, instead of every session.
+
+    python -m test.benchmarks.bench_pep_fanout [contacts] [publications]
+"""
+
+import asyncio
+import sys
+import time
+from types import SimpleNamespace
+from unittest.mock import patch
+from xml.etree import ElementTree as ET
+
+from sqlalchemy import insert
+
+from pyjabber.db.database import DB
+from pyjabber.db.model import Model
+from pyjabber.network.ConnectionManager import Client
+from pyjabber.plugins.xep_0115.xep_0115 import DISCO_INFO, Caps, caps_hash
+from pyjabber.plugins.xep_0115.xep_0115 import NAMESPACE as CAPS
+from pyjabber.plugins.xep_0163.xep_0163 import PEP
+from pyjabber.queues.QueueManager import QueueName, get_queue
+from pyjabber.queues.workers.NotificationWorker import (
+    NotificationMetrics,
+    notification_worker,
+)
+from pyjabber.stanzas.IQ import IQ
+from pyjabber.stream.JID import JID
+
+PUBSUB = "http://jabber.org/protocol/pubsub"
+MOOD = "http://jabber.org/protocol/mood"
+
+CONFIG = SimpleNamespace(
+    host="localhost",
+    plugins=[PUBSUB],
+    items={"pubsub.$": {"category": "pubsub", "type": "service", "var": PUBSUB}},
+    database_in_memory=True,
+    database_debug=False,
+    database_write_timeout=5.0,
+    database_read_timeout=5.0,
+    database_readers=1,
+    database_shards=1,
+)
+
+FEATURES = [DISCO_INFO, "urn:xmpp:ping", "jabber:iq:version"]
+
+
+class Transport:
+    __slots__ = ("written",)
+
+    def __init__(self):
+        self.written = 0
+
+    def write(self, data: bytes):
+        self.written += len(data)
+
+
+class Connections:
+    def __init__(self):
+        self.clients = {}
+
+    def get_transport(self, jid: JID):
+        client = self.clients.get(str(jid))
+        return [client] if client else []
+
+
+def disco_info(features) -> bytes:
+    iq = IQ(type_=IQ.TYPE.RESULT)
+    query = ET.SubElement(iq, f"{{{DISCO_INFO}}}query")
+    for var in features:
+        ET.SubElement(query, f"{{{DISCO_INFO}}}feature", attrib={"var": var})
+    return ET.tostring(iq)
+
+
+def publish(item_id: str) -> ET.Element:
+    element = ET.Element("iq", attrib={"type": "set", "id": item_id})
+    pubsub = ET.SubElement(element, f"{{{PUBSUB}}}pubsub")
+    node = ET.SubElement(pubsub, f"{{{PUBSUB}}}publish", attrib={"node": MOOD})
+    item = ET.SubElement(node, f"{{{PUBSUB}}}item", attrib={"id": item_id})
+    ET.SubElement(item, f"{{{MOOD}}}mood").text = "happy"
+    return element
+
+
+def per_publish_disco(sessions: dict) -> float:
+    """
+    The receivers of one event, asking every session for its features
+    """
+    start = time.perf_counter()
+    receivers = []
+    for full, response in sessions.items():
+        query = IQ(type_=IQ.TYPE.GET, from_="localhost", to=full)
+        ET.SubElement(query, f"{{{DISCO_INFO}}}query")
+        ET.tostring(query)
+
+        features = ET.fromstring(response).iterfind(f".//{{{DISCO_INFO}}}feature")
+        if any(f.attrib["var"] == MOOD + "+notify" for f in features):
+            receivers.append(full)
+    return time.perf_counter() - start
+
+
+async def run(contacts: int, publications: int):
+    connections = Connections()
+    sessions = {}
+
+    with (
+        patch("pyjabber.AppConfig.app_config", CONFIG),
+        patch(
+            "pyjabber.queues.workers.NotificationWorker.ConnectionManager",
+            return_value=connections,
+        ),
+        patch(
+            "pyjabber.plugins.xep_0115.xep_0115.ConnectionManager",
+            return_value=connections,
+        ),
+    ):
+        caps = Caps()
+        await DB.setup_database()
+        async with DB.writer() as con:
+            await con.execute(
+                insert(Model.Roster),
+                [
+                    {
+                        "jid": "juliet",
+                        "roster_item": f"<item jid='user{i}' subscription='both'/>",
+                    }
+                    for i in range(contacts)
+                ],
+            )
+
+        # Two sessions per contact, the phone wants the moods. The sessions of
+        # a kind share their caps version
+        start = time.perf_counter()
+        asked = 0
+        for i in range(contacts):
+            for resource, features in (
+                ("phone", FEATURES + [MOOD + "+notify"]),
+                ("desktop", FEATURES),
+            ):
+                jid = JID(f"user{i}@localhost/{resource}")
+                connections.clients[str(jid)] = Client(jid, Transport(), True)
+                sessions[str(jid)] = disco_info(features)
+
+                response = ET.fromstring(sessions[str(jid)])
+                presence = ET.fromstring(
+                    f"<presence><c xmlns='{CAPS}' hash='sha-1' node='urn:example' "
+                    f"ver='{caps_hash(response[0])}'/></presence>"
+                )
+                caps.presence(jid, presence)
+
+                query = caps._queries.get(str(jid))
+                if query:
+                    asked += 1
+                    response.attrib["id"] = query[0]
+                    await caps.response(jid, response)
+        print(
+            f"        caps of {len(sessions)} sessions: {asked} disco#info queries, "
+            f"{(time.perf_counter() - start) * 1e3:.2f} ms"
+        )
+
+        disco = per_publish_disco(sessions)
+        print(
+            f"per publication disco: {disco * 1e3:7.2f} ms to find the receivers, "
+            f"{len(sessions)} queries (plus their round trips)"
+        )
+        print(f"      every session: {len(sessions)} deliveries per publication")
+
+        pep = PEP()
+        worker = asyncio.create_task(notification_worker())
+        juliet = JID("juliet@localhost/balcony")
+
+        start = time.perf_counter()
+        for i in range(publications):
+            await pep.feed(juliet, publish(str(i)))
+        elapsed = (time.perf_counter() - start) / publications
+
+        metrics = NotificationMetrics()
+        while metrics.events < publications:
+            await asyncio.sleep(0.001)
+        worker.cancel()
+        await worker
+
+        print(
+            f"          caps index: {elapsed * 1e3:7.2f} ms per publication "
+            f"(stored, receivers found and enqueued), "
+            f"{metrics.deliveries / publications:.0f} deliveries per publication, "
+            f"fan-out {metrics.latency_total / metrics.events * 1e3:.2f} ms"
+        )
+        print(f"queue: {get_queue(QueueName.NOTIFICATIONS).qsize()} left")
+
+        await DB.close_engine_async()
+
+
+if __name__ == "__main__":
+    asyncio.run(
+        run(
+            int(sys.argv[1]) if len(sys.argv) > 1 else 300,
+            int(sys.argv[2]) if len(sys.argv) > 2 else 100,
+        )
+    )
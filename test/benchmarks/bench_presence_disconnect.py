@@ -0,0 +1,178 @@
+"""
+10k clients dropped at once by a network outage. Every account has 10
+contacts among 500 watchers that stay online with two sessions each, and one
+in ten of the dropped clients reconnects before the batch is processed.
+
+Before, nothing consumed the lost connections: the queue kept growing and
+the contacts never got the unavailable presences. Per event below is that
+queue processed one lost session at a time, with a write per presence. The
+worker processes the outage as one batch: the reconnected sessions are left
+out, and every watcher session gets its presences in a single write.
+
+    python -m test.benchmarks.bench_presence_disconnect [clients] [watchers]
+"""
+
+import asyncio
+import sys
+import time
+from types import SimpleNamespace
+from unittest.mock import patch
+from xml.etree import ElementTree as ET
+
+from pyjabber.features.presence.PresenceFeature import Presence
+from pyjabber.network.ConnectionManager import ConnectionManager, Peer
+from pyjabber.queues.QueueManager import QueueManager, QueueName, get_queue
+from pyjabber.queues.workers.PresenceWorker import flush, presence_worker
+from pyjabber.stream.JID import JID
+from pyjabber.utils import Singleton
+
+CONFIG = SimpleNamespace(host="localhost", plugins=[])
+CONTACTS = 10
+RECONNECTED = 10  # One in ten dropped clients comes back
+
+
+class Transport:
+    __slots__ = ("writes", "closing")
+
+    def __init__(self):
+        self.writes = 0
+        self.closing = False
+
+    def write(self, data: bytes):
+        self.writes += 1
+
+    def is_closing(self) -> bool:
+        return self.closing
+
+
+class Roster:
+    def __init__(self, watchers: int):
+        self._watchers = watchers
+
+    def roster_by_jid(self, jid: JID):
+        if not jid.user.startswith("user"):
+            return []
+        i = int(jid.user[4:])
+        return [
+            {
+                "item": f"<item jid='watcher{(i * 7 + k) % self._watchers}' "
+                "subscription='both'/>"
+            }
+            for k in range(CONTACTS)
+        ]
+
+
+async def online(clients: int, watchers: int):
+    """
+    Binds every session, the clients first so their presences reach nobody
+    """
+    for cls in (Presence, ConnectionManager):
+        Singleton._instances.pop(cls, None)
+    for name in (QueueName.CONNECTIONS, QueueName.PRESENCE):
+        QueueManager._queues.pop(name, None)
+
+    connections = ConnectionManager()
+    presence = Presence()
+    transports = {}
+    port = 0
+
+    async def bind(full: str):
+        nonlocal port
+        port += 1
+        peer = Peer("10.0.0.1", port)
+        transports[full] = Transport()
+        connections.connection(peer, transports[full])
+        connections.set_jid(peer, JID(full))
+        await presence.feed(JID(full), ET.Element("presence"))
+
+    for i in range(clients):
+        await bind(f"user{i}@localhost/res")
+    for i in range(watchers):
+        for resource in ("a", "b"):
+            await bind(f"watcher{i}@localhost/{resource}")
+
+    return presence, bind, transports
+
+
+async def outage(clients: int, bind, transports):
+    """
+    Drops every client, and binds again one in ten of them
+    """
+    queue = get_queue(QueueName.PRESENCE)
+    for i in range(clients):
+        full = f"user{i}@localhost/res"
+        transports[full].closing = True
+        queue.put_nowait((JID(full), ET.Element("presence", {"type": "INTERNAL"})))
+    for i in range(0, clients, RECONNECTED):
+        await bind(f"user{i}@localhost/res")
+
+
+def watcher_writes(transports) -> int:
+    return sum(t.writes for f, t in transports.items() if f.startswith("watcher"))
+
+
+def reset(transports):
+    for transport in transports.values():
+        transport.writes = 0
+
+
+async def run(clients: int, watchers: int):
+    with (
+        patch("pyjabber.AppConfig.app_config", CONFIG),
+        patch(
+            "pyjabber.features.presence.PresenceFeature.Roster",
+            return_value=Roster(watchers),
+        ),
+    ):
+        # Per event: every lost session on its own, a write per presence
+        presence, bind, transports = await online(clients, watchers)
+        await outage(clients, bind, transports)
+        reset(transports)
+        queue = get_queue(QueueName.PRESENCE)
+
+        start = time.perf_counter()
+        events = 0
+        while not queue.empty():
+            jid, _ = queue.get_nowait()
+            flush(presence.lost_connections([jid]))
+            events += 1
+        per_event = time.perf_counter() - start
+        writes = watcher_writes(transports)
+        print(
+            f"per event: {events} lost sessions, {per_event * 1e3:8.2f} ms, "
+            f"{writes} writes to the watchers"
+        )
+
+        # Coalesced: the worker drains the outage as one batch
+        presence, bind, transports = await online(clients, watchers)
+        await outage(clients, bind, transports)
+        reset(transports)
+        queue = get_queue(QueueName.PRESENCE)
+
+        with patch("pyjabber.queues.workers.PresenceWorker.COALESCE_WINDOW", 0):
+            worker = asyncio.create_task(presence_worker())
+            start = time.perf_counter()
+            while not queue.empty():
+                await asyncio.sleep(0)
+            while watcher_writes(transports) == 0:
+                await asyncio.sleep(0)
+            coalesced = time.perf_counter() - start
+            worker.cancel()
+            await worker
+
+        writes = watcher_writes(transports)
+        print(
+            f"coalesced: {clients - clients // RECONNECTED} lost sessions, "
+            f"{coalesced * 1e3:8.2f} ms, {writes} writes to the watchers "
+            f"(x{per_event / coalesced:.1f})"
+        )
+        print(f"queue: {queue.qsize()} left")
+
+
+if __name__ == "__main__":
+    asyncio.run(
+        run(
+            int(sys.argv[1]) if len(sys.argv) > 1 else 10000,
+            int(sys.argv[2]) if len(sys.argv) > 2 else 500,
+        )
+    )
@@ -0,0 +1,154 @@
+"""
+Publishing to a node with 50k online subscribers.
+
+Before: the notification was built and serialized for every receiver while
+handling the publish request. After: the request only enqueues the event, and
+the notification worker serializes it once and writes it in batches.
+
+Reports how long the publisher waits and the longest stall of the loop.
+
+    python -m test.benchmarks.bench_pubsub_fanout [subscribers]
+"""
+
+import asyncio
+import sys
+import time
+from types import SimpleNamespace
+from unittest.mock import patch
+from uuid import uuid4
+from xml.etree import ElementTree as ET
+
+from pyjabber.network.ConnectionManager import Client
+from pyjabber.plugins.xep_0060.enum import Affiliation
+from pyjabber.plugins.xep_0060.xep_0060 import PubSub
+from pyjabber.queues.QueueManager import QueueName, get_queue
+from pyjabber.queues.workers.NotificationWorker import (
+    NotificationMetrics,
+    notification_worker,
+)
+from pyjabber.stanzas.Message import Message
+from pyjabber.stream.JID import JID
+
+
+class Transport:
+    __slots__ = ("written",)
+
+    def __init__(self):
+        self.written = 0
+
+    def write(self, data: bytes):
+        self.written += len(data)
+
+
+class Connections:
+    def __init__(self):
+        self.clients = {}
+
+    def get_transport(self, jid: JID):
+        client = self.clients.get(jid.user)
+        if client is None:
+            client = self.clients[jid.user] = [Client(jid, Transport(), True)]
+        return client
+
+
+def payload() -> ET.Element:
+    entry = ET.Element("{http://www.w3.org/2005/Atom}entry")
+    ET.SubElement(entry, "{http://www.w3.org/2005/Atom}title").text = "x" * 200
+    return entry
+
+
+def event(node: str) -> ET.Element:
+    element = ET.Element(
+        "event", attrib={"xmlns": "http://jabber.org/protocol/pubsub#event"}
+    )
+    items = ET.SubElement(element, "items", attrib={"node": node})
+    ET.SubElement(items, "item").append(payload())
+    return element
+
+
+def per_receiver(connections: Connections, host: str, receivers: list) -> float:
+    """
+    The previous send_notification
+    """
+    start = time.perf_counter()
+    body = event("news")
+    for user in receivers:
+        for jid, buffer, _ in connections.get_transport(JID(user=user, domain=host)):
+            message = Message(
+                mto=jid.bare(), mfrom=host, id=str(uuid4()), mtype=None, body=body
+            )
+            buffer.write(ET.tostring(message))
+    return time.perf_counter() - start
+
+
+async def queued(connections: Connections, receivers: list):
+    service = object.__new__(PubSub)
+    service._subscribers = {
+        "news": {
+            str(i): ("news", user, str(i), "subscribed", Affiliation.PUBLISHER)
+            for i, user in enumerate(receivers)
+        }
+    }
+    service._notifications = get_queue(QueueName.NOTIFICATIONS)
+
+    stall = 0.0
+    done = False
+
+    async def ticker():
+        nonlocal stall
+        last = time.perf_counter()
+        while not done:
+            await asyncio.sleep(0)
+            now = time.perf_counter()
+            stall, last = max(stall, now - last), now
+
+    worker = asyncio.create_task(notification_worker())
+    monitor = asyncio.create_task(ticker())
+    await asyncio.sleep(0)
+
+    start = time.perf_counter()
+    service.send_notification(node="news", payload=payload())
+    enqueued = time.perf_counter() - start
+
+    metrics = NotificationMetrics()
+    while metrics.events < 1:
+        await asyncio.sleep(0.001)
+    total = time.perf_counter() - start
+
+    done = True
+    worker.cancel()
+    await asyncio.gather(worker, monitor)
+    return enqueued, total, stall
+
+
+def run(subscribers: int):
+    host = "localhost"
+    receivers = [f"user{i}" for i in range(subscribers)]
+    connections = Connections()
+    for user in receivers:
+        connections.get_transport(JID(user=user, domain=host))
+
+    with (
+        patch("pyjabber.AppConfig.app_config", SimpleNamespace(host=host)),
+        patch(
+            "pyjabber.queues.workers.NotificationWorker.ConnectionManager",
+            return_value=connections,
+        ),
+    ):
+        before = per_receiver(connections, host, receivers)
+        print(
+            f"per receiver: publisher waits {before * 1e3:8.1f} ms, "
+            f"loop stalled {before * 1e3:8.1f} ms"
+        )
+
+        enqueued, total, stall = asyncio.run(queued(connections, receivers))
+        print(
+            f"      queued: publisher waits {enqueued * 1e3:8.1f} ms, "
+            f"loop stalled {stall * 1e3:8.1f} ms, "
+            f"fan-out done in {total * 1e3:.1f} ms"
+        )
+        print(NotificationMetrics().stats())
+
+
+if __name__ == "__main__":
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 50_000)
@@ -0,0 +1,150 @@
+"""
+Items requests on a busy node, with max_items enforced and the newest items
+cached in memory.
+
+A node with the default max_items (1024) receives N publications. Before,
+every publication stayed in pubsub_items and each items request read and
+parsed all of them. Now the table stays bounded and the requests for the
+newest items are answered from memory.
+
+    python -m test.benchmarks.bench_pubsub_items [publications] [requests]
+"""
+
+import asyncio
+import sys
+import time
+from types import SimpleNamespace
+from unittest.mock import patch
+from xml.etree import ElementTree as ET
+
+from sqlalchemy import func, insert, select
+
+from pyjabber.db.database import DB
+from pyjabber.db.model import Model
+from pyjabber.plugins.xep_0060.xep_0060 import PubSub
+from pyjabber.stream.JID import JID
+
+PUBSUB = "http://jabber.org/protocol/pubsub"
+
+CONFIG = SimpleNamespace(
+    host="localhost",
+    items={"pubsub.$": {"category": "pubsub", "type": "service", "var": PUBSUB}},
+    database_in_memory=True,
+    database_debug=False,
+    database_write_timeout=5.0,
+    database_read_timeout=5.0,
+    database_readers=1,
+    database_shards=1,
+)
+
+
+def publish(item_id: str) -> ET.Element:
+    element = ET.Element("iq", attrib={"type": "set", "id": item_id})
+    pubsub = ET.SubElement(element, f"{{{PUBSUB}}}pubsub")
+    publish = ET.SubElement(pubsub, f"{{{PUBSUB}}}publish", attrib={"node": "news"})
+    item = ET.SubElement(publish, f"{{{PUBSUB}}}item", attrib={"id": item_id})
+    ET.SubElement(item, "{urn:example}entry").text = "x" * 200
+    return element
+
+
+def items(max_items: int = None) -> ET.Element:
+    element = ET.Element("iq", attrib={"type": "get", "id": "items"})
+    pubsub = ET.SubElement(element, f"{{{PUBSUB}}}pubsub")
+    attrib = {"node": "news"}
+    if max_items:
+        attrib["max_items"] = str(max_items)
+    ET.SubElement(pubsub, f"{{{PUBSUB}}}items", attrib=attrib)
+    return element
+
+
+async def stored() -> int:
+    async with DB.reader() as con:
+        res = await con.execute(select(func.count()).select_from(Model.PubsubItems))
+        return res.scalar()
+
+
+async def read_all() -> list:
+    """
+    The previous items request: every item of the node, parsed
+    """
+    async with DB.reader() as con:
+        res = await con.execute(
+            select(Model.PubsubItems).where(Model.PubsubItems.c.node == "news")
+        )
+        return [ET.fromstring(row[3]) for row in res.fetchall()]
+
+
+async def timed(coro_factory, count: int) -> float:
+    start = time.perf_counter()
+    for _ in range(count):
+        await coro_factory()
+    return (time.perf_counter() - start) / count
+
+
+async def run(publications: int, requests: int):
+    jid = JID("demo@localhost")
+
+    with patch("pyjabber.AppConfig.app_config", CONFIG):
+        # Before: every publication is kept
+        await DB.setup_database()
+        async with DB.writer() as con:
+            await con.execute(
+                insert(Model.PubsubItems),
+                [
+                    {
+                        "node": "news",
+                        "publisher": "demo@localhost",
+                        "item_id": str(i),
+                        "payload": ET.tostring(publish(str(i))[0][0][0][0]),
+                        "seq": i + 1,
+                        "published": int(time.time()),
+                    }
+                    for i in range(publications)
+                ],
+            )
+        rows = await stored()
+        before = await timed(read_all, requests)
+        await DB.close_engine_async()
+        print(f"   unbounded: {rows:6} rows, items request {before * 1e3:8.3f} ms")
+
+        # After
+        await DB.setup_database()
+        async with DB.writer() as con:
+            await con.execute(
+                insert(Model.Pubsub).values(
+                    node="news", owner="demo", type="leaf", max_items=1024
+                )
+            )
+        service = object.__new__(PubSub)
+        service.__init__()
+        await service.update_memory_from_database()
+
+        start = time.perf_counter()
+        for i in range(publications):
+            await service.publish(publish(str(i)), jid)
+        elapsed = time.perf_counter() - start
+        rows = await stored()
+        print(
+            f"max_items=1024: {rows:6} rows, "
+            f"{publications / elapsed:8.0f} publications/s"
+        )
+
+        for max_items in (None, 10, 1):
+            after = await timed(
+                lambda: service.retrieve_items_node(items(max_items), jid), requests
+            )
+            print(
+                f"{'max_items=' + str(max_items or 'all'):>14}: "
+                f"items request {after * 1e3:8.3f} ms"
+            )
+
+        await DB.close_engine_async()
+
+
+if __name__ == "__main__":
+    asyncio.run(
+        run(
+            int(sys.argv[1]) if len(sys.argv) > 1 else 20_000,
+            int(sys.argv[2]) if len(sys.argv) > 2 else 50,
+        )
+    )
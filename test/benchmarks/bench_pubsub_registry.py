@@ -0,0 +1,124 @@
+"""
+Lookups of the PubSub service over 100k nodes and 1M subscriptions, with the
+flat lists of rows the service used to keep against the indexed registry.
+
+Measures the lookups done by the operations: the node of a request, the
+subscriptions of a user on a node (subscribe, unsubscribe, retract, publish)
+and the receivers of a notification.
+
+    python -m test.benchmarks.bench_pubsub_registry [nodes] [subscriptions] [lookups]
+"""
+
+import random
+import sys
+import time
+
+from pyjabber.plugins.xep_0060.enum import Affiliation, NodeAttrib, SubscribersAttrib
+from pyjabber.plugins.xep_0060.xep_0060 import PubSub
+
+RECEIVERS = [Affiliation.MEMBER, Affiliation.PUBLISHER, Affiliation.OWNER]
+
+
+def rows(nodes: int, subscriptions: int, users: int):
+    node_rows = [
+        (f"node{i}", f"user{i % users}", None, "leaf", 1024) for i in range(nodes)
+    ]
+    sub_rows = [
+        (
+            f"node{random.randrange(nodes)}",
+            f"user{random.randrange(users)}",
+            f"sub{i}",
+            "subscribed",
+            Affiliation.PUBLISHER,
+        )
+        for i in range(subscriptions)
+    ]
+    return node_rows, sub_rows
+
+
+def registry(node_rows: list, sub_rows: list) -> PubSub:
+    service = object.__new__(PubSub)
+    service._nodes, service._subscribers = {}, {}
+    service._subscriptions, service._subids = {}, {}
+    for node in node_rows:
+        service._index_node(node)
+    for sub in sub_rows:
+        service._index_subscription(sub)
+    return service
+
+
+def timed(func, requests: list) -> float:
+    start = time.perf_counter()
+    for request in requests:
+        func(*request)
+    return (time.perf_counter() - start) / len(requests)
+
+
+def run(nodes: int, subscriptions: int, count: int):
+    users = max(subscriptions // 20, 1)
+    node_rows, sub_rows = rows(nodes, subscriptions, users)
+
+    start = time.perf_counter()
+    service = registry(node_rows, sub_rows)
+    print(
+        f"registry built in {time.perf_counter() - start:.2f} s "
+        f"({nodes} nodes, {subscriptions} subscriptions, {users} users)"
+    )
+
+    requests = [
+        (
+            random.choice(sub_rows)[SubscribersAttrib.NODE.value],
+            f"user{random.randrange(users)}",
+        )
+        for _ in range(count)
+    ]
+
+    cases = {
+        "node": (
+            lambda node, _: [n for n in node_rows if n[NodeAttrib.NODE.value] == node],
+            lambda node, _: service._nodes.get(node),
+        ),
+        "user on node": (
+            lambda node, jid: [
+                s
+                for s in sub_rows
+                if s[SubscribersAttrib.JID.value] == jid
+                and s[SubscribersAttrib.NODE.value] == node
+            ],
+            lambda node, jid: service._subscriptions_of(jid, node),
+        ),
+        "receivers": (
+            lambda node, _: [
+                s
+                for s in sub_rows
+                if s[SubscribersAttrib.NODE.value] == node
+                and s[SubscribersAttrib.AFFILIATION.value] in RECEIVERS
+            ],
+            lambda node, _: [
+                s
+                for s in service._subscribers.get(node, {}).values()
+                if s[SubscribersAttrib.AFFILIATION.value] in RECEIVERS
+            ],
+        ),
+    }
+
+    for name, (scan, index) in cases.items():
+        for node, jid in requests[:10]:
+            assert sorted(scan(node, jid) or []) == sorted(
+                [index(node, jid)] if name == "node" else index(node, jid)
+            )
+
+        before = timed(scan, requests)
+        after = timed(index, requests)
+        print(
+            f"{name:>12}: scan {before * 1e3:9.3f} ms, "
+            f"index {after * 1e6:7.2f} us ({before / after:,.0f}x faster)"
+        )
+
+
+if __name__ == "__main__":
+    run(
+        int(sys.argv[1]) if len(sys.argv) > 1 else 100_000,
+        int(sys.argv[2]) if len(sys.argv) > 2 else 1_000_000,
+        int(sys.argv[3]) if len(sys.argv) > 3 else 20,
+    )
@@ -0,0 +1,161 @@
+"""
+Items requests on a node with 10k items: a single response with every item
+(the previous behaviour) against RSM pages.
+
+Reports the latency, the peak memory allocated while answering (tracemalloc)
+and the size of the response.
+
+    python -m test.benchmarks.bench_pubsub_rsm [items] [page]
+"""
+
+import asyncio
+import sys
+import time
+import tracemalloc
+from types import SimpleNamespace
+from unittest.mock import patch
+from xml.etree import ElementTree as ET
+
+from sqlalchemy import insert, select
+
+from pyjabber.db.database import DB
+from pyjabber.db.model import Model
+from pyjabber.plugins.xep_0059.xep_0059 import NAMESPACE as RSM
+from pyjabber.plugins.xep_0060.utils import success_response
+from pyjabber.plugins.xep_0060.xep_0060 import PubSub
+from pyjabber.stream.JID import JID
+
+PUBSUB = "http://jabber.org/protocol/pubsub"
+
+CONFIG = SimpleNamespace(
+    host="localhost",
+    items={"pubsub.$": {"category": "pubsub", "type": "service", "var": PUBSUB}},
+    database_in_memory=True,
+    database_debug=False,
+    database_write_timeout=5.0,
+    database_read_timeout=5.0,
+    database_readers=1,
+    database_shards=1,
+)
+
+
+def request(rsm: str = None) -> ET.Element:
+    element = ET.Element("iq", attrib={"type": "get", "id": "items"})
+    pubsub = ET.SubElement(element, f"{{{PUBSUB}}}pubsub")
+    ET.SubElement(pubsub, f"{{{PUBSUB}}}items", attrib={"node": "news"})
+    if rsm is not None:
+        pubsub.append(ET.fromstring(f"<set xmlns='{RSM}'>{rsm}</set>"))
+    return element
+
+
+async def every_item(element: ET.Element) -> bytes:
+    """
+    The previous items request: every row, in a single response
+    """
+    async with DB.reader() as con:
+        res = await con.execute(
+            select(Model.PubsubItems).where(Model.PubsubItems.c.node == "news")
+        )
+        res = res.fetchall()
+
+    iq_res, pubsub_res = success_response(element)
+    items_res = ET.SubElement(pubsub_res, f"{{{PUBSUB}}}items", attrib={"node": "news"})
+    for row in res:
+        item = ET.SubElement(items_res, f"{{{PUBSUB}}}item", attrib={"id": row[2]})
+        item.append(ET.fromstring(row[3]))
+    return ET.tostring(iq_res)
+
+
+async def measure(name: str, coro_factory):
+    tracemalloc.start()
+    start = time.perf_counter()
+    res = await coro_factory()
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(
+        f"{name:>22}: {elapsed * 1e3:8.1f} ms, peak {peak / 2**20:7.2f} MiB, "
+        f"response {len(res) / 1024:8.1f} KiB"
+    )
+    return res
+
+
+async def run(count: int, page: int):
+    jid = JID("demo@localhost")
+    entry = ET.Element("{http://www.w3.org/2005/Atom}entry")
+    ET.SubElement(entry, "{http://www.w3.org/2005/Atom}title").text = "x" * 400
+    payload = ET.tostring(entry)
+
+    with patch("pyjabber.AppConfig.app_config", CONFIG):
+        await DB.setup_database()
+        async with DB.writer() as con:
+            await con.execute(
+                insert(Model.Pubsub).values(
+                    node="news", owner="demo", type="leaf", max_items=count
+                )
+            )
+            await con.execute(
+                insert(Model.PubsubItems),
+                [
+                    {
+                        "node": "news",
+                        "publisher": "demo@localhost",
+                        "item_id": f"item{i}",
+                        "payload": payload,
+                        "seq": i + 1,
+                        "published": int(time.time()),
+                    }
+                    for i in range(count)
+                ],
+            )
+
+        service = object.__new__(PubSub)
+        service.__init__()
+        await service.update_memory_from_database()
+        await service.retrieve_items_node(request("<max>1</max>"), jid)  # Load
+
+        await measure("every item", lambda: every_item(request()))
+        await measure(
+            f"rsm first page ({page})",
+            lambda: service.retrieve_items_node(request(f"<max>{page}</max>"), jid),
+        )
+        await measure(
+            f"rsm last page ({page})",
+            lambda: service.retrieve_items_node(
+                request(f"<max>{page}</max><before/>"), jid
+            ),
+        )
+        await measure(
+            "rsm middle page",
+            lambda: service.retrieve_items_node(
+                request(f"<max>{page}</max><after>item{count // 2}</after>"), jid
+            ),
+        )
+
+        start, pages, after = time.perf_counter(), 0, ""
+        while True:
+            res = ET.fromstring(
+                await service.retrieve_items_node(
+                    request(f"<max>{page}</max>{after}"), jid
+                )
+            )
+            pages += 1
+            last = res.find(f".//{{{RSM}}}last")
+            if last is None or last.text == f"item{count - 1}":
+                break
+            after = f"<after>{last.text}</after>"
+        print(
+            f"{'walk every page':>22}: {(time.perf_counter() - start) * 1e3:8.1f} ms "
+            f"({pages} pages)"
+        )
+
+        await DB.close_engine_async()
+
+
+if __name__ == "__main__":
+    asyncio.run(
+        run(
+            int(sys.argv[1]) if len(sys.argv) > 1 else 10_000,
+            int(sys.argv[2]) if len(sys.argv) > 2 else 100,
+        )
+    )
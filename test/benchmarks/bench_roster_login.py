@@ -0,0 +1,105 @@
+"""
+Roster retrieval on login, for users with 1000 contacts.
+
+Before, every login got the whole roster, parsing and serializing every
+stored item. With roster versioning (XEP-0237), a client that reconnects
+with the version it has gets an empty result, and one a few changes behind
+gets only the pushes of those changes.
+
+    python -m test.benchmarks.bench_roster_login [contacts] [logins]
+"""
+
+import asyncio
+import sys
+import time
+from types import SimpleNamespace
+from unittest.mock import patch
+from xml.etree import ElementTree as ET
+
+from sqlalchemy import insert
+
+from pyjabber.db.database import DB
+from pyjabber.db.model import Model
+from pyjabber.plugins.roster.Roster import Roster
+from pyjabber.stream.JID import JID
+
+CONFIG = SimpleNamespace(
+    host="localhost",
+    database_path=None,
+    database_in_memory=True,
+    database_debug=False,
+    database_write_timeout=5.0,
+    database_read_timeout=5.0,
+    database_readers=1,
+    database_shards=1,
+)
+BEHIND = 5  # Changes missed by the client a few changes behind
+
+
+def roster_iq(type_: str, ver: str = None, item: dict = None) -> ET.Element:
+    iq = ET.Element("iq", attrib={"type": type_, "id": "login"})
+    query = ET.SubElement(iq, "{jabber:iq:roster}query")
+    if ver is not None:
+        query.attrib["ver"] = ver
+    if item is not None:
+        ET.SubElement(query, "{jabber:iq:roster}item", attrib=item)
+    return iq
+
+
+async def populate(contacts: int) -> Roster:
+    async with DB.writer("user") as con:
+        await con.execute(
+            insert(Model.Roster).values(
+                [
+                    {
+                        "jid": "user",
+                        "roster_item": f'<item jid="contact{i}" name="Contact {i}" '
+                        'subscription="both"><group>Friends</group></item>',
+                    }
+                    for i in range(contacts)
+                ]
+            )
+        )
+
+    roster = Roster()
+    user = JID("user@localhost/res")
+    for i in range(BEHIND):
+        await roster.feed(
+            user,
+            roster_iq("set", item={"jid": f"contact{i}", "name": f"Renamed {i}"}),
+        )
+    return roster
+
+
+async def login(roster: Roster, logins: int, ver: str = None):
+    user = JID("user@localhost/res")
+    start = time.perf_counter()
+    for _ in range(logins):
+        res = await roster.feed(user, roster_iq("get", ver))
+    return (time.perf_counter() - start) / logins, len(res)
+
+
+async def run(contacts: int, logins: int):
+    with patch("pyjabber.AppConfig.app_config", CONFIG):
+        await DB.setup_database()
+        roster = await populate(contacts)
+
+        full, full_size = await login(roster, logins)
+        print(f"full roster:   {full * 1e3:8.3f} ms, {full_size:7d} bytes")
+        for name, ver in (("same version:", str(BEHIND)), ("behind:", "0")):
+            elapsed, size = await login(roster, logins, ver)
+            print(
+                f"{name:14s} {elapsed * 1e3:8.3f} ms, {size:7d} bytes "
+                f"(x{full / elapsed:.1f})"
+            )
+
+        await DB.close_engine_async()
+
+
+if __name__ == "__main__":
+    asyncio.run(
+        run(
+            int(sys.argv[1]) if len(sys.argv) > 1 else 1000,
+            int(sys.argv[2]) if len(sys.argv) > 2 else 50,
+        )
+    )
@@ -0,0 +1,93 @@
+"""
+Handshakes and memory per federated peer, with and without XEP-0288.
+
+Without bidirectional streams, two domains exchanging stanzas need two server
+streams (one dialed by each side). With bidi, one stream serves both ways.
+The benchmark opens the TLS streams used by N peers on loopback, with the same
+TLS setup as the server to server listener, and reports the handshake time and
+the memory held per peer (both ends of the streams, as traced by tracemalloc).
+
+    python -m test.benchmarks.bench_s2s_bidi [peers]
+"""
+
+import asyncio
+import os
+import shutil
+import ssl
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from pyjabber.network import CertGenerator
+
+CERTS = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+    "pyjabber",
+    "network",
+    "certs",
+)
+
+
+def contexts(cert_path: str):
+    cert = os.path.join(cert_path, "localhost_cert.pem")
+    key = os.path.join(cert_path, "localhost_key.pem")
+
+    server = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    server.verify_mode = ssl.CERT_OPTIONAL
+    server.load_cert_chain(certfile=cert, keyfile=key)
+    server.load_verify_locations(cafile=os.path.join(cert_path, "ca_cert.pem"))
+
+    client = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
+    client.check_hostname = False
+    client.verify_mode = ssl.CERT_NONE
+    client.load_cert_chain(certfile=cert, keyfile=key)
+
+    return server, client
+
+
+async def open_streams(count: int, server_ctx, client_ctx):
+    accepted = []
+    listener = await asyncio.start_server(
+        lambda r, w: accepted.append(w), "127.0.0.1", 0, ssl=server_ctx
+    )
+    host, port = listener.sockets[0].getsockname()
+
+    tracemalloc.start()
+    start = time.perf_counter()
+
+    streams = [
+        await asyncio.open_connection(host, port, ssl=client_ctx) for _ in range(count)
+    ]
+
+    elapsed = time.perf_counter() - start
+    heap, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    for _, writer in streams:
+        writer.close()
+    listener.close()
+    await listener.wait_closed()
+
+    return elapsed, heap
+
+
+async def run(peers: int):
+    with tempfile.TemporaryDirectory() as cert_path:
+        for file in ("ca_cert.pem", "ca_key.pem"):
+            shutil.copy(os.path.join(CERTS, file), cert_path)
+        CertGenerator.generate_hostname_cert("localhost", cert_path)
+        server_ctx, client_ctx = contexts(cert_path)
+
+    for name, streams_per_peer in (("two streams", 2), ("bidi (XEP-0288)", 1)):
+        elapsed, heap = await open_streams(
+            peers * streams_per_peer, server_ctx, client_ctx
+        )
+        print(
+            f"{name:>16}: {peers * streams_per_peer} TLS handshakes in {elapsed:.3f}s "
+            f"| per peer: {elapsed / peers * 1e3:.2f} ms, {heap / peers / 1024:.1f} KiB"
+        )
+
+
+if __name__ == "__main__":
+    asyncio.run(run(int(sys.argv[1]) if len(sys.argv) > 1 else 200))
@@ -0,0 +1,124 @@
+"""
+Throughput of the inbound S2S router.
+
+A remote server stream and a local client session are opened on loopback.
+The remote stream is already authenticated (the negotiation is skipped), so
+the benchmark measures the parser, the ServerStanzaHandler and the delivery
+to the local session.
+
+The server components are singletons, so two Server instances cannot live in
+the same process. The remote side is a raw loopback stream instead.
+
+    python -m test.benchmarks.bench_s2s_inbound [stanzas]
+"""
+
+import asyncio
+import sys
+import time
+from types import SimpleNamespace
+from xml import sax
+
+from pyjabber import AppConfig
+from pyjabber.network.ConnectionManager import ConnectionManager
+from pyjabber.network.parsers.XMLParser import XMLParser
+from pyjabber.stream.handlers.ServerStanzaHandler import ServerStanzaHandler
+from pyjabber.stream.JID import JID
+from pyjabber.stream.utils.Enums import Signal
+
+REMOTE_HOST = "remote.bench"
+LOCAL_JID = JID("demo@localhost/bench")
+STREAM_HEADER = (
+    b"<stream:stream xmlns='jabber:server' "
+    b"xmlns:stream='http://etherx.jabber.org/streams' "
+    b"from='remote.bench' to='localhost' version='1.0'>"
+)
+
+
+class AuthenticatedNegotiator:
+    def __init__(self, *_):
+        pass
+
+    async def handle_open_stream(self, _):
+        return Signal.DONE
+
+
+class InboundProtocol(asyncio.Protocol):
+    def connection_made(self, transport):
+        peer = transport.get_extra_info("peername")
+        connections = ConnectionManager()
+        connections.connection_server_incoming(peer, transport)
+        connections.set_host_incoming(peer, REMOTE_HOST)
+
+        self._parser = sax.make_parser()
+        self._parser.setFeature(sax.handler.feature_namespaces, True)
+        self._parser.setContentHandler(
+            XMLParser(
+                transport,
+                self,
+                stream_negotiator=AuthenticatedNegotiator,
+                stanza_handler=ServerStanzaHandler,
+            )
+        )
+
+    def data_received(self, data):
+        self._parser.feed(data)
+
+
+class SessionSink(asyncio.Protocol):
+    def __init__(self, expected: int, done: asyncio.Future):
+        self._expected = expected
+        self._done = done
+        self._received = 0
+        self._tail = b""
+
+    def data_received(self, data):
+        data = self._tail + data
+        self._received += data.count(b"</ns0:message>")
+        self._tail = data[-16:]
+        if self._received >= self._expected and not self._done.done():
+            self._done.set_result(None)
+
+
+async def run(stanzas: int):
+    AppConfig.app_config = SimpleNamespace(
+        host="localhost", ip=["127.0.0.1"], message_persistence=False, verbose=False
+    )
+    loop = asyncio.get_running_loop()
+    done = loop.create_future()
+
+    sink = await loop.create_server(lambda: SessionSink(stanzas, done), "127.0.0.1", 0)
+    session, _ = await loop.create_connection(
+        asyncio.Protocol, *sink.sockets[0].getsockname()
+    )
+    connections = ConnectionManager()
+    peer = session.get_extra_info("sockname")
+    connections.connection(peer, session)
+    connections.set_jid(peer, JID(str(LOCAL_JID)))
+    connections.online(LOCAL_JID)
+
+    server = await loop.create_server(InboundProtocol, "127.0.0.1", 0)
+    _, remote = await asyncio.open_connection(*server.sockets[0].getsockname())
+    remote.write(STREAM_HEADER)
+
+    payload = b"".join(
+        f"<message from='user@{REMOTE_HOST}/r' to='{LOCAL_JID}' id='{i}' "
+        f"type='chat'><body>benchmark message {i}</body></message>".encode()
+        for i in range(stanzas)
+    )
+
+    start = time.perf_counter()
+    remote.write(payload)
+    await remote.drain()
+    await asyncio.wait_for(done, 120)
+    elapsed = time.perf_counter() - start
+
+    print(f"{stanzas} stanzas in {elapsed:.3f}s -> {stanzas / elapsed:,.0f} stanzas/s")
+
+    remote.close()
+    session.close()
+    server.close()
+    sink.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(run(int(sys.argv[1]) if len(sys.argv) > 1 else 50000))
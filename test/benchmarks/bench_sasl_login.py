@@ -0,0 +1,87 @@
+"""
+Server side cost of a login, PLAIN against SCRAM.
+
+A PLAIN login runs PBKDF2 on the server with the stored iteration count. With
+SCRAM the client runs PBKDF2, and the server only verifies the proof against
+the StoredKey/ServerKey precomputed at registration. The benchmark measures
+the server side of each exchange, sequentially on a single core.
+
+    python -m test.benchmarks.bench_sasl_login [logins]
+"""
+
+import hashlib
+import os
+import sys
+import time
+
+from pyjabber.features.SASL import SCRAM
+from pyjabber.features.SASL.Mechanism import MECHANISM
+from test.benchmarks.scram_client import ScramClient
+
+ITERATIONS = 100000
+PASSWORD = "pencil"
+
+
+def credentials() -> SCRAM.Credentials:
+    salt = os.urandom(16)
+    return SCRAM.parse_credentials(
+        SCRAM.format_credentials(
+            ITERATIONS,
+            salt,
+            hashlib.pbkdf2_hmac("sha256", PASSWORD.encode(), salt, ITERATIONS),
+            hashlib.pbkdf2_hmac("sha1", PASSWORD.encode(), salt, ITERATIONS),
+        )
+    )
+
+
+def plain(creds: SCRAM.Credentials, logins: int) -> float:
+    elapsed = 0
+    for _ in range(logins):
+        start = time.perf_counter()
+        salted = hashlib.pbkdf2_hmac(
+            "sha256", PASSWORD.encode(), creds.salt, creds.iterations
+        )
+        assert creds.verify("sha256", salted)
+        elapsed += time.perf_counter() - start
+    return elapsed
+
+
+def scram(creds: SCRAM.Credentials, logins: int) -> float:
+    # The client proof is computed once, out of the measured time: a PBKDF2 per
+    # login would only measure the client
+    client = ScramClient("user", PASSWORD)
+    first = client.first()
+    exchange = SCRAM.ScramExchange(MECHANISM.SCRAM_SHA_256)
+    exchange.client_first(first)
+    server_first = exchange.server_first(creds)
+    final = client.final(server_first)
+
+    elapsed = 0
+    for _ in range(logins):
+        start = time.perf_counter()
+        exchange = SCRAM.ScramExchange(MECHANISM.SCRAM_SHA_256)
+        exchange.client_first(first)
+        exchange.server_first(creds)
+        # Replay the same nonce, as the server nonce is random on each exchange
+        exchange._nonce = server_first.decode().split(",")[0][2:]
+        exchange._server_first = server_first.decode()
+        assert client.verify(exchange.client_final(final))
+        elapsed += time.perf_counter() - start
+    return elapsed
+
+
+def run(logins: int):
+    creds = credentials()
+    for name, func, count in (
+        ("PLAIN", plain, logins),
+        ("SCRAM-SHA-256", scram, logins * 100),
+    ):
+        elapsed = func(creds, count)
+        print(
+            f"{name:>14}: {count / elapsed:10.1f} logins/s "
+            f"| {elapsed / count * 1e6:10.1f} us per login (server side)"
+        )
+
+
+if __name__ == "__main__":
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 50)
@@ -0,0 +1,271 @@
+"""
+Reconnection of a client with a roster of 200 online contacts, as a full
+login and as a Stream Management (XEP-0198) resumption.
+
+Both authenticate with SCRAM-SHA-256 over SASL2. Then, a full login binds a
+new resource, fetches the roster and broadcasts its initial presence, after
+the contacts got the unavailable presence of the lost session. A resumption
+takes the detached session back: the stanzas sent while the client was away
+come after the <resumed/>, while a full login loses them.
+
+    python -m test.benchmarks.bench_stream_resumption [contacts] [reconnections]
+"""
+
+import asyncio
+import base64
+import socket
+import statistics
+import sys
+import time
+from xml.etree import ElementTree as ET
+
+from sqlalchemy import insert
+
+from pyjabber import AppConfig
+from pyjabber.db.database import DB
+from pyjabber.db.model import Model
+from pyjabber.features.presence.PresenceFeature import Presence
+from pyjabber.features.SASL.KDF import KDFExecutor
+from pyjabber.features.SASL.SASL2 import SASL2
+from pyjabber.network.ConnectionManager import ConnectionManager
+from pyjabber.plugins.roster.Roster import Roster
+from pyjabber.plugins.xep_0198.xep_0198 import NAMESPACE, StreamManagement
+from pyjabber.queues.workers.PresenceWorker import flush
+from pyjabber.stream.JID import JID
+from pyjabber.stream.negotiators.StreamNegotiator import StreamNegotiator
+from pyjabber.stream.utils.Enums import Signal, Stage
+from test.benchmarks.scram_client import ScramClient
+
+PASSWORD = "pencil"
+IN_FLIGHT = 5  # Messages sent to the client while it is away
+
+
+class Transport:
+    __slots__ = ("peer", "writes", "last")
+
+    def __init__(self, peer):
+        self.peer = peer
+        self.writes = 0
+        self.last = None
+
+    def write(self, data: bytes):
+        self.writes += 1
+        self.last = data
+
+    def get_extra_info(self, name: str):
+        return self.peer if name == "peername" else None
+
+    def is_closing(self) -> bool:
+        return False
+
+    def close(self):
+        pass
+
+
+class Handler:
+    transport = None
+
+
+def authenticate(initial_response: bytes) -> ET.Element:
+    element = ET.Element(
+        "{urn:xmpp:sasl:2}authenticate", attrib={"mechanism": "SCRAM-SHA-256"}
+    )
+    ET.SubElement(element, "{urn:xmpp:sasl:2}initial-response").text = base64.b64encode(
+        initial_response
+    ).decode()
+    return element
+
+
+async def connect(port: int) -> Transport:
+    """
+    A new connection, authenticated as the user
+    """
+    peer = ("127.0.0.1", port)
+    transport = Transport(peer)
+    ConnectionManager().connection(peer, transport)
+
+    sasl = SASL2(transport, None, peer)
+    client = ScramClient("user", PASSWORD)
+    await sasl.feed(authenticate(client.first()))
+    response = ET.Element("{urn:xmpp:sasl:2}response")
+    response.text = base64.b64encode(
+        client.final(base64.b64decode(ET.fromstring(transport.last).text))
+    ).decode()
+    assert await sasl.feed(response) == Stage.AUTH, transport.last
+    return transport
+
+
+async def full_login(transport: Transport, lost: JID, roster: Roster) -> JID:
+    presence = Presence()
+    flush(presence.lost_connections([lost]))
+
+    negotiator = StreamNegotiator(transport, None, None, Handler())
+    bind = ET.Element("{jabber:client}iq", attrib={"type": "set", "id": "b"})
+    ET.SubElement(bind, "{urn:ietf:params:xml:ns:xmpp-bind}bind")
+    assert await negotiator._handle_resource_bind(bind) == Signal.DONE
+    jid = ConnectionManager().get_jid(transport.peer)
+
+    get = ET.Element("iq", attrib={"type": "get", "id": "r"})
+    ET.SubElement(get, "{jabber:iq:roster}query")
+    transport.write(await roster.feed(jid, get))
+
+    await presence.feed(jid, ET.Element("presence"))
+    return jid
+
+
+async def resume(transport: Transport, previd: str, h: int):
+    negotiator = StreamNegotiator(transport, None, None, Handler())
+    element = ET.Element(
+        f"{{{NAMESPACE}}}resume", attrib={"previd": previd, "h": str(h)}
+    )
+    assert await negotiator._handle_resume(element) == Signal.DONE
+
+
+def in_flight(jid: JID):
+    for client in ConnectionManager().get_transport(jid):
+        for i in range(IN_FLIGHT):
+            client.transport.write(
+                f"<message to='{jid}' type='chat'><body>{i}</body></message>".encode()
+            )
+
+
+def contact_writes(contacts) -> int:
+    return sum(t.writes for t in contacts)
+
+
+async def setup(contacts: int):
+    AppConfig.app_config = AppConfig.AppConfig(
+        host="localhost",
+        ip=[],
+        ssl_context=None,
+        ssl_context_s2s=None,
+        connection_timeout=60,
+        server_port=5269,
+        family=socket.AF_INET,
+        config_path="",
+        cert_path="",
+        root_path="",
+        database_path="",
+        database_in_memory=True,
+        database_purge=False,
+        database_debug=False,
+        message_persistence=False,
+        verbose=False,
+        plugins=[NAMESPACE],
+        items={},
+    )
+    await DB.setup_database()
+
+    transport = Transport(("127.0.0.1", 0))
+    ConnectionManager().connection(transport.peer, transport)
+    await SASL2(transport, None, transport.peer)._store_hash_task(PASSWORD, "user")
+
+    async with DB.writer("user") as con:
+        await con.execute(
+            insert(Model.Roster).values(
+                [
+                    {
+                        "jid": "user",
+                        "roster_item": f'<item jid="contact{i}" subscription="both"/>',
+                    }
+                    for i in range(contacts)
+                ]
+            )
+        )
+
+    presence = Presence()
+    await presence._roster._update_roster()
+
+    transports = []
+    for i in range(contacts):
+        peer = ("10.0.0.1", i)
+        transports.append(Transport(peer))
+        ConnectionManager().connection(peer, transports[-1])
+        ConnectionManager().set_jid(peer, JID(f"contact{i}@localhost/res"))
+        await presence.feed(JID(f"contact{i}@localhost/res"), ET.Element("presence"))
+    return transports
+
+
+async def run(contacts: int, reconnections: int):
+    contact_transports = await setup(contacts)
+    roster = Roster()
+    port = 1000
+
+    def report(name: str, auth, restore, writes, recovered):
+        total = [a + r for a, r in zip(auth, restore)]
+        print(
+            f"{name:>12}: auth {statistics.mean(auth) * 1e3:7.2f} ms "
+            f"| session {statistics.mean(restore) * 1e3:7.2f} ms "
+            f"| total {statistics.mean(total) * 1e3:7.2f} ms "
+            f"| {writes / reconnections:6.1f} writes to contacts "
+            f"| {recovered}/{IN_FLIGHT * reconnections} in-flight recovered"
+        )
+        return statistics.mean(restore)
+
+    # Full login: every reconnection is a new session
+    port += 1
+    jid = await full_login(await connect(port), JID("user@localhost/none"), roster)
+    auth, restore = [], []
+    writes = contact_writes(contact_transports)
+    for _ in range(reconnections):
+        in_flight(jid)  # Written to the dead connection
+        start = time.perf_counter()
+        port += 1
+        transport = await connect(port)
+        auth.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        jid = await full_login(transport, jid, roster)
+        restore.append(time.perf_counter() - start)
+    full = report(
+        "full login",
+        auth,
+        restore,
+        contact_writes(contact_transports) - writes,
+        0,
+    )
+
+    # Resumption: the session survives the lost connections
+    port += 1
+    transport = await connect(port)
+    jid = await full_login(transport, jid, roster)
+    session = StreamManagement().enable(jid, transport, transport.peer, True)
+    ConnectionManager().update_transport_jid(session, jid)
+
+    auth, restore = [], []
+    recovered = 0
+    writes = contact_writes(contact_transports)
+    for _ in range(reconnections):
+        StreamManagement().detach(session.original_transport)
+        h = session.sent
+        in_flight(jid)
+
+        start = time.perf_counter()
+        port += 1
+        transport = await connect(port)
+        auth.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await resume(transport, session.id, h)
+        restore.append(time.perf_counter() - start)
+        recovered += transport.last.count(b"<message")
+    resumed = report(
+        "resumption",
+        auth,
+        restore,
+        contact_writes(contact_transports) - writes,
+        recovered,
+    )
+    print(f"session restored x{full / resumed:.1f} faster")
+
+    KDFExecutor().shutdown()
+    await DB.close_engine_async()
+
+
+if __name__ == "__main__":
+    asyncio.run(
+        run(
+            int(sys.argv[1]) if len(sys.argv) > 1 else 200,
+            int(sys.argv[2]) if len(sys.argv) > 2 else 20,
+        )
+    )
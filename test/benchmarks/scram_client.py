@@ -0,0 +1,64 @@
+import base64
+import hashlib
+import hmac
+import secrets
+from typing import Optional
+
+
+class ScramClient:
+    """
+    Client side of SCRAM (RFC 5802), used by the tests and benchmarks
+    """
+
+    def __init__(
+        self,
+        username: str,
+        password: str,
+        hash_name: str = "sha256",
+        cbind_flag: str = "n",
+        cb_data: Optional[bytes] = None,
+    ):
+        self._username = username
+        self._password = password
+        self._hash = hash_name
+        self._gs2_header = f"{cbind_flag},,"
+        self._cb_data = cb_data or b""
+        self._nonce = secrets.token_urlsafe(18)
+        self._client_first_bare = f"n={username},r={self._nonce}"
+        self._server_signature = None
+
+    def first(self) -> bytes:
+        return (self._gs2_header + self._client_first_bare).encode()
+
+    def final(self, server_first: bytes) -> bytes:
+        server_first = server_first.decode()
+        attrs = dict(attr.split("=", 1) for attr in server_first.split(","))
+
+        salted_password = hashlib.pbkdf2_hmac(
+            self._hash,
+            self._password.encode(),
+            base64.b64decode(attrs["s"]),
+            int(attrs["i"]),
+        )
+        client_key = hmac.digest(salted_password, b"Client Key", self._hash)
+        stored_key = hashlib.new(self._hash, client_key).digest()
+
+        cbind_input = self._gs2_header.encode()
+        if self._gs2_header.startswith("p="):
+            cbind_input += self._cb_data
+
+        without_proof = f"c={base64.b64encode(cbind_input).decode()},r={attrs['r']}"
+        auth_message = ",".join(
+            [self._client_first_bare, server_first, without_proof]
+        ).encode()
+
+        client_signature = hmac.digest(stored_key, auth_message, self._hash)
+        proof = bytes(a ^ b for a, b in zip(client_key, client_signature))
+
+        server_key = hmac.digest(salted_password, b"Server Key", self._hash)
+        self._server_signature = hmac.digest(server_key, auth_message, self._hash)
+
+        return f"{without_proof},p={base64.b64encode(proof).decode()}".encode()
+
+    def verify(self, server_final: bytes) -> bool:
+        return server_final == b"v=" + base64.b64encode(self._server_signature)
@@ -0,0 +1,134 @@
+import hashlib
+import json
+from types import SimpleNamespace
+from unittest.mock import patch
+
+import pytest
+from sqlalchemy import insert, select
+
+from pyjabber.db import BulkImport
+from pyjabber.db.database import DB
+from pyjabber.db.model import Model
+from pyjabber.features.SASL import SCRAM
+
+CSV = """jid,password,roster
+alice,pencil,bob;carol@example.org
+bob@localhost,secret,alice@localhost
+,nopass,
+"""
+
+JSONL = "\n".join(
+    [
+        json.dumps(
+            {
+                "jid": "alice",
+                "password": "pencil",
+                "roster": ["bob", {"jid": "carol@example.org", "name": "Carol"}],
+            }
+        ),
+        "{not json",
+        json.dumps(
+            {
+                "jid": "bob",
+                "password": "secret",
+                "roster": [{"jid": "x", "subscription": "bad"}],
+            }
+        ),
+    ]
+)
+
+
+@pytest.fixture(params=[1, 2], ids=["main", "shards"])
+async def database(tmp_path, request):
+    config = SimpleNamespace(
+        database_path=str(tmp_path / "pyjabber.db"),
+        database_in_memory=False,
+        database_debug=False,
+        database_write_timeout=5.0,
+        database_read_timeout=5.0,
+        database_readers=2,
+        database_shards=request.param,
+    )
+    with patch("pyjabber.AppConfig.app_config", config):
+        await DB.setup_database()
+        yield config
+        await DB.close_engine_async()
+
+
+def test_parse_csv():
+    users, errors = BulkImport.parse(CSV, "csv", "localhost")
+
+    assert [u.jid for u in users] == ["alice", "bob"]
+    assert [r.jid for r in users[0].roster] == ["bob", "carol@example.org"]
+    assert [r.jid for r in users[1].roster] == ["alice"]
+    assert errors == ["line 4: Missing jid or password"]
+
+    with pytest.raises(BulkImport.ImportFormatError):
+        BulkImport.parse("user,pwd\na,b\n", "csv")
+
+
+def test_parse_jsonl():
+    users, errors = BulkImport.parse(JSONL, "jsonl", "localhost")
+
+    assert [u.jid for u in users] == ["alice"]
+    assert users[0].roster[1] == BulkImport.RosterEntry(
+        jid="carol@example.org", name="Carol"
+    )
+    assert [e.split(":")[0] for e in errors] == ["line 2", "line 3"]
+
+
+def test_hash_passwords_scram_format():
+    salt = b"0123456789abcdef"
+    stored = BulkImport.hash_passwords([("pencil", salt)], 4096)[0]
+    credentials = SCRAM.parse_credentials(stored)
+
+    assert stored.startswith("sha256$4096$")
+    assert not credentials.legacy
+    for hash_name in ("sha256", "sha1"):
+        salted = hashlib.pbkdf2_hmac(hash_name, b"pencil", salt, 4096)
+        assert credentials.verify(hash_name, salted)
+
+
+async def test_import_users(database):
+    users, _ = BulkImport.parse(CSV, "csv", "localhost")
+    users.append(BulkImport.UserEntry(jid="alice", password="again"))
+    users += [BulkImport.UserEntry(jid=f"user{i}", password="pwd") for i in range(7)]
+
+    batches = []
+
+    async def progress(result):
+        batches.append(result.created + result.skipped)
+
+    result = await BulkImport.import_users(
+        users, iterations=4096, batch_size=4, progress=progress
+    )
+
+    assert (result.total, result.created, result.skipped) == (10, 9, 1)
+    assert result.roster_items == 3
+    assert batches == [5, 9, 10]  # The duplicate is skipped before the batches
+
+    async with DB.reader() as con:
+        res = await con.execute(select(Model.Credentials.c.jid))
+        assert len(res.fetchall()) == 9
+
+    async with DB.reader("alice") as con:
+        res = await con.execute(
+            select(Model.Roster.c.roster_item).where(Model.Roster.c.jid == "alice")
+        )
+        assert 'jid="carol@example.org"' in res.fetchall()[1][0]
+
+    # Already imported accounts are skipped
+    result = await BulkImport.import_users(users, iterations=4096)
+    assert (result.created, result.skipped, result.roster_items) == (0, 10, 0)
+
+
+async def test_roster_only_for_created(database):
+    # Created meanwhile, after the check of import_users
+    async with DB.writer() as con:
+        await con.execute(insert(Model.Credentials).values(jid="alice", hash_pwd="x"))
+
+    users, _ = BulkImport.parse(CSV, "csv", "localhost")
+    assert await BulkImport._store_batch(users, ["hash", "hash"]) == (1, 1)
+
+    shards = await DB.query_shards(select(Model.Roster.c.jid))
+    assert [row for rows in shards for row in rows] == [("bob",)]
@@ -0,0 +1,164 @@
+import os
+
+import pytest
+from alembic import command
+from alembic.config import Config
+from sqlalchemy import create_engine, inspect, select, text
+
+from pyjabber.db.model import Model
+
+ALEMBIC_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+    "alembic_local",
+)
+
+HOT_QUERIES = {
+    "login": select(Model.Credentials.c.hash_pwd).where(
+        Model.Credentials.c.jid == "demo"
+    ),
+    "roster": select(Model.Roster.c.roster_item).where(Model.Roster.c.jid == "demo"),
+    "subscriptions": select(
+        Model.PubsubSubscribers.c.node,
+        Model.PubsubSubscribers.c.subscription,
+        Model.PubsubSubscribers.c.subid,
+    ).where(Model.PubsubSubscribers.c.jid == "demo"),
+    "items": select(Model.PubsubItems).where(Model.PubsubItems.c.node == "news"),
+    "last items": select(Model.PubsubItems.c.item_id, Model.PubsubItems.c.payload)
+    .where(Model.PubsubItems.c.node == "news")
+    .order_by(Model.PubsubItems.c.seq.desc())
+    .limit(10),
+    "items page": select(Model.PubsubItems.c.item_id, Model.PubsubItems.c.payload)
+    .where(Model.PubsubItems.c.node == "news", Model.PubsubItems.c.seq > 100)
+    .order_by(Model.PubsubItems.c.seq)
+    .limit(10),
+}
+
+
+@pytest.fixture
+def engine():
+    engine = create_engine("sqlite://")
+    Model.server_metadata.create_all(engine)
+    yield engine
+    engine.dispose()
+
+
+@pytest.mark.parametrize("name", HOT_QUERIES.keys())
+def test_hot_query_uses_index(engine, name):
+    query = HOT_QUERIES[name].compile(engine, compile_kwargs={"literal_binds": True})
+
+    with engine.connect() as con:
+        plan = [
+            row.detail
+            for row in con.execute(text(f"EXPLAIN QUERY PLAN {query}")).fetchall()
+        ]
+
+    assert any("USING" in step and "INDEX" in step for step in plan), plan
+    assert not any(step.startswith("SCAN") for step in plan), plan
+    assert not any("TEMP B-TREE" in step for step in plan), plan
+
+
+def old_schema(con):
+    """
+    Tables previous to the indexes
+    """
+    con.execute(
+        text(
+            "CREATE TABLE credentials (id INTEGER PRIMARY KEY, "
+            "jid VARCHAR NOT NULL, hash_pwd VARCHAR NOT NULL)"
+        )
+    )
+    con.execute(
+        text(
+            "CREATE TABLE roster (id INTEGER PRIMARY KEY, "
+            "jid VARCHAR NOT NULL, roster_item VARCHAR NOT NULL)"
+        )
+    )
+    con.execute(
+        text(
+            "CREATE TABLE pubsub_subscribers (node VARCHAR, jid VARCHAR, "
+            "subid VARCHAR, subscription VARCHAR NOT NULL, "
+            "affiliation VARCHAR NOT NULL, PRIMARY KEY (node, jid, subid))"
+        )
+    )
+
+
+def upgrade(database):
+    cfg = Config()
+    cfg.set_main_option("script_location", ALEMBIC_PATH)
+    cfg.set_main_option("sqlalchemy.url", f"sqlite:///{database}")
+    command.upgrade(cfg, "head")
+
+
+def test_migration_adds_indexes(tmp_path):
+    database = tmp_path / "old.db"
+    engine = create_engine(f"sqlite:///{database}")
+
+    # An account registered twice
+    with engine.begin() as con:
+        old_schema(con)
+        con.execute(
+            text(
+                "INSERT INTO credentials (jid, hash_pwd) "
+                "VALUES ('demo', 'first'), ('demo', 'second'), ('other', 'pwd')"
+            )
+        )
+
+    upgrade(database)
+
+    inspector = inspect(engine)
+    indexes = {
+        table: {
+            index["name"]: index["unique"] for index in inspector.get_indexes(table)
+        }
+        for table in ("credentials", "roster", "pubsub_subscribers")
+    }
+    assert indexes["credentials"]["ix_credentials_jid"]
+    assert "ix_roster_jid" in indexes["roster"]
+    assert "ix_pubsub_subscribers_jid" in indexes["pubsub_subscribers"]
+
+    with engine.connect() as con:
+        rows = con.execute(text("SELECT jid, hash_pwd FROM credentials")).fetchall()
+    assert sorted(rows) == [("demo", "first"), ("other", "pwd")]
+
+    engine.dispose()
+
+
+def test_migration_orders_pubsub_items(tmp_path):
+    database = tmp_path / "old.db"
+    engine = create_engine(f"sqlite:///{database}")
+
+    with engine.begin() as con:
+        old_schema(con)
+        con.execute(
+            text(
+                "CREATE TABLE pubsub_items (node VARCHAR, "
+                "publisher VARCHAR NOT NULL, item_id VARCHAR, "
+                "payload VARCHAR NOT NULL, PRIMARY KEY (node, item_id))"
+            )
+        )
+        con.execute(
+            text(
+                "INSERT INTO pubsub_items VALUES ('news', 'demo', 'b', '<b/>'), "
+                "('blog', 'demo', 'x', '<x/>'), ('news', 'demo', 'a', '<a/>')"
+            )
+        )
+
+    upgrade(database)
+
+    indexes = {
+        index["name"]: index for index in inspect(engine).get_indexes("pubsub_items")
+    }
+    assert indexes["ix_pubsub_items_node_seq"]["column_names"] == ["node", "seq"]
+    assert indexes["ix_pubsub_items_node_seq"]["unique"]
+
+    # The stored items keep their insertion order
+    with engine.connect() as con:
+        rows = con.execute(
+            select(Model.PubsubItems.c.item_id, Model.PubsubItems.c.published)
+            .where(Model.PubsubItems.c.node == "news")
+            .order_by(Model.PubsubItems.c.seq)
+        ).fetchall()
+    assert [item_id for item_id, _ in rows] == ["b", "a"]
+    assert all(published > 0 for _, published in rows)
+
+    engine.dispose()
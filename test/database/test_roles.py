@@ -0,0 +1,146 @@
+import asyncio
+from types import SimpleNamespace
+from unittest.mock import patch
+
+import pytest
+from sqlalchemy import func, insert, select
+from sqlalchemy.exc import IntegrityError, OperationalError
+
+from pyjabber.db.database import DB, DatabaseTimeout
+from pyjabber.db.model import Model
+
+
+def config(**kwargs):
+    params = {
+        "database_path": None,
+        "database_in_memory": False,
+        "database_debug": False,
+        "database_write_timeout": 5.0,
+        "database_read_timeout": 5.0,
+        "database_readers": 2,
+        "database_shards": 1,
+    }
+    params.update(kwargs)
+    return SimpleNamespace(**params)
+
+
+@pytest.fixture
+async def database(tmp_path):
+    with patch("pyjabber.db.database.AppConfig") as mock_config:
+        mock_config.app_config = config(database_path=str(tmp_path / "roles.db"))
+        await DB.setup_database()
+        yield mock_config.app_config
+        await DB.close_engine_async()
+
+
+async def credentials() -> int:
+    async with DB.reader() as con:
+        res = await con.execute(select(func.count()).select_from(Model.Credentials))
+        return res.scalar()
+
+
+async def test_concurrent_writers(database):
+    async def register(i: int):
+        async with DB.writer() as con:
+            await con.execute(
+                insert(Model.Credentials).values({"jid": f"user{i}", "hash_pwd": "x"})
+            )
+            await asyncio.sleep(0)
+
+    await asyncio.gather(*[register(i) for i in range(50)])
+
+    assert await credentials() == 50
+    metrics = DB.metrics()
+    assert metrics["write"]["acquired"] == 50
+    assert metrics["write"]["errors"] == 0
+    assert metrics["read"]["acquired"] == 1
+
+
+async def test_writer_rollback(database):
+    with pytest.raises(ValueError):
+        async with DB.writer() as con:
+            await con.execute(
+                insert(Model.Credentials).values({"jid": "demo", "hash_pwd": "x"})
+            )
+            raise ValueError
+
+    assert await credentials() == 0
+    # An error of the caller is not one of the database
+    assert DB.metrics()["write"]["errors"] == 0
+
+    with pytest.raises(IntegrityError):
+        async with DB.writer() as con:
+            for _ in range(2):
+                await con.execute(
+                    insert(Model.Credentials).values({"jid": "demo", "hash_pwd": "x"})
+                )
+
+    assert await credentials() == 0
+    assert DB.metrics()["write"]["errors"] == 1
+
+
+async def test_writer_timeout(database):
+    with patch.object(database, "database_write_timeout", 0.05):
+        async with DB.writer():
+            with pytest.raises(DatabaseTimeout):
+                async with DB.writer():
+                    pass
+
+    assert DB.metrics()["write"]["timeouts"] == 1
+
+
+async def test_reader_is_read_only(database):
+    with pytest.raises(OperationalError):
+        async with DB.reader() as con:
+            await con.execute(
+                insert(Model.Credentials).values({"jid": "demo", "hash_pwd": "x"})
+            )
+
+
+async def test_reader_timeout(database):
+    async with DB.reader(), DB.reader():
+        with patch.object(DB._read_engine.sync_engine.pool, "_timeout", 0.05):
+            with pytest.raises(DatabaseTimeout):
+                async with DB.reader():
+                    pass
+
+    assert DB.metrics()["read"]["timeouts"] == 1
+
+
+async def test_readers_not_blocked_by_writer(database):
+    async with DB.writer() as con:
+        await con.execute(
+            insert(Model.Credentials).values({"jid": "demo", "hash_pwd": "x"})
+        )
+        # Uncommitted write. WAL readers see the previous snapshot
+        assert await asyncio.wait_for(credentials(), 1) == 0
+
+    assert await credentials() == 1
+
+
+async def test_in_memory_writer_atomic():
+    with patch("pyjabber.db.database.AppConfig") as mock_config:
+        mock_config.app_config = config(database_in_memory=True)
+        await DB.setup_database()
+
+        with pytest.raises(ValueError):
+            async with DB.writer() as con:
+                await con.execute(
+                    insert(Model.Credentials).values({"jid": "demo", "hash_pwd": "x"})
+                )
+                # Its own reads see the write, the other ones wait for its end
+                assert await credentials() == 1
+                other = asyncio.create_task(credentials())
+                await asyncio.sleep(0.05)
+                assert not other.done()
+                raise ValueError
+        assert await other == 0
+        assert await credentials() == 0
+
+        async with DB.writer() as con:
+            await con.execute(
+                insert(Model.Credentials).values({"jid": "demo", "hash_pwd": "x"})
+            )
+        assert await credentials() == 1
+
+        await DB.close_engine_async()
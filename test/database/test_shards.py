@@ -0,0 +1,213 @@
+import os
+import xml.etree.ElementTree as ET
+from types import SimpleNamespace
+from unittest.mock import patch
+
+import pytest
+from sqlalchemy import create_engine, delete, func, insert, inspect, select, text
+
+import pyjabber
+from pyjabber.db.database import DB, ShardingError
+from pyjabber.db.model import Model
+from pyjabber.plugins.roster.Roster import Roster
+from pyjabber.stanzas.IQ import IQ
+from pyjabber.stream.JID import JID
+from pyjabber.utils import Singleton
+
+SHARDS = 4
+
+
+@pytest.fixture
+async def database(tmp_path):
+    config = SimpleNamespace(
+        host="localhost",
+        root_path=str(tmp_path),
+        database_path=str(tmp_path / "pyjabber.db"),
+        database_in_memory=False,
+        database_debug=False,
+        database_write_timeout=5.0,
+        database_read_timeout=5.0,
+        database_readers=2,
+        database_shards=SHARDS,
+    )
+    with patch("pyjabber.AppConfig.app_config", config):
+        Singleton._instances.pop(Roster, None)
+        await DB.setup_database()
+        yield config
+        await DB.close_engine_async()
+        Singleton._instances.pop(Roster, None)
+
+
+def rows_in_file(path: str, table: str) -> int:
+    engine = create_engine(f"sqlite:///{path}")
+    with engine.connect() as con:
+        res = con.execute(text(f"SELECT COUNT(*) FROM {table}")).scalar()
+    engine.dispose()
+    return res
+
+
+def tables_in_file(path: str) -> set:
+    engine = create_engine(f"sqlite:///{path}")
+    tables = set(inspect(engine).get_table_names())
+    engine.dispose()
+    return tables
+
+
+USER_TABLES = {table.name for table in Model.user_tables}
+
+
+async def test_shard_files(database, tmp_path):
+    assert DB.shard_paths() == [
+        str(tmp_path / f"pyjabber.shard{i}.db") for i in range(SHARDS)
+    ]
+    assert all(os.path.isfile(path) for path in DB.shard_paths())
+
+    assert tables_in_file(database.database_path) == set(Model.server_metadata.tables)
+    for path in DB.shard_paths():
+        assert tables_in_file(path) == USER_TABLES
+
+
+async def test_shard_of_stable(database):
+    jids = [f"user{i}" for i in range(200)]
+    shards = [DB.shard_of(jid) for jid in jids]
+
+    assert shards == [DB.shard_of(jid) for jid in jids]
+    assert set(shards) == set(range(SHARDS))
+
+
+def test_row_key():
+    with patch.object(DB, "_shards", [None] * SHARDS):
+        assert DB.split_row_key(DB.row_key(3, 41)) == (3, 41)
+        assert DB.row_key(0, 1) != DB.row_key(1, 1)
+
+    with patch.object(DB, "_shards", []):
+        assert DB.row_key(0, 41) == 41
+        assert DB.split_row_key(41) == (0, 41)
+
+
+async def test_writes_routed_by_jid(database):
+    for jid in ("alice", "bob", "carol", "dave"):
+        async with DB.writer(jid) as con:
+            await con.execute(
+                insert(Model.Roster).values({"jid": jid, "roster_item": "<item/>"})
+            )
+
+    for jid in ("alice", "bob", "carol", "dave"):
+        async with DB.reader(jid) as con:
+            res = await con.execute(
+                select(func.count())
+                .select_from(Model.Roster)
+                .where(Model.Roster.c.jid == jid)
+            )
+            assert res.scalar() == 1
+
+    assert rows_in_file(database.database_path, "roster") == 0
+    assert sum(rows_in_file(path, "roster") for path in DB.shard_paths()) == 4
+
+
+async def test_cross_shard_queries(database):
+    for i in range(20):
+        async with DB.writer(f"user{i}") as con:
+            await con.execute(
+                insert(Model.PendingSubs).values({"jid": f"user{i}", "item": "<p/>"})
+            )
+
+    shards = await DB.query_shards(select(Model.PendingSubs.c.jid))
+    assert len(shards) == SHARDS
+    assert sorted(row.jid for rows in shards for row in rows) == sorted(
+        f"user{i}" for i in range(20)
+    )
+
+    deleted = await DB.execute_shards(
+        delete(Model.PendingSubs).where(Model.PendingSubs.c.jid.like("user1%"))
+    )
+    assert deleted == 11
+    assert len(DB.metrics()["shards"]) == SHARDS
+
+
+async def test_roster_across_shards(database):
+    roster = Roster()
+
+    for user in ("alice", "bob", "carol"):
+        iq = IQ(type_=IQ.TYPE.SET, id_="set")
+        query = ET.SubElement(iq, "{jabber:iq:roster}query")
+        ET.SubElement(query, "{jabber:iq:roster}item", attrib={"jid": "dave"})
+        await roster.feed(JID(f"{user}@localhost"), iq)
+
+    item = roster.roster_by_jid(JID("bob@localhost"))[0]
+    await roster.update_item(ET.Element("item", attrib={"jid": "eve"}), item["id"])
+
+    assert [
+        ET.fromstring(i["item"]).get("jid")
+        for user in ("alice", "bob", "carol")
+        for i in roster.roster_by_jid(JID(f"{user}@localhost"))
+    ] == ["dave", "eve", "dave"]
+
+
+def test_migrations_per_shard(tmp_path):
+    config = SimpleNamespace(
+        root_path="..",
+        database_path=str(tmp_path / "pyjabber.db"),
+        database_in_memory=False,
+        database_shards=2,
+    )
+    with (
+        patch("pyjabber.AppConfig.app_config", config),
+        patch("pyjabber.db.database.command") as mock_command,
+        patch("pyjabber.db.database.Config") as mock_config,
+    ):
+        DB.run_db_migrations()
+
+    urls = [
+        c.args[1]
+        for c in mock_config.return_value.set_main_option.call_args_list
+        if c.args[0] == "sqlalchemy.url"
+    ]
+    assert urls == [
+        f"sqlite:///{tmp_path / 'pyjabber.db'}",
+        f"sqlite:///{tmp_path / 'pyjabber.shard0.db'}",
+        f"sqlite:///{tmp_path / 'pyjabber.shard1.db'}",
+    ]
+    assert mock_command.upgrade.call_count == 3
+
+
+async def test_migrations_on_shards(database, tmp_path):
+    await DB.close_engine_async()
+    database.root_path = os.path.dirname(pyjabber.__file__)
+
+    DB.run_db_migrations()
+
+    assert tables_in_file(database.database_path) == {
+        *Model.server_metadata.tables,
+        "alembic_version",
+    }
+    for path in DB.shard_paths():
+        assert tables_in_file(path) == {*USER_TABLES, "alembic_version"}
+
+    await DB.setup_database()
+
+
+async def test_unsharded_rows_refused(tmp_path):
+    config = SimpleNamespace(
+        host="localhost",
+        database_path=str(tmp_path / "pyjabber.db"),
+        database_in_memory=False,
+        database_debug=False,
+        database_write_timeout=5.0,
+        database_read_timeout=5.0,
+        database_readers=1,
+        database_shards=1,
+    )
+    with patch("pyjabber.AppConfig.app_config", config):
+        await DB.setup_database()
+        async with DB.writer("juliet") as con:
+            await con.execute(
+                insert(Model.Roster).values(jid="juliet", roster_item="<item/>")
+            )
+        await DB.close_engine_async()
+
+        # The shards would hide the roster of the main file
+        config.database_shards = SHARDS
+        with pytest.raises(ShardingError, match="roster"):
+            await DB.setup_database()
+        assert not any(os.path.isfile(path) for path in DB.shard_paths())
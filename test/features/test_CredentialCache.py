@@ -0,0 +1,85 @@
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import pytest
+
+from pyjabber.features.SASL.CredentialCache import CredentialCache
+from pyjabber.features.SASL.SASL import SASL
+from pyjabber.features.SASL.SCRAM import Credentials
+
+CREDENTIALS = Credentials(iterations=4096, salt=b"salt", keys={})
+
+
+@pytest.fixture
+def cache():
+    config = SimpleNamespace(credential_cache_size=2, credential_cache_negative_ttl=30)
+    with patch("pyjabber.features.SASL.CredentialCache.AppConfig") as mock_config:
+        mock_config.app_config = config
+        cache = object.__new__(CredentialCache)
+        cache.__init__()
+    return cache
+
+
+def test_hit_miss(cache):
+    assert cache.get("user") == (False, None)
+    cache.put("user", CREDENTIALS)
+    assert cache.get("user") == (True, CREDENTIALS)
+    assert cache.stats() == {"hits": 1, "misses": 1, "size": 1}
+
+
+def test_lru_eviction(cache):
+    cache.put("a", CREDENTIALS)
+    cache.put("b", CREDENTIALS)
+    cache.get("a")
+    cache.put("c", CREDENTIALS)
+
+    assert cache.get("b") == (False, None)
+    assert cache.get("a") == (True, CREDENTIALS)
+    assert cache.get("c") == (True, CREDENTIALS)
+
+
+def test_negative_ttl(cache):
+    with patch("pyjabber.features.SASL.CredentialCache.time") as mock_time:
+        mock_time.monotonic.return_value = 100
+        cache.put("ghost", None)
+
+        mock_time.monotonic.return_value = 120
+        assert cache.get("ghost") == (True, None)
+
+        mock_time.monotonic.return_value = 131
+        assert cache.get("ghost") == (False, None)
+
+
+def test_invalidate(cache):
+    cache.put("user", None)
+    generation = cache.generation
+    cache.invalidate("user")
+    assert cache.get("user") == (False, None)
+
+    # Read from the database before the invalidation
+    cache.put("user", CREDENTIALS, generation)
+    assert cache.get("user") == (False, None)
+
+
+async def test_sasl_credentials_cached(cache):
+    result = MagicMock()
+    result.fetchone.return_value = None
+    con = AsyncMock()
+    con.execute.return_value = result
+    reader = MagicMock()
+    reader.return_value.__aenter__.return_value = con
+
+    with (
+        patch("pyjabber.features.SASL.SASL.AppConfig"),
+        patch("pyjabber.features.SASL.SASL.ConnectionManager"),
+        patch("pyjabber.features.SASL.SASL.CredentialCache", return_value=cache),
+        patch("pyjabber.features.SASL.SASL.DB") as mock_db,
+    ):
+        mock_db.reader = reader
+        sasl = SASL(MagicMock(), MagicMock(), ("127.0.0.1", 5000))
+
+        assert await sasl._get_credentials("ghost") is None
+        assert await sasl._get_credentials("ghost") is None
+
+    assert reader.call_count == 1
+    assert cache.stats()["hits"] == 1
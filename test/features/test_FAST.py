@@ -0,0 +1,151 @@
+import base64
+from unittest.mock import AsyncMock, MagicMock, patch
+from xml.etree import ElementTree as ET
+
+import pytest
+from sqlalchemy import StaticPool, func, select
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from pyjabber.db.model import Model
+from pyjabber.features.SASL import FAST
+from pyjabber.features.SASL.SASL import SASL
+from pyjabber.features.SASL.SASL2 import SASL2
+from pyjabber.stream.utils.Enums import Stage
+
+CLIENT = "d4565fa7-4d72-4749-b3d3-740edbf87770"
+
+
+@pytest.fixture
+async def database():
+    engine = create_async_engine("sqlite+aiosqlite:///:memory:", poolclass=StaticPool)
+    async with engine.begin() as con:
+        await con.run_sync(Model.server_metadata.create_all)
+
+    with (
+        patch("pyjabber.features.SASL.FAST.DB") as mock_db,
+        patch("pyjabber.features.SASL.FAST.AppConfig") as mock_config,
+    ):
+        mock_db.writer = engine.begin
+        mock_config.app_config.fast_token_ttl = 3600
+        yield engine
+
+    await engine.dispose()
+
+
+async def tokens(engine) -> int:
+    async with engine.connect() as con:
+        res = await con.execute(select(func.count()).select_from(Model.FastTokens))
+        return res.scalar()
+
+
+async def test_issue_and_verify(database):
+    token, _ = await FAST.issue_token("user", CLIENT)
+
+    fast_token = await FAST.verify_token("user", CLIENT, FAST.initiator(token), 1)
+    assert fast_token.responder == FAST.responder(token)
+
+    # Replayed count, another client, wrong token
+    assert await FAST.verify_token("user", CLIENT, FAST.initiator(token), 1) is None
+    assert await FAST.verify_token("user", "other", FAST.initiator(token), 2) is None
+    assert await FAST.verify_token("user", CLIENT, FAST.initiator("x"), 3) is None
+
+    assert await FAST.verify_token("user", CLIENT, FAST.initiator(token), 2)
+
+
+async def test_rotation(database):
+    first, _ = await FAST.issue_token("user", CLIENT)
+    second, _ = await FAST.issue_token("user", CLIENT)
+
+    # Both are valid until the client uses the new one
+    assert await FAST.verify_token("user", CLIENT, FAST.initiator(first), 1)
+    assert await FAST.verify_token("user", CLIENT, FAST.initiator(second), 1)
+    assert await FAST.verify_token("user", CLIENT, FAST.initiator(first), 2) is None
+
+    await FAST.issue_token("user", CLIENT)
+    await FAST.issue_token("user", CLIENT)
+    assert await tokens(database) == FAST.TOKENS_PER_CLIENT
+
+
+async def test_expired_token(database):
+    with patch("pyjabber.features.SASL.FAST.AppConfig") as mock_config:
+        mock_config.app_config.fast_token_ttl = 0
+        token, _ = await FAST.issue_token("user", CLIENT)
+
+    assert await FAST.verify_token("user", CLIENT, FAST.initiator(token), 1) is None
+
+
+def test_must_rotate():
+    token = FAST.FastToken("user", CLIENT, b"", 1, issued=0, expiry=100)
+    assert not token.must_rotate(now=40)
+    assert token.must_rotate(now=60)
+
+
+def authenticate(mechanism: str, initial_response: bytes, **fast) -> ET.Element:
+    element = ET.Element(
+        "{urn:xmpp:sasl:2}authenticate", attrib={"mechanism": mechanism}
+    )
+    ET.SubElement(element, "{urn:xmpp:sasl:2}initial-response").text = base64.b64encode(
+        initial_response
+    ).decode()
+    ET.SubElement(element, "{urn:xmpp:sasl:2}user-agent", attrib={"id": CLIENT})
+    if fast:
+        ET.SubElement(element, "{urn:xmpp:fast:0}fast", attrib=fast)
+    else:
+        ET.SubElement(
+            element,
+            "{urn:xmpp:fast:0}request-token",
+            attrib={"mechanism": "HT-SHA-256-NONE"},
+        )
+    return element
+
+
+async def test_sasl2_fast_reconnect(database):
+    transport = MagicMock()
+
+    with (
+        patch("pyjabber.features.SASL.SASL.AppConfig"),
+        patch("pyjabber.features.SASL.SASL.ConnectionManager") as mock_connections,
+        patch("pyjabber.features.SASL.SASL2.AppConfig") as mock_config,
+        patch.object(
+            SASL, "_get_credentials", AsyncMock(return_value=MagicMock(legacy=False))
+        ),
+        patch.object(SASL, "_verify_password_async", AsyncMock(return_value=True)),
+    ):
+        mock_config.app_config.host = "localhost"
+
+        # Password authentication, requesting a token
+        sasl = SASL2(transport, MagicMock(), ("127.0.0.1", 5000))
+        res = await sasl.feed(authenticate("PLAIN", b"\x00user\x00pencil"))
+        assert res == Stage.AUTH
+
+        success = ET.fromstring(transport.write.call_args.args[0])
+        assert success.tag == "{urn:xmpp:sasl:2}success"
+        assert success.findtext("{urn:xmpp:sasl:2}authorization-identifier") == (
+            "user@localhost"
+        )
+        token = success.find("{urn:xmpp:fast:0}token").attrib["token"]
+
+        # Reconnection with the token
+        sasl = SASL2(transport, MagicMock(), ("127.0.0.1", 5001))
+        res = await sasl.feed(
+            authenticate(
+                "HT-SHA-256-NONE", b"user\x00" + FAST.initiator(token), count="1"
+            )
+        )
+        assert res == Stage.AUTH
+        SASL._verify_password_async.assert_awaited_once()
+
+        success = ET.fromstring(transport.write.call_args.args[0])
+        additional_data = success.findtext("{urn:xmpp:sasl:2}additional-data")
+        assert base64.b64decode(additional_data) == FAST.responder(token)
+        assert mock_connections.return_value.set_jid.call_count == 2
+
+        # Replay
+        res = await sasl.feed(
+            authenticate(
+                "HT-SHA-256-NONE", b"user\x00" + FAST.initiator(token), count="1"
+            )
+        )
+        assert res is None
+        failure = ET.fromstring(transport.write.call_args.args[0])
+        assert failure.tag == "{urn:xmpp:sasl:2}failure"
@@ -0,0 +1,80 @@
+import asyncio
+import hashlib
+from types import SimpleNamespace
+from unittest.mock import patch
+
+import pytest
+
+from pyjabber.features.SASL.KDF import (
+    AdmissionRejected,
+    KDFExecutor,
+    KDFMode,
+    LoginAdmission,
+)
+
+
+def kdf_executor(mode: str) -> KDFExecutor:
+    config = SimpleNamespace(
+        kdf_mode=mode,
+        kdf_workers=2,
+        login_rate=10.0,
+        login_burst=5,
+        login_max_wait=1.0,
+    )
+    with patch("pyjabber.features.SASL.KDF.AppConfig") as mock_config:
+        mock_config.app_config = config
+        executor = object.__new__(KDFExecutor)
+        executor.__init__()
+    return executor
+
+
+def test_token_bucket():
+    admission = LoginAdmission(rate=1.0, burst=2, max_wait=1.5, concurrency=1)
+
+    assert admission.reserve("10.0.0.1", now=0) == 0
+    assert admission.reserve("10.0.0.1", now=0) == 0
+    assert admission.reserve("10.0.0.1", now=0) == pytest.approx(1.0)
+    with pytest.raises(AdmissionRejected):
+        admission.reserve("10.0.0.1", now=0)
+
+    # Other addresses are not affected
+    assert admission.reserve("10.0.0.2", now=0) == 0
+
+    # Refilled with time
+    assert admission.reserve("10.0.0.1", now=3) == 0
+
+
+async def test_admission_bounded_wait():
+    admission = LoginAdmission(rate=100.0, burst=10, max_wait=0.05, concurrency=1)
+
+    async with admission.admit("10.0.0.1"):
+        with pytest.raises(AdmissionRejected):
+            async with admission.admit("10.0.0.2"):
+                pass
+
+    async with admission.admit("10.0.0.2"):
+        pass
+
+
+@pytest.mark.parametrize("mode", [m.value for m in KDFMode])
+async def test_kdf_modes(mode):
+    executor = kdf_executor(mode)
+    assert executor._executor is None
+
+    res = await executor.pbkdf2("sha256", "pencil", b"salt", 1000, ip="10.0.0.1")
+    assert res == hashlib.pbkdf2_hmac("sha256", b"pencil", b"salt", 1000)
+    assert (executor._executor is None) == (mode == KDFMode.INLINE.value)
+
+    executor.shutdown()
+
+
+async def test_kdf_concurrent_logins():
+    executor = kdf_executor("thread")
+    results = await asyncio.gather(
+        *[
+            executor.pbkdf2("sha256", "pencil", b"salt", 1000, ip=f"10.0.0.{i}")
+            for i in range(8)
+        ]
+    )
+    assert len(set(results)) == 1
+    executor.shutdown()
@@ -7,6 +7,7 @@ from sqlalchemy import create_engine
 
 from pyjabber.db.model import Model
 from pyjabber.features.presence.PresenceFeature import Presence, PresenceType
+from pyjabber.features.presence.ResourceTable import Resource, ResourceTable
 from pyjabber.stream.JID import JID
 
 FILE_PATH = os.path.dirname(os.path.abspath(__file__))
@@ -44,14 +45,12 @@ def elements_are_equal(e1, e2):
 
 def test_presence_by_jid(setup_presence):
     presence, _, _ = setup_presence
-    presence._online_status = {
-        "test@localhost": [
-            ("res1", PresenceType.AVAILABLE, None, None, None),
-            ("res2", PresenceType.AVAILABLE, None, None, 0),
-            ("res3", PresenceType.AVAILABLE, None, None, 1),
-            ("res4", PresenceType.AVAILABLE, None, None, 2),
-        ]
-    }
+    table = ResourceTable()
+    table.update(Resource("res1", PresenceType.AVAILABLE, None, None, 0))
+    table.update(Resource("res2", PresenceType.AVAILABLE, None, None, 0))
+    table.update(Resource("res3", PresenceType.AVAILABLE, None, None, 1))
+    table.update(Resource("res4", PresenceType.AVAILABLE, None, None, 2))
+    presence._online_status = {"test@localhost": table}
 
     res = presence.priority_by_jid(JID("test@localhost"))
 
@@ -65,14 +64,12 @@ def test_presence_by_jid(setup_presence):
 
 def test_most_priority_by_jid(setup_presence):
     presence, _, _ = setup_presence
-    presence._online_status = {
-        "test@localhost": [
-            ("res1", PresenceType.AVAILABLE, None, None, None),
-            ("res2", PresenceType.AVAILABLE, None, None, 0),
-            ("res3", PresenceType.AVAILABLE, None, None, 1),
-            ("res4", PresenceType.AVAILABLE, None, None, 2),
-        ]
-    }
+    table = ResourceTable()
+    table.update(Resource("res1", PresenceType.AVAILABLE, None, None, 0))
+    table.update(Resource("res2", PresenceType.AVAILABLE, None, None, 0))
+    table.update(Resource("res3", PresenceType.AVAILABLE, None, None, 1))
+    table.update(Resource("res4", PresenceType.AVAILABLE, None, None, 2))
+    presence._online_status = {"test@localhost": table}
 
     res = presence.most_priority(JID("test@localhost"))
 
@@ -171,9 +168,9 @@ def test_handle_global_presence_no_roster_entries(setup_presence):
     presence.handle_global_presence(jid, element)
 
     mock_roster.roster_by_jid.assert_called()
-    assert presence._online_status == {
-        jid.bare(): [(jid.resource, PresenceType.AVAILABLE, None, None, None)]
-    }
+    assert presence.priority_by_jid(jid) == [
+        (jid.resource, PresenceType.AVAILABLE, None, None, 0)
+    ]
     mock_connections.get_buffer.assert_not_called()
 
 
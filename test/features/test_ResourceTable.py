@@ -0,0 +1,126 @@
+import xml.etree.ElementTree as ET
+from types import SimpleNamespace
+from unittest.mock import patch
+
+import pytest
+
+from pyjabber.features.presence.Enums import PresenceType
+from pyjabber.features.presence.PresenceFeature import Presence
+from pyjabber.features.presence.ResourceTable import (
+    Resource,
+    ResourceTable,
+    parse_priority,
+)
+from pyjabber.queues.QueueManager import QueueManager, QueueName
+from pyjabber.stream.JID import JID
+from pyjabber.utils import Singleton
+
+
+def available(resource: str, priority: int) -> Resource:
+    return Resource(resource, PresenceType.AVAILABLE, None, None, priority)
+
+
+def test_parse_priority():
+    assert parse_priority("10") == 10
+    assert parse_priority(" -5 ") == -5
+    assert parse_priority(None) == 0
+    assert parse_priority("high") == 0
+    assert parse_priority("500") == 127
+    assert parse_priority("-500") == -128
+
+
+def test_highest_priority():
+    table = ResourceTable()
+    table.update(available("nine", parse_priority("9")))
+    table.update(available("ten", parse_priority("10")))
+
+    # Compared as integers, not as the text of the presence
+    assert [r.resource for r in table.top] == ["ten"]
+
+    table.update(available("ten", 1))
+    assert [r.resource for r in table.top] == ["nine"]
+
+    table.remove("nine")
+    assert [r.resource for r in table.top] == ["ten"]
+
+
+def test_tie_delivers_to_all():
+    table = ResourceTable()
+    table.update(available("a", 5))
+    table.update(available("b", 5))
+    table.update(available("c", 1))
+
+    assert [r.resource for r in table.top] == ["a", "b"]
+
+
+def test_negative_and_unavailable_excluded():
+    table = ResourceTable()
+    table.update(available("a", -1))
+    table.update(available("b", -10))
+
+    # RFC 6121 8.5.2.1.1: never the target of messages to the bare JID
+    assert table.top == ()
+
+    table.update(available("c", 0))
+    assert [r.resource for r in table.top] == ["c"]
+
+    table.update(Resource("c", PresenceType.UNAVAILABLE, None, None, 0))
+    assert table.top == ()
+    assert [r.resource for r in table.available()] == ["a", "b"]
+    assert len(table) == 3
+
+
+@pytest.fixture
+def presence():
+    config = SimpleNamespace(host="localhost", plugins=[])
+    with (
+        patch("pyjabber.AppConfig.app_config", config),
+        patch("pyjabber.features.presence.PresenceFeature.ConnectionManager"),
+        patch("pyjabber.features.presence.PresenceFeature.Roster") as roster,
+    ):
+        roster.return_value.roster_by_jid.return_value = []
+        Singleton._instances.pop(Presence, None)
+        QueueManager._queues.pop(QueueName.CONNECTIONS, None)
+
+        yield Presence()
+
+        Singleton._instances.pop(Presence, None)
+        QueueManager._queues.pop(QueueName.CONNECTIONS, None)
+
+
+def stanza(priority: str = None, type_: str = None) -> ET.Element:
+    element = ET.Element("presence")
+    if type_:
+        element.attrib["type"] = type_
+    if priority is not None:
+        ET.SubElement(element, "{jabber:client}priority").text = priority
+    return element
+
+
+async def test_presence_routing(presence):
+    await presence.feed(JID("romeo@localhost/phone"), stanza("9"))
+    await presence.feed(JID("romeo@localhost/laptop"), stanza("10"))
+    await presence.feed(JID("romeo@localhost/bot"), stanza("-1"))
+
+    top = presence.most_priority(JID("romeo@localhost"))
+    assert [r.resource for r in top] == ["laptop"]
+    assert top[0].priority == 10
+
+    await presence.feed(JID("romeo@localhost/phone"), stanza("10"))
+    assert [r.resource for r in presence.most_priority(JID("romeo@localhost"))] == [
+        "phone",
+        "laptop",
+    ]
+
+    await presence.feed(JID("romeo@localhost/laptop"), stanza(type_="unavailable"))
+    await presence.feed(JID("romeo@localhost/phone"), stanza(type_="unavailable"))
+    assert presence.most_priority(JID("romeo@localhost")) == ()
+    assert len(presence.priority_by_jid(JID("romeo@localhost"))) == 3
+
+    presence.lost_connections(
+        [JID("romeo@localhost/bot"), JID("romeo@localhost/phone")]
+    )
+    assert [r.resource for r in presence.priority_by_jid(JID("romeo@localhost"))] == [
+        "laptop"
+    ]
+    assert presence.most_priority(JID("juliet@localhost")) == ()
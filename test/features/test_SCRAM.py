@@ -0,0 +1,126 @@
+import base64
+import hashlib
+from unittest.mock import AsyncMock, MagicMock, patch
+from xml.etree import ElementTree as ET
+
+import pytest
+
+from pyjabber.features.SASL import SCRAM
+from pyjabber.features.SASL.Mechanism import MECHANISM
+from pyjabber.features.SASL.SASL import SASL
+from pyjabber.stream.utils.Enums import Stage
+from test.benchmarks.scram_client import ScramClient
+
+SALT = b"0123456789abcdef"
+ITERATIONS = 4096
+
+
+def credentials(password: str = "pencil") -> SCRAM.Credentials:
+    return SCRAM.parse_credentials(
+        SCRAM.format_credentials(
+            ITERATIONS,
+            SALT,
+            hashlib.pbkdf2_hmac("sha256", password.encode(), SALT, ITERATIONS),
+            hashlib.pbkdf2_hmac("sha1", password.encode(), SALT, ITERATIONS),
+        )
+    )
+
+
+def exchange(mechanism, client, creds, cb_data=None) -> bytes:
+    scram = SCRAM.ScramExchange(mechanism, cb_data)
+    assert scram.client_first(client.first()) == "user"
+    return scram.client_final(client.final(scram.server_first(creds)))
+
+
+@pytest.mark.parametrize(
+    "mechanism, hash_name",
+    [(MECHANISM.SCRAM_SHA_256, "sha256"), (MECHANISM.SCRAM_SHA_1, "sha1")],
+)
+def test_exchange(mechanism, hash_name):
+    client = ScramClient("user", "pencil", hash_name)
+    assert client.verify(exchange(mechanism, client, credentials()))
+
+
+def test_wrong_password():
+    client = ScramClient("user", "wrong")
+    with pytest.raises(SCRAM.ScramError) as e:
+        exchange(MECHANISM.SCRAM_SHA_256, client, credentials())
+    assert e.value.condition == "not-authorized"
+
+
+def test_unknown_user_gets_stable_salt():
+    first = ScramClient("ghost", "pencil").first()
+    salts = []
+    for _ in range(2):
+        scram = SCRAM.ScramExchange(MECHANISM.SCRAM_SHA_256)
+        scram.client_first(first)
+        salts.append(scram.server_first(None).split(b",")[1])
+    assert salts[0] == salts[1]
+
+
+def test_legacy_credentials():
+    salted = hashlib.pbkdf2_hmac("sha256", b"pencil", SALT, ITERATIONS)
+    legacy = SCRAM.parse_credentials(f"sha256${ITERATIONS}${SALT.hex()}${salted.hex()}")
+    assert legacy.legacy
+    assert legacy.verify("sha256", salted)
+
+    client = ScramClient("user", "pencil")
+    assert client.verify(exchange(MECHANISM.SCRAM_SHA_256, client, legacy))
+
+    with pytest.raises(SCRAM.ScramError):
+        exchange(MECHANISM.SCRAM_SHA_1, ScramClient("user", "pencil", "sha1"), legacy)
+
+
+def test_channel_binding():
+    cb_data = b"tls-unique-data"
+
+    client = ScramClient("user", "pencil", cbind_flag="p=tls-unique", cb_data=cb_data)
+    assert client.verify(
+        exchange(MECHANISM.SCRAM_SHA_256_PLUS, client, credentials(), cb_data)
+    )
+
+    # Bound to another TLS session
+    client = ScramClient("user", "pencil", cbind_flag="p=tls-unique", cb_data=b"x")
+    with pytest.raises(SCRAM.ScramError):
+        exchange(MECHANISM.SCRAM_SHA_256_PLUS, client, credentials(), cb_data)
+
+    # Client supports channel binding but was offered no PLUS mechanism
+    client = ScramClient("user", "pencil", cbind_flag="y")
+    with pytest.raises(SCRAM.ScramError):
+        exchange(MECHANISM.SCRAM_SHA_256, client, credentials(), cb_data)
+
+
+@pytest.mark.asyncio
+async def test_sasl_scram_flow():
+    transport = MagicMock()
+    transport.get_extra_info.return_value = None
+
+    with (
+        patch("pyjabber.features.SASL.SASL.AppConfig") as mock_config,
+        patch("pyjabber.features.SASL.SASL.ConnectionManager") as mock_connections,
+        patch.object(SASL, "_get_credentials", AsyncMock(return_value=credentials())),
+    ):
+        mock_config.app_config.host = "localhost"
+        sasl = SASL(transport, MagicMock(), ("127.0.0.1", 5000))
+
+        client = ScramClient("user", "pencil")
+        auth = ET.Element(
+            "{urn:ietf:params:xml:ns:xmpp-sasl}auth",
+            attrib={"mechanism": "SCRAM-SHA-256"},
+        )
+        auth.text = base64.b64encode(client.first()).decode()
+        assert await sasl.feed(auth) is None
+
+        challenge = ET.fromstring(transport.write.call_args.args[0])
+        assert challenge.tag == "{urn:ietf:params:xml:ns:xmpp-sasl}challenge"
+
+        response = ET.Element("{urn:ietf:params:xml:ns:xmpp-sasl}response")
+        response.text = base64.b64encode(
+            client.final(base64.b64decode(challenge.text))
+        ).decode()
+        assert await sasl.feed(response) == Stage.AUTH
+
+        success = ET.fromstring(transport.write.call_args.args[0])
+        assert success.tag == "{urn:ietf:params:xml:ns:xmpp-sasl}success"
+        assert client.verify(base64.b64decode(success.text))
+        mock_connections.return_value.set_jid.assert_called_once()
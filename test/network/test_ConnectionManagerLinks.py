@@ -0,0 +1,50 @@
+from unittest.mock import MagicMock
+
+import pytest
+
+from pyjabber.network.ConnectionManager import ConnectionManager
+
+OUT_PEER = ("10.0.0.2", 5269)
+IN_PEER = ("10.0.0.2", 41000)
+
+
+@pytest.fixture
+def connections():
+    connections = object.__new__(ConnectionManager)
+    connections.__init__()
+    return connections
+
+
+def test_outgoing_link_once_ready(connections):
+    transport = MagicMock()
+    connections.connection_server(OUT_PEER, transport, "remote.com")
+    assert connections.get_server_transport_host("remote.com") is None
+
+    connections.ready_server(OUT_PEER)
+    assert connections.get_server_transport_host("remote.com") == transport
+
+    connections.disconnection_server(OUT_PEER)
+    assert connections.get_server_transport_host("remote.com") is None
+
+
+def test_single_link_per_domain(connections):
+    in_transport, out_transport = MagicMock(), MagicMock()
+
+    connections.connection_server_incoming(IN_PEER, in_transport)
+    connections.set_host_incoming(IN_PEER, "remote.com", bidi=True)
+    connections.connection_server(OUT_PEER, out_transport, "remote.com")
+    connections.ready_server(OUT_PEER)
+
+    # The bidirectional stream came first, and keeps serving the domain
+    assert connections.get_server_transport_host("remote.com") == in_transport
+
+    connections.disconnection_server_incoming(IN_PEER)
+    assert connections.get_server_transport_host("remote.com") == out_transport
+
+
+def test_incoming_without_bidi_is_not_a_link(connections):
+    connections.connection_server_incoming(IN_PEER, MagicMock())
+    connections.set_host_incoming(IN_PEER, "remote.com")
+
+    assert connections.get_server_incoming_host(IN_PEER) == "remote.com"
+    assert connections.get_server_transport_host("remote.com") is None
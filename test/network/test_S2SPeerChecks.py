@@ -0,0 +1,78 @@
+import os
+import shutil
+from types import SimpleNamespace
+from unittest.mock import MagicMock, patch
+from xml.etree import ElementTree as ET
+
+import pytest
+from cryptography import x509
+from cryptography.hazmat.primitives import serialization
+
+from pyjabber.features.SASL import utils
+from pyjabber.network.CertGenerator import generate_hostname_cert
+from pyjabber.stream.negotiators.ServerIncomingStreamNegotiator import (
+    ServerIncomingStreamNegotiator,
+)
+
+CERTS_PATH = os.path.join(os.path.dirname(__file__), "../../pyjabber/network/certs")
+PEER = ("10.0.0.1", 5269)
+
+
+@pytest.fixture
+def certs(tmp_path):
+    for name in ("ca_cert.pem", "ca_key.pem"):
+        shutil.copy(os.path.join(CERTS_PATH, name), tmp_path)
+    cwd = os.getcwd()
+    generate_hostname_cert("remote.com", str(tmp_path))
+    os.chdir(cwd)
+
+    with open(tmp_path / "remote.com_cert.pem", "rb") as f:
+        der = x509.load_pem_x509_certificate(f.read()).public_bytes(
+            serialization.Encoding.DER
+        )
+    ssl_object = MagicMock()
+    ssl_object.getpeercert.return_value = der
+
+    utils._load_ca.cache_clear()
+    with patch(
+        "pyjabber.AppConfig.app_config", SimpleNamespace(cert_path=str(tmp_path))
+    ):
+        yield tmp_path, ssl_object
+    utils._load_ca.cache_clear()
+
+
+def test_ca_loaded_once(certs):
+    path, ssl_object = certs
+
+    assert utils.verify_peer_cert("remote.com", ssl_object)
+    assert not utils.verify_peer_cert("other.com", ssl_object)
+    assert utils._load_ca.cache_info().misses == 1
+
+    # A new CA file is read again
+    stat = os.stat(path / "ca_cert.pem")
+    os.utime(path / "ca_cert.pem", ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert utils.verify_peer_cert("remote.com", ssl_object)
+    assert utils._load_ca.cache_info().misses == 2
+
+    os.remove(path / "ca_cert.pem")
+    assert not utils.verify_peer_cert("remote.com", ssl_object)
+
+
+async def test_bidi_only_before_sasl():
+    transport = MagicMock()
+    transport.get_extra_info.return_value = PEER
+    config = SimpleNamespace(host="localhost", plugins=[])
+    with patch("pyjabber.AppConfig.app_config", config):
+        negotiator = ServerIncomingStreamNegotiator(
+            transport, MagicMock(), MagicMock(), MagicMock()
+        )
+    bidi = ET.Element("{urn:xmpp:bidi}bidi")
+
+    await negotiator._handle_ssl(bidi)
+    assert negotiator._bidi
+
+    negotiator._bidi = False
+    negotiator._sasl = MagicMock()  # The authentication started
+    await negotiator._handle_ssl(bidi)
+    assert not negotiator._bidi
+    negotiator._sasl.feed.assert_not_called()
@@ -1,13 +1,17 @@
 import xml.etree.ElementTree as ET
+from types import SimpleNamespace
 from unittest.mock import patch
 
 import pytest
-from sqlalchemy import create_engine, insert
+from sqlalchemy import create_engine, insert, select
 
+from pyjabber.db import BulkImport
+from pyjabber.db.database import DB
 from pyjabber.db.model import Model
 from pyjabber.plugins.roster.Roster import Roster
 from pyjabber.stanzas.error import StanzaError as SE
 from pyjabber.stream.JID import JID
+from pyjabber.utils import Singleton
 
 
 @pytest.fixture(scope="function")
@@ -188,3 +192,164 @@ def test_handleSet_no_items(setup):
 
     res = roster.handle_set(JID("jid1@localhost"), element)
     assert res == SE.invalid_xml()
+
+
+@pytest.fixture
+async def versioned():
+    config = SimpleNamespace(
+        host="localhost",
+        database_path=None,
+        database_in_memory=True,
+        database_debug=False,
+        database_write_timeout=5.0,
+        database_read_timeout=5.0,
+        database_readers=1,
+        database_shards=1,
+    )
+    with patch("pyjabber.AppConfig.app_config", config):
+        Singleton._instances.pop(Roster, None)
+        await DB.setup_database()
+        yield Roster()
+        await DB.close_engine_async()
+        Singleton._instances.pop(Roster, None)
+
+
+def roster_iq(type_: str, ver: str = None, item: dict = None) -> ET.Element:
+    iq = ET.Element("iq", attrib={"type": type_, "id": "r1"})
+    query = ET.SubElement(iq, "{jabber:iq:roster}query")
+    if ver is not None:
+        query.attrib["ver"] = ver
+    if item is not None:
+        ET.SubElement(query, "{jabber:iq:roster}item", attrib=item)
+    return iq
+
+
+def stanzas(data: bytes) -> list:
+    return list(ET.fromstring(b"<s>" + data + b"</s>"))
+
+
+async def test_roster_versioning(versioned):
+    roster = versioned
+    juliet = JID("juliet@localhost/balcony")
+
+    for contact in ("romeo", "nurse", "tybalt"):
+        await roster.feed(juliet, roster_iq("set", item={"jid": contact}))
+    await roster.feed(
+        juliet, roster_iq("set", item={"jid": "tybalt", "subscription": "remove"})
+    )
+
+    # Full roster, with the version when the client supports it
+    (full,) = stanzas(await roster.feed(juliet, roster_iq("get", ver="")))
+    query = full.find("{jabber:iq:roster}query")
+    assert query.attrib["ver"] == "4"
+    assert [i.attrib["jid"] for i in query] == ["romeo", "nurse"]
+
+    (legacy,) = stanzas(await roster.feed(juliet, roster_iq("get")))
+    assert "ver" not in legacy.find("{jabber:iq:roster}query").attrib
+
+    # Up to date: an empty result
+    (result,) = stanzas(await roster.feed(juliet, roster_iq("get", ver="4")))
+    assert result.attrib["type"] == "result" and len(result) == 0
+
+    # A few changes behind: only the pushes of the changes
+    result, *pushes = stanzas(await roster.feed(juliet, roster_iq("get", ver="2")))
+    assert len(result) == 0
+    assert [
+        (
+            p.attrib["type"],
+            p.attrib["to"],
+            p[0].attrib["ver"],
+            p[0][0].attrib["jid"],
+            p[0][0].attrib.get("subscription"),
+        )
+        for p in pushes
+    ] == [
+        ("set", str(juliet), "3", "tybalt", None),
+        ("set", str(juliet), "4", "tybalt", "remove"),
+    ]
+
+    # Unknown versions get the full roster
+    for ver in ("7", "abc"):
+        (full,) = stanzas(await roster.feed(juliet, roster_iq("get", ver=ver)))
+        assert len(full.find("{jabber:iq:roster}query")) == 2
+
+
+async def test_roster_changelog_window(versioned):
+    roster = versioned
+    juliet = JID("juliet@localhost/balcony")
+
+    with patch("pyjabber.plugins.roster.Roster.CHANGELOG_SIZE", 3):
+        for i in range(6):
+            await roster.feed(juliet, roster_iq("set", item={"jid": f"c{i}"}))
+
+        async with DB.reader("juliet") as con:
+            res = await con.execute(select(Model.RosterChanges.c.version))
+            assert sorted(v for (v,) in res) == [4, 5, 6]
+
+        # Too old for the log
+        (full,) = stanzas(await roster.feed(juliet, roster_iq("get", ver="2")))
+        assert len(full.find("{jabber:iq:roster}query")) == 6
+
+        _, *pushes = stanzas(await roster.feed(juliet, roster_iq("get", ver="3")))
+        assert [p[0].attrib["ver"] for p in pushes] == ["4", "5", "6"]
+
+
+async def test_roster_versioning_after_import(versioned):
+    roster = versioned
+    juliet = JID("juliet@localhost/balcony")
+    await roster.feed(juliet, roster_iq("set", item={"jid": "romeo"}))
+
+    # Rosters of a bulk import are versioned as any other change
+    await BulkImport._store_batch(
+        [
+            BulkImport.UserEntry(
+                jid="juliet",
+                password="pencil",
+                roster=(BulkImport.RosterEntry(jid="nurse", subscription="both"),),
+            )
+        ],
+        ["hash"],
+    )
+
+    result, push = stanzas(await roster.feed(juliet, roster_iq("get", ver="1")))
+    assert len(result) == 0
+    query = push.find("{jabber:iq:roster}query")
+    assert query.attrib["ver"] == "2"
+    assert query[0].attrib == {"jid": "nurse", "subscription": "both"}
+
+    (full,) = stanzas(await roster.feed(juliet, roster_iq("get", ver="")))
+    query = full.find("{jabber:iq:roster}query")
+    assert query.attrib["ver"] == "2"
+    assert [i.attrib["jid"] for i in query] == ["romeo", "nurse"]
+
+
+async def test_roster_loaded_once(versioned):
+    roster = versioned
+    juliet = JID("juliet@localhost/balcony")
+
+    with patch.object(Roster, "_update_roster", wraps=roster._update_roster) as load:
+        for contact in ("romeo", "nurse"):
+            await roster.feed(juliet, roster_iq("set", item={"jid": contact}))
+        await roster.feed(
+            juliet, roster_iq("set", item={"jid": "romeo", "name": "Romeo"})
+        )
+        await roster.feed(
+            juliet, roster_iq("set", item={"jid": "nurse", "subscription": "remove"})
+        )
+        (entry,) = roster.roster_by_jid(juliet)
+        await roster.update_item(
+            ET.Element("item", attrib={"jid": "romeo", "subscription": "both"}),
+            entry["id"],
+        )
+        (full,) = stanzas(await roster.feed(juliet, roster_iq("get")))
+        assert load.call_count == 1
+
+    # The changes in memory match the database
+    assert [i.attrib for i in full.find("{jabber:iq:roster}query")] == [
+        {"jid": "romeo", "subscription": "both"}
+    ]
+    await roster._update_roster()
+    assert roster.roster_by_jid(juliet) == [entry]
+
+    roster.forget("juliet")
+    assert roster.roster_by_jid(juliet) == [] and not roster._items_by_id
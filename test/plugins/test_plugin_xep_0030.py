@@ -0,0 +1,139 @@
+from types import SimpleNamespace
+from unittest.mock import patch
+from xml.etree import ElementTree as ET
+
+import pytest
+
+from pyjabber.db.database import DB
+from pyjabber.plugins.xep_0030.xep_0030 import Disco
+from pyjabber.plugins.xep_0060.xep_0060 import PubSub
+from pyjabber.queues.QueueManager import QueueManager, QueueName
+from pyjabber.stream.JID import JID
+from pyjabber.utils import Singleton
+
+PUBSUB = "http://jabber.org/protocol/pubsub"
+UPLOAD = "urn:xmpp:http:upload:0"
+DISCO_INFO = "http://jabber.org/protocol/disco#info"
+DISCO_ITEMS = "http://jabber.org/protocol/disco#items"
+ERRORS = "urn:ietf:params:xml:ns:xmpp-stanzas"
+
+
+@pytest.fixture
+async def disco():
+    config = SimpleNamespace(
+        host="localhost",
+        config_path="",
+        plugins=[DISCO_INFO, DISCO_ITEMS, PUBSUB, UPLOAD],
+        items={
+            "pubsub.$": {
+                "name": "Pubsub Service",
+                "category": "pubsub",
+                "type": "service",
+                "var": PUBSUB,
+            },
+            "upload.$": {
+                "name": "HTTP File Upload",
+                "category": "store",
+                "type": "file",
+                "var": UPLOAD,
+                "extra": {"max-size": 1024},
+            },
+        },
+        database_in_memory=True,
+        database_debug=False,
+        database_write_timeout=5.0,
+        database_read_timeout=5.0,
+        database_readers=1,
+        database_shards=1,
+    )
+    with patch("pyjabber.AppConfig.app_config", config):
+        for cls in (Disco, PubSub):
+            Singleton._instances.pop(cls, None)
+        QueueManager._queues.pop(QueueName.NOTIFICATIONS, None)
+        await DB.setup_database()
+
+        yield Disco()
+
+        for cls in (Disco, PubSub):
+            Singleton._instances.pop(cls, None)
+        await DB.close_engine_async()
+
+
+def request(kind: str, to: str, id_: str = "1", node: str = None) -> ET.Element:
+    element = ET.Element(
+        "iq", attrib={"type": "get", "id": id_, "from": "romeo@localhost/r", "to": to}
+    )
+    query = ET.SubElement(element, f"{{http://jabber.org/protocol/disco#{kind}}}query")
+    if node:
+        query.attrib["node"] = node
+    return element
+
+
+async def test_response_spliced(disco):
+    first = await disco.feed(None, request("info", "localhost"))
+    second = ET.fromstring(
+        await disco.feed(None, request("info", "localhost", id_='a"b&<c'))
+    )
+
+    assert second.attrib == {
+        "id": 'a"b&<c',
+        "from": "localhost",
+        "to": "romeo@localhost/r",
+        "type": "result",
+    }
+    assert [f.attrib["var"] for f in second.iter(f"{{{DISCO_INFO}}}feature")] == [
+        DISCO_INFO,
+        DISCO_ITEMS,
+        PUBSUB,
+        UPLOAD,
+    ]
+    assert ET.tostring(ET.fromstring(first)[0]) == ET.tostring(second[0])
+    assert list(disco._responses) == [("info", None, None)]
+
+    # Every account gets the same info
+    for user in ("juliet", "romeo"):
+        res = ET.fromstring(
+            await disco.feed(None, request("info", f"{user}@localhost"))
+        )
+        assert res.attrib["from"] == f"{user}@localhost"
+        assert res.find(f".//{{{DISCO_INFO}}}identity[@type='pep']") is not None
+    assert len(disco._responses) == 2
+
+    res = ET.fromstring(await disco.feed(None, request("info", "upload.localhost")))
+    field = res.find(".//{jabber:x:data}field[@var='max-file-size']")
+    assert field.find("{jabber:x:data}value").text == "1024"
+
+
+async def test_pubsub_invalidated(disco):
+    pubsub = PubSub()
+
+    async def nodes():
+        res = ET.fromstring(
+            await disco.feed(None, request("items", "pubsub.localhost"))
+        )
+        return [i.attrib for i in res.iter(f"{{{DISCO_ITEMS}}}item")]
+
+    assert await nodes() == []
+
+    create = ET.fromstring(
+        f"<iq type='set' id='c'><pubsub xmlns='{PUBSUB}'>"
+        "<create node='news'/></pubsub></iq>"
+    )
+    await pubsub.feed(JID("romeo@localhost/r"), create)
+    assert await nodes() == [{"jid": "pubsub.localhost", "node": "news"}]
+    assert await nodes() == [{"jid": "pubsub.localhost", "node": "news"}]
+
+    res = ET.fromstring(
+        await disco.feed(None, request("info", "pubsub.localhost", node="news"))
+    )
+    assert res.find(f".//{{{DISCO_INFO}}}identity").attrib["type"] == "leaf"
+
+    delete = ET.fromstring(
+        f"<iq type='set' id='d'><pubsub xmlns='{PUBSUB}#owner'>"
+        "<delete node='news'/></pubsub></iq>"
+    )
+    await pubsub.feed(JID("romeo@localhost/r"), delete)
+    assert await nodes() == []
+
+    res = await disco.feed(None, request("info", "pubsub.localhost", node="news"))
+    assert ET.fromstring(res).find(f".//{{{ERRORS}}}item-not-found") is not None
@@ -0,0 +1,63 @@
+from xml.etree import ElementTree as ET
+
+import pytest
+
+from pyjabber.plugins.xep_0059.xep_0059 import (
+    MAX_PAGE,
+    NAMESPACE,
+    ItemNotFound,
+    ResultSetRequest,
+    parse_request,
+    result_set,
+    select_page,
+)
+
+UIDS = [str(i) for i in range(10)]
+
+
+def request(content: str) -> ET.Element:
+    return ET.fromstring(f"<pubsub><set xmlns='{NAMESPACE}'>{content}</set></pubsub>")
+
+
+def test_parse_request():
+    assert parse_request(ET.fromstring("<pubsub/>")) is None
+    assert parse_request(request("<max>10</max><after>a</after>")) == (
+        ResultSetRequest(max=10, after="a")
+    )
+    assert parse_request(request("<max>5</max><before/>")) == ResultSetRequest(
+        max=5, before=""
+    )
+    assert parse_request(request("<index>3</index>")).index == 3
+    assert parse_request(request(f"<max>{MAX_PAGE * 10}</max>")).page_size == MAX_PAGE
+
+
+@pytest.mark.parametrize(
+    "content",
+    ["<max>x</max>", "<max>-1</max>", "<after/>", "<after>a</after><before>b</before>"],
+)
+def test_parse_request_invalid(content):
+    with pytest.raises(ValueError):
+        parse_request(request(content))
+
+
+def test_select_page():
+    assert select_page(UIDS, ResultSetRequest(max=3)) == (0, 3)
+    assert select_page(UIDS, ResultSetRequest(max=3, after="8")) == (9, 10)
+    assert select_page(UIDS, ResultSetRequest(max=3, before="2")) == (0, 2)
+    assert select_page(UIDS, ResultSetRequest(max=3, before="")) == (7, 10)
+    assert select_page(UIDS, ResultSetRequest(max=3, index=5)) == (5, 8)
+    assert select_page(UIDS, ResultSetRequest(max=0)) == (0, 0)
+
+    with pytest.raises(ItemNotFound):
+        select_page(UIDS, ResultSetRequest(after="missing"))
+
+
+def test_result_set():
+    rsm = result_set(10, "3", "5", 3)
+    assert rsm.find(f"{{{NAMESPACE}}}first").attrib == {"index": "3"}
+    assert rsm.find(f"{{{NAMESPACE}}}first").text == "3"
+    assert rsm.find(f"{{{NAMESPACE}}}last").text == "5"
+    assert rsm.find(f"{{{NAMESPACE}}}count").text == "10"
+
+    empty = result_set(10)
+    assert [child.tag for child in empty] == [f"{{{NAMESPACE}}}count"]
@@ -0,0 +1,227 @@
+from collections import defaultdict
+from types import SimpleNamespace
+from unittest.mock import patch
+from xml.etree import ElementTree as ET
+
+import pytest
+
+from pyjabber.db.database import DB
+from pyjabber.plugins.xep_0030.utils import server_info
+from pyjabber.plugins.xep_0115.xep_0115 import NAMESPACE as CAPS
+from pyjabber.plugins.xep_0115.xep_0115 import NODE, Caps, caps_hash
+from pyjabber.stream.JID import JID
+from pyjabber.utils import Singleton
+
+DISCO_INFO = "http://jabber.org/protocol/disco#info"
+MOOD = "http://jabber.org/protocol/mood"
+
+
+class Session:
+    def __init__(self):
+        self.written = []
+
+    def write(self, data: bytes):
+        self.written.append(ET.fromstring(data))
+
+
+class Connections:
+    def __init__(self):
+        self.sessions = defaultdict(Session)
+
+    def get_transport(self, jid: JID):
+        return [SimpleNamespace(transport=self.sessions[str(jid)])]
+
+
+@pytest.fixture
+async def caps():
+    config = SimpleNamespace(
+        host="localhost",
+        plugins=[DISCO_INFO, "urn:xmpp:ping"],
+        items={},
+        database_in_memory=True,
+        database_debug=False,
+        database_write_timeout=5.0,
+        database_read_timeout=5.0,
+        database_readers=1,
+        database_shards=1,
+    )
+    with (
+        patch("pyjabber.AppConfig.app_config", config),
+        patch(
+            "pyjabber.plugins.xep_0115.xep_0115.ConnectionManager",
+            return_value=Connections(),
+        ),
+    ):
+        Singleton._instances.pop(Caps, None)
+        await DB.setup_database()
+
+        yield Caps()
+
+        Singleton._instances.pop(Caps, None)
+        await DB.close_engine_async()
+
+
+def disco_info(*features: str) -> ET.Element:
+    query = ET.Element(f"{{{DISCO_INFO}}}query")
+    ET.SubElement(
+        query,
+        f"{{{DISCO_INFO}}}identity",
+        attrib={"category": "client", "type": "pc", "name": "Exodus 0.9.1"},
+    )
+    for var in features:
+        ET.SubElement(query, f"{{{DISCO_INFO}}}feature", attrib={"var": var})
+    return query
+
+
+def presence(ver: str, hash_: str = "sha-1") -> ET.Element:
+    return ET.fromstring(
+        f"<presence><c xmlns='{CAPS}' hash='{hash_}' node='urn:example' "
+        f"ver='{ver}'/></presence>"
+    )
+
+
+def answer(caps: Caps, jid: JID, query: ET.Element) -> ET.Element:
+    """
+    Result of the last query the server sent to the session
+    """
+    request = caps._connections.sessions[str(jid)].written[-1]
+    assert (
+        request.find(f"{{{DISCO_INFO}}}query").attrib["node"].startswith("urn:example#")
+    )
+    response = ET.Element("iq", attrib={"type": "result", "id": request.attrib["id"]})
+    response.append(query)
+    return response
+
+
+def queries(caps: Caps) -> int:
+    return sum(len(s.written) for s in caps._connections.sessions.values())
+
+
+def test_caps_hash():
+    # XEP-0115, 5.2 and 5.3
+    features = (
+        "http://jabber.org/protocol/caps",
+        "http://jabber.org/protocol/disco#info",
+        "http://jabber.org/protocol/disco#items",
+        "http://jabber.org/protocol/muc",
+    )
+    assert caps_hash(disco_info(*features)) == "QgayPKawpkPSDYmwT/WM94uAlu0="
+
+    query = ET.fromstring(
+        f"<query xmlns='{DISCO_INFO}'>"
+        "<identity xml:lang='en' category='client' name='Psi 0.11' type='pc'/>"
+        "<identity xml:lang='el' category='client' name='Ψ 0.11' type='pc'/>"
+        + "".join(f"<feature var='{f}'/>" for f in reversed(features))
+        + "<x xmlns='jabber:x:data' type='result'>"
+        "<field var='FORM_TYPE' type='hidden'>"
+        "<value>urn:xmpp:dataforms:softwareinfo</value></field>"
+        "<field var='ip_version'><value>ipv4</value><value>ipv6</value></field>"
+        "<field var='os'><value>Mac</value></field>"
+        "<field var='os_version'><value>10.5.1</value></field>"
+        "<field var='software'><value>Psi</value></field>"
+        "<field var='software_version'><value>0.11</value></field>"
+        "</x></query>"
+    )
+    assert caps_hash(query) == "q07IKJEyjvHSyhy//CH0CxmKi8w="
+
+    # Repeated features cannot be trusted
+    assert caps_hash(disco_info(MOOD, MOOD)) is None
+
+
+async def test_shared_version(caps):
+    query = disco_info(DISCO_INFO, f"{MOOD}+notify")
+    ver = caps_hash(query)
+    phones = [JID(f"user{i}@localhost/phone") for i in range(3)]
+
+    # One query for the version, the other sessions wait for it
+    for jid in phones:
+        assert caps.presence(jid, presence(ver)) is None
+    assert queries(caps) == 1
+
+    learned = await caps.response(phones[0], answer(caps, phones[0], query))
+    assert learned == [(jid, frozenset({MOOD})) for jid in phones]
+
+    # Known from now on
+    assert caps.presence(JID("user9@localhost/phone"), presence(ver)) == {MOOD}
+    assert queries(caps) == 1
+    assert caps.interested("user9@localhost", MOOD) == ["user9@localhost/phone"]
+
+
+async def test_unverified_version(caps):
+    query = disco_info(DISCO_INFO, f"{MOOD}+notify")
+    ver = caps_hash(disco_info(DISCO_INFO))
+    liar, honest = JID("liar@localhost/pc"), JID("honest@localhost/pc")
+
+    caps.presence(liar, presence(ver))
+    caps.presence(honest, presence(ver))
+
+    # The answer is only trusted for its session. The next one is asked
+    assert await caps.response(liar, answer(caps, liar, query)) == [
+        (liar, frozenset({MOOD}))
+    ]
+    assert ver not in caps._features
+    assert len(caps._connections.sessions[str(honest)].written) == 1
+
+    learned = await caps.response(honest, answer(caps, honest, disco_info(DISCO_INFO)))
+    assert learned == [(honest, frozenset())]
+    assert caps._features[ver] == {DISCO_INFO}
+
+    # Legacy caps are queried for every session
+    for jid in (JID("old@localhost/a"), JID("old@localhost/b")):
+        caps.presence(jid, presence("1.0", hash_=""))
+        assert len(caps._connections.sessions[str(jid)].written) == 1
+        assert await caps.response(jid, answer(caps, jid, query)) == [
+            (jid, frozenset({MOOD}))
+        ]
+    assert "1.0" not in caps._features
+
+
+async def test_queried_session_offline(caps):
+    query = disco_info(DISCO_INFO, f"{MOOD}+notify")
+    ver = caps_hash(query)
+    first, second, third = (JID(f"user{i}@localhost/pc") for i in range(3))
+
+    for jid in (first, second, third):
+        caps.presence(jid, presence(ver))
+
+    # Its query goes to the next waiting session
+    caps.forget(first)
+    caps.forget(third)
+    assert len(caps._connections.sessions[str(second)].written) == 1
+    assert caps._waiting == {ver: []}
+
+    assert await caps.response(second, answer(caps, second, query)) == [
+        (second, frozenset({MOOD}))
+    ]
+    assert caps._waiting == {} and caps._queries == {}
+
+
+async def test_persistence(caps):
+    query = disco_info(DISCO_INFO, f"{MOOD}+notify")
+    ver = caps_hash(query)
+    jid = JID("romeo@localhost/phone")
+
+    await caps.load()
+    caps.presence(jid, presence(ver))
+    await caps.response(jid, answer(caps, jid, query))
+
+    # Another run knows the version without asking
+    Singleton._instances.pop(Caps, None)
+    restarted = Caps()
+    await restarted.load()
+    assert restarted.presence(jid, presence(ver)) == {MOOD}
+    assert queries(restarted) == 1
+
+
+async def test_server_caps(caps):
+    c = caps.server_caps()
+    assert c.attrib["node"] == NODE
+
+    # The disco#info of node#ver gives the hashed features
+    request = ET.fromstring(
+        "<iq type='get' id='1' to='localhost'>"
+        f"<query xmlns='{DISCO_INFO}' node='{NODE}#{c.attrib['ver']}'/></iq>"
+    )
+    query = ET.fromstring(server_info(request))[0]
+    assert query.attrib["node"] == f"{NODE}#{c.attrib['ver']}"
+    assert caps_hash(query) == c.attrib["ver"]
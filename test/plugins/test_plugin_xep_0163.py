@@ -0,0 +1,314 @@
+from collections import defaultdict
+from types import SimpleNamespace
+from unittest.mock import patch
+from xml.etree import ElementTree as ET
+
+import pytest
+from sqlalchemy import insert, select
+
+from pyjabber.db.database import DB
+from pyjabber.db.model import Model
+from pyjabber.plugins.PluginManager import PluginManager
+from pyjabber.plugins.roster.Roster import Roster
+from pyjabber.plugins.xep_0060.xep_0060 import PubSub
+from pyjabber.plugins.xep_0115.xep_0115 import NAMESPACE as CAPS
+from pyjabber.plugins.xep_0115.xep_0115 import Caps, caps_hash
+from pyjabber.plugins.xep_0163.xep_0163 import PEP
+from pyjabber.queues.QueueManager import QueueManager, QueueName, get_queue
+from pyjabber.stream.JID import JID
+from pyjabber.utils import Singleton
+
+PUBSUB = "http://jabber.org/protocol/pubsub"
+DISCO_INFO = "http://jabber.org/protocol/disco#info"
+MOOD = "http://jabber.org/protocol/mood"
+ERRORS = "urn:ietf:params:xml:ns:xmpp-stanzas"
+
+
+class Session:
+    """
+    Transport of a session, keeping what the server writes to it
+    """
+
+    def __init__(self):
+        self.written = []
+
+    def write(self, data: bytes):
+        self.written.append(ET.fromstring(data))
+
+
+class Connections:
+    def __init__(self):
+        self.sessions = defaultdict(Session)
+
+    def get_transport(self, jid: JID):
+        return [SimpleNamespace(transport=self.sessions[str(jid)])]
+
+
+@pytest.fixture
+async def pep():
+    config = SimpleNamespace(
+        host="localhost",
+        plugins=[PUBSUB],
+        items={"pubsub.$": {"category": "pubsub", "type": "service", "var": PUBSUB}},
+        database_in_memory=True,
+        database_debug=False,
+        database_write_timeout=5.0,
+        database_read_timeout=5.0,
+        database_readers=1,
+        database_shards=1,
+    )
+    with (
+        patch("pyjabber.AppConfig.app_config", config),
+        patch(
+            "pyjabber.plugins.xep_0115.xep_0115.ConnectionManager",
+            return_value=Connections(),
+        ),
+    ):
+        for cls in (PEP, Caps, PubSub, Roster):
+            Singleton._instances.pop(cls, None)
+        QueueManager._queues.pop(QueueName.NOTIFICATIONS, None)
+        await DB.setup_database()
+
+        # juliet <-> romeo, the nurse sees juliet, juliet sees tybalt
+        async with DB.writer() as con:
+            await con.execute(
+                insert(Model.Roster),
+                [
+                    {"jid": jid, "roster_item": f"<item jid='{c}' subscription='{s}'/>"}
+                    for jid, c, s in (
+                        ("juliet", "romeo", "both"),
+                        ("juliet", "nurse", "from"),
+                        ("juliet", "tybalt", "to"),
+                        ("romeo", "juliet", "both"),
+                        ("tybalt", "juliet", "from"),
+                    )
+                ],
+            )
+
+        yield PEP()
+
+        for cls in (PEP, Caps, PubSub, Roster):
+            Singleton._instances.pop(cls, None)
+        await DB.close_engine_async()
+
+
+async def interested(caps: Caps, jid: str, *namespaces: str):
+    """
+    The session advertised <namespace>+notify in its caps, and answered the
+    query of the server if the version was not known
+    """
+    jid = JID(jid)
+    query = ET.Element(f"{{{DISCO_INFO}}}query")
+    for ns in namespaces:
+        ET.SubElement(query, f"{{{DISCO_INFO}}}feature", attrib={"var": f"{ns}+notify"})
+
+    presence = ET.fromstring(
+        f"<presence><c xmlns='{CAPS}' hash='sha-1' node='urn:example' "
+        f"ver='{caps_hash(query)}'/></presence>"
+    )
+    namespaces = caps.presence(jid, presence)
+    if namespaces is not None:
+        return namespaces
+
+    request = caps._connections.sessions[str(jid)].written[-1]
+    response = ET.Element("iq", attrib={"type": "result", "id": request.attrib["id"]})
+    response.append(query)
+    learned = await caps.response(jid, response)
+    return learned[0][1]
+
+
+def request(operation: str, node: str, to: str = None, item: str = None):
+    element = ET.Element("iq", attrib={"type": "set", "id": "pep"})
+    if to:
+        element.attrib["to"] = to
+    pubsub = ET.SubElement(element, f"{{{PUBSUB}}}pubsub")
+    operation = ET.SubElement(pubsub, f"{{{PUBSUB}}}{operation}", attrib={"node": node})
+    if item is not None:
+        item = ET.SubElement(operation, f"{{{PUBSUB}}}item", attrib={"id": item})
+        ET.SubElement(item, f"{{{MOOD}}}mood").text = "happy"
+    return element
+
+
+def notifications() -> list:
+    queue = get_queue(QueueName.NOTIFICATIONS)
+    return [queue.get_nowait() for _ in range(queue.qsize())]
+
+
+async def test_caps_index(pep):
+    caps = Caps()
+    jid = JID("romeo@localhost/phone")
+
+    assert await interested(caps, str(jid), MOOD, "urn:xmpp:avatar:metadata") == {
+        MOOD,
+        "urn:xmpp:avatar:metadata",
+    }
+
+    # The same caps again do not query the session
+    ver = caps._versions[str(jid)].rpartition("#")[2]
+    presence = ET.fromstring(
+        f"<presence><c xmlns='{CAPS}' hash='sha-1' node='urn:example' ver='{ver}'/>"
+        "</presence>"
+    )
+    assert caps.presence(jid, presence) is None
+    assert caps.presence(jid, ET.Element("presence")) is None
+    assert len(caps._connections.sessions[str(jid)].written) == 1
+
+    assert caps.interested("romeo@localhost", MOOD) == [str(jid)]
+    assert caps.interested("romeo@localhost", "urn:example") == []
+
+    # Only the answer to the query is taken
+    assert await caps.response(jid, ET.fromstring("<iq type='result' id='x'/>")) is None
+
+    caps.forget(jid)
+    assert caps.interested("romeo@localhost", MOOD) == []
+    assert caps._interests == caps._versions == caps._queries == {}
+
+
+async def test_publish_notifies_interested(pep):
+    caps = Caps()
+    await interested(caps, "romeo@localhost/phone", MOOD)
+    await interested(caps, "romeo@localhost/desktop")
+    await interested(caps, "nurse@localhost/pc", MOOD)
+    await interested(caps, "tybalt@localhost/pc", MOOD)
+    await interested(caps, "juliet@localhost/tablet", MOOD)
+
+    juliet = JID("juliet@localhost/balcony")
+    res = ET.fromstring(await pep.feed(juliet, request("publish", MOOD, item="m1")))
+
+    assert res.attrib["type"] == "result"
+    assert res.find(f".//{{{PUBSUB}}}item").attrib == {"id": "m1"}
+
+    (notification,) = notifications()
+    assert notification.sender == "juliet@localhost"
+    assert sorted(notification.receivers) == [
+        "juliet@localhost/tablet",
+        "nurse@localhost/pc",
+        "romeo@localhost/phone",
+    ]
+    assert notification.event.find("items/item").attrib == {"id": "m1"}
+
+    async with DB.reader("juliet") as con:
+        res = await con.execute(select(Model.PepItems.c.node, Model.PepItems.c.item_id))
+        assert res.fetchall() == [(MOOD, "m1")]
+
+    # Only the owner publishes to its nodes
+    res = await pep.feed(
+        JID("romeo@localhost/phone"),
+        request("publish", MOOD, to="juliet@localhost", item="m2"),
+    )
+    assert ET.fromstring(res).find(f".//{{{ERRORS}}}forbidden") is not None
+
+
+async def test_retrieve_items(pep):
+    await pep.feed(JID("juliet@localhost/balcony"), request("publish", MOOD, item="m1"))
+    notifications()
+
+    for user in ("juliet", "romeo", "nurse"):
+        res = ET.fromstring(
+            await pep.feed(
+                JID(f"{user}@localhost/r"),
+                request("items", MOOD, to="juliet@localhost"),
+            )
+        )
+        assert res.attrib["from"] == "juliet@localhost"
+        assert res.find(f".//{{{MOOD}}}mood").text == "happy"
+
+    # Not subscribed to the presence of juliet
+    res = await pep.feed(
+        JID("tybalt@localhost/r"), request("items", MOOD, to="juliet@localhost")
+    )
+    assert ET.fromstring(res).find(f".//{{{ERRORS}}}forbidden") is not None
+
+    res = await pep.feed(
+        JID("juliet@localhost/r"), request("items", "urn:example:missing")
+    )
+    assert ET.fromstring(res).find(f".//{{{ERRORS}}}item-not-found") is not None
+
+
+async def test_last_items_bounded(pep):
+    for user in ("juliet", "romeo", "tybalt"):
+        await pep.feed(JID(f"{user}@localhost/r"), request("publish", MOOD, item=user))
+    notifications()
+
+    with patch("pyjabber.plugins.xep_0163.xep_0163.LAST_ITEMS_USERS", 2):
+        await pep.feed(JID("romeo@localhost/r"), request("items", MOOD))
+        assert list(pep._last) == ["tybalt", "romeo"]
+
+        # Dropped from memory, read again from the database
+        res = await pep.feed(
+            JID("romeo@localhost/r"), request("items", MOOD, to="juliet@localhost")
+        )
+        assert ET.fromstring(res).find(f".//{{{PUBSUB}}}item").attrib == {
+            "id": "juliet"
+        }
+        assert list(pep._last) == ["romeo", "juliet"]
+
+
+async def test_notify_without_database(pep):
+    await interested(Caps(), "romeo@localhost/phone", MOOD)
+    juliet = JID("juliet@localhost/balcony")
+    await pep.feed(juliet, request("publish", MOOD, item="m1"))
+    notifications()
+
+    # The rosters and the last items are in memory
+    with patch.object(DB, "reader") as reader:
+        await pep.feed(juliet, request("publish", MOOD, item="m2"))
+        reader.assert_not_called()
+    (notification,) = notifications()
+    assert notification.receivers == ("romeo@localhost/phone",)
+
+
+async def test_retract(pep):
+    await interested(Caps(), "romeo@localhost/phone", MOOD)
+    juliet = JID("juliet@localhost/balcony")
+    await pep.feed(juliet, request("publish", MOOD, item="m1"))
+    notifications()
+
+    element = request("retract", MOOD)
+    ET.SubElement(element[0][0], f"{{{PUBSUB}}}item", attrib={"id": "m1"})
+    res = ET.fromstring(await pep.feed(juliet, element))
+    assert res.attrib["type"] == "result"
+
+    (notification,) = notifications()
+    assert notification.receivers == ("romeo@localhost/phone",)
+    assert notification.event.find("items/retract").attrib == {"id": "m1"}
+
+    # Reloaded from the database
+    pep._last.clear()
+    res = await pep.feed(juliet, request("items", MOOD))
+    assert ET.fromstring(res).find(f".//{{{ERRORS}}}item-not-found") is not None
+
+
+async def test_plugin_manager(pep):
+    with patch("pyjabber.plugins.PluginManager.HTTPFieldUpload"):
+        romeo = JID("romeo@localhost/phone")
+        manager = PluginManager(romeo)
+        await manager.feed(request("publish", MOOD, item="m1"))
+        assert notifications() == []
+
+        # Pubsub requests to the service are not PEP
+        res = await manager.feed(request("items", MOOD, to="pubsub.localhost"))
+        assert ET.fromstring(res).find(f".//{{{ERRORS}}}item-not-found") is not None
+
+        # The session tells its interests: it gets the last items of its
+        # account and of juliet, who published before
+        await pep.feed(
+            JID("juliet@localhost/balcony"), request("publish", MOOD, item="j1")
+        )
+        notifications()
+
+        presence = ET.fromstring(
+            f"<presence><c xmlns='{CAPS}' node='urn:example' ver='1'/></presence>"
+        )
+        assert Caps().presence(romeo, presence) is None
+        query = Caps()._connections.sessions[str(romeo)].written[-1]
+        response = ET.fromstring(
+            f"<iq type='result' id='{query.attrib['id']}'>"
+            f"<query xmlns='{DISCO_INFO}'><feature var='{MOOD}+notify'/></query></iq>"
+        )
+        assert await manager.feed(response) is None
+
+    last = {n.sender: n for n in notifications()}
+    assert set(last) == {"romeo@localhost", "juliet@localhost"}
+    assert last["juliet@localhost"].receivers == (str(romeo),)
+    assert last["juliet@localhost"].event.find("items/item").attrib == {"id": "j1"}
@@ -0,0 +1,210 @@
+import asyncio
+from types import SimpleNamespace
+from unittest.mock import patch
+from xml.etree import ElementTree as ET
+
+import pytest
+
+from pyjabber.network.ConnectionManager import ConnectionManager, Peer
+from pyjabber.plugins.xep_0198.xep_0198 import (
+    H_MAX,
+    NAMESPACE,
+    SMMetrics,
+    SMTransport,
+    StreamManagement,
+    split_stanzas,
+)
+from pyjabber.queues.QueueManager import QueueManager, QueueName, get_queue
+from pyjabber.stream.JID import JID
+from pyjabber.stream.negotiators.StreamNegotiator import StreamNegotiator
+from pyjabber.stream.utils.Enums import Signal
+from pyjabber.utils import Singleton
+
+JULIET = JID("juliet@localhost/balcony")
+OLD = Peer("127.0.0.1", 5000)
+NEW = Peer("127.0.0.1", 5001)
+
+
+class Transport:
+    def __init__(self, peer: Peer):
+        self.peer = peer
+        self.writes = []
+        self.closed = False
+
+    def write(self, data: bytes):
+        self.writes.append(data)
+
+    def is_closing(self) -> bool:
+        return self.closed
+
+    def close(self):
+        self.closed = True
+
+    def get_extra_info(self, _):
+        return self.peer
+
+
+def message(body: str) -> bytes:
+    return f"<message to='{JULIET}'><body>{body}</body></message>".encode()
+
+
+@pytest.fixture
+def server():
+    config = SimpleNamespace(
+        host="localhost",
+        plugins=[NAMESPACE],
+        sm_resume_timeout=300,
+        sm_max_unacked=100,
+        message_persistence=True,
+    )
+    singletons = (StreamManagement, SMMetrics, ConnectionManager)
+    with (
+        patch("pyjabber.AppConfig.app_config", config),
+        patch("pyjabber.plugins.xep_0198.xep_0198.Presence") as presence,
+        patch("pyjabber.plugins.xep_0198.xep_0198.Caps"),
+    ):
+        for cls in singletons:
+            Singleton._instances.pop(cls, None)
+        QueueManager._queues.pop(QueueName.MESSAGES, None)
+
+        connections = ConnectionManager()
+        transport = Transport(OLD)
+        connections.connection(OLD, transport)
+        connections.set_jid(OLD, JULIET)
+        connections.online(JULIET)
+
+        yield config, connections, transport, presence.return_value
+
+        for cls in singletons:
+            Singleton._instances.pop(cls, None)
+        QueueManager._queues.pop(QueueName.MESSAGES, None)
+
+
+def enable(connections, transport) -> SMTransport:
+    session = StreamManagement().enable(JULIET, transport, OLD, True)
+    connections.update_transport_jid(session, JULIET)
+    return session
+
+
+def test_acks(server):
+    _, connections, transport, _ = server
+    session = enable(connections, transport)
+
+    for i in range(8):
+        session.write(message(str(i)))
+    session.write(b" " + message("8") + message("9"))
+    session.write(b"<a xmlns='urn:xmpp:sm:3' h='0'/>")  # Not a stanza
+
+    assert session.sent == 10 and len(session) == 10
+    assert list(session.unacked())[8:] == [message("8"), message("9")]
+    # An ack request goes with the tenth stanza
+    assert transport.writes[8].endswith(b':r xmlns:ns0="urn:xmpp:sm:3" />')
+
+    session.ack(4)
+    assert len(session) == 6
+    session.ack(10)
+    assert len(session) == 0
+
+    # The counters wrap around
+    session.sent = H_MAX - 1
+    session.write(message("a"))
+    session.write(message("b"))
+    assert session.sent == 1
+    session.ack(0)
+    assert [ET.fromstring(s).find("body").text for s in session.unacked()] == ["b"]
+
+
+def test_split_stanzas():
+    carbon = (
+        b"<message to='juliet@localhost'><received xmlns='urn:xmpp:carbons:2'>"
+        b"<forwarded xmlns='urn:xmpp:forward:0'><message from='romeo@localhost'>"
+        b"<body>hi</body></message></forwarded></received></message>"
+    )
+    iq = b"<ns0:iq xmlns:ns0='jabber:client' type='result' id='1' />"
+
+    assert split_stanzas(carbon) == [carbon]
+    assert split_stanzas(iq + b"<r xmlns='urn:xmpp:sm:3'/>" + carbon) == [iq, carbon]
+    # Stanzas mixed with what isn't XML, or not a whole element
+    assert split_stanzas(b"\n" + message("1") + b"</stream:stream>") == [message("1")]
+    assert split_stanzas(b"<stream:features><bind/></stream:features>") == []
+
+
+async def test_resume(server):
+    _, connections, transport, presence = server
+    session = enable(connections, transport)
+    session.write(message("acked"))
+    session.write(message("lost"))
+    session.handled()
+
+    assert StreamManagement().detach(transport)
+    # Stanzas keep coming for the detached session
+    assert not connections.get_transport_online(JULIET)[0].transport.is_closing()
+    connections.get_transport_online(JULIET)[0].transport.write(message("later"))
+    assert len(transport.writes) == 2
+
+    new = Transport(NEW)
+    connections.connection(NEW, new)
+    connections.set_jid(NEW, JID("juliet@localhost"))
+    handler = SimpleNamespace(transport=new)
+    negotiator = StreamNegotiator(new, None, None, handler)
+
+    resume = ET.Element(
+        f"{{{NAMESPACE}}}resume", attrib={"previd": session.id, "h": "1"}
+    )
+    assert await negotiator._handle_resume(resume) == Signal.DONE
+
+    resumed, *stanzas = ET.fromstring(b"<s>" + new.writes[0] + b"</s>")
+    assert resumed.tag == f"{{{NAMESPACE}}}resumed"
+    assert resumed.attrib == {"previd": session.id, "h": "1"}
+    assert [s.find("body").text for s in stanzas] == ["lost", "later"]
+
+    # Same session, on the new connection
+    (client,) = connections.get_transport_online(JULIET)
+    assert client.transport is session and handler.transport is session
+    assert session.original_transport is new
+    assert connections.get_jid(NEW) == JULIET
+    assert connections.get_jid(OLD) is None
+    presence.put_nowait.assert_not_called()
+    assert SMMetrics().stats()["resent"] == 2
+
+    # Only the owner resumes a session
+    assert StreamManagement().detach(new)
+    assert StreamManagement().resume(JID("romeo@localhost"), session.id, 0) is None
+
+
+async def test_expire(server):
+    config, connections, transport, presence = server
+    config.sm_resume_timeout = 0.01
+    session = enable(connections, transport)
+    session.write(message("unacked"))
+    session.write(b"<presence from='romeo@localhost/r'/>")
+
+    assert StreamManagement().detach(transport)
+    await asyncio.sleep(0.05)
+
+    assert connections.get_transport(JULIET)[0].transport.is_closing()
+    assert StreamManagement().resume(JULIET, session.id, 0) is None
+    assert SMMetrics().stats()["expired"] == 1
+    ((jid, element),), _ = presence.put_nowait.call_args
+    assert jid == JULIET and element.attrib["type"] == "INTERNAL"
+
+    # The unacked messages wait for the next login
+    pending = get_queue(QueueName.MESSAGES)
+    assert pending.qsize() == 1
+    assert pending.get_nowait().payload == message("unacked")
+
+
+def test_bounded_buffer(server):
+    config, connections, transport, _ = server
+    config.sm_max_unacked = 3
+    session = enable(connections, transport)
+
+    for i in range(4):
+        session.write(message(str(i)))
+
+    # Over the limit, the session is no longer resumable
+    assert len(session) == 0 and not session.resume
+    assert len(transport.writes) == 4
+    assert SMMetrics().stats()["overflows"] == 1
+    assert not StreamManagement().detach(transport)
+    assert len(StreamManagement()) == 0
@@ -0,0 +1,148 @@
+from xml.etree import ElementTree as ET
+
+import pytest
+
+from pyjabber.network.ConnectionManager import ConnectionManager, Peer
+from pyjabber.plugins.xep_0352.xep_0352 import (
+    CSI,
+    CSIMetrics,
+    CSITransport,
+    classify,
+)
+from pyjabber.stream.JID import JID
+from pyjabber.utils import Singleton
+
+JULIET = JID("juliet@localhost/phone")
+
+
+class Transport:
+    def __init__(self):
+        self.writes = []
+
+    def write(self, data: bytes):
+        self.writes.append(data)
+
+    def is_closing(self) -> bool:
+        return False
+
+
+@pytest.fixture
+def session():
+    for cls in (CSI, CSIMetrics, ConnectionManager):
+        Singleton._instances.pop(cls, None)
+
+    connections = ConnectionManager()
+    transport = Transport()
+    peer = Peer("127.0.0.1", 5000)
+    connections.connection(peer, transport)
+    connections.set_jid(peer, JULIET, transport)
+
+    yield connections, transport
+
+    for cls in (CSI, CSIMetrics, ConnectionManager):
+        Singleton._instances.pop(cls, None)
+
+
+def presence(sender: str, show: str = None, type_: str = None) -> bytes:
+    element = ET.Element("presence", attrib={"from": sender, "to": JULIET.bare()})
+    if type_:
+        element.attrib["type"] = type_
+    if show:
+        ET.SubElement(element, "show").text = show
+    return ET.tostring(element)
+
+
+def chat(body: str) -> bytes:
+    return (
+        f"<message from='romeo@localhost' type='chat'><body>{body}</body></message>"
+    ).encode()
+
+
+EVENT = (
+    b"<message from='pubsub.localhost'>"
+    b"<event xmlns='http://jabber.org/protocol/pubsub#event'><items node='n'/></event>"
+    b"</message>"
+)
+COMPOSING = (
+    b"<message from='romeo@localhost/r' type='chat'>"
+    b"<composing xmlns='http://jabber.org/protocol/chatstates'/></message>"
+)
+
+
+def test_classify():
+    def kind(data: bytes):
+        return classify(ET.fromstring(data))
+
+    assert kind(presence("romeo@localhost/r")) == "romeo@localhost/r"
+    assert (
+        kind(presence("romeo@localhost/r", type_="unavailable")) == "romeo@localhost/r"
+    )
+    assert kind(presence("romeo@localhost", type_="subscribe")) is False
+    assert kind(EVENT) is True
+    assert kind(COMPOSING) is True
+    assert kind(chat("hi")) is False
+    assert kind(b"<iq type='get' id='1'/>") is False
+
+
+def test_inactive_held_and_collapsed(session):
+    connections, transport = session
+    metrics = CSIMetrics()
+    csi = CSI()
+
+    held = csi.feed(JULIET, ET.Element("{urn:xmpp:csi:0}inactive"))
+    assert isinstance(held, CSITransport)
+    assert connections.get_transport(JULIET)[0].transport is held
+
+    for show in ("away", "xa", "dnd"):
+        held.write(presence("romeo@localhost/r", show))
+    held.write(EVENT)
+    held.write(presence("mercutio@localhost/m"))
+    # A batch of presences in the same write, as the presence worker does
+    held.write(
+        presence("romeo@localhost/r", type_="unavailable")
+        + presence("tybalt@localhost/t")
+    )
+    held.write(COMPOSING)
+
+    assert transport.writes == []
+    assert len(held) == 5
+    assert metrics.suppressed == 3
+
+    # An urgent stanza takes the held ones with it, in order
+    held.write(chat("hello"))
+    assert len(transport.writes) == 1
+    stanzas = list(ET.fromstring(b"<s>" + transport.writes[0] + b"</s>"))
+    assert [(s.tag, s.attrib.get("from"), s.attrib.get("type")) for s in stanzas] == [
+        ("message", "pubsub.localhost", None),
+        ("presence", "mercutio@localhost/m", None),
+        ("presence", "romeo@localhost/r", "unavailable"),
+        ("presence", "tybalt@localhost/t", None),
+        ("message", "romeo@localhost/r", "chat"),
+        ("message", "romeo@localhost", "chat"),
+    ]
+    assert metrics.stats() == {
+        "held": 8,
+        "suppressed": 3,
+        "flushed": 5,
+        "flushes": 1,
+    }
+
+
+def test_active_flushes(session):
+    connections, transport = session
+    csi = CSI()
+
+    held = csi.feed(JULIET, ET.Element("{urn:xmpp:csi:0}inactive"))
+    assert csi.feed(JULIET, ET.Element("{urn:xmpp:csi:0}inactive")) is held
+    held.write(presence("romeo@localhost/r", "away"))
+    held.write(presence("romeo@localhost/r", "chat"))
+
+    restored = csi.feed(JULIET, ET.Element("{urn:xmpp:csi:0}active"))
+    assert restored is transport
+    assert connections.get_transport(JULIET)[0].transport is transport
+    assert transport.writes == [presence("romeo@localhost/r", "chat")]
+
+    # Active again, nothing is held
+    connections.get_transport(JULIET)[0].transport.write(EVENT)
+    assert transport.writes[-1] == EVENT
+    assert csi.feed(JID("nobody@localhost/x"), ET.Element("active")) is None
@@ -0,0 +1,414 @@
+import asyncio
+from types import SimpleNamespace
+from unittest.mock import patch
+from xml.etree import ElementTree as ET
+
+import pytest
+from sqlalchemy import insert, select
+
+from pyjabber.db.database import DB
+from pyjabber.db.model import Model
+from pyjabber.plugins.xep_0059.xep_0059 import NAMESPACE as RSM
+from pyjabber.plugins.xep_0059.xep_0059 import ResultSetRequest
+from pyjabber.plugins.xep_0060.items import NodeItems
+from pyjabber.plugins.xep_0060.xep_0060 import PubSub
+from pyjabber.queues.QueueManager import QueueManager, QueueName
+from pyjabber.stream.JID import JID
+from pyjabber.utils import Singleton
+
+PUBSUB = "http://jabber.org/protocol/pubsub"
+ERRORS = "urn:ietf:params:xml:ns:xmpp-stanzas"
+
+
+@pytest.fixture
+async def pubsub():
+    config = SimpleNamespace(
+        host="localhost",
+        items={
+            "pubsub.$": {
+                "name": "Pubsub Service",
+                "category": "pubsub",
+                "type": "service",
+                "var": PUBSUB,
+            }
+        },
+        database_in_memory=True,
+        database_debug=False,
+        database_write_timeout=5.0,
+        database_read_timeout=5.0,
+        database_readers=1,
+        database_shards=1,
+    )
+    with patch("pyjabber.AppConfig.app_config", config):
+        Singleton._instances.pop(PubSub, None)
+        QueueManager._queues.pop(QueueName.NOTIFICATIONS, None)
+        await DB.setup_database()
+
+        async with DB.writer() as con:
+            await con.execute(
+                insert(Model.Pubsub).values(
+                    node="news", owner="demo", name="News", type="leaf", max_items=10
+                )
+            )
+            await con.execute(
+                insert(Model.PubsubSubscribers).values(
+                    [
+                        ("news", "alice", "s1", "subscribed", "publisher"),
+                        ("news", "bob", "s2", "subscribed", "member"),
+                    ]
+                )
+            )
+
+        service = PubSub()
+        await service.update_memory_from_database()
+        yield service
+
+        Singleton._instances.pop(PubSub, None)
+        await DB.close_engine_async()
+
+
+def iq(operation: str, sender: str, **attrib) -> ET.Element:
+    element = ET.Element("iq", attrib={"type": "set", "id": "1", "from": sender})
+    namespace = PUBSUB + "#owner" if operation in ("delete", "purge") else PUBSUB
+    pubsub = ET.SubElement(element, f"{{{namespace}}}pubsub")
+    ET.SubElement(pubsub, f"{{{namespace}}}{operation}", attrib=attrib)
+    return element
+
+
+async def stored_subscriptions() -> set:
+    async with DB.reader() as con:
+        res = await con.execute(select(Model.PubsubSubscribers))
+        return {tuple(row) for row in res.fetchall()}
+
+
+def indexed_subscriptions(service: PubSub) -> set:
+    by_node = {s for subs in service._subscribers.values() for s in subs.values()}
+    by_jid = {s for subs in service._subscriptions.values() for s in subs.values()}
+    assert by_node == by_jid == set(service._subids.values())
+    return by_node
+
+
+async def test_registry_loaded(pubsub):
+    assert pubsub._nodes == {"news": ("news", "demo", "News", "leaf", 10)}
+    assert set(pubsub._subscribers["news"]) == {"s1", "s2"}
+    assert set(pubsub._subscriptions) == {"alice", "bob"}
+    assert indexed_subscriptions(pubsub) == await stored_subscriptions()
+
+
+async def test_registry_follows_mutations(pubsub):
+    jid = JID("carol@localhost")
+
+    await pubsub.create_node(iq("create", str(jid), node="blog"), jid)
+    assert pubsub._nodes["blog"] == ("blog", "carol", None, "leaf", 1024)
+    assert pubsub.discover_info("blog") == (None, "leaf")
+
+    await pubsub.subscribe(iq("subscribe", str(jid), node="news", jid=str(jid)), jid)
+    await pubsub.subscribe(iq("subscribe", str(jid), node="blog", jid=str(jid)), jid)
+    assert {s[0] for s in pubsub._subscriptions["carol"].values()} == {"news", "blog"}
+    assert indexed_subscriptions(pubsub) == await stored_subscriptions()
+
+    await pubsub.unsubscribe(
+        iq("unsubscribe", str(jid), node="news", jid=str(jid)), jid
+    )
+    assert [s[0] for s in pubsub._subscriptions["carol"].values()] == ["blog"]
+    assert indexed_subscriptions(pubsub) == await stored_subscriptions()
+
+    await pubsub.delete_node(iq("delete", str(jid), node="blog"), jid)
+    assert "blog" not in pubsub._nodes and "blog" not in pubsub._subscribers
+    assert "carol" not in pubsub._subscriptions
+    assert indexed_subscriptions(pubsub) == await stored_subscriptions()
+
+
+async def test_create_node_race(pubsub):
+    carol, dave = JID("carol@localhost"), JID("dave@localhost")
+
+    results = await asyncio.gather(
+        pubsub.create_node(iq("create", str(carol), node="blog"), carol),
+        pubsub.create_node(iq("create", str(dave), node="blog"), dave),
+    )
+
+    types = [ET.fromstring(r).attrib["type"] for r in results]
+    assert sorted(types) == ["error", "result"]
+    assert pubsub._nodes["blog"][1] == ("carol" if types[0] == "result" else "dave")
+
+
+async def test_retrieve_subscriptions_from_registry(pubsub):
+    jid = JID("alice@localhost")
+    res = ET.fromstring(
+        await pubsub.retrieve_subscriptions(iq("subscriptions", str(jid)), jid)
+    )
+
+    subs = res.findall(f".//{{{PUBSUB}}}subscription")
+    assert [s.attrib for s in subs] == [
+        {
+            "node": "news",
+            "jid": "alice@localhost",
+            "subscription": "subscribed",
+            "subid": "s1",
+        }
+    ]
+
+
+async def test_notification_enqueued(pubsub):
+    pubsub.send_notification(node="news", payload=ET.Element("entry"), item_id="i1")
+
+    queue = QueueManager.get_queue(QueueName.NOTIFICATIONS)
+    assert queue.qsize() == 1
+
+    notification = queue.get_nowait()
+    assert notification.node == "news"
+    assert sorted(notification.receivers) == ["alice", "bob"]
+    assert notification.event.find("items/item").attrib == {"id": "i1"}
+
+
+def publish(node: str, item_id: str) -> ET.Element:
+    element = iq("publish", "demo@localhost", node=node)
+    item = ET.SubElement(element[0][0], f"{{{PUBSUB}}}item", attrib={"id": item_id})
+    ET.SubElement(item, "{urn:example}entry").text = item_id
+    return element
+
+
+async def item_ids(service: PubSub, max_items: int = None) -> list:
+    attrib = {"node": "news"}
+    if max_items is not None:
+        attrib["max_items"] = str(max_items)
+    jid = JID("demo@localhost")
+    res = ET.fromstring(
+        await service.retrieve_items_node(iq("items", str(jid), **attrib), jid)
+    )
+    return [i.attrib["id"] for i in res.iter(f"{{{PUBSUB}}}item")]
+
+
+async def stored_item_ids() -> list:
+    async with DB.reader() as con:
+        res = await con.execute(
+            select(Model.PubsubItems.c.item_id).order_by(Model.PubsubItems.c.seq)
+        )
+        return [row[0] for row in res.fetchall()]
+
+
+def test_node_items_ring():
+    node_items = NodeItems(max_items=3)
+    for i in range(5):
+        node_items.push(str(i), ET.Element("entry"), replaced=False)
+    node_items.push("2", ET.Element("entry"), replaced=True)
+
+    assert list(node_items.recent) == ["3", "4", "2"]
+    assert node_items.last[0] == "2"
+    assert node_items.stored == 5
+    assert [i for i, _ in node_items.newest()] == ["3", "4", "2"]
+    assert [i for i, _ in node_items.newest(2)] == ["4", "2"]
+
+    # The oldest item of a full listing is only stored in the database
+    node_items.remove("4")
+    assert [i for i, _ in node_items.newest(2)] == ["3", "2"]
+    assert node_items.newest() is None
+
+
+async def test_publish_enforces_max_items(pubsub):
+    jid = JID("demo@localhost")
+    with patch("pyjabber.plugins.xep_0060.items.EVICT_BATCH", 2):
+        for i in range(13):
+            await pubsub.publish(publish("news", f"i{i}"), jid)
+
+    # max_items is 10, the oldest ones are deleted two at a time
+    assert await stored_item_ids() == [f"i{i}" for i in range(2, 13)]
+
+    with patch.object(DB, "reader", side_effect=AssertionError("not cached")):
+        assert await item_ids(pubsub) == [f"i{i}" for i in range(3, 13)]
+        assert await item_ids(pubsub, max_items=2) == ["i11", "i12"]
+
+    await pubsub.publish(publish("news", "i5"), jid)
+    await pubsub.retract(iq("retract", str(jid), node="news"), jid)  # No item
+    element = iq("retract", str(jid), node="news")
+    ET.SubElement(element[0][0], f"{{{PUBSUB}}}item", attrib={"id": "i12"})
+    await pubsub.retract(element, jid)
+
+    assert (await item_ids(pubsub))[-3:] == ["i10", "i11", "i5"]
+
+
+async def test_item_sequence(pubsub):
+    jid = JID("demo@localhost")
+    for item_id in ("i0", "i1", "i0"):
+        await pubsub.publish(publish("news", item_id), jid)
+
+    # Published again, the item moves to the newest position
+    async with DB.reader() as con:
+        res = await con.execute(
+            select(
+                Model.PubsubItems.c.item_id,
+                Model.PubsubItems.c.seq,
+                Model.PubsubItems.c.published,
+            ).order_by(Model.PubsubItems.c.seq)
+        )
+        rows = res.fetchall()
+    assert [(item_id, seq) for item_id, seq, _ in rows] == [("i1", 2), ("i0", 3)]
+    assert all(published > 0 for _, _, published in rows)
+
+    # The sequence goes on after reloading the node
+    pubsub._items.clear()
+    await pubsub.publish(publish("news", "i2"), jid)
+    assert pubsub._items["news"].seq == 4
+    assert await stored_item_ids() == ["i1", "i0", "i2"]
+
+
+async def test_items_not_cached(pubsub):
+    jid = JID("demo@localhost")
+    with patch("pyjabber.plugins.xep_0060.items.CACHED_ITEMS", 2):
+        for i in range(4):
+            await pubsub.publish(publish("news", f"i{i}"), jid)
+
+    assert list(pubsub._items["news"].recent) == ["i2", "i3"]
+    assert await item_ids(pubsub, max_items=3) == ["i1", "i2", "i3"]
+
+    # Reloaded from the database
+    pubsub._items.clear()
+    assert await item_ids(pubsub) == ["i0", "i1", "i2", "i3"]
+
+
+async def test_subscribers_read_items(pubsub):
+    await pubsub.publish(publish("news", "i0"), JID("demo@localhost"))
+
+    for user in ("alice", "bob", "carol"):
+        jid = JID(f"{user}@localhost")
+        res = ET.fromstring(
+            await pubsub.retrieve_items_node(iq("items", str(jid), node="news"), jid)
+        )
+        items = [i.attrib["id"] for i in res.iter(f"{{{PUBSUB}}}item")]
+        if user == "carol":  # Not subscribed
+            assert res.find(f".//{{{ERRORS}}}forbidden") is not None
+        else:
+            assert items == ["i0"]
+
+
+async def test_last_item_to_new_subscriber(pubsub):
+    await pubsub.publish(publish("news", "first"), JID("demo@localhost"))
+    await pubsub.publish(publish("news", "last"), JID("demo@localhost"))
+    queue = QueueManager.get_queue(QueueName.NOTIFICATIONS)
+    while queue.qsize():
+        queue.get_nowait()
+
+    jid = JID("carol@localhost")
+    await pubsub.subscribe(iq("subscribe", str(jid), node="news", jid=str(jid)), jid)
+
+    notification = queue.get_nowait()
+    assert notification.receivers == ("carol",)
+    assert notification.event.find("items/item").attrib == {"id": "last"}
+
+
+async def test_last_item_not_cached(pubsub):
+    jid = JID("demo@localhost")
+    with patch("pyjabber.plugins.xep_0060.items.CACHED_ITEMS", 1):
+        await pubsub.publish(publish("news", "first"), jid)
+        await pubsub.publish(publish("news", "last"), jid)
+    element = iq("retract", str(jid), node="news")
+    ET.SubElement(element[0][0], f"{{{PUBSUB}}}item", attrib={"id": "last"})
+    await pubsub.retract(element, jid)
+    assert not pubsub._items["news"].recent
+
+    queue = QueueManager.get_queue(QueueName.NOTIFICATIONS)
+    while queue.qsize():
+        queue.get_nowait()
+
+    carol = JID("carol@localhost")
+    await pubsub.subscribe(
+        iq("subscribe", str(carol), node="news", jid=str(carol)), carol
+    )
+
+    notification = queue.get_nowait()
+    assert notification.event.find("items/item").attrib == {"id": "first"}
+
+
+async def items_page(service: PubSub, rsm: str, **attrib) -> tuple:
+    element = iq("items", "demo@localhost", node="news", **attrib)
+    ET.SubElement(element[0], f"{{{RSM}}}set").extend(
+        ET.fromstring(f"<s xmlns='{RSM}'>{rsm}</s>")
+    )
+    res = ET.fromstring(
+        await service.retrieve_items_node(element, JID("demo@localhost"))
+    )
+
+    if res.attrib["type"] == "error":
+        return res[0][0].tag, None
+    rsm_res = res.find(f".//{{{RSM}}}set")
+    first = rsm_res.find(f"{{{RSM}}}first")
+    return (
+        [i.attrib["id"] for i in res.iter(f"{{{PUBSUB}}}item")],
+        (
+            None if first is None else first.attrib.get("index"),
+            rsm_res.find(f"{{{RSM}}}count").text,
+        ),
+    )
+
+
+async def test_items_rsm(pubsub):
+    with patch("pyjabber.plugins.xep_0060.items.CACHED_ITEMS", 2):
+        for i in range(10):
+            await pubsub.publish(publish("news", f"i{i}"), JID("demo@localhost"))
+
+    # max_items of the node is 10
+    assert await items_page(pubsub, "<max>3</max>") == (["i0", "i1", "i2"], ("0", "10"))
+    assert await items_page(pubsub, "<max>3</max><after>i2</after>") == (
+        ["i3", "i4", "i5"],
+        (None, "10"),
+    )
+    assert await items_page(pubsub, "<max>3</max><before>i3</before>") == (
+        ["i0", "i1", "i2"],
+        (None, "10"),
+    )
+    assert await items_page(pubsub, "<max>3</max><before/>") == (
+        ["i7", "i8", "i9"],
+        ("7", "10"),
+    )
+    assert await items_page(pubsub, "<max>4</max><index>8</index>") == (
+        ["i8", "i9"],
+        ("8", "10"),
+    )
+    assert await items_page(pubsub, "<max>0</max>") == ([], (None, "10"))
+
+    # The result set is limited to the newest max_items
+    assert await items_page(pubsub, "<max>2</max>", max_items="4") == (
+        ["i6", "i7"],
+        ("0", "4"),
+    )
+    not_found = "{urn:ietf:params:xml:ns:xmpp-stanzas}item-not-found"
+    assert (await items_page(pubsub, "<after>i1</after>", max_items="4"))[0] == (
+        not_found
+    )
+    assert (await items_page(pubsub, "<after>missing</after>"))[0] == not_found
+
+
+async def test_items_truncated_without_rsm(pubsub):
+    for i in range(5):
+        await pubsub.publish(publish("news", f"i{i}"), JID("demo@localhost"))
+
+    with patch("pyjabber.plugins.xep_0060.xep_0060.ResultSetRequest") as request:
+        request.return_value = ResultSetRequest(max=2, before="")
+        jid = JID("demo@localhost")
+        res = ET.fromstring(
+            await pubsub.retrieve_items_node(iq("items", str(jid), node="news"), jid)
+        )
+
+    assert [i.attrib["id"] for i in res.iter(f"{{{PUBSUB}}}item")] == ["i3", "i4"]
+    assert res.find(f".//{{{RSM}}}first").attrib == {"index": "3"}
+    assert res.find(f".//{{{RSM}}}count").text == "5"
+
+
+async def test_subscriptions_rsm(pubsub):
+    for node in ("n1", "n2", "n3"):
+        pubsub._index_node((node, "demo", None, "leaf", 10))
+        pubsub._index_subscription(
+            (node, "alice", f"{node}-sub", "subscribed", "member")
+        )
+
+    jid = JID("alice@localhost")
+    element = iq("subscriptions", str(jid))
+    ET.SubElement(element[0], f"{{{RSM}}}set").extend(
+        ET.fromstring(f"<s xmlns='{RSM}'><max>2</max><after>s1</after></s>")
+    )
+    res = ET.fromstring(await pubsub.retrieve_subscriptions(element, jid))
+
+    subs = res.findall(f".//{{{PUBSUB}}}subscription")
+    assert [s.attrib["subid"] for s in subs] == ["n1-sub", "n2-sub"]
+    assert res.find(f".//{{{RSM}}}first").attrib == {"index": "1"}
+    assert res.find(f".//{{{RSM}}}count").text == "4"
@@ -0,0 +1,156 @@
+import asyncio
+import time
+from types import SimpleNamespace
+from unittest.mock import MagicMock, patch
+from xml.etree import ElementTree as ET
+
+import pytest
+
+from pyjabber.network.ConnectionManager import Client
+from pyjabber.queues.PendingNotification import PendingNotificationWrapper
+from pyjabber.queues.QueueManager import QueueManager, QueueName, get_queue
+from pyjabber.queues.workers.NotificationWorker import (
+    FANOUT_BATCH,
+    NotificationMetrics,
+    fanout,
+    notification_worker,
+    serialize,
+)
+from pyjabber.utils import Singleton
+
+EVENT_NS = "http://jabber.org/protocol/pubsub#event"
+
+
+def event(node: str = "news") -> ET.Element:
+    element = ET.Element("event", attrib={"xmlns": EVENT_NS})
+    items = ET.SubElement(element, "items", attrib={"node": node})
+    item = ET.SubElement(items, "item", attrib={"id": "1"})
+    ET.SubElement(item, "{urn:example}entry").text = "hello"
+    return element
+
+
+def notification(receivers, node: str = "news") -> PendingNotificationWrapper:
+    NotificationMetrics().pending_receivers += len(receivers)
+    return PendingNotificationWrapper(
+        node=node,
+        event=event(node),
+        receivers=tuple(receivers),
+        created=time.monotonic(),
+    )
+
+
+@pytest.fixture
+def connections():
+    """
+    Every receiver is online with two resources (a and b), except the ones
+    named offline*
+    """
+    transports = {}
+
+    def get_transport(jid):
+        if jid.user.startswith("offline"):
+            return []
+        return [
+            Client(jid, transports.setdefault((jid.user, r), MagicMock()), True)
+            for r in ([jid.resource] if jid.resource else ["a", "b"])
+        ]
+
+    config = SimpleNamespace(host="localhost")
+    with (
+        patch("pyjabber.AppConfig.app_config", config),
+        patch(
+            "pyjabber.queues.workers.NotificationWorker.ConnectionManager"
+        ) as mock_manager,
+    ):
+        Singleton._instances.pop(NotificationMetrics, None)
+        QueueManager._queues.pop(QueueName.NOTIFICATIONS, None)
+        mock_manager.return_value.get_transport.side_effect = get_transport
+        yield transports
+
+
+def written(transport: MagicMock) -> ET.Element:
+    transport.write.assert_called_once()
+    return ET.fromstring(transport.write.call_args.args[0])
+
+
+def test_serialize_once(connections):
+    head, tail = serialize(event())
+    message = ET.fromstring(head + b' to="demo@localhost"' + tail)
+
+    assert message.tag == "message"
+    assert message.attrib["to"] == "demo@localhost"
+    assert message.attrib["from"] == "localhost"
+    assert message.find(f"{{{EVENT_NS}}}event/{{{EVENT_NS}}}items").attrib == {
+        "node": "news"
+    }
+    assert message.find(".//{urn:example}entry").text == "hello"
+
+
+async def test_fanout(connections):
+    receivers = [f"user{i}" for i in range(FANOUT_BATCH * 2 + 10)] + ["offline"]
+
+    ticks = 0
+
+    async def ticker():
+        nonlocal ticks
+        while True:
+            ticks += 1
+            await asyncio.sleep(0)
+
+    task = asyncio.create_task(ticker())
+    await asyncio.sleep(0)
+    await fanout(notification(receivers))
+    task.cancel()
+
+    # The loop was released between the batches
+    assert ticks >= 3
+
+    assert len(connections) == (len(receivers) - 1) * 2
+    for (user, _), transport in connections.items():
+        assert written(transport).attrib["to"] == f"{user}@localhost"
+
+    stats = NotificationMetrics().stats()
+    assert stats["events"] == 1
+    assert stats["deliveries"] == len(connections)
+    assert stats["pending_receivers"] == 0
+    assert stats["latency_last_ms"] > 0
+
+
+async def test_worker(connections):
+    queue = get_queue(QueueName.NOTIFICATIONS)
+    queue.put_nowait(notification(["alice"], node="first"))
+    queue.put_nowait(notification(["alice"], node="second"))
+    assert NotificationMetrics().stats()["queue_depth"] == 2
+
+    task = asyncio.create_task(notification_worker())
+    while queue.qsize() or NotificationMetrics().events < 2:
+        await asyncio.sleep(0)
+    task.cancel()
+    await task
+
+    nodes = [
+        ET.fromstring(call.args[0]).find(f".//{{{EVENT_NS}}}items").attrib["node"]
+        for call in connections[("alice", "a")].write.call_args_list
+    ]
+    assert nodes == ["first", "second"]
+    assert NotificationMetrics().stats()["pending_receivers"] == 0
+
+
+async def test_fanout_pep(connections):
+    NotificationMetrics().pending_receivers += 2
+    await fanout(
+        PendingNotificationWrapper(
+            node="news",
+            event=event(),
+            receivers=("alice@localhost/a", "offline@localhost/a"),
+            created=time.monotonic(),
+            sender="bob@localhost",
+        )
+    )
+
+    # Only the session that asked for it
+    assert set(connections) == {("alice", "a")}
+    message = written(connections[("alice", "a")])
+    assert message.attrib["to"] == "alice@localhost/a"
+    assert message.attrib["from"] == "bob@localhost"
+    assert NotificationMetrics().stats()["pending_receivers"] == 0
@@ -0,0 +1,126 @@
+import asyncio
+from types import SimpleNamespace
+from unittest.mock import patch
+from xml.etree import ElementTree as ET
+
+import pytest
+
+from pyjabber.features.presence.PresenceFeature import Presence
+from pyjabber.network.ConnectionManager import ConnectionManager, Peer
+from pyjabber.queues.QueueManager import QueueManager, QueueName, get_queue
+from pyjabber.queues.workers.PresenceWorker import presence_worker
+from pyjabber.stream.JID import JID
+from pyjabber.utils import Singleton
+
+ROSTERS = {
+    "romeo": ["juliet"],
+    "juliet": ["romeo"],
+}
+
+
+class Transport:
+    def __init__(self):
+        self.writes = []
+        self.closing = False
+
+    def write(self, data: bytes):
+        self.writes.append(data)
+
+    def is_closing(self) -> bool:
+        return self.closing
+
+
+def roster_by_jid(jid: JID):
+    return [
+        {"id": 1, "item": f'<item jid="{contact}" subscription="both"/>'}
+        for contact in ROSTERS.get(jid.user, [])
+    ]
+
+
+@pytest.fixture
+async def server():
+    config = SimpleNamespace(host="localhost", plugins=[])
+    with (
+        patch("pyjabber.AppConfig.app_config", config),
+        patch("pyjabber.features.presence.PresenceFeature.Roster") as roster,
+        patch("pyjabber.queues.workers.PresenceWorker.COALESCE_WINDOW", 0),
+    ):
+        roster.return_value.roster_by_jid.side_effect = roster_by_jid
+        for cls in (Presence, ConnectionManager):
+            Singleton._instances.pop(cls, None)
+        for name in (QueueName.CONNECTIONS, QueueName.PRESENCE):
+            QueueManager._queues.pop(name, None)
+
+        connections = ConnectionManager()
+        presence = Presence()
+        transports = {}
+        ports = iter(range(5000, 6000))
+
+        async def bind(full: str) -> Transport:
+            peer = Peer("127.0.0.1", next(ports))
+            transports[full] = Transport()
+            connections.connection(peer, transports[full])
+            connections.set_jid(peer, JID(full))
+            await presence.feed(JID(full), ET.Element("presence"))
+            return transports[full]
+
+        for full in ("romeo@localhost/phone", "romeo@localhost/laptop"):
+            await bind(full)
+        for full in ("juliet@localhost/a", "juliet@localhost/b"):
+            await bind(full)
+
+        yield presence, bind, transports
+
+        for cls in (Presence, ConnectionManager):
+            Singleton._instances.pop(cls, None)
+        for name in (QueueName.CONNECTIONS, QueueName.PRESENCE):
+            QueueManager._queues.pop(name, None)
+
+
+def lose(transport: Transport, full: str):
+    transport.closing = True
+    get_queue(QueueName.PRESENCE).put_nowait(
+        (JID(full), ET.Element("presence", attrib={"type": "INTERNAL"}))
+    )
+
+
+async def test_coalesced_disconnects(server):
+    presence, bind, transports = server
+    for transport in transports.values():
+        transport.writes.clear()
+
+    lose(transports["romeo@localhost/phone"], "romeo@localhost/phone")
+    lose(transports["romeo@localhost/laptop"], "romeo@localhost/laptop")
+    lose(transports["juliet@localhost/b"], "juliet@localhost/b")
+
+    # Juliet comes back with the same resource before the batch is processed
+    back = await bind("juliet@localhost/b")
+    for transport in transports.values():
+        transport.writes.clear()
+    lose(transports["romeo@localhost/phone"], "romeo@localhost/phone")
+
+    task = asyncio.create_task(presence_worker())
+    await asyncio.sleep(0.05)
+    task.cancel()
+    await task
+
+    # Every unavailable presence of the batch, in a single write per receiver
+    for transport in (transports["juliet@localhost/a"], back):
+        assert len(transport.writes) == 1
+        stanzas = ET.fromstring(b"<batch>" + transport.writes[0] + b"</batch>")
+        assert sorted(p.attrib["from"] for p in stanzas) == [
+            "romeo@localhost/laptop",
+            "romeo@localhost/phone",
+        ]
+        assert {p.attrib["type"] for p in stanzas} == {"unavailable"}
+        assert {p.attrib["to"] for p in stanzas} == {"juliet@localhost"}
+
+    # Lost sessions get nothing, and juliet/b never left
+    assert transports["romeo@localhost/phone"].writes == []
+    assert transports["romeo@localhost/laptop"].writes == []
+    assert presence.priority_by_jid(JID("romeo@localhost")) == []
+    assert [r.resource for r in presence.most_priority(JID("juliet@localhost"))] == [
+        "a",
+        "b",
+    ]
+    assert get_queue(QueueName.PRESENCE).empty()
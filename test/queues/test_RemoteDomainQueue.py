@@ -0,0 +1,223 @@
+import asyncio
+from unittest.mock import MagicMock, patch
+from xml.etree import ElementTree as ET
+
+import pytest
+
+from pyjabber.queues.FailedRemoteConnection import FailedRemoteConnectionWrapper
+from pyjabber.queues.NewConnection import NewConnectionWrapper
+from pyjabber.queues.PendingMessage import PendingMessageWrapper
+from pyjabber.queues.RemoteDomainQueue import RemoteDomainQueue, RemoteStreamState
+from pyjabber.queues.workers import MessageQueueWorker
+from pyjabber.queues.workers.MessageQueueWorker import bounce_stanzas, queue_worker
+from pyjabber.stream.JID import JID
+
+
+def stanza(i: int) -> bytes:
+    return (
+        f"<message xmlns='jabber:server' from='demo@localhost/res' "
+        f"to='user@remote.com' id='{i}'><body>{i}</body></message>"
+    ).encode()
+
+
+def test_put_bounded():
+    queue = RemoteDomainQueue("remote.com", max_size=2)
+    assert queue.put(JID("user@remote.com"), stanza(1))
+    assert queue.put(JID("user@remote.com"), stanza(2))
+    assert not queue.put(JID("user@remote.com"), stanza(3))
+    assert len(queue) == 2
+
+
+def test_state_lifecycle():
+    queue = RemoteDomainQueue("remote.com")
+    assert queue.state == RemoteStreamState.IDLE
+    queue.connecting()
+    assert queue.state == RemoteStreamState.CONNECTING
+    queue.flush(MagicMock())
+    assert queue.state == RemoteStreamState.READY
+    queue.reset()
+    assert queue.state == RemoteStreamState.IDLE
+
+
+def test_flush_batches_in_order():
+    queue = RemoteDomainQueue("remote.com", batch_size=len(stanza(1)) * 2)
+    for i in range(5):
+        queue.put(JID("user@remote.com"), stanza(i))
+
+    transport = MagicMock()
+    assert queue.flush(transport) == 5
+    assert len(queue) == 0
+
+    writes = [c.args[0] for c in transport.write.call_args_list]
+    assert len(writes) == 3
+    assert b"".join(writes) == b"".join(stanza(i) for i in range(5))
+
+
+def test_expired():
+    queue = RemoteDomainQueue("remote.com", ttl=10)
+    with patch("pyjabber.queues.RemoteDomainQueue.time.monotonic") as mock_time:
+        mock_time.return_value = 100
+        queue.put(JID("user@remote.com"), stanza(1))
+        mock_time.return_value = 105
+        queue.put(JID("user@remote.com"), stanza(2))
+
+        mock_time.return_value = 111
+        expired = queue.expired()
+        assert [p for _, p in expired] == [stanza(1)]
+        assert len(queue) == 1
+        assert queue.next_expiry() == 4
+
+
+def test_drain():
+    queue = RemoteDomainQueue("remote.com")
+    queue.put(JID("user@remote.com"), stanza(1))
+    assert queue.drain() == [(JID("user@remote.com"), stanza(1))]
+    assert len(queue) == 0
+
+
+def test_bounce_stanzas():
+    with patch(
+        "pyjabber.queues.workers.MessageQueueWorker.ConnectionManager"
+    ) as mock_cm:
+        client = MagicMock()
+        mock_cm.return_value.get_transport.return_value = [client]
+
+        bounce_stanzas([(JID("user@remote.com"), stanza(1))], "remote-server-timeout")
+
+        mock_cm.return_value.get_transport.assert_called_with(JID("demo@localhost/res"))
+        bounce = ET.fromstring(client.transport.write.call_args.args[0])
+        assert bounce.tag == "{jabber:client}message"
+        assert bounce.attrib["type"] == "error"
+        assert bounce.attrib["to"] == "demo@localhost/res"
+        assert bounce.attrib["from"] == "user@remote.com"
+        error = bounce.find("error")
+        assert error.attrib["type"] == "wait"
+        assert (
+            error.find("{urn:ietf:params:xml:ns:xmpp-stanzas}remote-server-timeout")
+            is not None
+        )
+
+
+@pytest.fixture
+def worker_env():
+    queues = {
+        "connections": asyncio.Queue(),
+        "messages": asyncio.Queue(),
+        "servers": asyncio.Queue(),
+    }
+    with (
+        patch("pyjabber.queues.workers.MessageQueueWorker.AppConfig") as mock_config,
+        patch(
+            "pyjabber.queues.workers.MessageQueueWorker.ConnectionManager"
+        ) as mock_cm,
+        patch(
+            "pyjabber.queues.workers.MessageQueueWorker.get_queue",
+            side_effect=lambda name: queues[name.value],
+        ),
+        patch(
+            "pyjabber.queues.workers.MessageQueueWorker.bounce_stanzas"
+        ) as mock_bounce,
+    ):
+        mock_config.app_config.s2s_queue_size = 2
+        mock_config.app_config.s2s_queue_ttl = 30
+        mock_cm.return_value.get_server_transport_host.return_value = None
+        yield queues, mock_cm.return_value, mock_bounce
+
+
+async def run_worker(queues, items):
+    task = asyncio.create_task(queue_worker())
+    for queue, item in items:
+        await queues[queue].put(item)
+        await asyncio.sleep(0.01)
+    task.cancel()
+    await task
+
+
+async def test_worker_dials_once_and_flushes(worker_env):
+    queues, connection_manager, _ = worker_env
+    jid = JID("user@remote.com")
+
+    task = asyncio.create_task(queue_worker())
+    for i in range(2):
+        await queues["messages"].put(
+            PendingMessageWrapper(jid, stanza(i), "remote.com")
+        )
+        await asyncio.sleep(0.01)
+    assert queues["servers"].qsize() == 1
+
+    transport = MagicMock()
+    connection_manager.get_server_transport_host.return_value = transport
+    await queues["connections"].put(NewConnectionWrapper("remote.com", False))
+    await asyncio.sleep(0.01)
+    await queues["messages"].put(PendingMessageWrapper(jid, stanza(2), "remote.com"))
+    await asyncio.sleep(0.01)
+    task.cancel()
+    await task
+
+    writes = [c.args[0] for c in transport.write.call_args_list]
+    assert writes == [stanza(0) + stanza(1), stanza(2)]
+
+
+async def test_worker_bounces_on_overflow_and_failure(worker_env):
+    queues, _, mock_bounce = worker_env
+    jid = JID("user@remote.com")
+
+    await run_worker(
+        queues,
+        [
+            ("messages", PendingMessageWrapper(jid, stanza(1), "remote.com")),
+            ("messages", PendingMessageWrapper(jid, stanza(2), "remote.com")),
+            ("messages", PendingMessageWrapper(jid, stanza(3), "remote.com")),
+            (
+                "connections",
+                FailedRemoteConnectionWrapper("remote.com", "remote-server-not-found"),
+            ),
+        ],
+    )
+
+    assert mock_bounce.call_args_list[0].args == (
+        [(jid, stanza(3))],
+        "resource-constraint",
+    )
+    assert mock_bounce.call_args_list[1].args == (
+        [(jid, stanza(1)), (jid, stanza(2))],
+        "remote-server-not-found",
+    )
+
+
+async def test_worker_dials_again_after_timeout(worker_env):
+    queues, connection_manager, mock_bounce = worker_env
+    MessageQueueWorker.AppConfig.app_config.s2s_queue_ttl = 0.1
+    jid = JID("user@remote.com")
+
+    task = asyncio.create_task(queue_worker())
+    await queues["messages"].put(PendingMessageWrapper(jid, stanza(0), "remote.com"))
+    await asyncio.sleep(0.05)
+    await queues["messages"].put(PendingMessageWrapper(jid, stanza(1), "remote.com"))
+    assert queues["servers"].qsize() == 1
+
+    # The dial never got ready (e.g. failed TLS) and nothing reported it
+    await asyncio.sleep(0.08)
+    assert mock_bounce.call_args.args == ([(jid, stanza(0))], "remote-server-timeout")
+    assert queues["servers"].qsize() == 2
+
+    # The queue expires empty and is gone, the next stanza dials again
+    await asyncio.sleep(0.1)
+    assert mock_bounce.call_args.args == ([(jid, stanza(1))], "remote-server-timeout")
+    await queues["messages"].put(PendingMessageWrapper(jid, stanza(2), "remote.com"))
+    await asyncio.sleep(0.01)
+    assert queues["servers"].qsize() == 3
+
+    # Once the stream is ready, the stanzas go straight to it
+    transport = MagicMock()
+    connection_manager.get_server_transport_host.return_value = transport
+    await queues["connections"].put(NewConnectionWrapper("remote.com", False))
+    await asyncio.sleep(0.01)
+    await queues["messages"].put(PendingMessageWrapper(jid, stanza(3), "remote.com"))
+    await asyncio.sleep(0.01)
+    task.cancel()
+    await task
+
+    writes = [c.args[0] for c in transport.write.call_args_list]
+    assert writes == [stanza(2), stanza(3)]
+    assert mock_bounce.call_count == 2
@@ -0,0 +1,208 @@
+import asyncio
+from unittest.mock import MagicMock, patch
+from xml.etree import ElementTree as ET
+
+import pytest
+
+from pyjabber.network.ConnectionManager import ConnectionManager
+from pyjabber.queues.PendingMessage import PendingMessageWrapper
+from pyjabber.stream.handlers.ServerStanzaHandler import ServerStanzaHandler
+from pyjabber.stream.JID import JID
+
+REMOTE_PEER = ("10.0.0.2", 5269)
+LOCAL_PEER = ("127.0.0.1", 40000)
+
+
+def stanza(xml: str) -> ET.Element:
+    return ET.fromstring(xml)
+
+
+@pytest.fixture
+def env():
+    connections = object.__new__(ConnectionManager)
+    connections.__init__()
+
+    remote_transport = MagicMock()
+    remote_transport.get_extra_info.return_value = REMOTE_PEER
+    connections.connection_server_incoming(REMOTE_PEER, remote_transport)
+    connections.set_host_incoming(REMOTE_PEER, "remote.com")
+
+    local_transport = MagicMock()
+    connections.connection(LOCAL_PEER, local_transport)
+    connections.set_jid(LOCAL_PEER, JID("demo@localhost/res"))
+    connections.online(JID("demo@localhost/res"))
+
+    message_queue = asyncio.Queue()
+    presence = MagicMock()
+    presence.most_priority.return_value = [("res", None, None, None, "0")]
+
+    with (
+        patch("pyjabber.stream.handlers.ServerStanzaHandler.AppConfig") as mock_config,
+        patch(
+            "pyjabber.stream.handlers.ServerStanzaHandler.ConnectionManager",
+            return_value=connections,
+        ),
+        patch(
+            "pyjabber.stream.handlers.Delivery.ConnectionManager",
+            return_value=connections,
+        ),
+        patch("pyjabber.stream.handlers.Delivery.Presence", return_value=presence),
+        patch(
+            "pyjabber.stream.handlers.Delivery.get_queue", return_value=message_queue
+        ),
+    ):
+        mock_config.app_config.host = "localhost"
+        mock_config.app_config.ip = ["127.0.0.1"]
+        mock_config.app_config.message_persistence = True
+
+        yield (
+            ServerStanzaHandler(remote_transport),
+            remote_transport,
+            local_transport,
+            message_queue,
+            presence,
+        )
+
+
+@pytest.mark.asyncio
+async def test_message_to_local_session(env):
+    handler, _, local_transport, message_queue, _ = env
+
+    await handler.feed(
+        stanza(
+            "<message xmlns='jabber:server' from='user@remote.com/r' "
+            "to='demo@localhost'><body>hi</body></message>"
+        )
+    )
+
+    local_transport.write.assert_called_once()
+    delivered = ET.fromstring(local_transport.write.call_args.args[0])
+    assert delivered.tag == "{jabber:client}message"
+    assert delivered.find("{jabber:client}body").text == "hi"
+    assert message_queue.empty()
+
+
+@pytest.mark.asyncio
+async def test_message_to_offline_user_is_spooled(env):
+    handler, _, local_transport, message_queue, presence = env
+    presence.most_priority.return_value = []
+
+    await handler.feed(
+        stanza(
+            "<message xmlns='jabber:server' from='user@remote.com/r' "
+            "to='offline@localhost'><body>hi</body></message>"
+        )
+    )
+
+    local_transport.write.assert_not_called()
+    pending = message_queue.get_nowait()
+    assert isinstance(pending, PendingMessageWrapper)
+    assert not pending.is_external
+    assert pending.jid == JID("offline@localhost")
+    assert ET.fromstring(pending.payload).tag == "{jabber:client}message"
+
+
+@pytest.mark.asyncio
+async def test_spoofed_from_closes_stream(env):
+    handler, remote_transport, local_transport, _, _ = env
+
+    await handler.feed(
+        stanza(
+            "<message xmlns='jabber:server' from='user@other.com/r' "
+            "to='demo@localhost'><body>hi</body></message>"
+        )
+    )
+
+    local_transport.write.assert_not_called()
+    assert b"invalid-from" in remote_transport.write.call_args_list[0].args[0]
+    remote_transport.close.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_missing_to_closes_stream(env):
+    handler, remote_transport, local_transport, _, _ = env
+
+    await handler.feed(
+        stanza(
+            "<iq xmlns='jabber:server' type='get' id='1' from='user@remote.com/r'>"
+            "<ping xmlns='urn:xmpp:ping'/></iq>"
+        )
+    )
+
+    local_transport.write.assert_not_called()
+    assert b"improper-addressing" in remote_transport.write.call_args_list[0].args[0]
+    remote_transport.close.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_iq_to_account_is_rejected(env):
+    handler, _, local_transport, message_queue, _ = env
+
+    await handler.feed(
+        stanza(
+            "<iq xmlns='jabber:server' from='user@remote.com/r' to='demo@localhost' "
+            "type='get' id='1'><query xmlns='jabber:iq:version'/></iq>"
+        )
+    )
+
+    local_transport.write.assert_not_called()
+    pending = message_queue.get_nowait()
+    assert pending.external_host == "remote.com"
+    reply = ET.fromstring(pending.payload)
+    assert reply.tag == "{jabber:server}iq"
+    assert reply.attrib["type"] == "error"
+    assert reply.attrib["id"] == "1"
+    error = reply.find("{jabber:server}error")
+    assert (
+        error.find("{urn:ietf:params:xml:ns:xmpp-stanzas}service-unavailable")
+        is not None
+    )
+
+
+@pytest.mark.asyncio
+async def test_bidi_incoming_stream_is_remote_link(env):
+    handler, remote_transport, _, _, _ = env
+    connections = handler._connections
+
+    bidi_transport = MagicMock()
+    bidi_transport.get_extra_info.return_value = ("10.0.0.3", 5269)
+    connections.connection_server_incoming(("10.0.0.3", 5269), bidi_transport)
+    connections.set_host_incoming(("10.0.0.3", 5269), "bidi.com", bidi=True)
+
+    with patch(
+        "pyjabber.stream.handlers.ServerStanzaHandler.get_queue"
+    ) as mock_get_queue:
+        ServerStanzaHandler(bidi_transport)
+        ServerStanzaHandler(remote_transport)
+
+    assert connections.get_server_transport_host("bidi.com") == bidi_transport
+    assert connections.get_server_transport_host("remote.com") is None
+    mock_get_queue.return_value.put_nowait.assert_called_once()
+    assert mock_get_queue.return_value.put_nowait.call_args.args[0].value == "bidi.com"
+
+
+@pytest.mark.asyncio
+async def test_outgoing_stream_routes_only_if_bidi(env):
+    handler, _, local_transport, _, _ = env
+    connections = handler._connections
+
+    out_transport = MagicMock()
+    out_transport.get_extra_info.return_value = ("10.0.0.4", 5269)
+    connections.connection_server(("10.0.0.4", 5269), out_transport, "out.com")
+
+    element = (
+        "<message xmlns='jabber:server' from='user@out.com/r' "
+        "to='demo@localhost/res'><body>hi</body></message>"
+    )
+
+    with patch("pyjabber.stream.handlers.ServerStanzaHandler.get_queue"):
+        handler = ServerStanzaHandler(out_transport)
+    await handler.feed(stanza(element))
+    local_transport.write.assert_not_called()
+    assert connections.get_server_transport_host("out.com") == out_transport
+
+    connections.set_bidi_server(("10.0.0.4", 5269))
+    with patch("pyjabber.stream.handlers.ServerStanzaHandler.get_queue"):
+        handler = ServerStanzaHandler(out_transport)
+    await handler.feed(stanza(element))
+    local_transport.write.assert_called_once()